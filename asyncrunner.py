@@ -0,0 +1,143 @@
+import asyncio
+import logging
+from swatcuppython import sufi2files
+from swatcuppython.processutil import new_process_group_kwargs, kill_process_tree
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("pre", "run", "post")
+
+
+class AsyncSUFI2Runner(object):
+    """
+    Runs the SUFI2 stages of a project folder as asyncio coroutines. Each stage is started with
+    asyncio.create_subprocess_exec in its own process group and its output is read without blocking the event loop.
+    Cancelling a stage kills the whole process tree (the .bat and SWAT_Edit.exe / swat.exe / extract exes).
+
+    Many runners can be awaited concurrently from one event loop (see run_concurrently).
+    """
+    # Size of the stdout reads. The output is split in lines, so long lines are not a problem
+    READ_SIZE = 65536
+
+    def __init__(self, wrapper, folder_path: str, output_callback=None):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module used to run the stages
+        folder_path : project (or process) folder
+        output_callback : function(folder_path, line) called with each line of the stage output. The lines are
+        logged (debug) if None
+        """
+        self.wrapper = wrapper
+        self.folder_path = folder_path
+        self.output_callback = output_callback
+
+    def _output(self, line: bytes):
+        line = line.decode(errors="replace").rstrip("\r\n")
+        if self.output_callback is not None:
+            self.output_callback(self.folder_path, line)
+        else:
+            logger.debug(self.folder_path + ": " + line)
+
+    async def _read_output(self, stream):
+        pending = b""
+        while True:
+            data = await stream.read(self.READ_SIZE)
+            if not data:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                self._output(line)
+        if pending:
+            self._output(pending)
+
+    async def run_stage(self, stage: str) -> int:
+        """ Runs a SUFI2 stage ('pre', 'run' or 'post') and returns its return code """
+        command = self.wrapper.get_sufi2_command(self.folder_path, stage)
+        logger.debug("Starting SUFI2 " + stage + ": " + " ".join(command["args"]))
+        process = await asyncio.create_subprocess_exec(
+            *command["args"], cwd=self.folder_path,
+            stdin=asyncio.subprocess.PIPE if command["input"] is not None else asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT,
+            **new_process_group_kwargs(command["new_console"]))
+        try:
+            if command["input"] is not None:
+                process.stdin.write(command["input"].encode())
+                await process.stdin.drain()
+                process.stdin.close()
+            await self._read_output(process.stdout)
+            return_code = await process.wait()
+        except BaseException:
+            # Cancelled (or failed): the stage should not keep running without anyone waiting for it
+            if process.returncode is None:
+                logger.warning("Killing SUFI2 " + stage + " in " + self.folder_path)
+                kill_process_tree(process.pid)
+                await process.wait()
+            raise
+        logger.debug("SUFI2 " + stage + " finished with return code " + str(return_code) + ": " + self.folder_path)
+        return return_code
+
+    async def pre(self) -> int:
+        return await self.run_stage("pre")
+
+    async def run(self) -> int:
+        return await self.run_stage("run")
+
+    async def post(self) -> int:
+        return await self.run_stage("post")
+
+    async def run_range(self, start: int, end: int) -> int:
+        """ Runs the simulations start-end, writing SUFI2_swEdit.def first """
+        sufi2files.write_swedit_def(self.folder_path, start, end)
+        return await self.run()
+
+    async def run_stages(self, stages=STAGES) -> list:
+        """ Runs the stages in order, stopping at the first one that fails
+
+        Returns
+        -------
+        list with the return code of each stage run
+        """
+        return_codes = []
+        for stage in stages:
+            return_code = await self.run_stage(stage)
+            return_codes.append(return_code)
+            if return_code != 0:
+                logger.error("SUFI2 " + stage + " failed with return code " + str(return_code) + ": " +
+                             self.folder_path)
+                break
+        return return_codes
+
+
+async def run_concurrently(runners, stages=STAGES, max_concurrency: int = None) -> list:
+    """ Runs the stages of many runners (projects or process folders) concurrently. The stages of each runner run in
+    order. If the caller is cancelled, every running stage is killed.
+
+    Parameters
+    ----------
+    runners : AsyncSUFI2Runner list
+    stages : stages run by each runner
+    max_concurrency : maximum number of runners running at the same time. No limit if None
+
+    Returns
+    -------
+    list with the return codes (see AsyncSUFI2Runner.run_stages) of each runner
+    """
+    semaphore = asyncio.Semaphore(max_concurrency) if max_concurrency is not None else None
+
+    async def run(runner):
+        if semaphore is None:
+            return await runner.run_stages(stages)
+        async with semaphore:
+            return await runner.run_stages(stages)
+
+    tasks = [asyncio.ensure_future(run(runner)) for runner in runners]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        # gather does not cancel the other tasks when one fails
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
@@ -0,0 +1,710 @@
+"""
+Benchmarks for the swatcuppython parsers, output handling, workspaces and SUFI2 runs. Run with:
+
+    python -m swatcuppython.benchmark [project_path] [--scale small|medium|large] [--output baseline.json]
+                                      [--compare old_baseline.json] [--tolerance 0.2]
+
+The suite builds synthetic projects scaled up from the bundled templates (build_synthetic_project) and writes the
+results as a JSON baseline. Comparing with the baseline of another version exits with 1 if any timing regressed.
+The extractor and end to end benchmarks run the bundled linux executables, with a stub swat.exe.
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+
+import numpy
+import pandas as pd
+from swatcuppython import sufi2files
+from swatcuppython.varfile import read_sufi2_var_array
+from swatcuppython.extract import SWATOutputExtractor, read_extract_def, count_time_steps
+from swatcuppython.resultstore import ResultStore
+from swatcuppython.workspace import WorkspaceProvisioner
+from swatcuppython.sampling import LatinHypercubeSampler
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+from swatcuppython.swatcupversion import SWATCUPVersion
+from swatcuppython.swatcup import SWATCUP
+
+PACKAGE_PATH = os.path.dirname(os.path.abspath(__file__))
+# Project template with the SUFI2 executables for linux
+LINUX_TEMPLATE = os.path.join(PACKAGE_PATH, "sawtcupv5_1_6_2", "linux")
+# SWAT-CUP 2019 SUFI2 template (def files and SUFI2.IN, Windows executables)
+SWATCUP2019_TEMPLATE = os.path.join(PACKAGE_PATH, "swatcup2019", "windows", "SourceData", "SUFI2")
+TEMPLATES = {"v5_1_6_2": LINUX_TEMPLATE, "2019": SWATCUP2019_TEMPLATE}
+
+# Sizes of the synthetic projects of the suite. SUFI2_goal_fn.exe reads up to 30000 observations
+SCALES = {
+    "small": {"n_reaches": 20, "n_hrus": 100, "begin_year": 2001, "end_year": 2001, "time_step": 1, "n_sims": 100,
+              "n_observed": 2},
+    "medium": {"n_reaches": 500, "n_hrus": 2000, "begin_year": 1996, "end_year": 2001, "time_step": 1,
+               "n_sims": 1000, "n_observed": 3},
+    "large": {"n_reaches": 2000, "n_hrus": 20000, "begin_year": 1982, "end_year": 2001, "time_step": 1,
+              "n_sims": 5000, "n_observed": 4},
+}
+# Folder of the synthetic projects with the outputs copied by the stub swat.exe and the stub programs
+STUB_FOLDER = "SyntheticStub"
+# Extension of the outputs in STUB_FOLDER (rch.synthetic -> output.rch). Not named output.* so the workspaces get them
+STUB_OUTPUT_EXTENSION = ".synthetic"
+# Parameters of the synthetic projects: (name, min, max)
+SYNTHETIC_PARAMETERS = [("r__CN2.mgt", -0.2, 0.2), ("v__ALPHA_BF.gw", 0.0, 1.0), ("v__ESCO.hru", 0.8, 1.0),
+                        ("v__GW_DELAY.gw", 0.0, 500.0)]
+# Model input files of the synthetic projects, per subbasin and per HRU
+SUBBASIN_EXTENSIONS = ["sub", "rte", "pnd", "swq", "wgn", "wus"]
+HRU_EXTENSIONS = ["hru", "mgt", "sol", "chm", "gw", "sep"]
+
+logger = logging.getLogger(__name__)
+
+
+def write_synthetic_var_file(file_path: str, n_sims: int, n_steps: int, seed: int = 0):
+    """ Writes a SUFI2.OUT var file with n_sims simulations of n_steps random values """
+    rng = numpy.random.RandomState(seed)
+    steps = numpy.arange(1, n_steps + 1)
+    with open(file_path, "w") as fo:
+        for simulation in range(1, n_sims + 1):
+            fo.write("{:>5d}\n".format(simulation))
+            block = numpy.column_stack((steps, rng.gamma(2.0, 10.0, n_steps)))
+            numpy.savetxt(fo, block, fmt=["%5d", "%14.4f"])
+
+
+def _get_periods(year: int, time_step: int):
+    """ Values of the MON column of a year of SWAT output: the days or months followed by the yearly summary """
+    if time_step == 1:
+        return list(range(1, count_time_steps(year, year, 1) + 1)) + [year]
+    if time_step == 2:
+        return list(range(1, 13)) + [year]
+    return [year]
+
+
+def write_synthetic_output_rch(file_path: str, n_reaches: int, begin_year: int, end_year: int, n_columns: int = 43,
+                               seed: int = 0, time_step: int = 2):
+    """ Writes an output.rch in the SWAT2012 layout (daily, monthly or yearly time_step), with the yearly summary
+    rows after each year
+    """
+    rng = numpy.random.RandomState(seed)
+    value_format = "%12.4E" * n_columns
+    with open(file_path, "w") as fo:
+        fo.write("1\n SWAT synthetic output\n General Input/Output section (file.cio):\n\n\n\n\n\n")
+        fo.write("      RCH      GIS   MON     AREAkm2" + "".join("{:>12s}".format("VAR" + str(i))
+                                                             for i in range(1, n_columns)) + "\n")
+        reaches = numpy.arange(1, n_reaches + 1)
+        for year in range(begin_year, end_year + 1):
+            for month in _get_periods(year, time_step):
+                block = numpy.column_stack((reaches, numpy.zeros(n_reaches), numpy.full(n_reaches, month),
+                                            rng.gamma(2.0, 10.0, (n_reaches, n_columns))))
+                numpy.savetxt(fo, block, fmt="REACH %4d %8d %5d" + value_format)
+
+
+def write_synthetic_output_hru(file_path: str, n_hrus: int, n_subbasins: int, begin_year: int, end_year: int,
+                               n_columns: int = 60, seed: int = 0, time_step: int = 2):
+    """ Writes an output.hru in the SWAT2012 layout, the HRUs spread over n_subbasins subbasins """
+    rng = numpy.random.RandomState(seed)
+    value_format = "%10.3E" * n_columns
+    hrus = numpy.arange(1, n_hrus + 1)
+    subbasins = (hrus - 1) % n_subbasins + 1
+    gis = subbasins * 10000 + (hrus - 1) // n_subbasins + 1
+    with open(file_path, "w") as fo:
+        fo.write("1\n SWAT synthetic output\n General Input/Output section (file.cio):\n\n\n\n\n\n")
+        fo.write("LULC  HRU       GIS  SUB  MGT  MON   AREAkm2" + "".join("{:>10s}".format("VAR" + str(i))
+                                                                      for i in range(1, n_columns)) + "\n")
+        for year in range(begin_year, end_year + 1):
+            for month in _get_periods(year, time_step):
+                block = numpy.column_stack((hrus, gis, subbasins, numpy.ones(n_hrus), numpy.full(n_hrus, month),
+                                            rng.gamma(2.0, 10.0, (n_hrus, n_columns))))
+                numpy.savetxt(fo, block, fmt="AGRL%5d %09d %4d %4d %4d" + value_format)
+
+
+def write_extract_def(file_path: str, output_file: str, columns, entity_number: int, entities, begin_year: int,
+                      end_year: int, time_step: int):
+    """ Writes a SUFI2_extract_*.def file, entities being the list of entity numbers of each column """
+    with open(file_path, "w") as fo:
+        fo.write("{:<15s}: swat output file name\n".format(output_file))
+        fo.write("{:<15d}: number of variables to get\n".format(len(columns)))
+        fo.write("{:<15s}: variable column number(s) in the swat output file\n\n".format(
+            " ".join(str(column) for column in columns)))
+        fo.write("{:<15d}: total number of entities in the project\n\n".format(entity_number))
+        for v, numbers in enumerate(entities):
+            fo.write("{:<15d}: number of entities to get for variable {:d}\n".format(len(numbers), v + 1))
+            fo.write("{:<15s}: entity numbers for variable {:d}\n\n".format(" ".join(str(n) for n in numbers),
+                                                                             v + 1))
+        fo.write("{:<15d}: beginning year of simulation not including the warm up period\n".format(begin_year))
+        fo.write("{:<15d}: end year of simulation\n\n".format(end_year))
+        fo.write("{:<15d}: time step (1=daily, 2=monthly, 3=yearly)\n\n// Remarks\n".format(time_step))
+
+
+def write_observed(file_path: str, names, values, goal_type: int = None, threshold: float = 0.5):
+    """ Writes a SUFI2.IN observed file with one observation per time step of each variable. With goal_type, the
+    observed.txt layout (objective function settings and weights), otherwise the observed_rch.txt layout
+    """
+    with open(file_path, "w") as fo:
+        fo.write("{:<6d}: number of observed variables\n".format(len(names)))
+        if goal_type is not None:
+            fo.write("{:<6d}: Objective function type\n".format(goal_type))
+            fo.write("{:<6s}: min value of objective function threshold for the behavioral solutions\n".format(
+                str(threshold)))
+            fo.write("1     : if objective function is 11=MNS (modified NS),indicate the power, p.\n")
+        fo.write("\n\n")
+        for name, observed in zip(names, values):
+            fo.write("{:<12s}: this is the name of the variable and the subbasin number\n".format(name))
+            if goal_type is not None:
+                fo.write("1     : weight of the variable in the objective function\n"
+                         "-1    : Dynamic flow separation. Not considered if -1\n"
+                         "-1    : constant flow separation, threshold value. (not considered if -1)\n"
+                         "1     : weight of the smaller values\n"
+                         "1     : weight of the larger values\n"
+                         "10    : percentage of measurement error\n")
+            fo.write("{:<6d}: number of data points for this variable as it follows below\n\n".format(len(observed)))
+            for i, value in enumerate(observed):
+                fo.write("{:d}\t{}_{:d}\t{:.4f}\n".format(i + 1, name, i + 1, value))
+            fo.write("\n\n")
+
+
+def write_model_files(folder_path: str, n_subbasins: int, n_hrus: int):
+    """ Writes placeholder SWAT model input files (TxtInOut layout): SUBBASIN_EXTENSIONS files per subbasin and
+    HRU_EXTENSIONS files per HRU. Only their number and size matter to the benchmarks
+    """
+    body = "".join("{:16.4f}    | PARAM{:d} : synthetic parameter\n".format(0.0, i) for i in range(40))
+    hru_counts = numpy.bincount(numpy.arange(n_hrus) % n_subbasins, minlength=n_subbasins)
+    for subbasin in range(1, n_subbasins + 1):
+        for extension in SUBBASIN_EXTENSIONS:
+            with open(os.path.join(folder_path, "{:05d}0000.{}".format(subbasin, extension)), "w") as fo:
+                fo.write(" .{} file Subbasin: {:d}\n".format(extension, subbasin) + body)
+        for hru in range(1, hru_counts[subbasin - 1] + 1):
+            for extension in HRU_EXTENSIONS:
+                with open(os.path.join(folder_path, "{:05d}{:04d}.{}".format(subbasin, hru, extension)), "w") as fo:
+                    fo.write(" .{} file Subbasin: {:d} HRU: {:d}\n".format(extension, subbasin, hru) + body)
+
+
+def write_stub_swat(folder_path: str, seconds: float = 0.0):
+    """ Writes a stub swat.exe that copies the synthetic outputs of STUB_FOLDER, after sleeping seconds, and a stub
+    mono in STUB_FOLDER (SUFI2_execute.exe runs SWAT_Edit.exe with mono in linux). Add STUB_FOLDER to the PATH
+    """
+    stub_folder = os.path.join(folder_path, STUB_FOLDER)
+    with open(os.path.join(folder_path, "swat.exe"), "w") as fo:
+        fo.write("#!/bin/sh\n# Stub written by swatcuppython.benchmark\n")
+        if seconds > 0:
+            fo.write("sleep " + str(seconds) + "\n")
+        for name in sorted(os.listdir(stub_folder)):
+            if name.endswith(STUB_OUTPUT_EXTENSION):
+                fo.write("cp " + STUB_FOLDER + "/" + name + " output." + name[:-len(STUB_OUTPUT_EXTENSION)] + "\n")
+    with open(os.path.join(stub_folder, "mono"), "w") as fo:
+        fo.write("#!/bin/sh\n# Stub written by swatcuppython.benchmark\nexit 0\n")
+    for file in (os.path.join(folder_path, "swat.exe"), os.path.join(stub_folder, "mono")):
+        os.chmod(file, 0o755)
+
+
+def build_synthetic_project(folder_path: str, template_path: str = LINUX_TEMPLATE, n_reaches: int = 500,
+                            n_hrus: int = 2000, begin_year: int = 1996, end_year: int = 2001, time_step: int = 1,
+                            n_sims: int = 1000, n_observed: int = 3, seed: int = 0, var_files: bool = True,
+                            stub_seconds: float = 0.0) -> dict:
+    """ Builds a SWAT-CUP project scaled up from a template: output.rch and output.hru of n_reaches reaches and n_hrus
+    HRUs, the model input files, extract def files, observed files, par_inf.txt and par_val.txt for n_sims
+    simulations, the var files and goal.txt of a finished iteration and a stub swat.exe (see write_stub_swat)
+
+    Parameters
+    ----------
+    folder_path : project folder. Created, must not exist
+    template_path : template project (LINUX_TEMPLATE or SWATCUP2019_TEMPLATE)
+    n_reaches : reaches (and subbasins)
+    n_hrus : HRUs
+    begin_year : first simulated year
+    end_year : last simulated year
+    time_step : 1 daily, 2 monthly, 3 yearly
+    n_sims : simulations of par_inf.txt, the var files and goal.txt
+    n_observed : observed reaches (var files)
+    seed : random seed
+    var_files : writes SUFI2.OUT with the var files and goal.txt
+    stub_seconds : seconds each stub swat.exe run sleeps
+
+    Returns
+    -------
+    dict with the size of the project
+    """
+    shutil.copytree(template_path, folder_path)
+    for folder in ("SUFI2.OUT", "Echo", STUB_FOLDER):
+        os.makedirs(os.path.join(folder_path, folder), exist_ok=True)
+    in_folder = os.path.join(folder_path, "SUFI2.IN")
+    rng = numpy.random.RandomState(seed)
+    n_steps = count_time_steps(begin_year, end_year, time_step)
+
+    reaches = sorted(set(numpy.linspace(1, n_reaches, n_observed).astype(int)))
+    hrus = sorted(set(numpy.linspace(1, n_hrus, n_observed).astype(int)))
+    rch_names = ["FLOW_OUT_" + str(reach) for reach in reaches]
+    hru_names = ["PET_" + str(hru) for hru in hrus]
+    write_extract_def(os.path.join(folder_path, "SUFI2_extract_rch.def"), "output.rch", [7], n_reaches, [reaches],
+                      begin_year, end_year, time_step)
+    write_extract_def(os.path.join(folder_path, "SUFI2_extract_hru.def"), "output.hru", [11], n_hrus, [hrus],
+                      begin_year, end_year, time_step)
+    write_synthetic_output_rch(os.path.join(folder_path, STUB_FOLDER, "rch" + STUB_OUTPUT_EXTENSION), n_reaches,
+                               begin_year, end_year, seed=seed, time_step=time_step)
+    write_synthetic_output_hru(os.path.join(folder_path, STUB_FOLDER, "hru" + STUB_OUTPUT_EXTENSION), n_hrus,
+                               n_reaches, begin_year, end_year, seed=seed, time_step=time_step)
+    for output_type in ("rch", "hru"):
+        shutil.copy2(os.path.join(folder_path, STUB_FOLDER, output_type + STUB_OUTPUT_EXTENSION),
+                     os.path.join(folder_path, "output." + output_type))
+    write_model_files(folder_path, n_reaches, n_hrus)
+    write_stub_swat(folder_path, stub_seconds)
+
+    for name in os.listdir(in_folder):
+        # Observations and var file lists of the template project
+        if name.startswith(("observed", "var_file_")):
+            os.remove(os.path.join(in_folder, name))
+    observed = rng.gamma(2.0, 10.0, (len(rch_names), n_steps))
+    write_observed(os.path.join(in_folder, "observed.txt"), rch_names, observed, goal_type=5)
+    write_observed(os.path.join(in_folder, "observed_rch.txt"), rch_names, observed)
+    for file_name, names in (("var_file_rch.txt", rch_names), ("var_file_hru.txt", hru_names),
+                             ("var_file_name.txt", rch_names)):
+        with open(os.path.join(in_folder, file_name), "w") as fo:
+            fo.write("".join(name + ".txt\n" for name in names))
+    with open(os.path.join(in_folder, "par_inf.txt"), "w") as fo:
+        fo.write("{:<3d}: Number of Parameters\n{:<3d}: number of simulations\n\n\n".format(
+            len(SYNTHETIC_PARAMETERS), n_sims))
+        for name, minimum, maximum in SYNTHETIC_PARAMETERS:
+            fo.write(" {:<20s}{:>10g}{:>10g}\n".format(name, minimum, maximum))
+    with open(os.path.join(folder_path, "Par_Name.out"), "w") as fo:
+        # Written by SWAT_Edit.exe (stubbed) and read by SUFI2_goal_fn.exe
+        fo.write("".join(name + "\n" for name, minimum, maximum in SYNTHETIC_PARAMETERS))
+    sampler = LatinHypercubeSampler(folder_path, seed)
+    values = sampler.sample()
+    sampler.write_par_val(values)
+    sufi2files.write_swedit_def(folder_path, 1, n_sims)
+
+    if var_files:
+        for i, name in enumerate(rch_names):
+            write_synthetic_var_file(os.path.join(folder_path, "SUFI2.OUT", name + ".txt"), n_sims, n_steps,
+                                     seed + i)
+        sufi2files.write_goal(folder_path, [name for name, minimum, maximum in SYNTHETIC_PARAMETERS],
+                              numpy.arange(1, n_sims + 1), values, rng.uniform(-1.0, 1.0, n_sims), "Nash_Sutcliff")
+    size = sum(os.path.getsize(os.path.join(folder, file)) for folder, folders, files in os.walk(folder_path)
+               for file in files)
+    return {"n_reaches": n_reaches, "n_hrus": n_hrus, "n_steps": n_steps, "n_sims": n_sims,
+            "var_files": len(rch_names) if var_files else 0, "project_size": size,
+            "files": sum(len(files) for folder, folders, files in os.walk(folder_path))}
+
+
+def has_linux_executables(project_path: str) -> bool:
+    """ True if the SUFI2 executables of the project are linux (ELF) programs """
+    file = os.path.join(project_path, "SUFI2_execute.exe")
+    if not os.path.isfile(file):
+        return False
+    with open(file, "rb") as fo:
+        return fo.read(4) == b"\x7fELF"
+
+
+def _read_sufi2_var_lines(file_path: str):
+    """ Line by line parser used by read_sufi2_var before the NumPy reader. Kept as the benchmark reference """
+    fo = open(file_path, "r")
+    iterations = []
+    data = []
+    index = []
+    data_index = -1
+    for line in fo:
+        list = line.split()
+        if len(list) == 1:
+            iterations.append(int(list[0]))
+            data.append([])
+            index.append([])
+            data_index += 1
+        if len(list) == 2:
+            data[data_index].append(float(list[1]))
+            index[data_index].append(int(list[0]))
+    fo.close()
+    return pd.DataFrame(columns=iterations, index=index[0], data=numpy.transpose(data))
+
+
+def _best_time(function, repeat: int):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmark_read_sufi2_var(n_sims: int = 500, n_steps: int = 4400, repeat: int = 3) -> dict:
+    """ Compares the line by line var file parser with read_sufi2_var_array
+
+    Returns
+    -------
+    dict with the best time (seconds) of each parser and the speedup
+    """
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        file_path = os.path.join(folder, "FLOW_OUT_1.txt")
+        write_synthetic_var_file(file_path, n_sims, n_steps)
+        reference = _read_sufi2_var_lines(file_path)
+        simulations, time_steps, values = read_sufi2_var_array(file_path)
+        if not numpy.allclose(reference.values.T, values):
+            raise ValueError("read_sufi2_var_array does not match the reference parser")
+        lines_time = _best_time(lambda: _read_sufi2_var_lines(file_path), repeat)
+        numpy_time = _best_time(lambda: read_sufi2_var_array(file_path), repeat)
+        return {"benchmark": "read_sufi2_var", "n_sims": n_sims, "n_steps": n_steps,
+                "file_size": os.path.getsize(file_path), "lines_seconds": lines_time,
+                "numpy_seconds": numpy_time, "speedup": lines_time / numpy_time}
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_extract(project_path: str = None, def_file: str = "SUFI2_extract_rch.def", n_reaches: int = 500,
+                      repeat: int = 3) -> dict:
+    """ Compares the SUFI2_extract executable of a def file with SWATOutputExtractor
+
+    Parameters
+    ----------
+    project_path : project folder with the def file, the SWAT output file and the executable. The project is copied,
+        so the benchmark does not change its SUFI2.OUT. If None, the linux template is used with a synthetic
+        output.rch of n_reaches reaches
+    def_file : extract def file (SUFI2_extract_rch.def, SUFI2_extract_sub.def, SUFI2_extract_hru.def, ...)
+    n_reaches : reaches of the synthetic output.rch
+    repeat : number of runs of each extractor
+
+    Returns
+    -------
+    dict with the best time (seconds) of each extractor, the speedup and whether the var files are identical
+    """
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        if project_path is None:
+            project_path = LINUX_TEMPLATE
+            definition = read_extract_def(os.path.join(project_path, def_file))
+            write_synthetic_output_rch(os.path.join(folder, definition["output_file"]), n_reaches,
+                                       definition["begin_year"], definition["end_year"])
+            with open(os.path.join(project_path, def_file), "r") as fo:
+                content = fo.read()
+            with open(os.path.join(folder, def_file), "w") as fo:
+                fo.write(re.sub(r"^\d+(\s*: total number)", lambda m: str(n_reaches) + m.group(1), content,
+                                flags=re.MULTILINE))
+        definition = read_extract_def(os.path.join(project_path, def_file))
+        executable = def_file.replace(".def", ".exe")
+        if executable.lower().startswith("extract_"):
+            executable = executable.replace("_obs", "_Obs")
+        for name in (definition["output_file"], def_file, executable):
+            if not os.path.exists(os.path.join(folder, name)):
+                shutil.copy2(os.path.join(project_path, name), os.path.join(folder, name))
+        os.chmod(os.path.join(folder, executable), 0o755)
+        shutil.copytree(os.path.join(project_path, "SUFI2.IN"), os.path.join(folder, "SUFI2.IN"))
+        os.makedirs(os.path.join(folder, "Echo"))
+        out_folder = os.path.join(folder, "SUFI2.OUT")
+
+        def clean():
+            shutil.rmtree(out_folder, ignore_errors=True)
+            os.makedirs(out_folder)
+
+        def run_executable():
+            clean()
+            subprocess.run([os.path.join(folder, executable)], cwd=folder, check=True, stdout=subprocess.DEVNULL)
+
+        def run_numpy():
+            clean()
+            SWATOutputExtractor(folder, def_file).run()
+
+        executable_time = _best_time(run_executable, repeat)
+        reference = {name: open(os.path.join(out_folder, name), "rb").read() for name in os.listdir(out_folder)}
+        numpy_time = _best_time(run_numpy, repeat)
+        identical = all(open(os.path.join(out_folder, name), "rb").read() == content
+                        for name, content in reference.items())
+        return {"benchmark": "extract", "def_file": def_file,
+                "file_size": os.path.getsize(os.path.join(folder, definition["output_file"])),
+                "executable_seconds": executable_time, "numpy_seconds": numpy_time,
+                "speedup": executable_time / numpy_time, "identical": identical}
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_result_store(n_sims: int = 500, n_steps: int = 4400, top: int = 100, repeat: int = 3) -> dict:
+    """ Compares reading a var file as text (read_sufi2_var_array) with reading it from a ResultStore, compressed and
+    memory mapped, and reading only the top simulations by goal value
+
+    Returns
+    -------
+    dict with the best time (seconds) of each read and the speedups
+    """
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        os.makedirs(os.path.join(folder, "SUFI2.OUT"))
+        os.makedirs(os.path.join(folder, "SUFI2.IN"))
+        file_path = os.path.join(folder, "SUFI2.OUT", "FLOW_OUT_1.txt")
+        write_synthetic_var_file(file_path, n_sims, n_steps)
+        simulations = numpy.arange(1, n_sims + 1)
+        goal = pd.DataFrame({"Sim_No.": simulations, "goal_value": numpy.random.RandomState(0).random_sample(n_sims)})
+        info = {"no_pars": 0, "no_sims": n_sims, "type_of_goal_fn": "Nash_Sutcliff"}
+        compressed = ResultStore(os.path.join(folder, "compressed"))
+        compressed.archive(folder, "1", ["FLOW_OUT_1.txt"], (info, goal))
+        mapped = ResultStore(os.path.join(folder, "mapped"), compress=False)
+        mapped.archive(folder, "1", ["FLOW_OUT_1.txt"], (info, goal))
+        if not numpy.array_equal(read_sufi2_var_array(file_path)[2], mapped.read_variable("1", "FLOW_OUT_1")[2]):
+            raise ValueError("ResultStore does not match the var file")
+        text_time = _best_time(lambda: read_sufi2_var_array(file_path), repeat)
+        compressed_time = _best_time(lambda: compressed.read_variable("1", "FLOW_OUT_1"), repeat)
+        mapped_time = _best_time(lambda: mapped.read_variable("1", "FLOW_OUT_1"), repeat)
+        top_time = _best_time(lambda: mapped.read_top("1", "FLOW_OUT_1", top), repeat)
+        return {"benchmark": "result_store", "n_sims": n_sims, "n_steps": n_steps, "text_seconds": text_time,
+                "compressed_seconds": compressed_time, "mapped_seconds": mapped_time,
+                "top_" + str(top) + "_seconds": top_time, "compressed_speedup": text_time / compressed_time,
+                "mapped_speedup": text_time / mapped_time}
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_parsing(project_path: str, repeat: int = 3) -> dict:
+    """ Times the parsers of a (synthetic) project: the line by line var file parser, read_sufi2_var,
+    read_sufi2_var_array and read_sufi2_out_goal of the SWAT-CUP 2019 module and the NumPy extraction of output.rch
+    and output.hru
+
+    Returns
+    -------
+    dict with the best time (seconds) of each parser
+    """
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    var_file_names = sufi2files.read_var_file_names(project_path)
+    result = {"benchmark": "parsing", "var_files": len(var_file_names)}
+    out_folder = os.path.join(project_path, "SUFI2.OUT")
+    result["read_sufi2_var_lines_seconds"] = _best_time(
+        lambda: [_read_sufi2_var_lines(os.path.join(out_folder, name)) for name in var_file_names], repeat)
+    result["read_sufi2_var_seconds"] = _best_time(
+        lambda: [wrapper.read_sufi2_var(project_path, name) for name in var_file_names], repeat)
+    result["read_sufi2_var_array_seconds"] = _best_time(
+        lambda: [wrapper.read_sufi2_var_array(project_path, name) for name in var_file_names], repeat)
+    result["read_sufi2_out_goal_seconds"] = _best_time(lambda: wrapper.read_sufi2_out_goal(project_path), repeat)
+    for output_type in ("rch", "hru"):
+        extractor = SWATOutputExtractor(project_path, "SUFI2_extract_" + output_type + ".def")
+        result["output_" + output_type + "_size"] = os.path.getsize(extractor.get_output_path())
+        result["extract_" + output_type + "_seconds"] = _best_time(extractor.extract, repeat)
+    return result
+
+
+def benchmark_output_copy(project_path: str, repeat: int = 3) -> dict:
+    """ Times copying SUFI2.OUT (copy_output of the modules) and archiving it in a compressed ResultStore
+
+    Returns
+    -------
+    dict with the best time (seconds) of each operation and the sizes
+    """
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        destination = os.path.join(folder, "SUFI2.OUT")
+
+        def copy():
+            shutil.rmtree(destination, ignore_errors=True)
+            wrapper.copy_output(project_path, destination)
+
+        store = ResultStore(os.path.join(folder, "store"))
+        goal = wrapper.read_sufi2_out_goal(project_path)
+        out_folder = os.path.join(project_path, "SUFI2.OUT")
+        output_size = sum(os.path.getsize(os.path.join(out_folder, name)) for name in os.listdir(out_folder))
+        result = {"benchmark": "output_copy", "output_size": output_size,
+                  "copy_output_seconds": _best_time(copy, repeat),
+                  "archive_seconds": _best_time(lambda: store.archive(project_path, "1", goal=goal), repeat)}
+        result["archive_size"] = sum(os.path.getsize(os.path.join(path, name))
+                                     for path, folders, files in os.walk(store.get_iteration_path("1"))
+                                     for name in files)
+        return result
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_provisioning(project_path: str, workers: int = 4) -> dict:
+    """ Times provisioning worker workspaces from the project with WorkspaceProvisioner: the first (cold)
+    provisioning and the refresh of the provisioned workspaces (warm)
+
+    Returns
+    -------
+    dict with the time (seconds) of each pass and the files linked and copied per workspace
+    """
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        provisioner = WorkspaceProvisioner(project_path, exclude=[STUB_FOLDER, "swatcuppython"])
+        paths = [os.path.join(folder, "process" + str(worker)) for worker in range(1, workers + 1)]
+        start = time.perf_counter()
+        stats = [provisioner.provision(path) for path in paths][0]
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for path in paths:
+            provisioner.provision(path)
+        warm = time.perf_counter() - start
+        return {"benchmark": "provisioning", "workers": workers, "linked": stats["linked"],
+                "copied": stats["copied"], "cold_seconds": cold, "warm_seconds": warm}
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_end_to_end(project_path: str, n_sims: int = 10) -> dict:
+    """ Times the SUFI2 stages (SWATCUP.sufi2_pre, sufi2_run and sufi2_post) of a copy of a synthetic project with the
+    linux executables, n_sims simulations of the stub swat.exe
+
+    Returns
+    -------
+    dict with the time (seconds) and the return code of each stage and the time per simulation
+    """
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    path_variable = os.environ.get("PATH")
+    try:
+        path = os.path.join(folder, "project")
+        shutil.copytree(project_path, path, symlinks=True)
+        with open(os.path.join(path, "SUFI2.IN", "par_inf.txt"), "r") as fo:
+            lines = fo.readlines()
+        lines[1] = "{:<3d}: number of simulations\n".format(n_sims)
+        with open(os.path.join(path, "SUFI2.IN", "par_inf.txt"), "w") as fo:
+            fo.writelines(lines)
+        sufi2files.write_swedit_def(path, 1, n_sims)
+        swatcup = SWATCUP(SWATCUPVersion.SWATCUP2019)
+        swatcup.set_project_folder(path)
+        # set_permissions only sets the execute bit for others
+        for file in os.listdir(path):
+            if file.endswith((".exe", ".bat")):
+                os.chmod(os.path.join(path, file), 0o755)
+        os.environ["PATH"] = os.path.join(path, STUB_FOLDER) + os.pathsep + (path_variable or "")
+        result = {"benchmark": "end_to_end", "n_sims": n_sims}
+        for stage, method in (("pre", swatcup.sufi2_pre), ("run", swatcup.sufi2_run), ("post", swatcup.sufi2_post)):
+            start = time.perf_counter()
+            return_code = method()
+            result[stage + "_seconds"] = time.perf_counter() - start
+            result[stage + "_return_code"] = return_code
+        result["simulation_seconds"] = result["run_seconds"] / n_sims
+        return result
+    finally:
+        if path_variable is None:
+            os.environ.pop("PATH", None)
+        else:
+            os.environ["PATH"] = path_variable
+        shutil.rmtree(folder)
+
+
+def get_environment() -> dict:
+    """ Machine and version the results were measured on """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=PACKAGE_PATH, capture_output=True,
+                                  text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {"revision": revision, "python": platform.python_version(), "numpy": numpy.__version__,
+            "pandas": pd.__version__, "platform": platform.platform(), "machine": platform.machine(),
+            "cpus": os.cpu_count(), "date": datetime.datetime.now().isoformat(timespec="seconds")}
+
+
+def run_suite(scale: str = "small", templates=None, project_path: str = None, repeat: int = 3,
+              end_to_end_sims: int = 10) -> dict:
+    """ Runs every benchmark on synthetic projects built from the templates at a scale of SCALES
+
+    Parameters
+    ----------
+    scale : SCALES key
+    templates : TEMPLATES keys. All the templates if None
+    project_path : project of the extractor benchmark. The linux template with a synthetic output.rch if None
+    repeat : runs of each timing (the best is kept)
+    end_to_end_sims : simulations of the end to end benchmark
+
+    Returns
+    -------
+    baseline: dict with the 'environment', the 'scale' and the 'results', a list of dicts with the 'benchmark'
+    name, the 'template' (if any) and the measures. Timings end with _seconds
+    """
+    if scale not in SCALES:
+        raise ValueError("Invalid scale: " + str(scale) + ". Use one of " + str(sorted(SCALES)))
+    sizes = SCALES[scale]
+    results = [benchmark_read_sufi2_var(sizes["n_sims"], count_time_steps(sizes["begin_year"], sizes["end_year"],
+                                                                          sizes["time_step"]), repeat),
+               benchmark_result_store(repeat=repeat)]
+    if sys.platform.startswith("linux"):
+        results.append(benchmark_extract(project_path, repeat=repeat))
+    folder = tempfile.mkdtemp(prefix="swatcuppython_benchmark_")
+    try:
+        for template in templates or sorted(TEMPLATES):
+            path = os.path.join(folder, template)
+            start = time.perf_counter()
+            project = build_synthetic_project(path, TEMPLATES[template], **sizes)
+            build = dict(project, benchmark="build_project", template=template, build_time=time.perf_counter() - start)
+            template_results = [build, benchmark_parsing(path, repeat), benchmark_output_copy(path, repeat),
+                                benchmark_provisioning(path)]
+            if sys.platform.startswith("linux") and has_linux_executables(path):
+                template_results.append(benchmark_end_to_end(path, end_to_end_sims))
+            for result in template_results:
+                result["template"] = template
+                logger.info(str(result))
+            results.extend(template_results)
+    finally:
+        shutil.rmtree(folder)
+    return {"environment": get_environment(), "scale": scale, "results": results}
+
+
+def write_baseline(file_path: str, baseline: dict):
+    with open(file_path, "w") as fo:
+        json.dump(baseline, fo, indent=2)
+
+
+def read_baseline(file_path: str) -> dict:
+    with open(file_path, "r") as fo:
+        return json.load(fo)
+
+
+def compare_baselines(baseline: dict, current: dict, tolerance: float = 0.2) -> pd.DataFrame:
+    """ Compares the timings of two baselines (see run_suite) of the same scale
+
+    Parameters
+    ----------
+    baseline : reference baseline
+    current : baseline of the version being checked
+    tolerance : relative slowdown accepted before a timing is a regression
+
+    Returns
+    -------
+    DataFrame with the 'benchmark', 'template', 'measure', the 'baseline' and 'current' seconds, the 'ratio'
+    (current / baseline) and whether it is a 'regression'
+    """
+    if baseline.get("scale") != current.get("scale"):
+        raise ValueError("Baselines of different scales: " + str(baseline.get("scale")) + " and " +
+                         str(current.get("scale")))
+
+    def timings(results):
+        return {(result["benchmark"], result.get("template"), measure): value for result in results
+                for measure, value in result.items() if measure.endswith("seconds") and value is not None}
+
+    old, new = timings(baseline["results"]), timings(current["results"])
+    rows = []
+    for (benchmark, template, measure), value in old.items():
+        if (benchmark, template, measure) not in new:
+            continue
+        current_value = new[(benchmark, template, measure)]
+        rows.append({"benchmark": benchmark, "template": template, "measure": measure, "baseline": value,
+                     "current": current_value, "ratio": current_value / value if value > 0 else numpy.nan})
+    df = pd.DataFrame(rows, columns=["benchmark", "template", "measure", "baseline", "current", "ratio"])
+    df["regression"] = df["ratio"] > 1 + tolerance
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="swatcuppython benchmarks")
+    parser.add_argument("project_path", nargs="?", help="project of the extractor benchmark")
+    parser.add_argument("--scale", default="small", choices=sorted(SCALES))
+    parser.add_argument("--templates", nargs="*", choices=sorted(TEMPLATES), help="all the templates by default")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="JSON file the baseline is written to")
+    parser.add_argument("--compare", help="baseline JSON file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown accepted (0.2 = 20%%)")
+    args = parser.parse_args()
+    current = run_suite(args.scale, args.templates, args.project_path, args.repeat)
+    for result in current["results"]:
+        for key, value in result.items():
+            sys.stdout.write("{:<30s} {}\n".format(key, value))
+        sys.stdout.write("\n")
+    if args.output is not None:
+        write_baseline(args.output, current)
+    if args.compare is not None:
+        comparison = compare_baselines(read_baseline(args.compare), current, args.tolerance)
+        sys.stdout.write(comparison.to_string(index=False) + "\n")
+        if comparison["regression"].any():
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+import os
+import glob
+import fnmatch
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+import numpy
+from swatcuppython import sufi2files
+
+logger = logging.getLogger(__name__)
+
+# Files of the project whose content defines what is extracted into the var files
+EXTRACT_PATTERNS = ["*extract*.def", "SUFI2.IN/var_file_*.txt"]
+# Files of the project folder written by the runs (SWAT outputs, logs, SUFI2 definitions), left out of the fingerprint
+RUN_FILE_PATTERNS = ["*.def", "*.log", "*.out", "output.*", "input.std", "watout.dat", "fin.fin", "chan.deg",
+                     "model.in"]
+
+
+def input_fingerprint(project_path: str) -> str:
+    """ Fingerprint of the inputs of a simulation, other than the parameter values: the name, size and modification
+    time of every file of the Backup folder (the original model files SWAT_Edit.exe starts from) and of the model
+    files of the project folder that are not in Backup (file.cio, climate files, databases, executables, ...), the
+    content of the extract def files and var file lists, and the parameter names of par_inf.txt.
+
+    Without a Backup folder every model file of the project folder is used. The files SWAT_Edit.exe edits then
+    change with each simulation, so the cache only hits when they are unchanged.
+    """
+    backup_path = os.path.join(project_path, "Backup")
+    digest = hashlib.sha256()
+    backup_names = set()
+    if os.path.isdir(backup_path):
+        for folder, folders, files in os.walk(backup_path):
+            folders.sort()
+            for name in sorted(files):
+                stat = os.stat(os.path.join(folder, name))
+                rel_path = os.path.relpath(os.path.join(folder, name), backup_path).replace(os.sep, "/")
+                digest.update("{}\0{}\0{}\n".format(rel_path, stat.st_size, stat.st_mtime_ns).encode())
+                backup_names.add(os.path.normcase(rel_path))
+    else:
+        logger.warning("Backup folder not found, using the model files of the project folder: " + backup_path)
+    for name in sorted(os.listdir(project_path)):
+        file = os.path.join(project_path, name)
+        if (not os.path.isfile(file) or os.path.normcase(name) in backup_names or
+                any(fnmatch.fnmatch(name.lower(), pattern) for pattern in RUN_FILE_PATTERNS)):
+            continue
+        stat = os.stat(file)
+        digest.update("../{}\0{}\0{}\n".format(name, stat.st_size, stat.st_mtime_ns).encode())
+    for pattern in EXTRACT_PATTERNS:
+        for file in sorted(glob.glob(os.path.join(project_path, pattern))):
+            digest.update(os.path.relpath(file, project_path).replace(os.sep, "/").encode() + b"\0")
+            with open(file, "rb") as fo:
+                digest.update(fo.read())
+    names, ranges, simulation_number = sufi2files.read_par_inf(project_path)
+    digest.update("\0".join(names).encode())
+    return digest.hexdigest()
+
+
+class SimulationCache(object):
+    """
+    Content addressed cache of simulation results. The key of a simulation is the hash of its rounded parameter
+    vector and of the input fingerprint (see input_fingerprint), the value is the block of the simulation in every
+    var file, kept byte by byte so the rebuilt var files are identical.
+
+    The entries are files of the cache folder (<key[:2]>/<key>.npz). When the total size goes above max_size the
+    least recently used entries are removed.
+    """
+
+    def __init__(self, cache_path: str, max_size: int = 1024 ** 3, decimals: int = 6):
+        """
+        Parameters
+        ----------
+        cache_path : cache folder. Created if it does not exist
+        max_size : maximum size of the cache in bytes
+        decimals : decimals of the parameter values used in the key
+        """
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.decimals = decimals
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+        os.makedirs(cache_path, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        """ Rebuilds the LRU order from the modification time of the entry files """
+        entries = []
+        for file in glob.glob(os.path.join(self.cache_path, "*", "*.npz")):
+            stat = os.stat(file)
+            entries.append((stat.st_mtime_ns, os.path.basename(file)[:-4], stat.st_size))
+        for mtime, key, size in sorted(entries):
+            self._entries[key] = size
+            self._size += size
+        self._evict()
+
+    def get_entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_path, key[:2], key + ".npz")
+
+    def make_keys(self, fingerprint: str, values) -> list:
+        """ Returns the key of each row of values, a (n_sims, n_pars) array of parameter values """
+        # Adding 0.0 turns -0.0 into 0.0
+        rounded = numpy.round(numpy.asarray(values, dtype=numpy.float64), self.decimals) + 0.0
+        prefix = fingerprint.encode()
+        return [hashlib.sha256(prefix + row.astype("<f8").tobytes()).hexdigest() for row in rounded]
+
+    def get(self, key: str):
+        """ Returns dict var file name -> simulation block without its header (bytes), or None """
+        with self._lock:
+            if key not in self._entries:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+        file = self.get_entry_path(key)
+        try:
+            with numpy.load(file) as data:
+                names = [str(name) for name in data["names"]]
+                blocks = {name: data["block" + str(i)].tobytes() for i, name in enumerate(names)}
+            os.utime(file)
+        except (OSError, ValueError, KeyError):
+            # Removed by another process or unreadable
+            logger.warning("Invalid cache entry, ignoring: " + file)
+            with self._lock:
+                self.stats["hits"] -= 1
+                self.stats["misses"] += 1
+                self._forget(key)
+            return None
+        return blocks
+
+    def put(self, key: str, blocks: dict):
+        """ Stores the blocks of a simulation (dict var file name -> block bytes without the header line) """
+        file = self.get_entry_path(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        arrays = {"block" + str(i): numpy.frombuffer(block, dtype=numpy.uint8)
+                  for i, block in enumerate(blocks.values())}
+        tmp_file = file + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_file, "wb") as fo:
+            numpy.savez_compressed(fo, names=numpy.array(list(blocks.keys()), dtype=str), **arrays)
+        os.replace(tmp_file, file)
+        size = os.path.getsize(file)
+        with self._lock:
+            self._forget(key)
+            self._entries[key] = size
+            self._size += size
+            self.stats["stores"] += 1
+            self._evict()
+
+    def _forget(self, key: str):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self._size -= size
+
+    def _evict(self):
+        while self._size > self.max_size and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._size -= size
+            self.stats["evictions"] += 1
+            try:
+                os.remove(self.get_entry_path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                try:
+                    os.remove(self.get_entry_path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+    def get_stats(self) -> dict:
+        """ Returns the hit/miss counters, the hit rate, the number of entries and the size in bytes """
+        with self._lock:
+            stats = dict(self.stats)
+            stats["entries"] = len(self._entries)
+            stats["size"] = self._size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class CachedRunner(object):
+    """
+    Runs the SUFI2_swEdit.def simulation range of a project, running SWAT only for the simulations that are not in a
+    SimulationCache. The missed simulations run in contiguous sub ranges, their blocks are added to the cache, and
+    the var files are rebuilt in simulation order with the cached blocks of the hits.
+    """
+
+    def __init__(self, wrapper, project_folder_path: str, cache: SimulationCache):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module used to run the simulations
+        project_folder_path : SWAT-CUP project folder
+        cache : simulation cache
+        """
+        self.wrapper = wrapper
+        self.project_folder_path = project_folder_path
+        self.cache = cache
+
+    @staticmethod
+    def split_ranges(simulations):
+        """ Groups sorted simulation numbers into contiguous (start, end) ranges """
+        ranges = []
+        for simulation in simulations:
+            if ranges and ranges[-1][1] == simulation - 1:
+                ranges[-1][1] = simulation
+            else:
+                ranges.append([simulation, simulation])
+        return [tuple(simulation_range) for simulation_range in ranges]
+
+    def run(self) -> dict:
+        """ Runs the simulation range of SUFI2_swEdit.def
+
+        Returns
+        -------
+        dict with the 'hits' and 'misses' simulation lists and the 'return_codes' of the runs
+        """
+        path = self.project_folder_path
+        start, end = sufi2files.read_swedit_def(path)
+        fingerprint = input_fingerprint(path)
+        par_simulations, par_values = sufi2files.read_par_val(path)
+        selected = (par_simulations >= start) & (par_simulations <= end)
+        simulations = par_simulations[selected]
+        keys = dict(zip(simulations.tolist(), self.cache.make_keys(fingerprint, par_values[selected])))
+        var_file_names = sufi2files.read_var_file_names(path)
+
+        cached = {}
+        for simulation in sorted(keys):
+            blocks = self.cache.get(keys[simulation])
+            if blocks is not None and all(name in blocks for name in var_file_names):
+                cached[simulation] = blocks
+        misses = [simulation for simulation in sorted(keys) if simulation not in cached]
+        logger.info("Simulation cache: " + str(len(cached)) + " hits, " + str(len(misses)) + " misses")
+
+        return_codes = []
+        if misses:
+            try:
+                for range_start, range_end in self.split_ranges(misses):
+                    sufi2files.write_swedit_def(path, range_start, range_end)
+                    return_codes.append(self.wrapper.sufi2_run(path))
+            finally:
+                sufi2files.write_swedit_def(path, start, end)
+
+        out_folder = os.path.join(path, "SUFI2.OUT")
+        new_blocks = {simulation: {} for simulation in misses}
+        for name in var_file_names:
+            file = os.path.join(out_folder, name)
+            blocks = {}
+            if os.path.isfile(file):
+                blocks = dict(sufi2files.read_sufi2_var_blocks(file))
+            for simulation in misses:
+                if simulation in blocks:
+                    new_blocks[simulation][name] = blocks[simulation].split(b"\n", 1)[1]
+            for simulation, cached_blocks in cached.items():
+                blocks[simulation] = (sufi2files.SIMULATION_HEADER_FORMAT.format(simulation).encode() +
+                                      cached_blocks[name])
+            with open(file, "wb") as fo:
+                for simulation in sorted(blocks):
+                    fo.write(blocks[simulation])
+
+        for simulation, blocks in new_blocks.items():
+            # Simulations that failed are not in every var file and are not cached
+            if len(blocks) == len(var_file_names):
+                self.cache.put(keys[simulation], blocks)
+        return {"hits": sorted(cached), "misses": misses, "return_codes": return_codes}
@@ -0,0 +1,275 @@
+import re
+import sys
+import time
+import logging
+import threading
+import subprocess
+from collections import deque
+from swatcuppython import sufi2files
+
+logger = logging.getLogger(__name__)
+
+
+class SUFI2Progress(object):
+    """
+    Parses the progress lines of SUFI2_execute.exe ('simulation no=   3') and swat.exe ('Executing year 1990') into
+    the status of a SUFI2_swEdit.def simulation range: current simulation, completed simulations and ETA.
+    """
+    SIMULATION_PATTERN = re.compile(r"simulation\s+no\s*[=:]?\s*(\d+)", re.IGNORECASE)
+    YEAR_PATTERN = re.compile(r"executing\s+year\s+(\d+)", re.IGNORECASE)
+
+    def __init__(self, first: int = None, last: int = None):
+        """
+        Parameters
+        ----------
+        first : first simulation of the range. The first simulation seen if None
+        last : last simulation of the range. The total is unknown if None
+        """
+        self.first = first
+        self.last = last
+        self.simulation = None
+        self.year = None
+        self.started = time.time()
+        self.first_started = None
+        self.updated = None
+
+    @classmethod
+    def from_project(cls, path: str):
+        """ Progress of the simulation range of the SUFI2_swEdit.def of a project, without range if not found """
+        try:
+            return cls(*sufi2files.read_swedit_def(path))
+        except (OSError, ValueError):
+            return cls()
+
+    def parse(self, line: str) -> bool:
+        """ Updates the status from an output line. Returns True if the line is a progress line """
+        match = self.SIMULATION_PATTERN.search(line)
+        if match is not None:
+            now = time.time()
+            self.simulation = int(match.group(1))
+            self.year = None
+            if self.first is None:
+                self.first = self.simulation
+            if self.first_started is None:
+                self.first_started = now
+            self.updated = now
+            return True
+        match = self.YEAR_PATTERN.search(line)
+        if match is not None:
+            self.year = int(match.group(1))
+            self.updated = time.time()
+            return True
+        return False
+
+    def get_total(self):
+        if self.first is None or self.last is None:
+            return None
+        return self.last - self.first + 1
+
+    def get_completed(self) -> int:
+        """ Simulations finished: the ones before the current simulation """
+        if self.simulation is None:
+            return 0
+        return self.simulation - self.first
+
+    def get_eta(self):
+        """ Seconds to finish the range from the mean duration of the completed simulations, or None """
+        total, completed = self.get_total(), self.get_completed()
+        if total is None or completed <= 0:
+            return None
+        mean = (time.time() - self.first_started) / completed
+        return max(0.0, mean * (total - completed))
+
+    def get_status(self) -> dict:
+        return {"simulation": self.simulation, "index": self.get_completed() + 1 if self.simulation else None,
+                "total": self.get_total(), "completed": self.get_completed(), "year": self.year,
+                "elapsed": time.time() - self.started, "eta": self.get_eta()}
+
+    def format_status(self) -> str:
+        """ Status as text, ex: 'simulation 3 of 10, year 1995, ETA 42 s' """
+        if self.simulation is None:
+            return "starting"
+        total = self.get_total()
+        text = "simulation " + str(self.get_completed() + 1) + (" of " + str(total) if total is not None else "")
+        if self.year is not None:
+            text += ", year " + str(self.year)
+        eta = self.get_eta()
+        if eta is not None:
+            text += ", ETA " + "{:.0f}".format(eta) + " s"
+        return text
+
+
+class OutputCapture(object):
+    """
+    Drains the output pipe of a process in a background thread, so a chatty process never blocks on a full pipe and
+    the caller never blocks on the output. The last max_lines lines are kept in a ring buffer, the whole output can
+    be written to a log file and the progress lines update a SUFI2Progress.
+    """
+    READ_SIZE = 65536
+
+    def __init__(self, stream, max_lines: int = 1000, log_path: str = None, echo: bool = False,
+                 progress: SUFI2Progress = None, progress_interval: float = None, line_callback=None,
+                 name: str = "process"):
+        """
+        Parameters
+        ----------
+        stream : binary output pipe (Popen.stdout)
+        max_lines : lines kept in memory
+        log_path : file the whole output is written to. Not written if None
+        echo : writes the output to sys.stdout
+        progress : status updated from the progress lines. Not parsed if None
+        progress_interval : logs (info) the progress status at most every progress_interval seconds. Not logged if
+            None
+        line_callback : function(line) called with each line from the reader thread
+        name : name used in the log messages
+        """
+        self.stream = stream
+        self.lines = deque(maxlen=max_lines)
+        self.line_count = 0
+        self.log_path = log_path
+        self.echo = echo
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.line_callback = line_callback
+        self.name = name
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._read, name="output-" + name, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        log = open(self.log_path, "wb") if self.log_path is not None else None
+        pending = b""
+        try:
+            while True:
+                data = self.stream.read1(self.READ_SIZE) if hasattr(self.stream, "read1") else \
+                    self.stream.read(self.READ_SIZE)
+                if not data:
+                    break
+                if log is not None:
+                    log.write(data)
+                if self.echo:
+                    sys.stdout.write(data.decode(errors="replace"))
+                    sys.stdout.flush()
+                # Progress bars rewrite the line with \r
+                lines = re.split(rb"\r\n|\r|\n", pending + data)
+                pending = lines.pop()
+                if len(pending) > self.READ_SIZE:
+                    # A line without end should not grow without limit
+                    lines.append(pending)
+                    pending = b""
+                for line in lines:
+                    self._add_line(line)
+            if pending:
+                self._add_line(pending)
+        except (OSError, ValueError):
+            # Pipe closed by a kill
+            pass
+        finally:
+            if log is not None:
+                log.close()
+            self.stream.close()
+
+    def _add_line(self, data: bytes):
+        line = data.decode(errors="replace")
+        if not line.strip():
+            return
+        with self._lock:
+            self.lines.append(line)
+            self.line_count += 1
+        if self.progress is not None and self.progress.parse(line) and self.progress_interval is not None:
+            now = time.time()
+            if now - self._last_report >= self.progress_interval:
+                self._last_report = now
+                logger.info(self.name + ": " + self.progress.format_status())
+        if self.line_callback is not None:
+            self.line_callback(line)
+
+    def join(self, timeout: float = None):
+        """ Waits until the whole output is read (the process and its children closed the pipe) """
+        self._thread.join(timeout)
+
+    def is_finished(self) -> bool:
+        return not self._thread.is_alive()
+
+    def get_lines(self, n: int = None) -> list:
+        """ Last n lines kept (all of them if None) """
+        with self._lock:
+            lines = list(self.lines)
+        return lines if n is None else lines[-n:]
+
+    def get_text(self, n: int = None) -> str:
+        return "\n".join(self.get_lines(n))
+
+
+class CapturedProcess(object):
+    """
+    Process started with its stdout and stderr captured by an OutputCapture. Has the Popen methods used by the
+    wrappers and SWATCUP (pid, poll, wait, kill, returncode); wait returns the true exit code once the output is read.
+    """
+    # Seconds the output is waited for after the process finished. Children of a killed shell may keep the pipe open
+    OUTPUT_GRACE = 10.0
+
+    def __init__(self, args, cwd: str, shell: bool = False, stdin_text: str = None, max_lines: int = 1000,
+                 log_path: str = None, echo: bool = False, progress: SUFI2Progress = None,
+                 progress_interval: float = None, name: str = None, **popen_kwargs):
+        """
+        Parameters
+        ----------
+        args : command
+        cwd : working folder
+        shell : runs args with the shell (the linux .bat files)
+        stdin_text : text written to stdin, then closed. stdin is DEVNULL if None
+        max_lines, log_path, echo, progress, progress_interval : see OutputCapture
+        name : name used in the log messages. The command if None
+        popen_kwargs : other Popen arguments (creationflags, start_new_session, ...)
+        """
+        self.name = name if name is not None else str(args)
+        self._reported = False
+        self.process = subprocess.Popen(args, cwd=cwd, shell=shell,
+                                        stdin=subprocess.PIPE if stdin_text is not None else subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **popen_kwargs)
+        self.capture = OutputCapture(self.process.stdout, max_lines, log_path, echo, progress, progress_interval,
+                                     name=self.name)
+        if stdin_text is not None:
+            try:
+                self.process.stdin.write(stdin_text.encode())
+                self.process.stdin.close()
+            except OSError:
+                # The process finished without reading it
+                pass
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    @property
+    def progress(self) -> SUFI2Progress:
+        return self.capture.progress
+
+    def poll(self):
+        return self.process.poll()
+
+    def wait(self, timeout: float = None) -> int:
+        """ Waits for the process and its output and returns the exit code. Logs the last lines if it failed """
+        return_code = self.process.wait(timeout)
+        self.capture.join(timeout if timeout is not None else self.OUTPUT_GRACE)
+        if return_code != 0 and not self._reported:
+            self._reported = True
+            logger.error(self.name + " failed with exit code " + str(return_code) + ". Last output lines:\n" +
+                         self.capture.get_text(20))
+        return return_code
+
+    def kill(self):
+        self.process.kill()
+
+    def get_lines(self, n: int = None) -> list:
+        return self.capture.get_lines(n)
+
+    def get_status(self) -> dict:
+        """ Progress status (see SUFI2Progress.get_status), None if the progress is not parsed """
+        return self.progress.get_status() if self.progress is not None else None
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import Counter
+
+from swatcuppython import sufi2files
+from swatcuppython.sufi2files import par_val_fingerprint
+from swatcuppython.extract import find_var_time_steps
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_FILE = "sufi2_checkpoint.json"
+
+
+def get_missing_ranges(start: int, end: int, completed) -> list:
+    """ Contiguous (first, last) ranges of the simulations of [start, end] not in completed """
+    completed = set(completed)
+    ranges = []
+    first = None
+    for simulation in range(start, end + 2):
+        missing = simulation <= end and simulation not in completed
+        if missing and first is None:
+            first = simulation
+        elif not missing and first is not None:
+            ranges.append((first, simulation - 1))
+            first = None
+    return ranges
+
+
+class RunCheckpoint(object):
+    """
+    Checkpoint of the run stage of a project (or process) folder, kept in sufi2_checkpoint.json: the simulation range
+    of the run, the par_val.txt fingerprint and the completed simulations.
+
+    The var files of SUFI2.OUT are the source of truth: a simulation is completed when every var file has its block
+    with all its time steps. validate drops the partial blocks a killed run leaves (and the goal.txt rows of the
+    simulations not completed) and writes the var files back in simulation order.
+    """
+
+    def __init__(self, folder_path: str):
+        """
+        Parameters
+        ----------
+        folder_path : project or process folder
+        """
+        self.folder_path = folder_path
+        self.file = os.path.join(folder_path, CHECKPOINT_FILE)
+        self.state = None
+        self._lock = threading.Lock()
+
+    def read(self):
+        """ The checkpoint state, or None if there is none or it belongs to other parameter sets """
+        if not os.path.isfile(self.file):
+            return None
+        try:
+            with open(self.file, "r") as fo:
+                state = json.load(fo)
+        except (OSError, ValueError):
+            logger.warning("Invalid checkpoint, ignoring: " + self.file)
+            return None
+        if state.get("par_val") != par_val_fingerprint(self.folder_path):
+            logger.info("Checkpoint of other parameter sets, ignoring: " + self.file)
+            return None
+        return state
+
+    def begin(self) -> dict:
+        """ Loads the checkpoint, or starts one for the SUFI2_swEdit.def range """
+        state = self.read()
+        if state is None:
+            start, end = sufi2files.read_swedit_def(self.folder_path)
+            state = {"start": start, "end": end, "par_val": par_val_fingerprint(self.folder_path), "completed": [],
+                     "runs": 0, "updated": time.time()}
+        self.state = state
+        self.write()
+        return state
+
+    def write(self):
+        with self._lock:
+            self.state["updated"] = time.time()
+            with open(self.file + ".tmp", "w") as fo:
+                json.dump(self.state, fo)
+            os.replace(self.file + ".tmp", self.file)
+
+    def add_run(self):
+        with self._lock:
+            self.state["runs"] += 1
+        self.write()
+
+    def mark_completed(self, simulations):
+        with self._lock:
+            self.state["completed"] = sorted(set(self.state["completed"]) | set(int(s) for s in simulations))
+        self.write()
+
+    def _expected_lines(self, name: str, blocks):
+        """ Data lines of a complete block of a var file """
+        time_steps = find_var_time_steps(self.folder_path, name)
+        if time_steps is not None:
+            return len(time_steps)
+        counts = Counter(block.count(b"\n") - 1 for simulation, block in blocks)
+        return counts.most_common(1)[0][0] if counts else None
+
+    def validate(self) -> list:
+        """ Keeps only the complete blocks of the simulations of the range in the var files, in simulation order, and
+        the goal.txt rows of those simulations. Returns the completed simulations
+        """
+        start, end = self.state["start"], self.state["end"]
+        out_folder = os.path.join(self.folder_path, "SUFI2.OUT")
+        names = sufi2files.read_var_file_names(self.folder_path)
+        file_blocks = {}
+        completed = None
+        for name in names:
+            file = os.path.join(out_folder, name)
+            blocks = sufi2files.read_sufi2_var_blocks(file) if os.path.isfile(file) else []
+            expected = self._expected_lines(name, blocks)
+            complete = {}
+            for simulation, block in blocks:
+                lines = [line for line in block.split(b"\n")[1:] if line.strip()]
+                if start <= simulation <= end and (expected is None or len(lines) == expected) and \
+                        all(len(line.split()) >= 2 for line in lines):
+                    complete[simulation] = block
+            file_blocks[name] = (blocks, complete)
+            completed = set(complete) if completed is None else completed & set(complete)
+        completed = completed or set()
+        for name, (blocks, complete) in file_blocks.items():
+            kept = [(simulation, complete[simulation]) for simulation in sorted(completed)]
+            if [block for simulation, block in kept] == [block for simulation, block in blocks]:
+                continue
+            file = os.path.join(out_folder, name)
+            logger.debug("Checkpoint: rewriting " + file + " with " + str(len(kept)) + " of " + str(len(blocks)) +
+                         " blocks")
+            with open(file + ".tmp", "wb") as fo:
+                for simulation, block in kept:
+                    fo.write(block)
+            os.replace(file + ".tmp", file)
+            # The binary sidecar no longer matches the var file
+            sidecar = os.path.splitext(file)[0] + sufi2files.SIDECAR_EXTENSION
+            if os.path.isfile(sidecar):
+                os.remove(sidecar)
+        goal_file = os.path.join(out_folder, sufi2files.GOAL_FILE)
+        if os.path.isfile(goal_file):
+            sufi2files.filter_goal_file(goal_file, completed)
+        with self._lock:
+            self.state["completed"] = sorted(completed)
+        self.write()
+        return sorted(completed)
+
+    def get_missing_ranges(self) -> list:
+        return get_missing_ranges(self.state["start"], self.state["end"], self.state["completed"])
+
+    def finish(self):
+        """ Writes the original range back to SUFI2_swEdit.def and removes the checkpoint """
+        sufi2files.write_swedit_def(self.folder_path, self.state["start"], self.state["end"])
+        if os.path.isfile(self.file):
+            os.remove(self.file)
+
+
+class CheckpointRunner(object):
+    """
+    Runs the SUFI2_swEdit.def range of a folder with a RunCheckpoint. While SUFI2_execute runs, the simulations it
+    finished (SUFI2.IN/trk.txt) are recorded every interval seconds. If the run is interrupted (node failure,
+    sufi2_async_kill, ...), running again validates the var files and runs only the missing simulations, one
+    SUFI2_swEdit.def range per gap, then writes the outputs in simulation order and restores the original range.
+    """
+
+    def __init__(self, wrapper, folder_path: str, interval: float = 5.0, max_attempts: int = 2):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module used to run the simulations
+        folder_path : project or process folder
+        interval : seconds between checkpoint updates
+        max_attempts : runs of a missing range that finish without completing it before giving up
+        """
+        self.wrapper = wrapper
+        self.folder_path = folder_path
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.checkpoint = RunCheckpoint(folder_path)
+
+    def _read_trk(self):
+        try:
+            return sufi2files.read_trk(self.folder_path)
+        except (OSError, ValueError):
+            # Missing or being written
+            return None
+
+    def _track(self, first: int, last: int, stop: threading.Event, stale):
+        recorded = first
+        while not stop.wait(self.interval):
+            current = self._read_trk()
+            if current is None or current == stale:
+                continue
+            stale = None
+            # trk.txt holds the simulation running: the ones before it in the range are finished
+            current = min(current, last + 1)
+            if current > recorded:
+                self.checkpoint.mark_completed(range(recorded, current))
+                recorded = current
+
+    def _run_range(self, first: int, last: int) -> int:
+        sufi2files.write_swedit_def(self.folder_path, first, last)
+        stop = threading.Event()
+        # trk.txt of the previous run until SUFI2_execute starts the first simulation
+        tracker = threading.Thread(target=self._track, args=(first, last, stop, self._read_trk()), daemon=True)
+        tracker.start()
+        try:
+            return self.wrapper.sufi2_run(self.folder_path)
+        finally:
+            stop.set()
+            tracker.join()
+
+    def run(self) -> dict:
+        """ Runs (or resumes) the range
+
+        Returns
+        -------
+        dict with the 'resumed' simulations found completed, the 'ran' simulation ranges, the 'return_codes' and
+        'missing' simulations left (empty when the range is complete)
+        """
+        state = self.checkpoint.begin()
+        resumed = self.checkpoint.validate()
+        if resumed:
+            logger.info("Resuming " + self.folder_path + ": " + str(len(resumed)) + " of " +
+                        str(state["end"] - state["start"] + 1) + " simulations already completed")
+        ran, return_codes = [], []
+        attempts = {}
+        missing = self.checkpoint.get_missing_ranges()
+        while missing:
+            first, last = missing[0]
+            attempts[first] = attempts.get(first, 0) + 1
+            if attempts[first] > self.max_attempts:
+                logger.error("Simulations " + str(first) + "-" + str(last) + " not completed after " +
+                             str(self.max_attempts) + " runs in " + self.folder_path)
+                break
+            self.checkpoint.add_run()
+            return_code = self._run_range(first, last)
+            ran.append((first, last))
+            return_codes.append(return_code)
+            self.checkpoint.validate()
+            missing = self.checkpoint.get_missing_ranges()
+            if return_code is not None and return_code != 0:
+                # Keep the checkpoint: the run failed and can be resumed
+                logger.error("SUFI2 run failed with return code " + str(return_code) + " in " + self.folder_path)
+                break
+        missing_simulations = [simulation for first, last in missing for simulation in range(first, last + 1)]
+        if not missing_simulations:
+            self.checkpoint.finish()
+        else:
+            sufi2files.write_swedit_def(self.folder_path, self.checkpoint.state["start"], self.checkpoint.state["end"])
+        return {"resumed": resumed, "ran": ran, "return_codes": return_codes, "missing": missing_simulations}
@@ -0,0 +1,401 @@
+import os
+import queue
+import logging
+import secrets
+import platform
+import ipaddress
+import threading
+import multiprocessing
+from multiprocessing.managers import BaseManager
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.cache import CachedRunner
+from swatcuppython.objectives import ObjectiveEngine
+from swatcuppython.workspace import WorkspaceProvisioner
+
+logger = logging.getLogger(__name__)
+
+
+class QueueTransport(object):
+    """
+    Transport between a coordinator and agents running on this machine: a task queue and a result queue of
+    multiprocessing. Pass it to the agent processes (see LocalCluster).
+    """
+
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context()
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+
+    def serve(self):
+        return self
+
+    def connect(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class _QueueManager(BaseManager):
+    pass
+
+
+def is_loopback(host: str) -> bool:
+    """ Whether a host name or address only reaches this machine """
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class TCPTransport(object):
+    """
+    Transport between a coordinator and agents on other nodes: the task and result queues are served by a
+    multiprocessing manager over TCP. The coordinator calls serve() and the agents connect() to its address.
+
+    The manager unpickles what it receives, so anyone with the address and the key can run code on the coordinator:
+    serving on an address reachable from other hosts needs an explicit, secret authkey.
+    """
+
+    def __init__(self, address=("127.0.0.1", 50000), authkey: bytes = None):
+        """
+        Parameters
+        ----------
+        address : (host, port) served by the coordinator or connected to by the agents
+        authkey : secret key shared by the coordinator and the agents. Required unless the host is a loopback
+            address, where a random key is generated (the agents get it with the pickled transport)
+        """
+        self.address = tuple(address)
+        if authkey is None:
+            if not is_loopback(self.address[0]):
+                raise ValueError("An authkey is required to use a TCPTransport on a non loopback address: " +
+                                 str(self.address[0]))
+            authkey = secrets.token_bytes(32)
+        self.authkey = authkey
+        self.tasks = None
+        self.results = None
+        self._server = None
+
+    def serve(self):
+        tasks = queue.Queue()
+        results = queue.Queue()
+        manager = _QueueManager(address=self.address, authkey=self.authkey)
+        manager.register("get_tasks", callable=lambda: tasks)
+        manager.register("get_results", callable=lambda: results)
+        # The server runs in a thread of this process, so the queues are plain queue.Queue
+        self._server = manager.get_server()
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.tasks, self.results = tasks, results
+        logger.info("Serving distributed queues on " + str(self._server.address))
+        return self
+
+    def connect(self):
+        _QueueManager.register("get_tasks")
+        _QueueManager.register("get_results")
+        manager = _QueueManager(address=self.address, authkey=self.authkey)
+        manager.connect()
+        self.tasks, self.results = manager.get_tasks(), manager.get_results()
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.stop_event.set()
+            self._server = None
+
+    def __getstate__(self):
+        # Only the address is sent to agent processes, they connect() on their own
+        return {"address": self.address, "authkey": self.authkey, "tasks": None, "results": None, "_server": None}
+
+
+class WorkerAgent(object):
+    """
+    Runs the tasks of a coordinator in a provisioned copy of the project: SUFI2_execute (make_input, SWAT_Edit,
+    swat and extract) for a simulation range or a batch of parameter sets, and sends back the blocks of the var files
+    and, when the task asks for it, the goal value of each simulation.
+    """
+
+    def __init__(self, project_folder_path: str, wrapper, transport, name: str = None):
+        """
+        Parameters
+        ----------
+        project_folder_path : provisioned copy of the project
+        wrapper : SWAT-CUP version module used to run the simulations
+        transport : connected transport (QueueTransport or TCPTransport)
+        name : agent name reported with the results. Host name and process id if None
+        """
+        self.project_folder_path = project_folder_path
+        self.wrapper = wrapper
+        self.transport = transport
+        self.name = name or platform.node() + ":" + str(os.getpid())
+
+    def _set_parameters(self, simulations, values):
+        """ Writes the parameter sets of a batch into the par_val.txt of the copy """
+        par_simulations, par_values = sufi2files.read_par_val(self.project_folder_path)
+        rows = dict(zip(par_simulations.tolist(), par_values))
+        rows.update(zip(simulations, numpy.asarray(values, dtype=numpy.float64)))
+        ordered = sorted(rows)
+        sufi2files.write_par_val(self.project_folder_path, ordered, [rows[simulation] for simulation in ordered])
+
+    def run_task(self, task: dict) -> dict:
+        path = self.project_folder_path
+        result = {"task": task["task"], "agent": self.name, "blocks": {}, "goal": None, "return_codes": [],
+                  "error": None}
+        try:
+            if "simulations" in task:
+                simulations = sorted(task["simulations"])
+                if "values" in task:
+                    self._set_parameters(task["simulations"], task["values"])
+            else:
+                simulations = list(range(task["first"], task["last"] + 1))
+                if task.get("par_val") is not None and sufi2files.par_val_fingerprint(path) != task["par_val"]:
+                    # Copy provisioned before the last sufi2_pre
+                    raise ValueError("par_val.txt of " + path + " does not match the parameter sets of the "
+                                     "coordinator, provision the copy again")
+            var_file_names = sufi2files.read_var_file_names(path)
+            out_folder = os.path.join(path, "SUFI2.OUT")
+            for name in var_file_names:
+                if os.path.isfile(os.path.join(out_folder, name)):
+                    os.remove(os.path.join(out_folder, name))
+            start, end = sufi2files.read_swedit_def(path)
+            try:
+                for first, last in CachedRunner.split_ranges(simulations):
+                    sufi2files.write_swedit_def(path, first, last)
+                    result["return_codes"].append(self.wrapper.sufi2_run(path))
+            finally:
+                sufi2files.write_swedit_def(path, start, end)
+            failed = [code for code in result["return_codes"] if code is not None and code != 0]
+            if failed:
+                raise ValueError("SUFI2 run failed with return code " + ", ".join(str(code) for code in failed))
+            for name in var_file_names:
+                file = os.path.join(out_folder, name)
+                result["blocks"][name] = sufi2files.read_sufi2_var_blocks(file) if os.path.isfile(file) else []
+                missing = sorted(set(simulations) - set(simulation for simulation, block in result["blocks"][name]))
+                if missing:
+                    raise ValueError("Simulations missing in " + name + ": " + str(missing))
+            if task.get("observed_file") is not None:
+                goal_simulations, objectives, goal = ObjectiveEngine(path, task["observed_file"]).evaluate()
+                result["goal"] = (goal_simulations.tolist(), goal.tolist())
+        except Exception as e:
+            logger.exception("Task " + str(task["task"]) + " failed")
+            result["error"] = str(e)
+        return result
+
+    def serve(self):
+        """ Runs tasks until the coordinator sends None """
+        logger.info("Agent " + self.name + " serving " + self.project_folder_path)
+        while True:
+            task = self.transport.tasks.get()
+            if task is None:
+                break
+            logger.debug("Agent " + self.name + " running task " + str(task["task"]))
+            self.transport.results.put(self.run_task(task))
+
+
+def run_agent(project_folder_path: str, version, transport, name: str = None):
+    """ Entry point of an agent process: connects to the coordinator and serves its tasks """
+    from swatcuppython.swatcup import SWATCUP
+    swatcup = SWATCUP(version)
+    swatcup.set_project_folder(project_folder_path)
+    WorkerAgent(project_folder_path, swatcup.wrapper, transport.connect(), name).serve()
+
+
+class DistributedCoordinator(object):
+    """
+    Hands simulation ranges (or batches of parameter sets) of a project to worker agents through a transport and
+    merges the var file blocks they send back into the project SUFI2.OUT in simulation order. With compute_goal the
+    goal values computed by the agents are written to SUFI2.OUT/goal.txt.
+    """
+
+    def __init__(self, project_folder_path: str, transport, batch_size: int = 10, compute_goal: bool = False,
+                 observed_file: str = "observed.txt", max_retries: int = 1, timeout: float = None):
+        """
+        Parameters
+        ----------
+        project_folder_path : SWAT-CUP project folder
+        transport : transport shared with the agents. Served by run if it is not served yet
+        batch_size : simulations per task
+        compute_goal : asks the agents for the goal values and writes goal.txt
+        observed_file : observed file in SUFI2.IN used to compute the goal
+        max_retries : times a failed task is sent again
+        timeout : seconds without any result before run raises TimeoutError. No limit if None
+        """
+        if not isinstance(batch_size, int) or batch_size < 1:
+            raise ValueError("batch_size should be a positive Int")
+        self.project_folder_path = project_folder_path
+        self.transport = transport
+        self.batch_size = batch_size
+        self.compute_goal = compute_goal
+        self.observed_file = observed_file
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    def make_range_tasks(self, start: int = None, end: int = None) -> list:
+        """ Splits a simulation range (the SUFI2_swEdit.def range if None) in tasks of batch_size simulations. The
+        tasks carry the par_val.txt fingerprint, so agents with other parameter sets fail them
+        """
+        if start is None or end is None:
+            start, end = sufi2files.read_swedit_def(self.project_folder_path)
+        fingerprint = sufi2files.par_val_fingerprint(self.project_folder_path)
+        return [{"task": number, "first": first, "last": min(first + self.batch_size - 1, end), "par_val": fingerprint}
+                for number, first in enumerate(range(start, end + 1, self.batch_size))]
+
+    def make_batch_tasks(self, simulations, values) -> list:
+        """ Splits parameter sets in tasks of batch_size sets. The sets are also written to the par_val.txt of the
+        project, so goal.txt has them
+
+        Parameters
+        ----------
+        simulations : simulation numbers of the sets
+        values : (n_sims, n_pars) parameter values
+        """
+        simulations = [int(simulation) for simulation in simulations]
+        values = numpy.asarray(values, dtype=numpy.float64)
+        rows = {}
+        if os.path.isfile(os.path.join(self.project_folder_path, "SUFI2.IN", "par_val.txt")):
+            par_simulations, par_values = sufi2files.read_par_val(self.project_folder_path)
+            rows = dict(zip(par_simulations.tolist(), par_values))
+        rows.update(zip(simulations, values))
+        ordered = sorted(rows)
+        sufi2files.write_par_val(self.project_folder_path, ordered, [rows[simulation] for simulation in ordered])
+        return [{"task": number, "simulations": simulations[first:first + self.batch_size],
+                 "values": values[first:first + self.batch_size]}
+                for number, first in enumerate(range(0, len(simulations), self.batch_size))]
+
+    def stop_agents(self, agents: int):
+        """ Sends the stop message to the agents """
+        for agent in range(agents):
+            self.transport.tasks.put(None)
+
+    def run(self, tasks: list = None) -> dict:
+        """ Sends the tasks (make_range_tasks() if None), waits for all the results and merges them
+
+        Returns
+        -------
+        dict with the number of 'simulations' merged, the 'failed' task numbers and the tasks run by each agent
+        """
+        if tasks is None:
+            tasks = self.make_range_tasks()
+        if self.transport.tasks is None:
+            self.transport.serve()
+        pending = {}
+        for task in tasks:
+            if self.compute_goal:
+                task = dict(task, observed_file=self.observed_file)
+            pending[task["task"]] = task
+            self.transport.tasks.put(task)
+        logger.info("Distributed run: " + str(len(tasks)) + " tasks sent")
+
+        retries = {}
+        failed = []
+        agents = {}
+        blocks = {}
+        goals = {}
+        while pending:
+            try:
+                result = self.transport.results.get(timeout=self.timeout)
+            except queue.Empty:
+                raise TimeoutError("No result from the agents in " + str(self.timeout) + " seconds. Pending tasks: " +
+                                   str(sorted(pending)))
+            task = pending.get(result["task"])
+            if task is None:
+                continue
+            agents[result["agent"]] = agents.get(result["agent"], 0) + 1
+            if result["error"] is not None:
+                logger.warning("Task " + str(result["task"]) + " failed in " + result["agent"] + ": " + result["error"])
+                retries[task["task"]] = retries.get(task["task"], 0) + 1
+                if retries[task["task"]] <= self.max_retries:
+                    self.transport.tasks.put(task)
+                else:
+                    failed.append(pending.pop(task["task"])["task"])
+                continue
+            del pending[task["task"]]
+            for name, name_blocks in result["blocks"].items():
+                blocks.setdefault(name, {}).update(name_blocks)
+            if result["goal"] is not None:
+                goals.update(zip(*result["goal"]))
+            logger.debug("Task " + str(result["task"]) + " done by " + result["agent"] + ", " + str(len(pending)) +
+                         " pending")
+
+        simulations = self.merge(blocks)
+        if self.compute_goal and goals:
+            ordered = sorted(goals)
+            ObjectiveEngine(self.project_folder_path, self.observed_file).write_goal(
+                numpy.array(ordered), numpy.array([goals[simulation] for simulation in ordered]))
+        return {"simulations": simulations, "failed": sorted(failed), "agents": agents}
+
+    def merge(self, blocks: dict) -> int:
+        """ Writes the var files of the project SUFI2.OUT from dict var file name -> {simulation: block} """
+        out_folder = os.path.join(self.project_folder_path, "SUFI2.OUT")
+        simulations = 0
+        for name in sufi2files.read_var_file_names(self.project_folder_path):
+            name_blocks = blocks.get(name, {})
+            with open(os.path.join(out_folder, name), "wb") as fo:
+                for simulation in sorted(name_blocks):
+                    fo.write(name_blocks[simulation])
+            simulations = max(simulations, len(name_blocks))
+        return simulations
+
+
+class LocalCluster(object):
+    """
+    Local stand-in for a cluster: N agent processes, each one with its own provisioned copy of the project
+    (<base folder>/nodeK), connected to the coordinator with a QueueTransport (or any transport given).
+
+    Usage:
+        with LocalCluster(project_path, version, base_folder_path, 4) as cluster:
+            DistributedCoordinator(project_path, cluster.transport).run()
+    """
+
+    def __init__(self, project_folder_path: str, version, base_folder_path: str, agents: int, transport=None):
+        """
+        Parameters
+        ----------
+        project_folder_path : SWAT-CUP project folder
+        version : SWATCUPVersion of the project
+        base_folder_path : folder where the agent copies are provisioned
+        agents : number of agent processes
+        transport : transport of the agents. A QueueTransport if None. A TCPTransport should be served first
+        """
+        if not isinstance(agents, int) or agents < 1:
+            raise ValueError("agents should be a positive Int")
+        self.project_folder_path = project_folder_path
+        self.version = version
+        self.base_folder_path = base_folder_path
+        self.agents = agents
+        self.transport = transport if transport is not None else QueueTransport()
+        self.processes = []
+
+    def get_node_folder_path(self, agent: int) -> str:
+        return os.path.join(self.base_folder_path, "node" + str(agent))
+
+    def start(self):
+        provisioner = WorkspaceProvisioner(self.project_folder_path,
+                                           exclude=[os.path.basename(self.base_folder_path)])
+        for agent in range(self.agents):
+            folder = self.get_node_folder_path(agent)
+            provisioner.provision(folder)
+            process = multiprocessing.Process(target=run_agent, args=(folder, self.version, self.transport,
+                                                                      "node" + str(agent)), daemon=True)
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def stop(self, timeout: float = None):
+        """ Stops the agents after the queued tasks """
+        for process in self.processes:
+            self.transport.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
@@ -0,0 +1,358 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.objectives import MAXIMIZED_GOAL_FUNCTIONS, get_goal_function, get_goal_layout
+from swatcuppython.ppu import PPUCalculator
+from swatcuppython.resultstore import ResultStore
+
+logger = logging.getLogger(__name__)
+
+HISTORY_FILE = "driver_history.json"
+
+
+def compute_new_ranges(values, goal, maximize: bool, ranges, bounds=None, behavioral=None, min_behavioral: int = 10,
+                       best_fraction: float = 0.1):
+    """ New parameter ranges with the SUFI2 update rule (Abbaspour et al., 2004), in place of SUFI2_new_pars.exe.
+    The 95% interval (lower, upper) of each parameter in the selected simulations is widened by
+    max((lower - min) / 2, (max - upper) / 2), so the new range is centered on the good simulations and narrower than
+    the current one.
+
+    Parameters
+    ----------
+    values : (n_sims, n_pars) parameter values of the simulations
+    goal : goal value of each simulation
+    maximize : the goal function is maximized
+    ranges : current (min, max) of each parameter
+    bounds : (min, max) the new ranges are clipped to (ex: the ranges of the first iteration). Not clipped if None
+    behavioral : boolean mask of the behavioral simulations. They are the selected simulations when there are at
+        least min_behavioral of them
+    min_behavioral : behavioral simulations needed to use them
+    best_fraction : fraction of the best simulations selected otherwise
+
+    Returns
+    -------
+    (ranges, n_selected). ranges is a list of (min, max)
+    """
+    values = numpy.asarray(values, dtype=numpy.float64)
+    goal = numpy.asarray(goal, dtype=numpy.float64)
+    ranges = numpy.array(ranges, dtype=numpy.float64)
+    valid = numpy.isfinite(goal)
+    if behavioral is not None and numpy.count_nonzero(behavioral & valid) >= min_behavioral:
+        selected = values[behavioral & valid]
+    else:
+        order = numpy.argsort(-goal[valid] if maximize else goal[valid], kind="stable")
+        selected = values[valid][order[:max(2, int(round(best_fraction * valid.sum())))]]
+    if len(selected) < 2:
+        return [tuple(row) for row in ranges.tolist()], len(selected)
+    lower, upper = numpy.percentile(selected, [2.5, 97.5], axis=0)
+    margin = numpy.maximum((lower - ranges[:, 0]) / 2, (ranges[:, 1] - upper) / 2)
+    new_ranges = numpy.column_stack((lower - margin, upper + margin))
+    if bounds is not None:
+        bounds = numpy.array(bounds, dtype=numpy.float64)
+        new_ranges = numpy.clip(new_ranges, bounds[:, [0]], bounds[:, [1]])
+    # A parameter without spread keeps a range SUFI2 can sample
+    collapsed = new_ranges[:, 1] - new_ranges[:, 0] <= 0
+    new_ranges[collapsed] = ranges[collapsed]
+    return [tuple(row) for row in new_ranges.tolist()], len(selected)
+
+
+def get_run_error(result):
+    """ Error of a run stage result, or None if it did not fail
+
+    Parameters
+    ----------
+    result : return code of sufi2_run, return codes of sufi2_parallel_run, dict with the 'return_codes' and the
+        'missing' simulations (sufi2_checkpoint_run) or a list of them. Other results (ex: sufi2_watchdog_run) are not
+        checked
+    """
+    if isinstance(result, (list, tuple)):
+        errors = [error for error in (get_run_error(item) for item in result) if error is not None]
+        return ", ".join(errors) if errors else None
+    if isinstance(result, dict):
+        if result.get("missing"):
+            return str(len(result["missing"])) + " simulations missing"
+        return get_run_error(result.get("return_codes"))
+    if isinstance(result, (int, numpy.integer)) and not isinstance(result, bool) and result != 0:
+        return "return code " + str(result)
+    return None
+
+
+class IterationDriver(object):
+    """
+    Runs K SUFI2 iterations of a project: sampling (pre), simulations (run), goal (post), new parameter ranges in
+    par_inf.txt, archiving; until a stopping rule is met. Keeps the history of every iteration (ranges, best goal and
+    parameters, P-factor and R-factor, stage timings) in swatcuppython/driver_history.json.
+
+    The iterations are pipelined: once the goal of iteration k is known, its new ranges are written and its SUFI2.OUT
+    is moved aside (swatcuppython/iterations/<k>), so the 95PPU and the archiving of iteration k run in a background
+    thread while the sampling and the provisioning of the process folders of iteration k+1 and its simulations run.
+    """
+
+    def __init__(self, swatcup, iterations: int = 5, simulations: int = None, native: bool = True,
+                 run_function=None, seed: int = None, target_goal: float = None, min_improvement: float = None,
+                 patience: int = 1, threshold: float = None, min_behavioral: int = 10, best_fraction: float = 0.1,
+                 clip_ranges: bool = True, observed_file: str = "observed.txt", store_path: str = None,
+                 compute_ppu: bool = True, keep_outputs: bool = None, on_iteration=None):
+        """
+        Parameters
+        ----------
+        swatcup : SWATCUP with the project folder set. Its process number and scratch mode are used
+        iterations : maximum number of iterations
+        simulations : simulations per iteration. The par_inf.txt number of simulations if None
+        native : samples with sufi2_lh_sample and computes the goal with compute_goal. Runs sufi2_pre and sufi2_post
+            (the SWAT-CUP executables) otherwise
+        run_function : function(swatcup) running the simulations of SUFI2_swEdit.def (ex: a sufi2_watchdog_run
+            call). sufi2_parallel_run (sufi2_run with one process) if None
+        seed : seed of the sample of the first iteration. Iteration k uses seed + k - 1. Random if None
+        target_goal : stops when the best goal reaches it
+        min_improvement : stops when the best goal improves less than min_improvement during patience iterations
+        patience : iterations without enough improvement before stopping
+        threshold : behavioral threshold used to select the simulations of the new ranges. Taken from the observed
+            file if None
+        min_behavioral, best_fraction : see compute_new_ranges
+        clip_ranges : keeps the new ranges inside the ranges of the first iteration
+        observed_file : observed file in SUFI2.IN
+        store_path : ResultStore folder the iterations are archived to ('iteration_<k>'). Not archived if None
+        compute_ppu : computes the 95PPU, P-factor and R-factor of every iteration
+        keep_outputs : keeps the SUFI2.OUT and SUFI2.IN copies of every iteration in swatcuppython/iterations.
+            True if there is no store_path
+        on_iteration : function(record) called with the history record of each iteration once its goal is known
+        """
+        if swatcup.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        if iterations < 1:
+            raise ValueError("iterations should be a positive Int")
+        self.swatcup = swatcup
+        self.iterations = iterations
+        self.simulations = simulations
+        self.native = native
+        self.run_function = run_function
+        self.seed = seed
+        self.target_goal = target_goal
+        self.min_improvement = min_improvement
+        self.patience = patience
+        self.threshold = threshold
+        self.min_behavioral = min_behavioral
+        self.best_fraction = best_fraction
+        self.clip_ranges = clip_ranges
+        self.observed_file = observed_file
+        self.store = ResultStore(store_path) if store_path is not None else None
+        self.compute_ppu = compute_ppu
+        self.keep_outputs = keep_outputs if keep_outputs is not None else store_path is None
+        self.on_iteration = on_iteration
+        self.iterations_folder_path = os.path.join(swatcup.swatcuppython_base_folder_path, "iterations")
+        self.history = []
+        self.stop_reason = None
+        self._lock = threading.Lock()
+
+    def get_staging_path(self, iteration: int) -> str:
+        return os.path.join(self.iterations_folder_path, "iteration_" + str(iteration))
+
+    def _write_par_inf(self, ranges, simulations):
+        folders = {self.swatcup.project_folder_path, self.swatcup.get_execution_folder_path()}
+        for folder in folders:
+            sufi2files.write_par_inf(folder, ranges, simulations)
+
+    def _prepare(self, iteration: int, ranges, simulations: int):
+        """ par_inf.txt, par_val.txt, SUFI2_swEdit.def and process folders of an iteration """
+        self._write_par_inf(ranges, simulations)
+        if self.native:
+            seed = self.seed + iteration - 1 if self.seed is not None else None
+            values = self.swatcup.sufi2_lh_sample(seed)
+            simulations = len(values)
+        else:
+            self.swatcup.sufi2_pre()
+        for folder in {self.swatcup.project_folder_path, self.swatcup.get_execution_folder_path()}:
+            sufi2files.write_swedit_def(folder, 1, simulations)
+        if self.swatcup.process_number > 1 and self.run_function is None:
+            # Incremental: the provisioning done by sufi2_parallel_run only copies what changed afterwards
+            self.swatcup.sync_processes()
+
+    def _run(self):
+        """ Runs the simulations of the iteration. Raises ValueError if the run failed """
+        if self.run_function is not None:
+            result = self.run_function(self.swatcup)
+        elif self.swatcup.process_number > 1:
+            result = self.swatcup.sufi2_parallel_run()
+        else:
+            result = self.swatcup.sufi2_run()
+        error = get_run_error(result)
+        if error is not None:
+            raise ValueError("SUFI2 run failed in " + self.swatcup.project_folder_path + ": " + error)
+        return result
+
+    def _post(self):
+        if self.native:
+            return self.swatcup.compute_goal(self.observed_file)
+        self.swatcup.sufi2_post()
+        return self.swatcup.read_sufi2_out_goal()
+
+    def _stage(self, iteration: int) -> str:
+        """ Moves SUFI2.OUT and copies SUFI2.IN of the project to the staging folder of the iteration """
+        staging_path = self.get_staging_path(iteration)
+        if os.path.isdir(staging_path):
+            shutil.rmtree(staging_path)
+        os.makedirs(staging_path)
+        project = self.swatcup.project_folder_path
+        # Same file system: a rename, whatever the output size
+        os.rename(os.path.join(project, "SUFI2.OUT"), os.path.join(staging_path, "SUFI2.OUT"))
+        os.mkdir(os.path.join(project, "SUFI2.OUT"))
+        shutil.copytree(os.path.join(project, "SUFI2.IN"), os.path.join(staging_path, "SUFI2.IN"))
+        return staging_path
+
+    def _finish(self, record: dict, staging_path: str, goal, behavioral, best_simulation: int):
+        """ 95PPU and archiving of a staged iteration (background thread) """
+        if self.compute_ppu:
+            started = time.time()
+            calculator = PPUCalculator(staging_path, self.observed_file)
+            simulations = get_goal_layout(goal)["simulations"][behavioral] \
+                if behavioral is not None and behavioral.any() else None
+            results = calculator.compute(simulations, best_simulation)
+            if simulations is not None:
+                calculator.write(results, "95ppu_beh.txt", "95ppu_g_beh.txt")
+            else:
+                calculator.write(results)
+            with self._lock:
+                record["p_factor"] = {name: float(result["p_factor"]) for name, result in results.items()}
+                record["r_factor"] = {name: float(result["r_factor"]) for name, result in results.items()}
+                record["timings"]["ppu"] = time.time() - started
+        if self.store is not None:
+            started = time.time()
+            self.store.archive(staging_path, "iteration_" + str(record["iteration"]), goal=goal)
+            with self._lock:
+                record["timings"]["archive"] = time.time() - started
+        if not self.keep_outputs:
+            shutil.rmtree(staging_path)
+        with self._lock:
+            record["finished"] = True
+        self.write_history()
+
+    def _check_stop(self, record: dict, maximize: bool):
+        """ Stopping rule met by an iteration, or None """
+        goals = [item["best_goal"] for item in self.history]
+        if self.target_goal is not None and (record["best_goal"] >= self.target_goal if maximize
+                                             else record["best_goal"] <= self.target_goal):
+            return "target goal reached"
+        if self.min_improvement is not None and len(goals) > self.patience:
+            before = max(goals[:-self.patience]) if maximize else min(goals[:-self.patience])
+            after = max(goals[-self.patience:]) if maximize else min(goals[-self.patience:])
+            improvement = after - before if maximize else before - after
+            if improvement < self.min_improvement:
+                return "improvement below " + str(self.min_improvement)
+        if record["iteration"] >= self.iterations:
+            return "maximum iterations"
+        return None
+
+    def run(self) -> list:
+        """ Runs the iterations
+
+        Returns
+        -------
+        history: list with a dict per iteration (see get_history)
+        """
+        project = self.swatcup.project_folder_path
+        names, ranges, simulation_number = sufi2files.read_par_inf(project)
+        simulations = self.simulations if self.simulations is not None else simulation_number
+        bounds = list(ranges) if self.clip_ranges else None
+        observed = sufi2files.read_observed(os.path.join(project, "SUFI2.IN", self.observed_file))
+        threshold = self.threshold if self.threshold is not None else observed["threshold"]
+        self.history, self.stop_reason = [], None
+        started = time.time()
+        previous = None
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for iteration in range(1, self.iterations + 1):
+                record = {"iteration": iteration, "ranges": dict(zip(names, [list(item) for item in ranges])),
+                          "timings": {}, "finished": False}
+                stage_started = time.time()
+                self._prepare(iteration, ranges, simulations)
+                record["timings"]["prepare"] = time.time() - stage_started
+
+                stage_started = time.time()
+                self._run()
+                record["timings"]["run"] = time.time() - stage_started
+
+                stage_started = time.time()
+                goal = self._post()
+                info, df = goal
+                layout = get_goal_layout(goal)
+                maximize = layout["maximize"]
+                goal_values = layout["goal"]
+                goal_simulations = layout["simulations"]
+                par_simulations, par_values = sufi2files.read_par_val(self.swatcup.get_execution_folder_path())
+                rows = numpy.searchsorted(par_simulations, goal_simulations)
+                if numpy.any(rows >= len(par_simulations)) or \
+                        numpy.any(par_simulations[numpy.minimum(rows, len(par_simulations) - 1)] != goal_simulations):
+                    raise ValueError("Simulations of goal.txt not found in par_val.txt")
+                values = par_values[rows, :len(names)]
+                behavioral = None
+                if threshold is not None:
+                    behavioral = goal_values >= threshold if maximize else goal_values <= threshold
+                best = int(numpy.nanargmax(goal_values) if maximize else numpy.nanargmin(goal_values))
+                best_simulation = int(goal_simulations[best])
+                new_ranges, selected = compute_new_ranges(values, goal_values, maximize, ranges, bounds,
+                                                          behavioral, self.min_behavioral, self.best_fraction)
+                record.update({"simulations": int(len(df)), "goal_function": info["type_of_goal_fn"],
+                               "best_goal": float(goal_values[best]), "best_simulation": best_simulation,
+                               "best_parameters": dict(zip(names, values[best].tolist())),
+                               "behavioral": int(behavioral.sum()) if behavioral is not None else None,
+                               "selected": selected,
+                               "new_ranges": dict(zip(names, [list(item) for item in new_ranges]))})
+                staging_path = self._stage(iteration)
+                record["timings"]["post"] = time.time() - stage_started
+                with self._lock:
+                    self.history.append(record)
+                logger.info("Iteration " + str(iteration) + ": best " + info["type_of_goal_fn"] + " " +
+                            str(record["best_goal"]) + " (simulation " + str(best_simulation) + ")")
+                if self.on_iteration is not None:
+                    self.on_iteration(record)
+
+                if previous is not None:
+                    # Surfaces the errors of the previous iteration; it is long finished by now
+                    previous.result()
+                previous = executor.submit(self._finish, record, staging_path, goal, behavioral, best_simulation)
+                self.stop_reason = self._check_stop(record, maximize)
+                if self.stop_reason is not None:
+                    break
+                ranges = new_ranges
+            if previous is not None:
+                previous.result()
+        logger.info("Calibration stopped after " + str(len(self.history)) + " iterations (" + self.stop_reason +
+                    ") in " + "{:.1f}".format(time.time() - started) + " s")
+        self.write_history()
+        return self.history
+
+    def get_history(self) -> list:
+        """ History records: 'iteration', 'ranges', 'new_ranges', 'simulations', 'goal_function', 'best_goal',
+        'best_simulation', 'best_parameters', 'behavioral' and 'selected' simulations, 'p_factor' and 'r_factor' per
+        variable and 'timings' (seconds) of the 'prepare', 'run', 'post', 'ppu' and 'archive' stages
+        """
+        with self._lock:
+            return list(self.history)
+
+    def get_summary(self) -> dict:
+        """ Wall time of the main thread stages and share of it spent running the simulations """
+        history = self.get_history()
+        stages = {}
+        for record in history:
+            for stage, seconds in record["timings"].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds
+        wall_time = sum(stages.get(stage, 0.0) for stage in ("prepare", "run", "post"))
+        goals = [record["best_goal"] for record in history]
+        maximize = bool(history) and get_goal_function(history[0]["goal_function"]) in MAXIMIZED_GOAL_FUNCTIONS
+        return {"iterations": len(history), "stop_reason": self.stop_reason,
+                "best_goal": (max(goals) if maximize else min(goals)) if goals else None, "stages": stages,
+                "wall_time": wall_time, "run_fraction": stages.get("run", 0.0) / wall_time if wall_time else None}
+
+    def write_history(self):
+        file = os.path.join(self.swatcup.swatcuppython_base_folder_path, HISTORY_FILE)
+        with self._lock:
+            with open(file + ".tmp", "w") as fo:
+                json.dump({"stop_reason": self.stop_reason, "iterations": self.history}, fo, indent=1)
+            os.replace(file + ".tmp", file)
@@ -0,0 +1,202 @@
+import os
+import time
+import logging
+
+import numpy
+from swatcuppython.extract import SWATOutputExtractor, MONTH_COLUMNS
+from swatcuppython.objectives import ObjectiveEngine, combine_goal
+from swatcuppython.varfile import SUFI2VarTail
+
+logger = logging.getLogger(__name__)
+
+# Goal functions with a bound from part of the simulated period: they only grow (or only shrink) with the squared
+# (or absolute) errors of the observations still to come
+BOUNDED_GOAL_FUNCTIONS = {"mult", "sum", "chi2", "NS", "RSR", "MNS"}
+
+
+class EarlyStopping(object):
+    """
+    Opt-in early stopping policy of the run stage (see WatchdogRunner).
+
+    Simulation level: while swat.exe runs, the observed variables are extracted from the part of the SWAT output
+    files written so far and the best goal value the simulation can still reach is computed (the errors of the
+    observations still to come can only make it worse). The simulation is aborted when this bound misses the
+    behavioral threshold. Only the goal functions of BOUNDED_GOAL_FUNCTIONS have such a bound.
+
+    Iteration level: the goal of every completed simulation is computed from the var files; the iteration stops when
+    the best goal did not improve more than tolerance over the last patience simulations.
+    """
+
+    def __init__(self, project_path: str, observed_file: str = "observed.txt", threshold: float = None,
+                 abort_simulations: bool = True, check_interval: float = 5.0, patience: int = None,
+                 tolerance: float = 0.0, min_simulations: int = None):
+        """
+        Parameters
+        ----------
+        project_path : project folder
+        observed_file : observed file in SUFI2.IN with the goal function and the behavioral threshold
+        threshold : behavioral threshold. Taken from the observed file if None
+        abort_simulations : aborts the simulations that cannot reach the threshold
+        check_interval : minimum seconds between two bound checks of a running simulation
+        patience : stops the iteration after patience simulations without improvement. Never stops if None
+        tolerance : improvements of the best goal up to tolerance do not count
+        min_simulations : simulations completed before the iteration can stop. patience if None
+        """
+        self.observed_file = observed_file
+        self.engine = ObjectiveEngine(project_path, observed_file)
+        self.goal_name = self.engine.get_goal_name()
+        self.maximize = self.engine.is_maximized()
+        self.threshold = threshold if threshold is not None else self.engine.observed["threshold"]
+        if abort_simulations:
+            if self.goal_name not in BOUNDED_GOAL_FUNCTIONS:
+                raise ValueError("Simulations cannot be aborted with the goal function " + self.goal_name +
+                                 ". Use one of " + str(sorted(BOUNDED_GOAL_FUNCTIONS)))
+            if self.threshold is None:
+                raise ValueError("Behavioral threshold not found in " + observed_file)
+        self.abort_simulations = abort_simulations
+        self.check_interval = check_interval
+        self.patience = patience
+        self.tolerance = tolerance
+        self.min_simulations = min_simulations if min_simulations is not None else (patience or 0)
+        self.variables = {variable["name"] + ".txt": variable for variable in self.engine.variables}
+        self._extractors = {}
+        self._last_check = {}
+        self._tails = {}
+        self._pending = {}
+        self.goals = []
+        self.best_goal = None
+        self.best_position = None
+
+    def _get_extractors(self, folder_path: str):
+        """ Extractors of the folder that write the observed variables """
+        if folder_path not in self._extractors:
+            extractors = []
+            for output_type in sorted(MONTH_COLUMNS):
+                def_file = "SUFI2_extract_" + output_type + ".def"
+                if not os.path.isfile(os.path.join(folder_path, def_file)):
+                    continue
+                try:
+                    extractor = SWATOutputExtractor(folder_path, def_file)
+                except OSError:
+                    # Def file without its var file list, not used by SUFI2_extract
+                    logger.debug("Var file list of " + def_file + " not found, ignoring it")
+                    continue
+                if set(extractor.var_file_names) & set(self.variables):
+                    extractors.append(extractor)
+            self._extractors[folder_path] = extractors
+        return self._extractors[folder_path]
+
+    def is_better(self, goal: float, other: float) -> bool:
+        return goal > other if self.maximize else goal < other
+
+    def get_bound(self, folder_path: str, started: float = None):
+        """ Best goal value the running simulation of a folder can reach, or None if the output files of the
+        simulation are not there yet
+
+        Parameters
+        ----------
+        folder_path : project or worker folder
+        started : start time of the simulation. Older output files are from the previous simulation
+        """
+        objectives = {}
+        for extractor in self._get_extractors(folder_path):
+            output_path = extractor.get_output_path()
+            try:
+                if started is not None and os.path.getmtime(output_path) < started:
+                    return None
+                results = extractor.extract(partial=True)
+            except (OSError, ValueError):
+                # Not created yet or being truncated by swat.exe
+                return None
+            for name, (time_steps, values) in results.items():
+                if name in self.variables:
+                    objectives[name] = self._bound_objectives(self.variables[name], time_steps, values)
+        if len(objectives) < len(self.variables):
+            return None
+        variables = list(self.variables)
+        return float(combine_goal([objectives[name] for name in variables],
+                                  [self.variables[name]["weight"] for name in variables],
+                                  self.engine.goal_type)[0])
+
+    def _bound_objectives(self, variable: dict, time_steps, values) -> dict:
+        """ Bounds of the objectives of a variable from the observations simulated so far """
+        observed = variable["values"]
+        n = observed.size
+        positions = numpy.zeros(n, dtype=int)
+        available = numpy.zeros(n, dtype=bool)
+        if len(time_steps):
+            positions = numpy.minimum(numpy.searchsorted(time_steps, variable["index"]), len(time_steps) - 1)
+            available = time_steps[positions] == variable["index"]
+        residual = values[positions[available]] - observed[available]
+        observed_anomaly = observed - observed.mean()
+        observed_ss = numpy.sum(observed_anomaly ** 2)
+        ssq = numpy.sum(residual ** 2)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            bounds = {"MSE": ssq / n, "SSQ": ssq, "Chi2": ssq / (observed_ss / (n - 1)), "NS": 1 - ssq / observed_ss,
+                      "RSR": numpy.sqrt(ssq) / numpy.sqrt(observed_ss),
+                      "MNS": 1 - (numpy.sum(numpy.abs(residual) ** self.engine.mns_power) /
+                                  numpy.sum(numpy.abs(observed_anomaly) ** self.engine.mns_power))}
+        return {key: numpy.array([value]) for key, value in bounds.items()}
+
+    def should_abort(self, folder_path: str, started: float) -> bool:
+        """ True if the simulation running in the folder cannot reach the behavioral threshold anymore """
+        if not self.abort_simulations:
+            return False
+        now = time.time()
+        if now - self._last_check.get(folder_path, 0.0) < self.check_interval:
+            return False
+        self._last_check[folder_path] = now
+        bound = self.get_bound(folder_path, started)
+        if bound is None:
+            return False
+        hopeless = self.is_better(self.threshold, bound)
+        if hopeless:
+            logger.debug("Best reachable goal " + str(bound) + " misses the threshold " + str(self.threshold) +
+                         ": " + folder_path)
+        return hopeless
+
+    def track(self, folder_path: str):
+        """ Reads the simulations completed in the var files of a folder and updates the best goal """
+        if self.patience is None:
+            return
+        if folder_path not in self._tails:
+            self._tails[folder_path] = {name: SUFI2VarTail(os.path.join(folder_path, "SUFI2.OUT", name))
+                                        for name in self.variables}
+            self._pending[folder_path] = {}
+        pending = self._pending[folder_path]
+        for name, tail in self._tails[folder_path].items():
+            for simulation, time_steps, values in tail.read():
+                pending.setdefault(simulation, {})[name] = (numpy.array([simulation]), time_steps, values[None, :])
+        for simulation in sorted(pending):
+            if len(pending[simulation]) < len(self.variables):
+                continue
+            series = {self.variables[name]["name"]: data for name, data in pending.pop(simulation).items()}
+            goal = float(self.engine.evaluate(series)[2][0])
+            self.goals.append((simulation, goal))
+            if self.best_goal is None or self.is_better(goal, self.best_goal + (self.tolerance if self.maximize
+                                                                                  else -self.tolerance)):
+                self.best_goal = goal
+                self.best_position = len(self.goals)
+
+    def reset(self, folder_path: str, simulation: int):
+        """ Forgets the blocks of simulation and the ones after it in the var files of a folder, after they were
+        truncated (see WatchdogRunner), so the tails read the blocks written next from the start
+        """
+        for tail in self._tails.get(folder_path, {}).values():
+            tail.reset()
+        pending = self._pending.get(folder_path, {})
+        for pending_simulation in [pending_simulation for pending_simulation in pending
+                                   if pending_simulation >= simulation]:
+            del pending[pending_simulation]
+
+    def is_converged(self) -> bool:
+        """ True when the best goal did not improve over the last patience completed simulations """
+        if self.patience is None or len(self.goals) < max(self.min_simulations, 1):
+            return False
+        return len(self.goals) - self.best_position >= self.patience
+
+    def write_goal(self, project_path: str = None):
+        """ Writes SUFI2.OUT/goal.txt with the simulations of the var files, so it matches the partial var files """
+        engine = self.engine if project_path is None else ObjectiveEngine(project_path, self.observed_file)
+        simulations, objectives, goal = engine.evaluate()
+        return engine.write_goal(simulations, goal)
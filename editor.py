@@ -0,0 +1,413 @@
+import os
+import re
+import glob
+import logging
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.extract import SWATOutputExtractor, read_extract_def_files
+
+logger = logging.getLogger(__name__)
+
+# Files with one set of values per subbasin (SSSSS0000.ext) and per HRU (SSSSSHHHH.ext)
+SUBBASIN_EXTENSIONS = {"sub", "rte", "swq", "pnd", "wus"}
+HRU_EXTENSIONS = {"hru", "mgt", "gw", "sol", "chm", "sep"}
+# Files of the whole watershed
+BASIN_FILES = {"bsn": "basins.bsn", "wwq": "basins.wwq"}
+# Labels of the .sol lines, by parameter name
+SOL_LABELS = {"SOL_ZMX": "Maximum rooting depth", "ANION_EXCL": "Porosity fraction from which anions are excluded",
+              "SOL_CRK": "Crack volume potential of soil", "SOL_Z": "Depth", "SOL_BD": "Bulk Density Moist",
+              "SOL_AWC": "Ave. AW Incl. Rock Frag", "SOL_K": "Ksat.", "SOL_CBN": "Organic Carbon",
+              "CLAY": "Clay", "SILT": "Silt", "SAND": "Sand", "ROCK": "Rock Fragments",
+              "SOL_ALB": "Soil Albedo (Moist)", "USLE_K": "Erosion K", "SOL_EC": "Salinity (EC, Form 5)"}
+HRU_FILE_PATTERN = re.compile(r"^(\d{5})(\d{4})\.(\w+)$")
+
+
+def parse_parameter(parameter: str) -> dict:
+    """ Parses a par_inf.txt parameter name: x__NAME(layer).ext__hydrogrp__soltext__landuse__subbsn__slope
+
+    Returns
+    -------
+    dict with 'change' (r, v or a), 'name', 'layer' (None, a layer number or 0 for all the layers), 'extension' and
+    the qualifiers 'hydrogrp', 'soltext', 'landuse', 'slope' (lists of values, empty for any) and 'subbasins'
+    (set of subbasin numbers, empty for any)
+    """
+    if parameter[:3].lower() not in ("r__", "v__", "a__"):
+        raise ValueError("Invalid parameter: " + parameter)
+    fields = parameter[3:].split("__")
+    match = re.match(r"^(\w+?)(?:\((\d*)\))?\.(\w+)$", fields[0])
+    if match is None:
+        # Operations ({...}), crop.dat, climate files, ...
+        raise ValueError("Parameter not supported by the editor: " + parameter)
+    qualifiers = (fields[1:] + [""] * 5)[:5]
+
+    def values(qualifier):
+        return [value for value in qualifier.split(",") if value]
+
+    subbasins = set()
+    for value in values(qualifiers[3]):
+        first, _, last = value.partition("-")
+        subbasins.update(range(int(first), int(last or first) + 1))
+    layer = match.group(2)
+    return {"change": parameter[0].lower(), "name": match.group(1).upper(),
+            "layer": None if layer is None else int(layer or 0), "extension": match.group(3).lower(),
+            "hydrogrp": [value.upper() for value in values(qualifiers[0])], "soltext": values(qualifiers[1]),
+            "landuse": [value.upper() for value in values(qualifiers[2])], "subbasins": subbasins,
+            "slope": values(qualifiers[4])}
+
+
+def read_absolute_values(file_path: str) -> dict:
+    """ Reads Absolute_SWAT_Values.txt. Returns dict parameter name -> (min, max) """
+    limits = {}
+    with open(file_path, "r") as fo:
+        for line in fo:
+            tokens = line.split()
+            if len(tokens) < 3 or line.lstrip().startswith("/"):
+                continue
+            try:
+                limits.setdefault(tokens[0].upper(), (float(tokens[1]), float(tokens[2])))
+            except ValueError:
+                continue
+    return limits
+
+
+def read_model_in(path: str):
+    """ Reads model.in (parameter name and value of the current simulation, written by SUFI2_make_input.exe)
+
+    Returns
+    -------
+    (names, values)
+    """
+    names = []
+    values = []
+    with open(os.path.join(path, "model.in"), "r") as fo:
+        for line in fo:
+            tokens = line.split()
+            if len(tokens) >= 2:
+                names.append(tokens[0])
+                values.append(float(tokens[1]))
+    return names, numpy.array(values)
+
+
+def get_field_format(text: bytes):
+    """ Returns (decimals, exponent) of a number field: the decimals of the mantissa and the exponent letter ('e' or
+    'E', None for fixed point) """
+    mantissa, exponent = re.match(rb"^([^eEdD]*)([eEdD]?)", text.strip()).groups()
+    decimals = len(mantissa.split(b".")[1]) if b"." in mantissa else 0
+    if not exponent:
+        return decimals, None
+    return decimals, "E" if exponent.isupper() else "e"
+
+
+def format_field(value: float, width: int, decimals: int, exponent: str = None) -> bytes:
+    """ Formats value right aligned in width characters with the given decimals, in fixed point or with the exponent
+    letter of the original field. Decimals are dropped if the value does not fit, as the fixed format Fortran reads
+    need the same width.
+    """
+    while True:
+        text = "{:{}.{}{}}".format(value, width, decimals, exponent or "f")
+        if len(text) <= width or decimals == 0:
+            break
+        decimals -= 1
+    if len(text) > width:
+        raise ValueError("Value " + str(value) + " does not fit in " + str(width) + " characters")
+    return text.encode()
+
+
+class ParameterEditor(object):
+    """
+    In process replacement of SWAT_Edit.exe for the single value parameters (| NAME : lines) of the HRU, subbasin
+    and basin files and the layer parameters of the .sol files.
+
+    The project is indexed once: for every parameter of par_inf.txt, the file, the byte offset, the width and the
+    decimals of each field it changes, and the original value read from the Backup folder. A simulation then
+    writes only those fields in the model files, formatted with their original width, computed from the original
+    values kept in memory. As SWAT_Edit.exe, r__ multiplies the value by (1 + x), v__ replaces it and a__ adds x,
+    and the results are limited to the range of Absolute_SWAT_Values.txt.
+    """
+
+    def __init__(self, project_path: str, names=None, backup_folder: str = "Backup",
+                 absolute_values_file: str = "Absolute_SWAT_Values.txt"):
+        """
+        Parameters
+        ----------
+        project_path : project folder (TxtInOut)
+        names : parameter names. The parameters of par_inf.txt if None
+        backup_folder : folder with the original model files
+        absolute_values_file : file with the absolute limits of the parameters
+        """
+        self.project_path = project_path
+        self.backup_path = os.path.join(project_path, backup_folder)
+        if not os.path.isdir(self.backup_path):
+            raise ValueError("Backup folder not found: " + self.backup_path)
+        if names is None:
+            names, ranges, simulation_number = sufi2files.read_par_inf(project_path)
+        self.names = list(names)
+        self.parameters = [parse_parameter(name) for name in self.names]
+        limits_file = os.path.join(project_path, absolute_values_file)
+        self.limits = read_absolute_values(limits_file) if os.path.isfile(limits_file) else {}
+        self.originals = {}
+        self.hru_info = {}
+        self.index = []
+        self.restored = False
+        self.build_index()
+
+    def _read_original(self, file_name: str) -> bytes:
+        if file_name not in self.originals:
+            with open(os.path.join(self.backup_path, file_name), "rb") as fo:
+                self.originals[file_name] = fo.read()
+        return self.originals[file_name]
+
+    def _read_hru_info(self):
+        """ Reads the qualifiers of every HRU from the .hru headers (Luse, Soil, Slope) and the .sol files
+        (hydrologic group)
+        """
+        for file in sorted(glob.glob(os.path.join(self.backup_path, "*.hru"))):
+            match = HRU_FILE_PATTERN.match(os.path.basename(file))
+            if match is None or match.group(2) == "0000":
+                continue
+            with open(file, "rb") as fo:
+                header = fo.readline().decode("latin-1")
+            info = {"subbasin": int(match.group(1)), "landuse": "", "soltext": "", "slope": "", "hydrogrp": ""}
+            for key, label in (("landuse", "Luse"), ("soltext", "Soil"), ("slope", "Slope")):
+                found = re.search(label + r":\s*(\S+)", header)
+                if found:
+                    info[key] = found.group(1)
+            info["landuse"] = info["landuse"].upper()
+            sol_file = os.path.join(self.backup_path, match.group(1) + match.group(2) + ".sol")
+            if os.path.isfile(sol_file):
+                found = re.search(rb"Soil Hydrologic Group\s*:\s*(\S+)", self._read_original(os.path.basename(
+                    sol_file)))
+                if found:
+                    info["hydrogrp"] = found.group(1).decode().upper()
+            self.hru_info[match.group(1) + match.group(2)] = info
+
+    def get_files(self, parameter: dict):
+        """ Returns the model files (names in the Backup folder) changed by a parameter, applying the qualifiers """
+        extension = parameter["extension"]
+        if extension in BASIN_FILES:
+            return [BASIN_FILES[extension]]
+        if extension in SUBBASIN_EXTENSIONS:
+            files = []
+            for file in sorted(glob.glob(os.path.join(self.backup_path, "*." + extension))):
+                match = HRU_FILE_PATTERN.match(os.path.basename(file))
+                if match and (not parameter["subbasins"] or int(match.group(1)) in parameter["subbasins"]):
+                    files.append(os.path.basename(file))
+            return files
+        if extension not in HRU_EXTENSIONS:
+            raise ValueError("File extension not supported by the editor: " + extension)
+        files = []
+        for hru, info in self.hru_info.items():
+            if parameter["subbasins"] and info["subbasin"] not in parameter["subbasins"]:
+                continue
+            if any(parameter[key] and info[key] not in parameter[key]
+                   for key in ("hydrogrp", "soltext", "landuse", "slope")):
+                continue
+            files.append(hru + "." + extension)
+        return files
+
+    @staticmethod
+    def locate(content: bytes, parameter: dict):
+        """ Finds the fields of a parameter in the content of a model file
+
+        Returns
+        -------
+        list of (offset, width, decimals, exponent, value). See get_field_format
+        """
+        fields = []
+        if parameter["extension"] == "sol" and parameter["name"] in SOL_LABELS:
+            label = re.escape(SOL_LABELS[parameter["name"]].encode())
+            line = re.search(rb"^[ \t]*" + label + rb"[^:\n]*:([^\n]*)", content, re.MULTILINE)
+            if line is None:
+                return fields
+            start = line.start(1)
+            tokens = list(re.finditer(rb"\S+", line.group(1)))
+            for number, token in enumerate(tokens, 1):
+                layer = parameter["layer"]
+                if layer is None or layer == 0 or layer == number:
+                    begin = tokens[number - 2].end() if number > 1 else 0
+                    fields.append((start + begin, token.end() - begin, token.group()))
+        else:
+            name = re.escape(parameter["name"].encode())
+            pattern = rb"^([ \t]*[-+0-9.eE]+)[ \t]*\|[ \t]*" + name + rb"[ \t]*:"
+            for match in re.finditer(pattern, content, re.MULTILINE | re.IGNORECASE):
+                fields.append((match.start(1), match.end(1) - match.start(1), match.group(1).strip()))
+        result = []
+        for offset, width, text in fields:
+            decimals, exponent = get_field_format(text)
+            result.append((offset, width, decimals, exponent, float(re.sub(rb"[dD]", b"e", text))))
+        return result
+
+    def build_index(self):
+        """ Locates the fields of every parameter in the Backup files """
+        self._read_hru_info()
+        self.index = []
+        for name, parameter in zip(self.names, self.parameters):
+            entries = []
+            for file_name in self.get_files(parameter):
+                if not os.path.isfile(os.path.join(self.backup_path, file_name)):
+                    continue
+                for offset, width, decimals, exponent, value in self.locate(self._read_original(file_name), parameter):
+                    entries.append((file_name, offset, width, (decimals, exponent), value))
+            if not entries:
+                logger.warning("Parameter not found in the model files: " + name)
+            self.index.append(entries)
+        # Only the files with parameters are kept in memory
+        used = {entry[0] for entries in self.index for entry in entries}
+        self.originals = {name: content for name, content in self.originals.items() if name in used}
+        logger.debug("Parameter index: " + str(sum(len(entries) for entries in self.index)) + " fields in " +
+                     str(len(used)) + " files")
+
+    def get_touched_files(self):
+        return sorted(self.originals)
+
+    def restore(self):
+        """ Writes the original content of the files changed by the parameters to the project """
+        for file_name, content in self.originals.items():
+            with open(os.path.join(self.project_path, file_name), "wb") as fo:
+                fo.write(content)
+        self.restored = True
+
+    def get_io_stats(self) -> dict:
+        """ Returns the number of files changed by the parameters, their size (bytes rewritten by SWAT_Edit.exe in
+        every simulation) and the bytes of the parameter fields (bytes written by apply)
+        """
+        return {"files": len(self.originals), "file_bytes": sum(len(content) for content in self.originals.values()),
+                "field_bytes": sum(entry[2] for entries in self.index for entry in entries)}
+
+    def _limit(self, name: str, values):
+        if name in self.limits:
+            low, high = self.limits[name]
+            return numpy.clip(values, low, high)
+        return values
+
+    def compute(self, values) -> dict:
+        """ Computes the new fields for the parameter values, applied in par_inf.txt order to the original values
+
+        Returns
+        -------
+        dict file name -> {offset: bytes}
+        """
+        if len(values) != len(self.parameters):
+            raise ValueError("Expected " + str(len(self.parameters)) + " parameter values, found " + str(len(values)))
+        current = {}
+        formats = {}
+        for parameter, entries, x in zip(self.parameters, self.index, values):
+            for file_name, offset, width, field_format, original in entries:
+                key = (file_name, offset)
+                value = current.get(key, original)
+                if parameter["change"] == "r":
+                    value = value * (1 + x)
+                elif parameter["change"] == "v":
+                    value = x
+                else:
+                    value = value + x
+                current[key] = float(self._limit(parameter["name"], value))
+                formats[key] = (width, field_format)
+        patches = {}
+        for (file_name, offset), value in current.items():
+            width, (decimals, exponent) = formats[(file_name, offset)]
+            patches.setdefault(file_name, {})[offset] = format_field(value, width, decimals, exponent)
+        return patches
+
+    def apply(self, values) -> int:
+        """ Writes the parameter values in the project files, patching only the parameter fields. The files are
+        restored from the original content on the first call only, the following calls rewrite the same fields.
+
+        Returns
+        -------
+        number of bytes written
+        """
+        if not self.restored:
+            self.restore()
+        written = 0
+        for file_name, fields in self.compute(values).items():
+            with open(os.path.join(self.project_path, file_name), "r+b") as fo:
+                for offset, field in sorted(fields.items()):
+                    fo.seek(offset)
+                    fo.write(field)
+                    written += len(field)
+        return written
+
+    def apply_model_in(self) -> int:
+        """ Applies the parameter values of model.in, as SWAT_Edit.exe does """
+        names, values = read_model_in(self.project_path)
+        if names != self.names:
+            raise ValueError("model.in parameters do not match the editor parameters")
+        return self.apply(values)
+
+    def apply_simulation(self, simulation: int, row=None) -> int:
+        """ Applies the parameter values of a simulation of par_val.txt
+
+        Parameters
+        ----------
+        simulation : simulation number
+        row : par_val.txt values of the simulation. Read from par_val.txt if None
+        """
+        if row is None:
+            simulations, values = sufi2files.read_par_val(self.project_path)
+            rows = numpy.flatnonzero(simulations == simulation)
+            if not rows.size:
+                raise ValueError("Simulation not found in par_val.txt: " + str(simulation))
+            row = values[rows[0]]
+        return self.apply(row[:len(self.parameters)])
+
+
+class EditorRunner(object):
+    """
+    Runs the SUFI2_swEdit.def simulation range in process, as SUFI2_execute.exe does with the executables: for each
+    simulation the ParameterEditor writes the parameter values of par_val.txt (in place of SUFI2_make_input.exe and
+    SWAT_Edit.exe), swat.exe runs and its output is appended to the var files with NumPy (in place of the
+    SUFI2_extract executables). Only the parameters supported by the editor can be calibrated this way.
+    """
+
+    def __init__(self, wrapper, project_folder_path: str, editor: ParameterEditor = None, def_files=None):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module, runs swat.exe
+        project_folder_path : SWAT-CUP project folder
+        editor : parameter editor of the project. Built from par_inf.txt if None
+        def_files : extract def files. The ones of the programs in SUFI2_extract.bat if None
+        """
+        self.wrapper = wrapper
+        self.project_folder_path = project_folder_path
+        self.editor = editor or ParameterEditor(project_folder_path)
+        if def_files is None:
+            def_files = read_extract_def_files(project_folder_path)
+        self.extractors = [SWATOutputExtractor(project_folder_path, def_file) for def_file in def_files]
+
+    def run(self) -> dict:
+        """ Runs the simulations of SUFI2_swEdit.def. Stops at the first swat.exe failure
+
+        Returns
+        -------
+        dict with the 'simulations' run, the 'return_codes' of swat.exe and the 'missing' simulations, not run
+        """
+        path = self.project_folder_path
+        start, end = sufi2files.read_swedit_def(path)
+        swat = self.wrapper.get_os_filename("swat.exe", "swat.exe")
+        result = {"simulations": [], "return_codes": [], "missing": list(range(start, end + 1))}
+        # par_val.txt is read once for the whole range
+        simulations, values = sufi2files.read_par_val(path)
+        rows = dict(zip(simulations.tolist(), values))
+        for simulation in range(start, end + 1):
+            if simulation not in rows:
+                raise ValueError("Simulation not found in par_val.txt: " + str(simulation))
+            sufi2files.write_trk(path, simulation)
+            self.editor.apply_simulation(simulation, rows[simulation])
+            # A failed swat.exe must not leave the output of the previous simulation to extract
+            for extractor in self.extractors:
+                if os.path.isfile(extractor.get_output_path()):
+                    os.remove(extractor.get_output_path())
+            return_code = self.wrapper.run_os_filename(path, swat)
+            result["return_codes"].append(return_code)
+            if return_code != 0:
+                logger.warning("swat.exe failed in simulation " + str(simulation) + " with return code " +
+                               str(return_code) + ": " + path)
+                break
+            for extractor in self.extractors:
+                extractor.run(simulation)
+            result["simulations"].append(simulation)
+            result["missing"].remove(simulation)
+        return result
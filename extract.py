@@ -0,0 +1,413 @@
+import os
+import re
+import mmap
+import calendar
+import logging
+
+import numpy
+from swatcuppython import sufi2files
+
+logger = logging.getLogger(__name__)
+
+# Column (1 based, counting the label) with the month, day or year of each row of the SWAT output files
+MONTH_COLUMNS = {"rch": 4, "sub": 4, "hru": 6, "rsv": 3}
+TIME_STEPS = {1: "daily", 2: "monthly", 3: "yearly"}
+
+
+def read_extract_def(file_path: str) -> dict:
+    """ Reads a SUFI2_extract_*.def file (or extract_*_No_obs.def)
+
+    Returns
+    -------
+    dict with 'output_file', 'columns', 'entity_number', 'entities' (list of entity numbers per variable),
+    'begin_year', 'end_year' and 'time_step'
+    """
+    values = []
+    with open(file_path, "r") as fo:
+        for line in fo:
+            if line.lstrip().startswith("/"):
+                # Remarks
+                break
+            value = line.split(":")[0].strip()
+            if value:
+                values.append(value)
+    # The No_obs files start with the program name
+    if values and "." not in values[0]:
+        values = values[1:]
+    try:
+        definition = {"output_file": values[0]}
+        variable_number = int(values[1])
+        definition["columns"] = [int(column) for column in values[2].split()]
+        definition["entity_number"] = int(values[3])
+        entities = []
+        for v in range(variable_number):
+            count = int(values[4 + 2 * v])
+            numbers = values[5 + 2 * v].split()
+            if numbers and numbers[0].lower() == "all":
+                numbers = range(1, definition["entity_number"] + 1)
+            numbers = [int(number) for number in numbers]
+            if len(numbers) != count:
+                raise ValueError("Invalid extract def file:" + file_path + ". Expected " + str(count) +
+                                 " entities for variable " + str(v + 1))
+            entities.append(numbers)
+        definition["entities"] = entities
+        i = 4 + 2 * variable_number
+        definition["begin_year"] = int(values[i])
+        definition["end_year"] = int(values[i + 1])
+        definition["time_step"] = int(values[i + 2])
+    except (IndexError, ValueError) as e:
+        raise ValueError("Invalid extract def file:" + file_path + " " + str(e))
+    if len(definition["columns"]) != variable_number:
+        raise ValueError("Invalid extract def file:" + file_path + ". Expected " + str(variable_number) + " columns")
+    if definition["time_step"] not in TIME_STEPS:
+        raise ValueError("Invalid time step in extract def file:" + file_path)
+    return definition
+
+
+def count_time_steps(begin_year: int, end_year: int, time_step: int) -> int:
+    """ Number of time steps printed by SWAT between begin_year and end_year """
+    years = end_year - begin_year + 1
+    if time_step == 1:
+        return sum(366 if calendar.isleap(year) else 365 for year in range(begin_year, end_year + 1))
+    if time_step == 2:
+        return 12 * years
+    return years
+
+
+class FixedWidthOutput(object):
+    """
+    Memory mapped view of the data rows of a SWAT output file (output.rch, output.sub, output.hru, output.rsv).
+
+    SWAT writes the rows with Fortran fixed formats, so all the rows have the same length and every column ends at
+    the same character. The rows are viewed as a (n_rows, row_length) byte matrix and a column is parsed by slicing
+    its characters out of the matrix, without splitting lines. Rows with a different length (ex: the average
+    summary at the end of some files) are parsed by splitting them.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise ValueError("Empty SWAT output file: " + file_path)
+        data = numpy.frombuffer(self._mmap, dtype=numpy.uint8)
+        start = self._find_data_start()
+        first_end = self._mmap.find(b"\n", start)
+        self.row_length = first_end - start
+        if self.row_length <= 0:
+            raise ValueError("No data in SWAT output file: " + file_path)
+        size = len(data) - start
+        step = self.row_length + 1
+        if size % step == 0 and numpy.all(data[start + self.row_length::step] == ord("\n")):
+            # Every row has the same length: zero copy view of the rows, the newlines are not searched
+            self.row_number = size // step
+            self.row_starts = start + step * numpy.arange(self.row_number)
+            self.rows = data[start:].reshape(self.row_number, step)
+            self.regular = None
+        else:
+            newlines = numpy.flatnonzero(data[start:] == ord("\n")) + start
+            if data[-1] != ord("\n"):
+                newlines = numpy.append(newlines, len(data))
+            starts = numpy.concatenate(([start], newlines[:-1] + 1))
+            lengths = newlines - starts
+            # Skips blank lines
+            starts, lengths = starts[lengths > 0], lengths[lengths > 0]
+            uniform = lengths == self.row_length
+            self.row_number = len(starts)
+            self.row_starts = starts
+            self.rows = data[starts[uniform, None] + numpy.arange(self.row_length)]
+            self.regular = numpy.flatnonzero(uniform)
+        self.field_ends = [match.end() for match in re.finditer(rb"\S+", self._mmap[start:first_end])]
+
+    def _find_data_start(self) -> int:
+        """ Position of the first data row: the row after the column header line (the one with the MON column) """
+        position = 0
+        while True:
+            end = self._mmap.find(b"\n", position)
+            if end < 0:
+                raise ValueError("Column header not found in SWAT output file: " + self.file_path)
+            if b"MON" in self._mmap[position:end].split():
+                return end + 1
+            position = end + 1
+
+    def close(self):
+        self.rows = None
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def column(self, column: int, rows=None):
+        """ Parses a column (1 based, counting the label) of the data rows
+
+        Parameters
+        ----------
+        column : column number, as in the SUFI2_extract_*.def files
+        rows : data row indices to parse. All the rows if None
+
+        Returns
+        -------
+        float64 array
+        """
+        if column < 2 or column > len(self.field_ends):
+            raise ValueError("Column " + str(column) + " not found in SWAT output file: " + self.file_path)
+        begin, end = self.field_ends[column - 2], self.field_ends[column - 1]
+        if rows is None:
+            rows = numpy.arange(self.row_number)
+        rows = numpy.asarray(rows)
+        if self.regular is None:
+            return self._parse_field(begin, end, rows, column, rows)
+        result = numpy.empty(len(rows))
+        # Position of each row inside the byte matrix of the regular rows
+        positions = numpy.searchsorted(self.regular, rows)
+        positions = numpy.minimum(positions, max(len(self.regular) - 1, 0))
+        regular = (len(self.regular) > 0) & (self.regular[positions] == rows)
+        if regular.any():
+            result[regular] = self._parse_field(begin, end, positions[regular], column, rows[regular])
+        if not regular.all():
+            result[~regular] = self._split_column(column, rows[~regular])
+        return result
+
+    def _parse_field(self, begin: int, end: int, positions, column: int, rows):
+        """ Parses the characters begin:end of the rows at positions of the byte matrix """
+        field = numpy.empty((len(positions), end - begin + 1), dtype=numpy.uint8)
+        field[:, :-1] = self.rows[positions, begin:end]
+        field[:, -1] = ord(" ")
+        values = numpy.fromstring(field.tobytes(), dtype=numpy.float64, sep=" ")
+        if len(values) != len(field):
+            # Overflowed (****) or glued fields
+            values = self._split_column(column, rows)
+        return values
+
+    def _split_column(self, column: int, rows):
+        values = numpy.empty(len(rows))
+        for i, row in enumerate(rows):
+            start = self.row_starts[row]
+            tokens = self._mmap[start:self._mmap.find(b"\n", start)].split()
+            try:
+                values[i] = float(tokens[column - 1])
+            except (IndexError, ValueError):
+                values[i] = numpy.nan
+        return values
+
+
+class SWATOutputExtractor(object):
+    """
+    NumPy replacement of SUFI2_extract_rch.exe, SUFI2_extract_sub.exe, SUFI2_extract_hru.exe and the extract_*_No_Obs
+    executables. Reads the SWAT output file given in the .def file, slices the requested columns and entities and
+    appends the simulation to the SUFI2.OUT var files.
+
+    Only the label, entity and month columns are parsed for every row, the value columns are parsed only for the
+    rows of the requested entities and time steps.
+    """
+
+    def __init__(self, project_path: str, def_file: str = "SUFI2_extract_rch.def", var_list_file: str = None,
+                 observed_file: str = None):
+        """
+        Parameters
+        ----------
+        project_path : project folder
+        def_file : extract def file in the project folder
+        var_list_file : file of SUFI2.IN with the var file names. Taken from the def file name if None
+            (SUFI2_extract_rch.def -> var_file_rch.txt, extract_rch_No_obs.def -> var_file_rch_No_obs.txt)
+        observed_file : observed file of SUFI2.IN. As the executables, only the observed time steps of each
+            variable are written. Taken from the def file name if None (observed_rch.txt), all the time steps are
+            written for the No_obs def files
+        """
+        self.project_path = project_path
+        self.def_file = def_file
+        self.definition = read_extract_def(os.path.join(project_path, def_file))
+        self.output_type = os.path.splitext(self.definition["output_file"])[1][1:].lower()
+        if self.output_type not in MONTH_COLUMNS:
+            raise ValueError("SWAT output file not supported: " + self.definition["output_file"])
+        no_obs = "no_obs" in def_file.lower()
+        suffix = self.output_type + ("_No_obs" if no_obs else "")
+        if var_list_file is None:
+            var_list_file = "var_file_" + suffix + ".txt"
+        entity_count = sum(len(entities) for entities in self.definition["entities"])
+        with open(os.path.join(project_path, "SUFI2.IN", var_list_file), "r") as fo:
+            # The executables read the names as whitespace separated tokens
+            self.var_file_names = fo.read().split()[:entity_count]
+        if len(self.var_file_names) != entity_count:
+            raise ValueError("Expected " + str(entity_count) + " var files in " + var_list_file + ", found " +
+                             str(len(self.var_file_names)))
+        self.observed_steps = {}
+        if observed_file is None and not no_obs:
+            observed_file = "observed_" + self.output_type + ".txt"
+            if not os.path.isfile(os.path.join(project_path, "SUFI2.IN", observed_file)):
+                observed_file = None
+        if observed_file is not None:
+            observed = sufi2files.read_observed(os.path.join(project_path, "SUFI2.IN", observed_file))
+            self.observed_steps = {variable["name"]: variable["index"] for variable in observed["variables"]}
+
+    def get_output_path(self) -> str:
+        return os.path.join(self.project_path, self.definition["output_file"])
+
+    def get_time_steps(self, name: str):
+        """ Time steps written to a var file of the def file """
+        stem = os.path.splitext(name)[0]
+        if stem in self.observed_steps:
+            return self.observed_steps[stem]
+        definition = self.definition
+        return numpy.arange(1, count_time_steps(definition["begin_year"], definition["end_year"],
+                                                definition["time_step"]) + 1)
+
+    def _select_time_steps(self, months):
+        """ Returns a mask of the rows of the simulated period at the def file time step """
+        time_step = self.definition["time_step"]
+        if time_step == 1:
+            return (months >= 1) & (months <= 366)
+        if time_step == 2:
+            # The yearly summaries have the year in the month column
+            return (months >= 1) & (months <= 12)
+        return (months >= self.definition["begin_year"]) & (months <= self.definition["end_year"])
+
+    def _find_block_rows(self, output: FixedWidthOutput, n_steps: int, entities, partial: bool = False):
+        """ Fast path: SWAT prints one row per entity and time step, ordered by entity, so the rows of a time step
+        are a block of entity_number rows. Only the month of the first row of each block is parsed. Returns None if
+        the file does not have this layout.
+
+        With partial, the file is being written: the last row is not used and fewer than n_steps time steps can be
+        returned.
+        """
+        entity_number = self.definition["entity_number"]
+        row_number = output.row_number - 1 if partial else output.row_number
+        block_rows = numpy.arange(0, row_number - entity_number + 1, entity_number)
+        if partial and len(block_rows) == 0:
+            return {entity: numpy.empty(0, dtype=int) for entity in entities}
+        month_column = MONTH_COLUMNS[self.output_type]
+        months = output.column(month_column, block_rows)
+        selected = numpy.flatnonzero(self._select_time_steps(months))[:n_steps]
+        if len(selected) < n_steps and not partial:
+            return None
+        if len(selected) == 0:
+            return {entity: numpy.empty(0, dtype=int) for entity in entities}
+        blocks = block_rows[selected]
+        rows = {entity: blocks + entity - 1 for entity in entities}
+        # Checks the entity of the rows and that the blocks do not span two time steps
+        needed = numpy.concatenate(list(rows.values()))
+        expected = numpy.repeat(list(rows.keys()), len(blocks))
+        if not numpy.array_equal(output.column(2, needed), expected):
+            return None
+        if not numpy.array_equal(output.column(month_column, blocks + entity_number - 1), months[selected]):
+            return None
+        return rows
+
+    def _find_rows(self, output: FixedWidthOutput, n_steps: int, entities):
+        """ Returns a dict entity -> row of each time step """
+        rows = self._find_block_rows(output, n_steps, entities)
+        if rows is not None:
+            return rows
+        logger.debug("SWAT output rows not in entity blocks, parsing all the rows: " + output.file_path)
+        all_entities = output.column(2).astype(int)
+        months = output.column(MONTH_COLUMNS[self.output_type])
+        candidates = numpy.flatnonzero(self._select_time_steps(months))
+        # Rows of the period grouped by entity, in file (time) order
+        order = candidates[numpy.argsort(all_entities[candidates], kind="stable")]
+        sorted_entities = all_entities[order]
+        rows = {}
+        for entity in entities:
+            begin, end = numpy.searchsorted(sorted_entities, [entity, entity + 1])
+            rows[entity] = order[begin:end][:n_steps]
+            if len(rows[entity]) < n_steps:
+                raise ValueError("Found " + str(len(rows[entity])) + " of " + str(n_steps) + " time steps for " +
+                                 str(entity) + " in " + output.file_path)
+        return rows
+
+    def extract(self, partial: bool = False) -> dict:
+        """ Extracts the variables from the SWAT output file
+
+        Parameters
+        ----------
+        partial : extracts the time steps written so far by a running swat.exe. Needs the rows in entity blocks
+
+        Returns
+        -------
+        dict var file name -> (time_steps, values)
+        """
+        definition = self.definition
+        n_steps = count_time_steps(definition["begin_year"], definition["end_year"], definition["time_step"])
+        result = {}
+        with FixedWidthOutput(self.get_output_path()) as output:
+            entities = sorted(set(sum(definition["entities"], [])))
+            if partial:
+                entity_rows = self._find_block_rows(output, n_steps, entities, partial=True)
+                if entity_rows is None:
+                    raise ValueError("SWAT output rows not in entity blocks: " + output.file_path)
+                n_steps = len(entity_rows[entities[0]])
+            else:
+                entity_rows = self._find_rows(output, n_steps, entities)
+            names = iter(self.var_file_names)
+            for column, variable_entities in zip(definition["columns"], definition["entities"]):
+                for entity in variable_entities:
+                    name = next(names)
+                    rows = entity_rows[entity]
+                    time_steps = numpy.arange(1, n_steps + 1)
+                    stem = os.path.splitext(name)[0]
+                    if stem in self.observed_steps:
+                        time_steps = self.observed_steps[stem]
+                        if partial:
+                            time_steps = time_steps[time_steps <= n_steps]
+                        if numpy.any(time_steps < 1) or numpy.any(time_steps > n_steps):
+                            raise ValueError("Observed time steps of " + stem + " out of the simulated period")
+                        rows = rows[time_steps - 1]
+                    result[name] = (time_steps, output.column(column, rows))
+        return result
+
+    def write(self, results: dict, simulation: int = None, text: bool = True, sidecar: bool = False):
+        """ Appends the extracted variables to the SUFI2.OUT var files
+
+        Parameters
+        ----------
+        results : extract result
+        simulation : simulation number. Read from SUFI2.IN/trk.txt if None
+        text : appends to the text var files
+        sidecar : appends to the binary sidecar of the var files (see varfile.read_sufi2_var_sidecar)
+        """
+        if simulation is None:
+            simulation = sufi2files.read_trk(self.project_path)
+        out_folder = os.path.join(self.project_path, "SUFI2.OUT")
+        for name, (time_steps, values) in results.items():
+            file_path = os.path.join(out_folder, name)
+            if text:
+                sufi2files.append_sufi2_var(file_path, simulation, time_steps, values)
+            if sidecar:
+                sufi2files.append_sufi2_var_sidecar(os.path.splitext(file_path)[0] + sufi2files.SIDECAR_EXTENSION,
+                                                    simulation, time_steps, values)
+
+    def run(self, simulation: int = None, text: bool = True, sidecar: bool = False) -> dict:
+        """ Extracts the variables and appends them to the var files, as the executables do after each simulation """
+        results = self.extract()
+        self.write(results, simulation, text, sidecar)
+        return results
+
+
+def read_extract_def_files(project_path: str) -> list:
+    """ Def files of the extract programs run by SUFI2_extract.bat (SUFI2_extract_rch.exe -> SUFI2_extract_rch.def) """
+    with open(os.path.join(project_path, "SUFI2_extract.bat"), "r") as fo:
+        programs = re.findall(r"([\w.-]+)\.exe", fo.read(), re.IGNORECASE)
+    return [program + ".def" for program in programs
+            if os.path.isfile(os.path.join(project_path, program + ".def"))]
+
+
+def find_var_time_steps(project_path: str, name: str):
+    """ Time steps written to a var file by the SUFI2_extract_*.def files of the project, or None if no def file
+    writes it
+    """
+    for output_type in sorted(MONTH_COLUMNS):
+        def_file = "SUFI2_extract_" + output_type + ".def"
+        if os.path.isfile(os.path.join(project_path, def_file)):
+            try:
+                extractor = SWATOutputExtractor(project_path, def_file)
+            except OSError:
+                # Def file without its var file list, not used by SUFI2_extract
+                continue
+            if name in extractor.var_file_names:
+                return extractor.get_time_steps(name)
+    return None
@@ -1,7 +1,11 @@
+import os
 import inspect
 from abc import ABC, abstractmethod, abstractproperty
 from typing import Tuple
+import numpy
 import pandas as pd
+from swatcuppython.capture import CapturedProcess, SUFI2Progress
+from swatcuppython.varfile import read_sufi2_var_array, read_sufi2_var_cube
 
 
 class ModuleInterface(ABC):
@@ -9,6 +13,10 @@ class ModuleInterface(ABC):
     Interface for swat cup modules. Use this as a parent class for your modules. You mus timplement the abstractmethods,
     while the others are optional.
     """
+    # profiling.Profiler measuring the SUFI2 stages and executables (see set_profiler)
+    profiler = None
+    # Output capture of the SUFI2 stages (see set_output_capture)
+    output_capture = {"max_lines": 1000, "log": False, "echo": False, "progress_interval": 10.0}
 
     @abstractmethod
     def get_version(self) -> str:
@@ -38,6 +46,76 @@ class ModuleInterface(ABC):
         """
         pass
 
+    def get_sufi2_command(self, path: str, stage: str) -> dict:
+        """
+        Returns how to start a SUFI2 stage ('pre', 'run' or 'post') without a shell: dict with the 'args' list, the
+        text written to stdin ('input', or None) and 'new_console' (Windows)
+        """
+        self._not_implemented_error()
+
+    def set_profiler(self, profiler) -> None:
+        """
+        Runs the SUFI2 stages and the single executables through a profiling.Profiler, which measures them. None
+        runs them directly
+        """
+        self.profiler = profiler
+
+    def set_output_capture(self, max_lines: int = 1000, log: bool = False, echo: bool = False,
+                           progress_interval: float = 10.0) -> None:
+        """
+        Sets how the output of the SUFI2 stages is captured. The output is always drained by a background thread
+
+        Parameters
+        ----------
+        max_lines : last output lines kept in memory
+        log : writes the whole output of each stage to sufi2_<stage>.log in the project folder
+        echo : writes the output to stdout
+        progress_interval : logs the 'simulation i of N, ETA' status at most every progress_interval seconds. Not
+            logged if None
+        """
+        self.output_capture = {"max_lines": max_lines, "log": log, "echo": echo,
+                               "progress_interval": progress_interval}
+
+    def start_captured(self, args, path: str, stage: str, shell: bool = False, stdin_text: str = None,
+                       **popen_kwargs) -> CapturedProcess:
+        """
+        Starts a SUFI2 stage with its output captured as set by set_output_capture
+        """
+        options = self.output_capture
+        log_path = os.path.join(path, "sufi2_" + stage + ".log") if options["log"] else None
+        return CapturedProcess(args, path, shell, stdin_text, options["max_lines"], log_path, options["echo"],
+                               SUFI2Progress.from_project(path), options["progress_interval"],
+                               name="SUFI2 " + stage + " (" + path + ")", **popen_kwargs)
+
+    def read_sufi2_var_file_name(self, path: str) -> list:
+        """
+        Returns the var file names of SUFI2.IN/var_file_name.txt
+        """
+        with open(os.path.join(path, "SUFI2.IN", "var_file_name.txt"), "r") as fo:
+            return [line.rstrip() for line in fo.readlines()]
+
+    def read_sufi2_var(self, path: str, file_name: str) -> pd.DataFrame:
+        """
+        Returns a SUFI2.OUT var file as a DataFrame with a column per simulation and a row per time step
+        """
+        simulations, time_steps, values = self.read_sufi2_var_array(path, file_name)
+        return pd.DataFrame(columns=simulations, index=time_steps, data=numpy.transpose(values))
+
+    def read_sufi2_var_array(self, path: str, file_name: str, dtype=numpy.float64) -> tuple:
+        """
+        Returns (simulations, time_steps, values) of a SUFI2.OUT var file with values as a (n_sims, n_steps) array
+        """
+        return read_sufi2_var_array(os.path.join(path, "SUFI2.OUT", file_name), dtype)
+
+    def read_sufi2_var_cube(self, path: str, file_names=None, dtype=numpy.float64, max_workers=None) -> tuple:
+        """
+        Reads the var files (all the files in var_file_name.txt if None) concurrently. Returns (simulations,
+        time_steps, cube) with cube as a (n_files, n_sims, n_steps) array
+        """
+        if file_names is None:
+            file_names = [file for file in self.read_sufi2_var_file_name(path) if file]
+        return read_sufi2_var_cube(os.path.join(path, "SUFI2.OUT"), file_names, dtype, max_workers)
+
     def load_backup(self) -> None:
         self._not_implemented_error()
 
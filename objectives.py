@@ -0,0 +1,231 @@
+import os
+import logging
+
+import numpy
+import pandas as pd
+from swatcuppython import sufi2files
+from swatcuppython.varfile import read_sufi2_var_array
+
+logger = logging.getLogger(__name__)
+
+# Objective function types of observed.txt
+GOAL_FUNCTIONS = {1: "mult", 2: "sum", 3: "r2", 4: "chi2", 5: "NS", 6: "br2", 7: "ssqr", 8: "PBIAS", 9: "KGE",
+                  10: "RSR", 11: "MNS"}
+# Goal function names written to goal.txt (type_of_goal_fn) by SUFI2_goal_fn.exe
+GOAL_FUNCTION_NAMES = {1: "Multiplicative_MSE", 2: "Summation_MSE", 3: "R2", 4: "Chi2", 5: "Nash_Sutcliff", 6: "bR2",
+                       7: "SSQR", 8: "PBIAS", 9: "KGE", 10: "RSR", 11: "MNS"}
+# Goal functions where bigger is better. The others are minimized
+MAXIMIZED_GOAL_FUNCTIONS = {"r2", "NS", "br2", "KGE", "MNS"}
+# Simulation number column of goal.txt (SUFI2_goal_fn.exe)
+SIMULATION_COLUMN = "Sim_No."
+
+
+def get_goal_function(name) -> str:
+    """ GOAL_FUNCTIONS name of a goal function given by its goal.txt name (Nash_Sutcliff, ...), its GOAL_FUNCTIONS
+    name (NS, ...) or its observed.txt number
+    """
+    key = str(name).strip().lower()
+    for goal_type, goal_function in GOAL_FUNCTIONS.items():
+        if key in (goal_function.lower(), GOAL_FUNCTION_NAMES[goal_type].lower(), str(goal_type)):
+            return goal_function
+    raise ValueError("Unknown goal function: " + str(name))
+
+
+def get_goal_layout(goal) -> dict:
+    """ Layout of a goal.txt as read by read_sufi2_out_goal, written by SUFI2_goal_fn.exe or ObjectiveEngine
+
+    Parameters
+    ----------
+    goal : (info, df) as read_sufi2_out_goal, compute_goal or ResultStore.read_goal
+
+    Returns
+    -------
+    dict with the 'goal_function' (GOAL_FUNCTIONS name), 'maximize', the 'simulation_column', the 'parameters'
+    columns, the 'simulations' (int array) and the 'goal' values (float array)
+    """
+    info, df = goal
+    if SIMULATION_COLUMN not in df.columns:
+        raise ValueError("Simulation column not found in goal.txt: " + str(list(df.columns)))
+    goal_function = get_goal_function(info["type_of_goal_fn"])
+    return {"goal_function": goal_function, "maximize": goal_function in MAXIMIZED_GOAL_FUNCTIONS,
+            "simulation_column": SIMULATION_COLUMN,
+            "parameters": [column for column in df.columns if column not in (SIMULATION_COLUMN, "goal_value")],
+            "simulations": df[SIMULATION_COLUMN].values.astype(int),
+            "goal": df["goal_value"].values.astype(numpy.float64)}
+
+
+def compute_objectives(observed, simulated, mns_power: float = 1.0) -> dict:
+    """ Computes the objective functions of all the simulations at once
+
+    Parameters
+    ----------
+    observed : (n_obs,) observed values
+    simulated : (n_sims, n_obs) simulated values aligned with the observations
+    mns_power : power of the modified Nash-Sutcliffe (MNS)
+
+    Returns
+    -------
+    dict objective name -> (n_sims,) array. Objectives: MSE, SSQ, SSQR, Chi2, R, R2, bR2, NS, MNS, PBIAS, KGE and
+    RSR. As in SUFI2_goal_fn.exe, SSQR is the mean of the squared differences of the sorted values and Chi2 uses the
+    sample variance of the observations
+    """
+    observed = numpy.asarray(observed, dtype=numpy.float64)
+    simulated = numpy.atleast_2d(numpy.asarray(simulated, dtype=numpy.float64))
+    n = observed.size
+    observed_mean = observed.mean()
+    observed_anomaly = observed - observed_mean
+    observed_ss = numpy.sum(observed_anomaly ** 2)
+    residual = simulated - observed
+    ssq = numpy.sum(residual ** 2, axis=1)
+
+    simulated_mean = simulated.mean(axis=1)
+    simulated_anomaly = simulated - simulated_mean[:, None]
+    simulated_ss = numpy.sum(simulated_anomaly ** 2, axis=1)
+    covariance = simulated_anomaly @ observed_anomaly
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        r = covariance / numpy.sqrt(observed_ss * simulated_ss)
+        r2 = r ** 2
+        # Slope of the regression line between observed and simulated values
+        b = covariance / observed_ss
+        br2 = numpy.where(numpy.abs(b) <= 1, numpy.abs(b) * r2, r2 / numpy.abs(b))
+        ns = 1 - ssq / observed_ss
+        mns = 1 - (numpy.sum(numpy.abs(residual) ** mns_power, axis=1) /
+                   numpy.sum(numpy.abs(observed_anomaly) ** mns_power))
+        pbias = 100 * numpy.sum(observed - simulated, axis=1) / observed.sum()
+        alpha = numpy.sqrt(simulated_ss / observed_ss)
+        beta = simulated_mean / observed_mean
+        kge = 1 - numpy.sqrt((r - 1) ** 2 + (alpha - 1) ** 2 + (beta - 1) ** 2)
+        rsr = numpy.sqrt(ssq) / numpy.sqrt(observed_ss)
+        chi2 = ssq / (observed_ss / (n - 1))
+    ssqr = numpy.mean((numpy.sort(simulated, axis=1) - numpy.sort(observed)) ** 2, axis=1)
+    return {"MSE": ssq / n, "SSQ": ssq, "SSQR": ssqr, "Chi2": chi2, "R": r, "R2": r2, "bR2": br2, "NS": ns,
+            "MNS": mns, "PBIAS": pbias, "KGE": kge, "RSR": rsr}
+
+
+def combine_goal(objectives, weights, goal_type: int):
+    """ Combines the objectives of several variables into the SUFI2 goal function, as SUFI2_goal_fn.exe does
+
+    mult is the MSE of a single variable, and the product of the MSE / 1000 of the variables with several. The other
+    goal functions are weighted means of the objectives of the variables (sum of the MSE, PBIAS with its sign). A
+    variable with a negative correlation counts as 0 in r2, br2 and KGE.
+
+    Parameters
+    ----------
+    objectives : list with the compute_objectives result of each variable
+    weights : weight of each variable
+    goal_type : objective function type (see GOAL_FUNCTIONS)
+
+    Returns
+    -------
+    (n_sims,) goal values
+    """
+    name = GOAL_FUNCTIONS[goal_type]
+    weights = numpy.asarray(weights, dtype=numpy.float64)
+    if name == "mult":
+        if len(objectives) == 1:
+            return objectives[0]["MSE"]
+        return numpy.prod([objective["MSE"] / 1000.0 for objective in objectives], axis=0)
+    key = {"sum": "MSE", "r2": "R2", "chi2": "Chi2", "NS": "NS", "br2": "bR2", "ssqr": "SSQR", "PBIAS": "PBIAS",
+           "KGE": "KGE", "RSR": "RSR", "MNS": "MNS"}[name]
+    values = numpy.array([objective[key] for objective in objectives])
+    if name in ("r2", "br2", "KGE"):
+        values = numpy.where(numpy.array([objective["R"] for objective in objectives]) < 0, 0.0, values)
+    return numpy.sum(weights[:, None] * values, axis=0) / weights.sum()
+
+
+class ObjectiveEngine(object):
+    """
+    Vectorized replacement of SUFI2_goal_fn.exe. The observed file is parsed once, the simulated values are aligned
+    with the observations by time step number and the objectives of all the simulations are computed at once.
+    """
+
+    def __init__(self, project_path: str, observed_file: str = "observed.txt", goal_type: int = None,
+                 mns_power: float = None):
+        """
+        Parameters
+        ----------
+        project_path : project folder
+        observed_file : observed file in SUFI2.IN (observed.txt, observed_rch.txt, observed_sub.txt, ...)
+        goal_type : objective function type (see GOAL_FUNCTIONS). Taken from the observed file if None
+        mns_power : power of the modified NS. Taken from the observed file if None
+        """
+        self.project_path = project_path
+        self.observed = sufi2files.read_observed(os.path.join(project_path, "SUFI2.IN", observed_file))
+        self.goal_type = goal_type if goal_type is not None else self.observed["goal_type"]
+        if self.goal_type not in GOAL_FUNCTIONS:
+            raise ValueError("Invalid objective function type: " + str(self.goal_type))
+        self.mns_power = mns_power if mns_power is not None else (self.observed["mns_power"] or 1.0)
+        self.variables = self.observed["variables"]
+
+    def get_goal_name(self) -> str:
+        return GOAL_FUNCTIONS[self.goal_type]
+
+    def is_maximized(self) -> bool:
+        return self.get_goal_name() in MAXIMIZED_GOAL_FUNCTIONS
+
+    def get_var_file_name(self, variable: dict) -> str:
+        return variable["name"] + ".txt"
+
+    @staticmethod
+    def align(variable: dict, time_steps, values):
+        """ Returns the (n_sims, n_obs) simulated values at the observed time steps """
+        positions = numpy.searchsorted(time_steps, variable["index"])
+        if numpy.any(positions >= len(time_steps)) or numpy.any(time_steps[positions] != variable["index"]):
+            raise ValueError("Observed time steps of " + variable["name"] + " not found in the simulated values")
+        return values[:, positions]
+
+    def load(self, dtype=numpy.float64):
+        """ Reads the var files of the observed variables
+
+        Returns
+        -------
+        dict variable name -> (simulations, time_steps, values)
+        """
+        out_folder = os.path.join(self.project_path, "SUFI2.OUT")
+        return {variable["name"]: read_sufi2_var_array(os.path.join(out_folder, self.get_var_file_name(variable)),
+                                                       dtype)
+                for variable in self.variables}
+
+    def evaluate(self, series: dict = None):
+        """ Computes the objectives of every variable and the goal function
+
+        Parameters
+        ----------
+        series : dict variable name -> (simulations, time_steps, values). Read from the var files if None
+
+        Returns
+        -------
+        (simulations, objectives, goal). objectives is a dict variable name -> compute_objectives result
+        """
+        if series is None:
+            series = self.load()
+        simulations = None
+        objectives = {}
+        for variable in self.variables:
+            variable_simulations, time_steps, values = series[variable["name"]]
+            if simulations is None:
+                simulations = variable_simulations
+            elif not numpy.array_equal(simulations, variable_simulations):
+                raise ValueError("Var files have different simulations: " + variable["name"])
+            objectives[variable["name"]] = compute_objectives(variable["values"],
+                                                              self.align(variable, time_steps, values),
+                                                              self.mns_power)
+        goal = combine_goal([objectives[variable["name"]] for variable in self.variables],
+                            [variable["weight"] for variable in self.variables], self.goal_type)
+        return simulations, objectives, goal
+
+    def write_goal(self, simulations, goal):
+        """ Writes SUFI2.OUT/goal.txt with the parameters of par_val.txt and returns it as read_sufi2_out_goal """
+        names, ranges, simulation_number = sufi2files.read_par_inf(self.project_path)
+        par_simulations, par_values = sufi2files.read_par_val(self.project_path)
+        rows = numpy.searchsorted(par_simulations, simulations)
+        if numpy.any(rows >= len(par_simulations)) or numpy.any(par_simulations[rows] != simulations):
+            raise ValueError("Simulations not found in par_val.txt")
+        values = par_values[rows, :len(names)]
+        goal_name = GOAL_FUNCTION_NAMES[self.goal_type]
+        sufi2files.write_goal(self.project_path, names, simulations, values, goal, goal_name)
+        info = {"no_pars": len(names), "no_sims": len(simulations), "type_of_goal_fn": goal_name}
+        df = pd.DataFrame(numpy.column_stack((simulations, values, goal)),
+                          columns=[SIMULATION_COLUMN] + list(names) + ["goal_value"])
+        df[SIMULATION_COLUMN] = df[SIMULATION_COLUMN].astype(int)
+        return info, df
@@ -0,0 +1,218 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from swatcuppython import sufi2files
+from swatcuppython.workspace import WorkspaceProvisioner
+from swatcuppython.asyncrunner import AsyncSUFI2Runner, run_concurrently
+from swatcuppython.checkpoint import CheckpointRunner, RunCheckpoint, par_val_fingerprint, CHECKPOINT_FILE
+
+logger = logging.getLogger(__name__)
+
+
+class ParallelRunner(object):
+    """
+    Runs the SUFI2 simulations of a project in parallel. The simulation range of SUFI2_swEdit.def is split across
+    N process folders (swatcuppython/processK), each one provisioned from the project by WorkspaceProvisioner.
+    SUFI2_execute.exe (or SUFI2_Run.bat in Windows) is executed in every folder, and the SUFI2.OUT var files and
+    goal.txt are merged back into the project in simulation order.
+    """
+
+    def __init__(self, wrapper, project_folder_path: str, base_folder_path: str, process_number: int,
+                 provisioner: WorkspaceProvisioner = None):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module used to run the simulations
+        project_folder_path : SWAT-CUP project folder
+        base_folder_path : folder where the process folders are created (swatcuppython folder)
+        process_number : number of parallel processes
+        provisioner : provisioner used to create the process folders
+        """
+        if not isinstance(process_number, int) or process_number < 1:
+            raise ValueError("Process number should be a positive Int")
+        self.wrapper = wrapper
+        self.project_folder_path = project_folder_path
+        self.base_folder_path = base_folder_path
+        self.process_number = process_number
+        if provisioner is None:
+            provisioner = WorkspaceProvisioner(project_folder_path, exclude=[os.path.basename(base_folder_path)])
+        self.provisioner = provisioner
+
+    def get_process_folder_path(self, process: int) -> str:
+        if isinstance(process, int):
+            if 0 <= process < self.process_number:
+                return os.path.join(self.base_folder_path, "process" + str(process))
+            else:
+                raise ValueError("Process out of range: (0: " + str(self.process_number - 1) + ")")
+        else:
+            raise ValueError("Process should be an Int type")
+
+    @staticmethod
+    def split_range(start: int, end: int, parts: int):
+        """ Splits the simulation range [start, end] in up to 'parts' contiguous ranges of similar size """
+        total = end - start + 1
+        parts = min(parts, total)
+        ranges = []
+        first = start
+        for i in range(parts):
+            size = total // parts + (1 if i < total % parts else 0)
+            ranges.append((first, first + size - 1))
+            first += size
+        return ranges
+
+    def sync_process(self, process: int):
+        """ Provisions the project into the process folder. SUFI2.OUT is created empty. """
+        process_folder = self.get_process_folder_path(process)
+        logger.debug("Sync process: " + str(process) + " -> " + process_folder)
+        return self.provisioner.provision(process_folder)
+
+    def sync_processes(self):
+        for process in range(self.process_number):
+            self.sync_process(process)
+
+    def provision_processes(self, ranges):
+        """ Provisions a process folder for each simulation range and writes the range to its SUFI2_swEdit.def """
+        for process, (first, last) in enumerate(ranges):
+            self.sync_process(process)
+            sufi2files.write_swedit_def(self.get_process_folder_path(process), first, last)
+
+    def run(self):
+        """ Runs the simulation range of SUFI2_swEdit.def in parallel and merges the results into the project. If a
+        process folder failed (see get_process_errors) nothing is merged and ValueError is raised
+
+        Returns
+        -------
+        list with the return code of each process
+        """
+        start, end = sufi2files.read_swedit_def(self.project_folder_path)
+        ranges = self.split_range(start, end, self.process_number)
+        logger.info("Running simulations " + str(start) + "-" + str(end) + " in " + str(len(ranges)) + " processes")
+        self.provision_processes(ranges)
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            # The simulations run in their own OS processes, so threads are enough to drive them
+            futures = [executor.submit(self.wrapper.sufi2_run, self.get_process_folder_path(process))
+                       for process in range(len(ranges))]
+            return_codes = [future.result() for future in futures]
+
+        self.check_processes(ranges, return_codes)
+        self.merge(len(ranges))
+        return return_codes
+
+    def get_process_errors(self, ranges, return_codes) -> dict:
+        """ Checks the run of every process folder: its return code and a complete block of each simulation of its
+        range in every var file
+
+        Returns
+        -------
+        dict process -> error of the processes that failed
+        """
+        names = sufi2files.read_var_file_names(self.project_folder_path)
+        errors = {}
+        for process, ((first, last), return_code) in enumerate(zip(ranges, return_codes)):
+            if return_code is not None and return_code != 0:
+                errors[process] = "return code " + str(return_code)
+                continue
+            out_folder = os.path.join(self.get_process_folder_path(process), "SUFI2.OUT")
+            for name in names:
+                file = os.path.join(out_folder, name)
+                blocks = sufi2files.read_sufi2_var_blocks(file) if os.path.isfile(file) else []
+                missing = set(range(first, last + 1)) - set(simulation for simulation, block in blocks)
+                if missing:
+                    errors[process] = str(len(missing)) + " simulations missing in " + name
+                    break
+                # A killed run leaves the last block short
+                if len(set(block.count(b"\n") for simulation, block in blocks)) > 1:
+                    errors[process] = "incomplete blocks in " + name
+                    break
+        return errors
+
+    def check_processes(self, ranges, return_codes):
+        """ Raises ValueError if any process folder failed (see get_process_errors), so nothing is merged """
+        errors = self.get_process_errors(ranges, return_codes)
+        if errors:
+            message = "; ".join("process " + str(process) + ": " + error for process, error in sorted(errors.items()))
+            logger.error("Parallel run failed, results not merged: " + message)
+            raise ValueError("Parallel run failed, results not merged: " + message)
+
+    def run_checkpointed(self, interval: float = 5.0):
+        """ Runs the simulation range like run, with a CheckpointRunner in every process folder. A process folder with
+        a checkpoint of the same parameter sets and range is resumed: it is not provisioned again and only its missing
+        simulations run.
+
+        Parameters
+        ----------
+        interval : seconds between checkpoint updates
+
+        Returns
+        -------
+        list with the result of each process (see CheckpointRunner.run)
+        """
+        start, end = sufi2files.read_swedit_def(self.project_folder_path)
+        ranges = self.split_range(start, end, self.process_number)
+        fingerprint = par_val_fingerprint(self.project_folder_path)
+        for process, (first, last) in enumerate(ranges):
+            process_folder = self.get_process_folder_path(process)
+            state = RunCheckpoint(process_folder).read() if os.path.isdir(process_folder) else None
+            if state is not None and state["par_val"] == fingerprint and \
+                    (state["start"], state["end"]) == (first, last):
+                logger.info("Resuming process " + str(process) + ": " + str(len(state["completed"])) +
+                            " simulations recorded")
+                continue
+            self.sync_process(process)
+            sufi2files.write_swedit_def(process_folder, first, last)
+            # A checkpoint of the project folder is not one of the process
+            if os.path.isfile(os.path.join(process_folder, CHECKPOINT_FILE)):
+                os.remove(os.path.join(process_folder, CHECKPOINT_FILE))
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(CheckpointRunner(self.wrapper, self.get_process_folder_path(process),
+                                                        interval).run) for process in range(len(ranges))]
+            results = [future.result() for future in futures]
+
+        self.merge(len(ranges))
+        return results
+
+    async def run_async(self, output_callback=None):
+        """ Coroutine version of run: the process folders run as asyncio subprocesses. Cancelling it kills the
+        simulations of every process folder.
+
+        Parameters
+        ----------
+        output_callback : function(folder_path, line) called with each output line. See AsyncSUFI2Runner
+
+        Returns
+        -------
+        list with the return code of each process. Raises ValueError like run if a process folder failed
+        """
+        start, end = sufi2files.read_swedit_def(self.project_folder_path)
+        ranges = self.split_range(start, end, self.process_number)
+        logger.info("Running simulations " + str(start) + "-" + str(end) + " in " + str(len(ranges)) + " processes")
+        # Provisioning and merging are file copies: they run in a thread so the event loop keeps running
+        await asyncio.to_thread(self.provision_processes, ranges)
+
+        runners = [AsyncSUFI2Runner(self.wrapper, self.get_process_folder_path(process), output_callback)
+                   for process in range(len(ranges))]
+        return_codes = [codes[0] for codes in await run_concurrently(runners, ("run",))]
+        await asyncio.to_thread(self.check_processes, ranges, return_codes)
+        await asyncio.to_thread(self.merge, len(ranges))
+        return return_codes
+
+    def merge(self, processes: int = None):
+        """ Merges the SUFI2.OUT var files and goal.txt of the process folders into the project SUFI2.OUT """
+        if processes is None:
+            processes = self.process_number
+        process_out_folders = [os.path.join(self.get_process_folder_path(process), "SUFI2.OUT")
+                               for process in range(processes)]
+        out_folder = os.path.join(self.project_folder_path, "SUFI2.OUT")
+        for file_name in self.wrapper.read_sufi2_var_file_name(self.project_folder_path):
+            if not file_name:
+                continue
+            logger.debug("Merging var file: " + file_name)
+            sufi2files.merge_sufi2_var_files([os.path.join(folder, file_name) for folder in process_out_folders],
+                                             os.path.join(out_folder, file_name))
+        goal_files = [os.path.join(folder, sufi2files.GOAL_FILE) for folder in process_out_folders]
+        if all(os.path.isfile(file) for file in goal_files):
+            logger.debug("Merging goal file")
+            sufi2files.merge_goal_files(goal_files, os.path.join(out_folder, sufi2files.GOAL_FILE))
@@ -0,0 +1,255 @@
+import os
+import logging
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.objectives import compute_objectives, get_goal_layout
+from swatcuppython.varfile import read_sufi2_var_array, iter_sufi2_var_chunks
+
+logger = logging.getLogger(__name__)
+
+# Histogram of the values of a time step across the simulations in SUFI2_95ppu.exe
+PPU_BINS = 10
+PPU_LIMITS = (2.5, 97.5)
+# Tolerance of SUFI2_95ppu.exe when it counts the values below a histogram edge
+PPU_TOLERANCE = 1e-7
+
+
+def p_factor(observed, lower, upper, error: float = None) -> float:
+    """ Fraction of the observations inside the 95PPU band. NaN observations are ignored
+
+    As SUFI2_95ppu.exe, the band of each observation is widened by its measurement error (percentage of measurement
+    error of observed.txt): L95PPU - error / 100 * observed <= observed <= U95PPU + error / 100 * observed
+    """
+    observed = numpy.asarray(observed, dtype=numpy.float64)
+    valid = ~numpy.isnan(observed)
+    if not valid.any():
+        return numpy.nan
+    observed, lower, upper = observed[valid], lower[valid], upper[valid]
+    margin = 0.01 * (error or 0.0) * observed
+    inside = (observed >= lower - margin) & (observed <= upper + margin)
+    return float(inside.mean())
+
+
+def r_factor(observed, lower, upper) -> float:
+    """ Mean width of the 95PPU band divided by the standard deviation of the observations. As SUFI2_95ppu.exe, the
+    population standard deviation is used and the width is not scaled up when n * std is below 1
+    """
+    observed = numpy.asarray(observed, dtype=numpy.float64)
+    valid = ~numpy.isnan(observed)
+    if valid.sum() < 2:
+        return numpy.nan
+    scale = max(valid.sum() * numpy.std(observed[valid]), 1.0)
+    return float(numpy.sum(upper[valid] - lower[valid]) / scale)
+
+
+class PPUHistogram(object):
+    """
+    95PPU band of SUFI2_95ppu.exe, per time step. The values of a time step across the simulations go in a histogram
+    of PPU_BINS bins between their min and max; L95PPU and U95PPU are interpolated in the cumulative histogram at 2.5%
+    and 97.5% and M95PPU is the mean of the values.
+
+    Values are added in chunks of simulations in two passes: the first one finds the range, sum and count of each time
+    step, the second one counts the values below each histogram edge. The band only depends on these sums, so it is
+    the same whether the simulations are added at once or chunk by chunk, and the memory does not depend on the number
+    of simulations.
+    """
+
+    def __init__(self, n_steps: int, bins: int = PPU_BINS):
+        self.n_steps = n_steps
+        self.bins = bins
+        self.minimum = numpy.full(n_steps, numpy.inf)
+        self.maximum = numpy.full(n_steps, -numpy.inf)
+        self.total = numpy.zeros(n_steps)
+        self.count = 0
+        self.below = None
+
+    def update_range(self, values):
+        """ First pass: values is a (n_sims_chunk, n_steps) array """
+        if values.size:
+            self.minimum = numpy.minimum(self.minimum, values.min(axis=0))
+            self.maximum = numpy.maximum(self.maximum, values.max(axis=0))
+            self.total += values.sum(axis=0)
+            self.count += len(values)
+
+    def get_edges(self):
+        """ (bins - 1, n_steps) inner edges of the histograms. The last edge is the max """
+        width = (self.maximum - self.minimum) / self.bins
+        return self.minimum + numpy.arange(1, self.bins)[:, None] * width
+
+    def update_histogram(self, values):
+        """ Second pass: values is a (n_sims_chunk, n_steps) array """
+        if self.below is None:
+            self.below = numpy.zeros((self.bins - 1, self.n_steps), dtype=numpy.int64)
+        if not values.size:
+            return
+        for i, edge in enumerate(self.get_edges()):
+            self.below[i] += numpy.count_nonzero(values <= edge + PPU_TOLERANCE, axis=0)
+
+    def band(self):
+        """ Returns the (3, n_steps) array of the L95PPU, M95PPU and U95PPU """
+        mean = self.total / self.count
+        width = (self.maximum - self.minimum) / self.bins
+        # Cumulative percentage of the values at the edges 0..bins
+        cumulative = numpy.vstack([numpy.zeros(self.n_steps), 100.0 * self.below / self.count,
+                                   numpy.full(self.n_steps, 100.0)])
+        # SUFI2_95ppu.exe interpolates between the bin centers, starting at min: min, min + w / 2, min + 3 w / 2, ...
+        centers = numpy.vstack([self.minimum, self.minimum + width / 2 + numpy.arange(self.bins)[:, None] * width])
+        steps = numpy.arange(self.n_steps)
+        result = [None, mean, None]
+        for position, limit in zip((0, 2), PPU_LIMITS):
+            # First edge where the cumulative percentage reaches the limit
+            i = numpy.maximum(numpy.argmax(cumulative >= limit, axis=0), 1)
+            before = cumulative[i - 1, steps]
+            step = cumulative[i, steps] - before
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                slope = step / (centers[i, steps] - centers[i - 1, steps])
+                result[position] = centers[i - 1, steps] + (limit - before) / slope
+        lower, upper = result[0], result[2]
+        # Same value in every simulation
+        constant = width == 0
+        lower[constant] = mean[constant]
+        upper[constant] = mean[constant]
+        return numpy.vstack([lower, mean, upper])
+
+
+class PPUCalculator(object):
+    """
+    Computes the 95PPU band, the P-factor and the R-factor of every observed variable at its observations, in place
+    of SUFI2_95ppu.exe and SUFI2_95ppu_beh.exe, with the same band (see PPUHistogram) and output files.
+
+    In memory mode the var files are read at once. In out of core mode the var files are read in chunks, so the
+    memory does not depend on the number of simulations. Both give the same band (up to the rounding of the sums).
+    """
+
+    def __init__(self, project_path: str, observed_file: str = "observed.txt", out_of_core: bool = False,
+                 chunk_size: int = 64 * 1024 * 1024):
+        """
+        Parameters
+        ----------
+        project_path : project folder
+        observed_file : observed file in SUFI2.IN
+        out_of_core : reads the var files in chunks
+        chunk_size : bytes read per chunk in out of core mode
+        """
+        self.project_path = project_path
+        self.observed = sufi2files.read_observed(os.path.join(project_path, "SUFI2.IN", observed_file))
+        self.out_of_core = out_of_core
+        self.chunk_size = chunk_size
+
+    def get_behavioral_simulations(self, goal, threshold: float = None):
+        """ Returns the simulations of goal.txt that reach the behavioral threshold
+
+        Parameters
+        ----------
+        goal : (info, df) as read_sufi2_out_goal or compute_goal
+        threshold : behavioral threshold. Taken from the observed file if None
+        """
+        if threshold is None:
+            threshold = self.observed["threshold"]
+        layout = get_goal_layout(goal)
+        behavioral = layout["goal"] >= threshold if layout["maximize"] else layout["goal"] <= threshold
+        return layout["simulations"][behavioral]
+
+    def compute(self, simulations=None, best_simulation: int = None) -> dict:
+        """ Computes the 95PPU of every observed variable
+
+        Parameters
+        ----------
+        simulations : simulations included in the band (ex: behavioral ones). All if None
+        best_simulation : simulation written in the Best_Sim column. NaN if None
+
+        Returns
+        -------
+        dict variable name -> dict with the 'time_steps' of the observations, 'observed', 'L95PPU', 'M95PPU',
+        'U95PPU', 'best_sim', 'p_factor', 'r_factor' and the 'R2' and 'NS' of the best simulation
+        """
+        results = {}
+        for variable in self.observed["variables"]:
+            file_path = os.path.join(self.project_path, "SUFI2.OUT", variable["name"] + ".txt")
+            if self.out_of_core:
+                time_steps, histogram, best = self._compute_out_of_core(file_path, simulations, best_simulation)
+            else:
+                time_steps, histogram, best = self._compute_in_memory(file_path, simulations, best_simulation)
+            # Band at the observations (NaN where the var file lacks the time step)
+            positions = numpy.minimum(numpy.searchsorted(time_steps, variable["index"]), len(time_steps) - 1)
+            found = time_steps[positions] == variable["index"]
+            if not found.all():
+                logger.warning(str(int((~found).sum())) + " observations of " + variable["name"] +
+                               " are not in " + file_path)
+            observed = numpy.where(found, variable["values"], numpy.nan)
+            lower, median, upper = numpy.where(found, histogram.band()[:, positions], numpy.nan)
+            best = numpy.where(found, best[positions], numpy.nan) if best is not None else numpy.full(len(found),
+                                                                                                      numpy.nan)
+            statistics = {"R2": numpy.nan, "NS": numpy.nan}
+            if found.any() and not numpy.isnan(best).any():
+                objectives = compute_objectives(variable["values"][found], best[found][None, :])
+                statistics = {key: float(objectives[key][0]) for key in statistics}
+            results[variable["name"]] = {"time_steps": variable["index"], "observed": observed, "L95PPU": lower,
+                                         "M95PPU": median, "U95PPU": upper, "best_sim": best,
+                                         "p_factor": p_factor(observed, lower, upper, variable["error"]),
+                                         "r_factor": r_factor(observed, lower, upper), **statistics}
+        return results
+
+    @staticmethod
+    def _select(file_simulations, values, simulations, best_simulation):
+        best = None
+        if best_simulation is not None:
+            rows = numpy.flatnonzero(file_simulations == best_simulation)
+            if rows.size:
+                best = values[rows[0]].astype(numpy.float64)
+        if simulations is not None:
+            values = values[numpy.isin(file_simulations, simulations)]
+        return values, best
+
+    def _compute_in_memory(self, file_path, simulations, best_simulation):
+        file_simulations, time_steps, values = read_sufi2_var_array(file_path)
+        values, best = self._select(file_simulations, values, simulations, best_simulation)
+        if not len(values):
+            raise ValueError("No simulations to compute the 95PPU: " + file_path)
+        histogram = PPUHistogram(len(time_steps))
+        histogram.update_range(values)
+        histogram.update_histogram(values)
+        return time_steps, histogram, best
+
+    def _compute_out_of_core(self, file_path, simulations, best_simulation):
+        histogram = None
+        time_steps = None
+        best = None
+        for update in ("update_range", "update_histogram"):
+            for file_simulations, chunk_time_steps, values in iter_sufi2_var_chunks(file_path, self.chunk_size):
+                if histogram is None:
+                    time_steps = chunk_time_steps
+                    histogram = PPUHistogram(len(time_steps))
+                values, chunk_best = self._select(file_simulations, values, simulations, best_simulation)
+                if chunk_best is not None:
+                    best = chunk_best
+                getattr(histogram, update)(values)
+        if histogram is None or not histogram.count:
+            raise ValueError("No simulations to compute the 95PPU: " + file_path)
+        return time_steps, histogram, best
+
+    def write(self, results: dict, file_name: str = "95ppu.txt", g_file_name: str = "95ppu_g.txt"):
+        """ Writes the 95PPU results in SUFI2.OUT in the layout of SUFI2_95ppu.exe: file_name has one block per
+        variable with its band and statistics, g_file_name the bands of all the variables for plotting
+
+        Returns
+        -------
+        path of file_name
+        """
+        out_path = os.path.join(self.project_path, "SUFI2.OUT")
+        with open(os.path.join(out_path, file_name), "w") as fo:
+            for name, result in results.items():
+                fo.write(" " + name + "\n")
+                fo.write("observed          L95PPU         U95PPU         Best_Sim       M95PPU\n")
+                for row in zip(result["observed"], result["L95PPU"], result["U95PPU"], result["best_sim"],
+                               result["M95PPU"]):
+                    fo.write(" ".join("{:<15f}".format(value) for value in row) + "\n")
+                fo.write("\np-factor= {:.2f}\nr-factor= {:.2f}\nR2= {:.2f}\nNash_Sutclif= {:.2f}\n\n\n".format(
+                    result["p_factor"], result["r_factor"], result["R2"], result["NS"]))
+        with open(os.path.join(out_path, g_file_name), "w") as fo:
+            fo.write("Stname  observed          L95PPU          U95PPU        Best_Sim\n")
+            for name, result in results.items():
+                for row in zip(result["observed"], result["L95PPU"], result["U95PPU"], result["best_sim"]):
+                    fo.write(name + "     " + " ".join("{:<15f}".format(value) for value in row) + "\n")
+        return os.path.join(out_path, file_name)
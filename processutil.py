@@ -0,0 +1,37 @@
+import os
+import signal
+import logging
+import platform
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+def new_process_group_kwargs(new_console: bool = False) -> dict:
+    """ Popen / create_subprocess_exec keyword arguments that start the process in its own process group, so the
+    whole tree (the .bat and the exes it starts) can be killed with kill_process_tree
+
+    Parameters
+    ----------
+    new_console : opens a new console window in Windows (SWAT_Edit.exe needs it)
+    """
+    if platform.system() == "Windows":
+        flags = subprocess.CREATE_NEW_PROCESS_GROUP
+        if new_console:
+            flags |= subprocess.CREATE_NEW_CONSOLE
+        return {"creationflags": flags}
+    return {"start_new_session": True}
+
+
+def kill_process_tree(pid: int):
+    """ Kills a process started with new_process_group_kwargs and all its children """
+    logger.debug("Killing process tree: " + str(pid))
+    if platform.system() == "Windows":
+        subprocess.call(["taskkill", "/F", "/T", "/PID", str(pid)], stdout=subprocess.DEVNULL,
+                        stderr=subprocess.DEVNULL)
+        return
+    try:
+        os.killpg(os.getpgid(pid), signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        # Already finished
+        pass
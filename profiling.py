@@ -0,0 +1,470 @@
+import os
+import sys
+import json
+import time
+import logging
+import threading
+import subprocess
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import pandas as pd
+from swatcuppython import sufi2files
+from swatcuppython.processutil import new_process_group_kwargs, kill_process_tree
+from swatcuppython.capture import OutputCapture, CapturedProcess
+
+logger = logging.getLogger(__name__)
+
+# Kinds of the profile records
+STAGE = "stage"
+EXECUTABLE = "executable"
+SECTION = "section"
+
+# Measures of the profile records
+MEASURES = ("wall_time", "cpu_time", "peak_rss", "read_bytes", "write_bytes")
+
+# Extensions of the SWAT-CUP executables, to name the processes started through an interpreter (the .bat files run
+# with /bin/sh in linux, the .exe files may run with wine)
+EXECUTABLE_EXTENSIONS = (".exe", ".bat")
+
+
+def _read_proc_io(path: str):
+    """ (rchar, wchar) of a /proc io file, or None """
+    try:
+        with open(path, "r") as fo:
+            fields = dict(line.split(":", 1) for line in fo if ":" in line)
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _read_peak_rss(pid: int):
+    """ Peak resident set size in bytes (VmHWM) of a process, or None """
+    try:
+        with open("/proc/" + str(pid) + "/status", "r") as fo:
+            for line in fo:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _get_process_name(pid: int, comm: str) -> str:
+    """ Executable name of a process: the first .exe or .bat of its command line, or its program """
+    try:
+        with open("/proc/" + str(pid) + "/cmdline", "rb") as fo:
+            args = [arg.decode(errors="replace") for arg in fo.read().split(b"\0") if arg]
+    except OSError:
+        args = []
+    if not args:
+        return comm
+    for arg in args[:2]:
+        if arg.lower().endswith(EXECUTABLE_EXTENSIONS):
+            return os.path.basename(arg)
+    return os.path.basename(args[0])
+
+
+class ProcessGroupMonitor(object):
+    """
+    Samples /proc (linux) for the processes of a process group while it runs, so the executables started by a
+    SUFI2 stage (SWAT_Edit.exe, swat.exe, the extract and goal executables) are measured one by one. Each process
+    gets its start time, CPU time, peak RSS (VmHWM) and the bytes read and written through read/write calls
+    (rchar/wchar, page cache included) of its last sample. Processes shorter than the sampling interval may be missed
+    and the last interval of each process is not measured.
+    """
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def __init__(self, process_group: int, interval: float = 0.1, folder_path: str = None, on_start=None,
+                 on_end=None):
+        """
+        Parameters
+        ----------
+        process_group : process group id (the pid of a process started with new_process_group_kwargs)
+        interval : seconds between samples
+        folder_path : project folder. The simulation of each process is read from its SUFI2.IN/trk.txt if given
+        on_start : function(process) called when a process is first seen
+        on_end : function(process) called when a process is gone, with its last sample
+        """
+        self.process_group = process_group
+        self.interval = interval
+        self.folder_path = folder_path
+        self.on_start = on_start
+        self.on_end = on_end
+        self.processes = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def is_supported() -> bool:
+        return os.path.isdir("/proc/self") and os.path.isfile("/proc/uptime")
+
+    def _read_simulation(self):
+        if self.folder_path is None:
+            return None
+        try:
+            return sufi2files.read_trk(self.folder_path)
+        except (OSError, ValueError):
+            return None
+
+    def sample(self):
+        """ Reads the processes of the group once, ending the ones that are gone """
+        now = time.time()
+        with open("/proc/uptime", "r") as fo:
+            uptime = float(fo.read().split()[0])
+        seen = set()
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/" + entry + "/stat", "r") as fo:
+                    stat = fo.read()
+            except OSError:
+                continue
+            comm = stat[stat.find("(") + 1:stat.rfind(")")]
+            fields = stat[stat.rfind(")") + 2:].split()
+            if int(fields[2]) != self.process_group:
+                continue
+            pid = int(entry)
+            key = (pid, int(fields[19]))
+            seen.add(key)
+            process = self.processes.get(key)
+            if process is None:
+                process = {"pid": pid, "name": _get_process_name(pid, comm), "simulation": self._read_simulation(),
+                           "start": now - (uptime - int(fields[19]) / self.CLOCK_TICKS), "cpu_time": 0.0,
+                           "peak_rss": None, "read_bytes": None, "write_bytes": None}
+                self.processes[key] = process
+                if self.on_start is not None:
+                    self.on_start(process)
+            # Forked processes get their name when they exec
+            process["name"] = _get_process_name(pid, comm)
+            process["end"] = now
+            process["cpu_time"] = (int(fields[11]) + int(fields[12])) / self.CLOCK_TICKS
+            peak_rss = _read_peak_rss(pid)
+            if peak_rss is not None:
+                process["peak_rss"] = max(peak_rss, process["peak_rss"] or 0)
+            io = _read_proc_io("/proc/" + entry + "/io")
+            if io is not None:
+                process["read_bytes"], process["write_bytes"] = io
+        for key in [key for key in self.processes if key not in seen and "ended" not in self.processes[key]]:
+            self._end(self.processes[key])
+
+    def _end(self, process: dict):
+        process["ended"] = True
+        process["wall_time"] = process["end"] - process["start"]
+        if self.on_end is not None:
+            self.on_end(process)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.sample()
+            except Exception:
+                logger.exception("Process group " + str(self.process_group) + " sample failed")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="profiler-" + str(self.process_group), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stops sampling and ends the processes still running """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for process in self.processes.values():
+            if "ended" not in process:
+                self._end(process)
+
+
+class Profiler(object):
+    """
+    Records the wall time, CPU time, peak RSS and bytes read/written of the SUFI2 stages and of each executable they
+    start, per simulation. Attach it with SWATCUP.set_profiler: the wrappers then run sufi2_pre/run/post and the
+    single executables (sufi2_goal_fn, sufi2_95ppu, ...) through run_stage / run_executable.
+
+    Each measure is a record (dict) with the 'kind' (STAGE, EXECUTABLE or SECTION), the 'name' (stage, executable
+    or section name), the 'stage', 'folder' and 'simulation' it belongs to, 'start' and 'end' (epoch seconds) and the
+    MEASURES (None when not available). The records are kept in memory (records, to_dataframe, summary,
+    get_simulations), appended to a JSON lines trace file and summed in a Prometheus text file
+    (node_exporter textfile collector format). Hooks are called with ('start' or 'end', record).
+
+    The CPU time of the stages is measured exactly with os.wait4 (whole process tree). The executables are sampled
+    from /proc (see ProcessGroupMonitor), so they are only measured in linux, and the peak RSS of a stage is the
+    largest peak RSS (VmHWM) of its processes.
+    """
+    METRIC_PREFIX = "swatcuppython"
+
+    def __init__(self, trace_path: str = None, prometheus_path: str = None, interval: float = 0.1,
+                 monitor_executables: bool = True, echo_output: bool = False):
+        """
+        Parameters
+        ----------
+        trace_path : JSON lines file the records are appended to. No trace if None
+        prometheus_path : Prometheus text file rewritten after each stage and executable. Not written if None
+        interval : seconds between the /proc samples of the running executables
+        monitor_executables : measures the executables started by the stages (linux)
+        echo_output : writes the output of the stages to stdout
+        """
+        self.trace_path = trace_path
+        self.prometheus_path = prometheus_path
+        self.interval = interval
+        self.monitor_executables = monitor_executables and ProcessGroupMonitor.is_supported()
+        self.echo_output = echo_output
+        self.records = []
+        self.hooks = []
+        self._totals = {}
+        self._lock = threading.RLock()
+
+    def add_hook(self, hook):
+        """ Adds a function(event, record) called when a stage, executable or section starts ('start', record
+        without the measures) and ends ('end', record). Hooks run in the thread that measured the record
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def _call_hooks(self, event: str, record: dict):
+        for hook in list(self.hooks):
+            try:
+                hook(event, record)
+            except Exception:
+                # A broken hook should not break the calibration
+                logger.exception("Profiler hook failed: " + str(hook))
+
+    def _new_record(self, kind: str, name: str, stage: str = None, folder_path: str = None, simulation: int = None,
+                    start: float = None) -> dict:
+        record = {"kind": kind, "name": name, "stage": stage, "folder": folder_path, "simulation": simulation,
+                  "pid": None, "start": start if start is not None else time.time(), "end": None, "return_code": None}
+        for measure in MEASURES:
+            record[measure] = None
+        return record
+
+    def _start(self, record: dict):
+        self._call_hooks("start", record)
+
+    def _end(self, record: dict):
+        """ Keeps a finished record, traces it, sums it in the totals and calls the hooks """
+        with self._lock:
+            self.records.append(record)
+            totals = self._totals.setdefault((record["kind"], record["name"]), {"count": 0})
+            totals["count"] += 1
+            for measure in MEASURES:
+                if record[measure] is None:
+                    continue
+                if measure == "peak_rss":
+                    totals[measure] = max(totals.get(measure, 0), record[measure])
+                else:
+                    totals[measure] = totals.get(measure, 0.0) + record[measure]
+            if self.trace_path is not None:
+                with open(self.trace_path, "a") as fo:
+                    fo.write(json.dumps(record) + "\n")
+        self._call_hooks("end", record)
+
+    def run_command(self, args: list, folder_path: str, kind: str, name: str, stage: str = None, text: str = None,
+                    new_console: bool = False) -> int:
+        """ Runs a command in its own process group measuring it (and its executables) and returns its return code
+
+        Parameters
+        ----------
+        args : command
+        folder_path : working folder
+        kind : STAGE or EXECUTABLE
+        name : name of the record
+        stage : SUFI2 stage the command belongs to
+        text : text written to stdin
+        new_console : opens a new console window in Windows
+        """
+        record = self._new_record(kind, name, stage, folder_path)
+        self._start(record)
+        wall_start = time.perf_counter()
+        process = subprocess.Popen(args, cwd=folder_path,
+                                   stdin=subprocess.PIPE if text is not None else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   **new_process_group_kwargs(new_console))
+        record["pid"] = process.pid
+        monitor = None
+        if self.monitor_executables:
+            monitor = ProcessGroupMonitor(process.pid, self.interval,
+                                          folder_path if stage == "run" else None,
+                                          lambda child: self._child_event("start", child, record),
+                                          lambda child: self._child_event("end", child, record))
+            monitor.start()
+        usage = None
+        capture = OutputCapture(process.stdout, echo=self.echo_output, name=name)
+        try:
+            if text is not None:
+                process.stdin.write(text.encode())
+                process.stdin.close()
+            if hasattr(os, "wait4"):
+                _, status, usage = os.wait4(process.pid, 0)
+                # Reaped by wait4, so Popen must not wait again
+                process.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                process.wait()
+        except BaseException:
+            if process.returncode is None:
+                logger.warning("Killing " + name + " in " + folder_path)
+                kill_process_tree(process.pid)
+                process.wait()
+            raise
+        finally:
+            if monitor is not None:
+                monitor.stop()
+            capture.join(CapturedProcess.OUTPUT_GRACE)
+        record["end"] = time.time()
+        record["wall_time"] = time.perf_counter() - wall_start
+        record["return_code"] = process.returncode
+        if usage is not None:
+            record["cpu_time"] = usage.ru_utime + usage.ru_stime
+        if monitor is not None:
+            # ru_maxrss of wait4 counts the memory of this Python process, inherited by the fork before the exec
+            values = [process["peak_rss"] for process in monitor.processes.values() if process["peak_rss"] is not None]
+            record["peak_rss"] = max(values) if values else None
+            for measure in ("read_bytes", "write_bytes"):
+                values = [process[measure] for process in monitor.processes.values() if process[measure] is not None]
+                record[measure] = sum(values) if values else None
+        self._end(record)
+        self._write_prometheus_file()
+        logger.debug(name + " finished in " + "{:.2f}".format(record["wall_time"]) + " s with return code " +
+                     str(process.returncode) + ": " + folder_path)
+        return process.returncode
+
+    def _child_event(self, event: str, process: dict, parent: dict):
+        if process["pid"] == parent["pid"]:
+            # Measured exactly by the parent record
+            return
+        if event == "start":
+            process["record"] = self._new_record(EXECUTABLE, process["name"], parent["stage"], parent["folder"],
+                                                 process["simulation"], process["start"])
+            process["record"]["pid"] = process["pid"]
+            self._start(process["record"])
+            return
+        record = process["record"]
+        record["name"], record["end"] = process["name"], process["end"]
+        for measure in MEASURES:
+            record[measure] = process.get(measure)
+        self._end(record)
+
+    def run_stage(self, wrapper, path: str, stage: str) -> int:
+        """ Runs a SUFI2 stage ('pre', 'run' or 'post') of a wrapper measuring it and returns its return code """
+        command = wrapper.get_sufi2_command(path, stage)
+        return self.run_command(command["args"], path, STAGE, stage, stage, command["input"], command["new_console"])
+
+    def run_executable(self, folder_path: str, filename: str) -> int:
+        """ Runs an executable of the project folder measuring it (see run_os_filename of the wrappers) """
+        return self.run_command([os.path.join(folder_path, filename)], folder_path, EXECUTABLE, filename)
+
+    @contextmanager
+    def measure(self, name: str, folder_path: str = None, simulation: int = None):
+        """ Measures a block of Python code as a SECTION record: wall time, CPU time and bytes read/written of the
+        calling thread, and the peak RSS of this process
+
+        Example
+        -------
+        with profiler.measure("compute_goal"):
+            swatcup.compute_goal()
+        """
+        record = self._new_record(SECTION, name, None, folder_path, simulation)
+        self._start(record)
+        io_path = "/proc/thread-self/io"
+        io_start = _read_proc_io(io_path)
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+        finally:
+            record["end"] = time.time()
+            record["wall_time"] = time.perf_counter() - wall_start
+            record["cpu_time"] = time.thread_time() - cpu_start
+            io_end = _read_proc_io(io_path)
+            if io_start is not None and io_end is not None:
+                record["read_bytes"], record["write_bytes"] = io_end[0] - io_start[0], io_end[1] - io_start[1]
+            if resource is not None:
+                peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                record["peak_rss"] = peak_rss * (1 if sys.platform == "darwin" else 1024)
+            self._end(record)
+
+    ######## Reports ##################
+    def to_dataframe(self) -> pd.DataFrame:
+        """ Records as a DataFrame, one row per record """
+        with self._lock:
+            return pd.DataFrame(self.records, columns=["kind", "name", "stage", "folder", "simulation", "pid",
+                                                       "start", "end", "return_code"] + list(MEASURES))
+
+    def summary(self) -> pd.DataFrame:
+        """ Totals per kind and name: 'count', summed wall time, CPU time and bytes, and the largest peak RSS """
+        with self._lock:
+            rows = [dict(totals, kind=kind, name=name) for (kind, name), totals in self._totals.items()]
+        return pd.DataFrame(rows, columns=["kind", "name", "count"] + list(MEASURES)).set_index(["kind", "name"])
+
+    def get_simulations(self) -> pd.DataFrame:
+        """ Executables of the run stage per folder and simulation: wall time from the first start to the last end,
+        summed CPU time and bytes and the largest peak RSS. Columns are (measure, executable) plus the totals
+        """
+        df = self.to_dataframe()
+        df = df[(df["kind"] == EXECUTABLE) & (df["stage"] == "run") & df["simulation"].notnull()]
+        keys = ["folder", "simulation"]
+        aggregations = {"wall_time": "sum", "cpu_time": "sum", "peak_rss": "max", "read_bytes": "sum",
+                        "write_bytes": "sum"}
+        executables = df.groupby(keys + ["name"]).agg(aggregations).unstack("name")
+        grouped = df.groupby(keys)
+        totals = grouped.agg({"cpu_time": "sum", "peak_rss": "max", "read_bytes": "sum", "write_bytes": "sum"})
+        totals["wall_time"] = grouped["end"].max() - grouped["start"].min()
+        totals.columns = pd.MultiIndex.from_product([["total"], totals.columns])
+        return pd.concat([executables, totals], axis=1)
+
+    def format_prometheus(self) -> str:
+        """ Totals in the Prometheus text format """
+        with self._lock:
+            totals = dict(self._totals)
+        metrics = [("runs_total", "count", "counter", "Finished runs"),
+                   ("wall_seconds_total", "wall_time", "counter", "Wall time in seconds"),
+                   ("cpu_seconds_total", "cpu_time", "counter", "CPU time in seconds"),
+                   ("peak_rss_bytes", "peak_rss", "gauge", "Largest peak resident set size in bytes"),
+                   ("read_bytes_total", "read_bytes", "counter", "Bytes read"),
+                   ("write_bytes_total", "write_bytes", "counter", "Bytes written")]
+        lines = []
+        for kind in (STAGE, EXECUTABLE, SECTION):
+            names = sorted(name for total_kind, name in totals if total_kind == kind)
+            if not names:
+                continue
+            for suffix, measure, metric_type, description in metrics:
+                metric = self.METRIC_PREFIX + "_" + kind + "_" + suffix
+                lines.append("# HELP " + metric + " " + description + " per " + kind)
+                lines.append("# TYPE " + metric + " " + metric_type)
+                for name in names:
+                    value = totals[(kind, name)].get(measure)
+                    if value is None:
+                        continue
+                    label = name.replace("\\", "\\\\").replace("\"", "\\\"")
+                    lines.append(metric + "{" + kind + "=\"" + label + "\"} " + repr(float(value)))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, file_path: str):
+        """ Writes the Prometheus text file, replacing it atomically so a collector never reads a partial file """
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "w") as fo:
+            fo.write(self.format_prometheus())
+        os.replace(temp_path, file_path)
+
+    def _write_prometheus_file(self):
+        if self.prometheus_path is not None:
+            with self._lock:
+                self.write_prometheus(self.prometheus_path)
+
+    def clear(self):
+        """ Forgets the records and the totals """
+        with self._lock:
+            self.records = []
+            self._totals = {}
+
+
+def read_trace(file_path: str) -> pd.DataFrame:
+    """ Reads a JSON lines trace written by a Profiler """
+    with open(file_path, "r") as fo:
+        return pd.DataFrame([json.loads(line) for line in fo if line.strip()])
@@ -0,0 +1,246 @@
+import os
+import json
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import pandas as pd
+from swatcuppython import sufi2files
+from swatcuppython.objectives import get_goal_layout
+from swatcuppython.varfile import read_sufi2_var_array
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStore(object):
+    """
+    Columnar store of calibration iterations. Each iteration is a folder with goal.txt and par_val.txt as NumPy
+    arrays and every var file split in chunks of simulations. An index (index.json) keeps the simulation range of
+    every chunk, so reading some simulations of a variable loads only the chunks that have them.
+
+    The chunks are compressed .npz files by default. Without compression they are .npy files read with memory
+    mapping, which is faster but takes more disk space.
+
+    Layout of an iteration folder:
+        index.json
+        goal.npz
+        par_val.npz
+        vars/<var file name without extension>/<chunk number>.npz (or .npy)
+    """
+    INDEX_FILE = "index.json"
+
+    def __init__(self, store_path: str, chunk_size: int = 256, compress: bool = True):
+        """
+        Parameters
+        ----------
+        store_path : store folder. Created if it does not exist
+        chunk_size : number of simulations per chunk
+        compress : writes compressed chunks
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive Int")
+        self.store_path = store_path
+        self.chunk_size = chunk_size
+        self.compress = compress
+        os.makedirs(store_path, exist_ok=True)
+
+    def get_iteration_path(self, iteration: str) -> str:
+        return os.path.join(self.store_path, str(iteration))
+
+    def list_iterations(self):
+        return sorted(name for name in os.listdir(self.store_path)
+                      if os.path.isfile(os.path.join(self.store_path, name, self.INDEX_FILE)))
+
+    def read_index(self, iteration: str) -> dict:
+        file = os.path.join(self.get_iteration_path(iteration), self.INDEX_FILE)
+        if not os.path.isfile(file):
+            raise ValueError("Iteration not found in the result store: " + str(iteration))
+        with open(file, "r") as fo:
+            return json.load(fo)
+
+    def remove(self, iteration: str):
+        shutil.rmtree(self.get_iteration_path(iteration))
+
+    def archive(self, project_path: str, iteration: str, var_file_names=None, goal=None, max_workers: int = None,
+                dtype=numpy.float64) -> dict:
+        """ Stores SUFI2.OUT and SUFI2.IN/par_val.txt of a project as an iteration. An iteration with the same name is
+        replaced.
+
+        Parameters
+        ----------
+        project_path : project folder
+        iteration : iteration name
+        var_file_names : var files of SUFI2.OUT. All the files of SUFI2.IN/var_file_name.txt if None
+        goal : (info, df) of goal.txt, as read_sufi2_out_goal. Not stored if None
+        max_workers : number of threads reading and writing var files
+        dtype : dtype of the stored values (numpy.float32 halves the size)
+
+        Returns
+        -------
+        iteration index
+        """
+        iteration_path = self.get_iteration_path(iteration)
+        if os.path.isdir(iteration_path):
+            shutil.rmtree(iteration_path)
+        os.makedirs(os.path.join(iteration_path, "vars"))
+        if var_file_names is None:
+            var_file_names = sufi2files.read_var_file_names(project_path)
+        index = {"iteration": str(iteration), "compress": self.compress, "goal": None, "par_val": False,
+                 "variables": {}}
+
+        if os.path.isfile(os.path.join(project_path, "SUFI2.IN", "par_val.txt")):
+            simulations, values = sufi2files.read_par_val(project_path)
+            numpy.savez_compressed(os.path.join(iteration_path, "par_val.npz"), simulations=simulations,
+                                   values=values)
+            index["par_val"] = True
+        if goal is not None:
+            info, df = goal
+            numpy.savez_compressed(os.path.join(iteration_path, "goal.npz"),
+                                   columns=numpy.array(df.columns, dtype=str), data=df.values.astype(numpy.float64))
+            index["goal"] = info
+
+        out_folder = os.path.join(project_path, "SUFI2.OUT")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            variables = executor.map(lambda name: self._archive_variable(os.path.join(out_folder, name),
+                                                                         iteration_path, dtype), var_file_names)
+            for name, variable in zip(var_file_names, variables):
+                index["variables"][self.get_variable_name(name)] = variable
+
+        with open(os.path.join(iteration_path, self.INDEX_FILE), "w") as fo:
+            json.dump(index, fo)
+        logger.debug("Iteration archived: " + iteration_path)
+        return index
+
+    @staticmethod
+    def get_variable_name(file_name: str) -> str:
+        """ Variable name of a var file (FLOW_OUT_1.txt -> FLOW_OUT_1) """
+        return os.path.splitext(os.path.basename(file_name))[0]
+
+    def _archive_variable(self, file_path: str, iteration_path: str, dtype) -> dict:
+        simulations, time_steps, values = read_sufi2_var_array(file_path, dtype)
+        name = self.get_variable_name(file_path)
+        folder = os.path.join(iteration_path, "vars", name)
+        os.makedirs(folder)
+        numpy.save(os.path.join(folder, "time_steps.npy"), time_steps)
+        order = numpy.argsort(simulations, kind="stable")
+        simulations, values = simulations[order], values[order]
+        chunks = []
+        for number, start in enumerate(range(0, len(simulations), self.chunk_size)):
+            chunk_simulations = simulations[start:start + self.chunk_size]
+            chunk_values = values[start:start + self.chunk_size]
+            if self.compress:
+                file = "{:05d}.npz".format(number)
+                numpy.savez_compressed(os.path.join(folder, file), simulations=chunk_simulations,
+                                       values=chunk_values)
+            else:
+                file = "{:05d}.npy".format(number)
+                numpy.save(os.path.join(folder, file), chunk_values)
+                numpy.save(os.path.join(folder, "{:05d}_simulations.npy".format(number)), chunk_simulations)
+            chunks.append({"file": file, "first": int(chunk_simulations[0]), "last": int(chunk_simulations[-1]),
+                           "count": len(chunk_simulations)})
+        return {"n_sims": len(simulations), "n_steps": len(time_steps), "dtype": numpy.dtype(dtype).name,
+                "chunks": chunks}
+
+    def read_par_val(self, iteration: str):
+        """ Returns (simulations, values) of par_val.txt """
+        if not self.read_index(iteration)["par_val"]:
+            raise ValueError("par_val.txt not stored in iteration: " + str(iteration))
+        with numpy.load(os.path.join(self.get_iteration_path(iteration), "par_val.npz")) as data:
+            return data["simulations"], data["values"]
+
+    def read_goal(self, iteration: str):
+        """ Returns (info, df) of goal.txt, as read_sufi2_out_goal """
+        info = self.read_index(iteration)["goal"]
+        if info is None:
+            raise ValueError("goal.txt not stored in iteration: " + str(iteration))
+        with numpy.load(os.path.join(self.get_iteration_path(iteration), "goal.npz")) as data:
+            df = pd.DataFrame(data["data"], columns=list(data["columns"]))
+        column = get_goal_layout((info, df))["simulation_column"]
+        df[column] = df[column].astype(int)
+        return info, df
+
+    def top_simulations(self, iteration: str, n: int, maximize: bool = None):
+        """ Returns the n best simulations by goal value, best first
+
+        Parameters
+        ----------
+        iteration : iteration name
+        n : number of simulations
+        maximize : bigger goal values are better. Taken from the goal function type if None
+        """
+        layout = get_goal_layout(self.read_goal(iteration))
+        if maximize is None:
+            maximize = layout["maximize"]
+        goal = layout["goal"]
+        order = numpy.argsort(-goal if maximize else goal, kind="stable")[:n]
+        return layout["simulations"][order]
+
+    def read_variable(self, iteration: str, name: str, simulations=None, time_steps=None):
+        """ Reads a variable, loading only the chunks with the requested simulations
+
+        Parameters
+        ----------
+        iteration : iteration name
+        name : variable (FLOW_OUT_1) or var file name (FLOW_OUT_1.txt)
+        simulations : simulation numbers, in the order returned. All if None
+        time_steps : time step numbers. All if None
+
+        Returns
+        -------
+        (simulations, time_steps, values) as read_sufi2_var_array
+        """
+        name = self.get_variable_name(name)
+        variable = self.read_index(iteration)["variables"].get(name)
+        if variable is None:
+            raise ValueError("Variable not found in iteration " + str(iteration) + ": " + name)
+        folder = os.path.join(self.get_iteration_path(iteration), "vars", name)
+        all_time_steps = numpy.load(os.path.join(folder, "time_steps.npy"))
+        columns = slice(None)
+        if time_steps is not None:
+            columns = numpy.searchsorted(all_time_steps, time_steps)
+            if numpy.any(columns >= len(all_time_steps)) or numpy.any(all_time_steps[columns] != time_steps):
+                raise ValueError("Time steps not found in variable: " + name)
+            all_time_steps = all_time_steps[columns]
+
+        chunks = variable["chunks"]
+        if simulations is not None:
+            simulations = numpy.asarray(simulations, dtype=int)
+            chunks = [chunk for chunk in chunks
+                      if numpy.any((simulations >= chunk["first"]) & (simulations <= chunk["last"]))]
+        chunk_simulations = []
+        chunk_values = []
+        for chunk in chunks:
+            sims, values = self._read_chunk(folder, chunk["file"])
+            if simulations is not None:
+                rows = numpy.isin(sims, simulations)
+                sims, values = sims[rows], values[rows]
+            chunk_simulations.append(sims)
+            chunk_values.append(values[:, columns])
+        dtype = numpy.dtype(variable["dtype"])
+        if not chunk_values:
+            result_simulations = numpy.empty(0, dtype=int)
+            result_values = numpy.empty((0, len(all_time_steps)), dtype=dtype)
+        else:
+            result_simulations = numpy.concatenate(chunk_simulations)
+            result_values = numpy.concatenate(chunk_values)
+        if simulations is not None:
+            positions = numpy.searchsorted(result_simulations, simulations)
+            positions = numpy.minimum(positions, max(len(result_simulations) - 1, 0))
+            found = (len(result_simulations) > 0) & (result_simulations[positions] == simulations)
+            if not found.all():
+                raise ValueError("Simulations not found in variable " + name + ": " + str(simulations[~found]))
+            result_simulations, result_values = result_simulations[positions], result_values[positions]
+        return result_simulations, all_time_steps, result_values
+
+    def read_top(self, iteration: str, name: str, n: int, maximize: bool = None):
+        """ Reads a variable for the n best simulations by goal value. See read_variable """
+        return self.read_variable(iteration, name, self.top_simulations(iteration, n, maximize))
+
+    @staticmethod
+    def _read_chunk(folder: str, file: str):
+        if file.endswith(".npz"):
+            with numpy.load(os.path.join(folder, file)) as data:
+                return data["simulations"], data["values"]
+        simulations = numpy.load(os.path.join(folder, file.replace(".npy", "_simulations.npy")))
+        return simulations, numpy.load(os.path.join(folder, file), mmap_mode="r")
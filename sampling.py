@@ -0,0 +1,105 @@
+import logging
+
+import numpy
+from swatcuppython import sufi2files
+
+logger = logging.getLogger(__name__)
+
+
+def latin_hypercube(n_samples: int, n_params: int, rng: numpy.random.Generator) -> numpy.ndarray:
+    """ Returns a (n_samples, n_params) Latin hypercube design in [0, 1). Every parameter has exactly one sample in
+    each of the n_samples equal intervals.
+    """
+    strata = numpy.argsort(rng.random((n_params, n_samples)), axis=1).T
+    return (strata + rng.random((n_samples, n_params))) / n_samples
+
+
+def min_distance(design: numpy.ndarray, block_size: int = 1024) -> float:
+    """ Minimum euclidean distance between two samples of a design, computed in blocks of rows """
+    best = numpy.inf
+    squared = numpy.sum(design ** 2, axis=1)
+    for start in range(0, len(design), block_size):
+        block = design[start:start + block_size]
+        distances = squared[start:start + block_size, None] + squared[None, :] - 2 * block @ design.T
+        # Ignores the distance of each sample to itself
+        rows = numpy.arange(len(block))
+        distances[rows, start + rows] = numpy.inf
+        best = min(best, distances.min())
+    return float(numpy.sqrt(max(best, 0.0)))
+
+
+class LatinHypercubeSampler(object):
+    """
+    Latin hypercube sampler for the parameters of SUFI2.IN/par_inf.txt, in place of SUFI2_LH_sample.exe.
+    The designs are reproducible for a given seed in every platform (NumPy PCG64 generator).
+    """
+
+    def __init__(self, project_path: str, seed: int = None, maximin_candidates: int = 1):
+        """
+        Parameters
+        ----------
+        project_path : project folder
+        seed : random seed. A random design is generated if None
+        maximin_candidates : number of designs generated. The one with the largest minimum distance between
+            samples (maximin) is used
+        """
+        if maximin_candidates < 1:
+            raise ValueError("maximin_candidates should be a positive Int")
+        self.project_path = project_path
+        self.seed = seed
+        self.maximin_candidates = maximin_candidates
+        self.names, self.ranges, self.simulation_number = sufi2files.read_par_inf(project_path)
+
+    def _design(self, n_samples: int, rng: numpy.random.Generator) -> numpy.ndarray:
+        best = None
+        best_distance = -1.0
+        for candidate in range(self.maximin_candidates):
+            design = latin_hypercube(n_samples, len(self.names), rng)
+            if self.maximin_candidates == 1:
+                return design
+            distance = min_distance(design)
+            if distance > best_distance:
+                best, best_distance = design, distance
+        logger.debug("Maximin design distance: " + str(best_distance))
+        return best
+
+    def scale(self, design: numpy.ndarray) -> numpy.ndarray:
+        """ Scales a [0, 1) design to the par_inf.txt parameter ranges """
+        ranges = numpy.array(self.ranges, dtype=numpy.float64)
+        return ranges[:, 0] + design * (ranges[:, 1] - ranges[:, 0])
+
+    def sample(self, n_samples: int = None) -> numpy.ndarray:
+        """ Returns a (n_samples, n_pars) design. n_samples is the par_inf.txt number of simulations if None """
+        if n_samples is None:
+            n_samples = self.simulation_number
+        return self.scale(self._design(n_samples, numpy.random.default_rng(self.seed)))
+
+    def sample_batches(self, batch_sizes):
+        """ Generates one independent Latin hypercube design per batch (ex: one per parallel worker). Each batch has
+        its own random stream spawned from the seed, so batches can be generated separately and reproducibly.
+
+        Returns
+        -------
+        list of (simulations, values), numbered consecutively from 1
+        """
+        seeds = numpy.random.SeedSequence(self.seed).spawn(len(batch_sizes))
+        batches = []
+        first = 1
+        for size, seed in zip(batch_sizes, seeds):
+            values = self.scale(self._design(size, numpy.random.default_rng(seed)))
+            batches.append((numpy.arange(first, first + size), values))
+            first += size
+        return batches
+
+    def write_par_val(self, values: numpy.ndarray, simulations=None, path: str = None):
+        """ Writes SUFI2.IN/par_val.txt
+
+        Parameters
+        ----------
+        values : (n_sims, n_pars) parameter values
+        simulations : simulation numbers. 1 to n_sims if None
+        path : project folder where the file is written. The sampler project if None
+        """
+        if simulations is None:
+            simulations = numpy.arange(1, len(values) + 1)
+        sufi2files.write_par_val(path or self.project_path, simulations, values)
@@ -29,6 +29,8 @@ class SWATCUPv5_1_6_2(ModuleInterface):
 
     def run_os_filename(self, folder_path, filename):
         logger.debug("Running file: " + os.path.join(folder_path, filename))
+        if self.profiler is not None:
+            return self.profiler.run_executable(folder_path, filename)
         process = subprocess.Popen(os.path.join(folder_path, filename), cwd=folder_path)
         # show output
         process.communicate()[0]
@@ -38,40 +40,56 @@ class SWATCUPv5_1_6_2(ModuleInterface):
         return "SWAT-CUPv5.1.6.2"
 
     def sufi2_pre(self, path):
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "pre")
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Pre.bat", "SUFI2_Pre.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        subprocess.call(cmd, cwd=path, shell=True)
+        return self.start_captured(cmd, path, "pre", shell=True).wait()
 
     def sufi2_run(self, path):
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "run")
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Run.bat", "SUFI2_Run.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        subprocess.call(cmd, cwd=path, shell=True)
+        return self.start_captured(cmd, path, "run", shell=True).wait()
 
     def sufi2_post(self, path):
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "post")
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Post.bat", "SUFI2_Post.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        subprocess.call(cmd, cwd=path, shell=True)
+        return self.start_captured(cmd, path, "post", shell=True).wait()
 
     def sufi2_async_pre(self, path):
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Pre.bat", "SUFI2_Pre.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+        return self.start_captured(cmd, path, "pre", shell=True)
 
     def sufi2_async_run(self, path):
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Run.bat", "SUFI2_Run.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+        return self.start_captured(cmd, path, "run", shell=True)
 
     def sufi2_async_post(self, path):
         cmd = os.path.join(path, self.get_os_filename("SUFI2_Post.bat", "SUFI2_Post.bat"))
         logger.debug(cmd)
         # TODO: shell=True eh um falaha de seguranca. Mas o bat so funciona assim. Corrigir no futuro
-        return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+        return self.start_captured(cmd, path, "post", shell=True)
+
+    def get_sufi2_command(self, path, stage):
+        if stage not in ("pre", "run", "post"):
+            raise ValueError("Invalid SUFI2 stage: " + str(stage))
+        file_name = {"pre": "SUFI2_Pre.bat", "run": "SUFI2_Run.bat", "post": "SUFI2_Post.bat"}[stage]
+        cmd = os.path.join(path, self.get_os_filename(file_name, file_name))
+        if self.operational_system == OperationalSystem.LINUX:
+            # The .bat files are shell scripts in the linux projects
+            return {"args": ["/bin/sh", cmd], "input": None, "new_console": False}
+        return {"args": [cmd], "input": None, "new_console": False}
 
     def sufi2_lh_sample(self, path):
         logger.debug("Running SUFI2_LH_sample")
@@ -127,6 +145,6 @@ class SWATCUPv5_1_6_2(ModuleInterface):
         print(info)
         # Le informações da tabela
         # data_widths = [5] + [9] * param_count
-        df = pd.read_csv(fo, header=0, delim_whitespace=True)
+        df = pd.read_csv(fo, header=0, sep=r"\s+")
         print(df)
 
@@ -0,0 +1,343 @@
+import os
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from swatcuppython import sufi2files
+from swatcuppython.swatcup import SWATCUP
+
+logger = logging.getLogger(__name__)
+
+
+class CalibrationJob(object):
+    """
+    Calibration iteration of a project run by CalibrationScheduler: SUFI2_pre in the project folder, the simulations
+    in chunks spread over worker slots (process folders swatcuppython/processK), merge of SUFI2.OUT and SUFI2_post.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, name: str, project_folder_path: str, version, simulations: int = None, priority: int = 0,
+                 max_workers: int = None, memory_per_worker: int = 0, chunk_size: int = None, run_pre: bool = True,
+                 run_post: bool = True):
+        """
+        Parameters
+        ----------
+        name : job name, unique in the scheduler
+        project_folder_path : SWAT-CUP project folder
+        version : SWATCUPVersion of the project
+        simulations : runs the simulations 1-simulations. The SUFI2_swEdit.def range if None
+        priority : jobs with higher priority get the free worker slots first
+        max_workers : maximum number of worker slots of the job. The scheduler cores if None
+        memory_per_worker : memory used by a worker slot in bytes, checked against the scheduler memory budget
+        chunk_size : simulations run by a worker slot at a time. About two chunks per worker if None
+        run_pre : runs SUFI2_pre before the simulations
+        run_post : runs SUFI2_post after the simulations
+        """
+        if simulations is not None and (not isinstance(simulations, int) or simulations < 1):
+            raise ValueError("simulations should be a positive Int")
+        if max_workers is not None and (not isinstance(max_workers, int) or max_workers < 1):
+            raise ValueError("max_workers should be a positive Int")
+        if chunk_size is not None and (not isinstance(chunk_size, int) or chunk_size < 1):
+            raise ValueError("chunk_size should be a positive Int")
+        self.name = name
+        self.project_folder_path = project_folder_path
+        self.version = version
+        self.simulations = simulations
+        self.priority = priority
+        self.max_workers = max_workers
+        self.memory_per_worker = memory_per_worker
+        self.chunk_size = chunk_size
+        self.run_pre = run_pre
+        self.run_post = run_post
+
+        self.state = self.QUEUED
+        self.phase = None
+        self.swatcup = None
+        self.runner = None
+        self.workers = 0
+        self.pending = []
+        self.free_folders = []
+        self.provisioned_folders = set()
+        self.used_folders = 0
+        self.total_simulations = 0
+        self.completed_simulations = 0
+        self.return_codes = []
+        self.error = None
+        self.submitted_time = time.time()
+        self.started_time = None
+        self.finished_time = None
+
+    def get_elapsed_time(self) -> float:
+        if self.started_time is None:
+            return 0.0
+        return (self.finished_time or time.time()) - self.started_time
+
+    def get_throughput(self) -> float:
+        """ Completed simulations per second since the job started """
+        elapsed = self.get_elapsed_time()
+        return self.completed_simulations / elapsed if elapsed > 0 else 0.0
+
+    def get_state(self) -> dict:
+        return {"name": self.name, "state": self.state, "phase": self.phase, "priority": self.priority,
+                "workers": self.workers, "total_simulations": self.total_simulations,
+                "completed_simulations": self.completed_simulations,
+                "pending_simulations": sum(last - first + 1 for first, last in self.pending),
+                "elapsed_time": self.get_elapsed_time(), "throughput": self.get_throughput(), "error": self.error}
+
+
+class CalibrationScheduler(object):
+    """
+    Runs many calibration jobs on one node within a core and memory budget. Every core is a worker slot: a free slot
+    goes to the job with the highest priority and, among jobs with the same priority, to the one with fewer running
+    workers, so the slots are shared fairly. A slot runs one unit of work of a job (SUFI2_pre, a chunk of
+    simulations or merge + SUFI2_post) and, in Linux, is pinned to its own CPU; the SWAT-CUP processes inherit the
+    affinity of the thread that starts them.
+
+    Usage:
+        scheduler = CalibrationScheduler(cores=16)
+        scheduler.submit(CalibrationJob("basin1", path1, SWATCUPVersion.SWATCUP2019, priority=1))
+        scheduler.submit(CalibrationJob("basin2", path2, SWATCUPVersion.SWATCUP2019))
+        scheduler.run()
+    """
+
+    def __init__(self, cores: int = None, memory_budget: int = None, pin_workers: bool = True,
+                 poll_interval: float = 0.5):
+        """
+        Parameters
+        ----------
+        cores : number of worker slots. The number of usable CPUs if None
+        memory_budget : memory available to the worker slots in bytes. No limit if None
+        pin_workers : pins each worker slot to a CPU (Linux only)
+        poll_interval : seconds between checks for new jobs while running
+        """
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+        if cores is None:
+            cores = len(cpus)
+        if not isinstance(cores, int) or cores < 1:
+            raise ValueError("cores should be a positive Int")
+        if pin_workers and (not hasattr(os, "sched_setaffinity") or cores > len(cpus)):
+            logger.warning("Worker pinning not available, running without it")
+            pin_workers = False
+        self.cores = cores
+        self.memory_budget = memory_budget
+        self.pin_workers = pin_workers
+        self.poll_interval = poll_interval
+        self.free_cpus = cpus[:cores]
+        self.free_slots = cores
+        self.used_memory = 0
+        self.jobs = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, job: CalibrationJob) -> CalibrationJob:
+        with self._lock:
+            if any(other.name == job.name for other in self.jobs):
+                raise ValueError("Job already submitted: " + job.name)
+            if self.memory_budget is not None and job.memory_per_worker > self.memory_budget:
+                raise ValueError("Job " + job.name + " does not fit in the memory budget")
+            if job.max_workers is None:
+                job.max_workers = self.cores
+            self.jobs.append(job)
+        logger.info("Job submitted: " + job.name)
+        return job
+
+    def get_job(self, name: str) -> CalibrationJob:
+        for job in self.jobs:
+            if job.name == name:
+                return job
+        raise ValueError("Job not found: " + name)
+
+    def cancel(self, name: str):
+        """ Cancels a job. A running job stops getting new work; the units already running are not interrupted """
+        with self._lock:
+            job = self.get_job(name)
+            if job.state in (CalibrationJob.QUEUED, CalibrationJob.RUNNING):
+                job.pending = []
+                job.state = CalibrationJob.CANCELLED
+                if job.workers == 0:
+                    job.finished_time = time.time()
+
+    def get_queue_state(self) -> dict:
+        """ Returns the free slots and memory and the state of every job (see CalibrationJob.get_state) """
+        with self._lock:
+            return {"cores": self.cores, "free_slots": self.free_slots, "used_memory": self.used_memory,
+                    "memory_budget": self.memory_budget, "jobs": [job.get_state() for job in self.jobs]}
+
+    def get_throughput(self) -> dict:
+        """ Returns the completed simulations per second of every job """
+        with self._lock:
+            return {job.name: job.get_throughput() for job in self.jobs}
+
+    def start(self):
+        """ Runs the scheduler in a background thread. See wait """
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def wait(self, timeout: float = None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def run(self):
+        """ Runs the submitted jobs (also the ones submitted while running) until there is nothing left to run """
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.cores) as executor:
+            while True:
+                with self._lock:
+                    self._dispatch(executor, running)
+                    if not running and not any(self._is_active(job) for job in self.jobs):
+                        break
+                done, not_done = wait(list(running), timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, unit, cpu = running.pop(future)
+                    with self._lock:
+                        self._complete(job, unit, cpu, future)
+
+    @staticmethod
+    def _is_active(job: CalibrationJob) -> bool:
+        return job.state in (CalibrationJob.QUEUED, CalibrationJob.RUNNING)
+
+    def _has_work(self, job: CalibrationJob) -> bool:
+        """ True if the job can take one more worker slot now """
+        if not self._is_active(job) or job.workers >= job.max_workers:
+            return False
+        if self.memory_budget is not None and self.used_memory + job.memory_per_worker > self.memory_budget:
+            return False
+        if job.state == CalibrationJob.QUEUED:
+            return True
+        if job.phase == "run":
+            return bool(job.pending) or job.workers == 0
+        # pre and post use a single worker
+        return False
+
+    def _dispatch(self, executor, running: dict):
+        while self.free_slots > 0:
+            candidates = [job for job in self.jobs if self._has_work(job)]
+            if not candidates:
+                return
+            job = min(candidates, key=lambda job: (-job.priority, job.workers, job.submitted_time))
+            if job.state == CalibrationJob.QUEUED:
+                try:
+                    self._admit(job)
+                except Exception as e:
+                    self._fail(job, e)
+                    continue
+            unit = self._next_unit(job)
+            cpu = self.free_cpus.pop(0) if self.pin_workers else None
+            self.free_slots -= 1
+            self.used_memory += job.memory_per_worker
+            job.workers += 1
+            logger.debug("Job " + job.name + ": starting " + str(unit))
+            running[executor.submit(self._run_unit, job, unit, cpu)] = (job, unit, cpu)
+
+    def _admit(self, job: CalibrationJob):
+        logger.info("Job admitted: " + job.name)
+        job.swatcup = SWATCUP(job.version)
+        job.swatcup.set_project_folder(job.project_folder_path)
+        job.swatcup.set_process_number(job.max_workers)
+        job.runner = job.swatcup.get_parallel_runner()
+        job.free_folders = list(range(job.max_workers))
+        job.state = CalibrationJob.RUNNING
+        job.started_time = time.time()
+        if job.run_pre:
+            job.phase = "pre"
+        else:
+            self._plan(job)
+
+    def _plan(self, job: CalibrationJob):
+        """ Splits the simulation range of the job in chunks """
+        if job.simulations is None:
+            start, end = sufi2files.read_swedit_def(job.project_folder_path)
+        else:
+            par_simulations, par_values = sufi2files.read_par_val(job.project_folder_path)
+            if job.simulations > len(par_simulations):
+                raise ValueError("Job " + job.name + ": par_val.txt has only " + str(len(par_simulations)) +
+                                 " simulations")
+            start, end = 1, job.simulations
+        chunk_size = job.chunk_size
+        if chunk_size is None:
+            chunk_size = max(1, math.ceil((end - start + 1) / (2 * job.max_workers)))
+        job.pending = [(first, min(first + chunk_size - 1, end)) for first in range(start, end + 1, chunk_size)]
+        job.total_simulations = end - start + 1
+        job.phase = "run"
+
+    def _next_unit(self, job: CalibrationJob):
+        if job.phase == "pre":
+            return ("pre", None, None)
+        if job.pending:
+            folder = job.free_folders.pop(0)
+            if folder >= job.used_folders:
+                job.used_folders = folder + 1
+            return ("run", job.pending.pop(0), folder)
+        job.phase = "post"
+        return ("post", None, None)
+
+    def _run_unit(self, job: CalibrationJob, unit, cpu):
+        if cpu is not None:
+            # Applies to this thread only; the processes it starts inherit it
+            os.sched_setaffinity(0, {cpu})
+        stage, simulation_range, folder = unit
+        if stage == "pre":
+            return job.swatcup.sufi2_pre()
+        if stage == "run":
+            folder_path = job.runner.get_process_folder_path(folder)
+            if folder not in job.provisioned_folders:
+                # Provisioned on first use, the chunks run later in the folder append to its SUFI2.OUT
+                job.runner.sync_process(folder)
+                job.provisioned_folders.add(folder)
+            sufi2files.write_swedit_def(folder_path, simulation_range[0], simulation_range[1])
+            return job.swatcup.wrapper.sufi2_run(folder_path)
+        job.runner.merge(job.used_folders)
+        if job.run_post:
+            return job.swatcup.sufi2_post()
+        return 0
+
+    def _complete(self, job: CalibrationJob, unit, cpu, future):
+        stage, simulation_range, folder = unit
+        self.free_slots += 1
+        self.used_memory -= job.memory_per_worker
+        if cpu is not None:
+            self.free_cpus.append(cpu)
+        job.workers -= 1
+        if folder is not None:
+            job.free_folders.append(folder)
+            job.free_folders.sort()
+        try:
+            return_code = future.result()
+        except Exception as e:
+            self._fail(job, e)
+            return
+        job.return_codes.append(return_code)
+        if job.state != CalibrationJob.RUNNING:
+            # Cancelled or failed while the unit was running
+            if job.workers == 0:
+                job.finished_time = time.time()
+            return
+        if return_code:
+            self._fail(job, "SUFI2 " + stage + " failed with return code " + str(return_code))
+            return
+        if stage == "pre":
+            try:
+                self._plan(job)
+            except Exception as e:
+                self._fail(job, e)
+        elif stage == "run":
+            job.completed_simulations += simulation_range[1] - simulation_range[0] + 1
+        else:
+            job.state = CalibrationJob.DONE
+            job.phase = None
+            job.finished_time = time.time()
+            logger.info("Job done: " + job.name + " (" + "{:.2f}".format(job.get_throughput()) + " sims/s)")
+
+    @staticmethod
+    def _fail(job: CalibrationJob, error):
+        logger.error("Job " + job.name + " failed: " + str(error))
+        job.error = str(error)
+        job.state = CalibrationJob.FAILED
+        job.pending = []
+        if job.workers == 0:
+            job.finished_time = time.time()
@@ -0,0 +1,163 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+from swatcuppython import sufi2files
+from swatcuppython.workspace import WorkspaceProvisioner
+
+logger = logging.getLogger(__name__)
+
+
+class ScratchWorkspace(object):
+    """
+    Stages a SWAT-CUP project into a scratch folder (a tmpfs RAM disk by default) and runs the SUFI2 stages there.
+    Only the SUFI2 results are synced back to the project: SUFI2.OUT after every stage (and every 'sync_every'
+    simulations during the run) and SUFI2.IN after sufi2_pre, which writes the new par_val.txt.
+    """
+    DEFAULT_SCRATCH_FOLDER = "/dev/shm"
+    # Fraction of the available memory that can be used when the scratch folder is a RAM disk
+    MEMORY_FRACTION = 0.9
+
+    def __init__(self, project_folder_path: str, scratch_folder_path: str = None, sync_every: int = None,
+                 memory_budget: int = None, exclude=None):
+        """
+        Parameters
+        ----------
+        project_folder_path : SWAT-CUP project folder
+        scratch_folder_path : folder where the project is staged. /dev/shm if None (or the temp folder if there is
+            no /dev/shm)
+        sync_every : syncs SUFI2.OUT back to the project every N simulations. Only at the end if None
+        memory_budget : max number of bytes the staged project may use. Not checked if None
+        exclude : top level names of the project that are not staged (ex: swatcuppython folder)
+        """
+        if sync_every is not None and (not isinstance(sync_every, int) or sync_every < 1):
+            raise ValueError("sync_every should be a positive Int")
+        if scratch_folder_path is None:
+            scratch_folder_path = self.DEFAULT_SCRATCH_FOLDER
+            if not os.path.isdir(scratch_folder_path):
+                scratch_folder_path = tempfile.gettempdir()
+        self.project_folder_path = project_folder_path
+        self.sync_every = sync_every
+        self.memory_budget = memory_budget
+        project_id = hashlib.sha1(os.path.abspath(project_folder_path).encode()).hexdigest()[:8]
+        self.folder_path = os.path.join(scratch_folder_path, "swatcuppython_" +
+                                        os.path.basename(os.path.normpath(project_folder_path)) + "_" + project_id)
+        self.provisioner = WorkspaceProvisioner(project_folder_path, exclude=exclude)
+
+    def get_required_size(self) -> int:
+        """ Estimates the bytes needed in the scratch folder: the staged files, the current SUFI2.OUT and the swat
+        output files (using the ones in the project, if any, as the estimate)
+        """
+        size = 0
+        for folder, folders, files in os.walk(self.project_folder_path):
+            rel_folder = os.path.relpath(folder, self.project_folder_path)
+            if rel_folder == ".":
+                folders[:] = [name for name in folders if name not in self.provisioner.exclude]
+                files = [name for name in files if name not in self.provisioner.exclude]
+            for name in files:
+                size += os.path.getsize(os.path.join(folder, name))
+        return size
+
+    @staticmethod
+    def get_available_memory():
+        """ Returns the available memory in bytes (MemAvailable in /proc/meminfo) or None if unknown """
+        try:
+            with open("/proc/meminfo", "r") as fo:
+                for line in fo:
+                    if line.startswith("MemAvailable:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        return None
+
+    def check_memory(self):
+        """ Raises MemoryError if the project does not fit in the scratch folder or in the memory budget """
+        required = self.get_required_size()
+        scratch_folder_path = os.path.dirname(self.folder_path)
+        available = shutil.disk_usage(scratch_folder_path).free
+        if os.path.isdir(self.folder_path):
+            # Already staged files are going to be reused
+            available += sum(os.path.getsize(os.path.join(folder, name))
+                             for folder, folders, files in os.walk(self.folder_path) for name in files)
+        if self.memory_budget is not None:
+            available = min(available, self.memory_budget)
+        if os.path.realpath(scratch_folder_path).startswith("/dev/shm"):
+            memory = self.get_available_memory()
+            if memory is not None:
+                available = min(available, int(memory * self.MEMORY_FRACTION))
+        logger.debug("Scratch required: " + str(required) + " bytes, available: " + str(available) + " bytes")
+        if required > available:
+            raise MemoryError("Project does not fit in the scratch folder '" + scratch_folder_path + "': " +
+                              str(required) + " bytes required, " + str(available) + " bytes available")
+
+    def stage(self):
+        """ Copies the project into the scratch folder, including the current SUFI2.OUT """
+        self.check_memory()
+        logger.info("Staging project into scratch folder: " + self.folder_path)
+        stats = self.provisioner.provision(self.folder_path)
+        self._sync_folder(os.path.join(self.project_folder_path, "SUFI2.OUT"),
+                          os.path.join(self.folder_path, "SUFI2.OUT"))
+        return stats
+
+    def sync_back(self, folders=("SUFI2.OUT",)):
+        """ Copies the changed files of the scratch folders back to the project """
+        for folder in folders:
+            logger.debug("Syncing scratch folder back: " + folder)
+            self._sync_folder(os.path.join(self.folder_path, folder), os.path.join(self.project_folder_path, folder))
+
+    @staticmethod
+    def _sync_folder(src_folder: str, dst_folder: str):
+        os.makedirs(dst_folder, exist_ok=True)
+        src_names = set(os.listdir(src_folder))
+        for name in src_names:
+            src = os.path.join(src_folder, name)
+            dst = os.path.join(dst_folder, name)
+            if os.path.isdir(src):
+                ScratchWorkspace._sync_folder(src, dst)
+                continue
+            if os.path.isfile(dst):
+                src_stat, dst_stat = os.stat(src), os.stat(dst)
+                if src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+                    continue
+            shutil.copy2(src, dst)
+        for name in os.listdir(dst_folder):
+            if name not in src_names and os.path.isfile(os.path.join(dst_folder, name)):
+                os.remove(os.path.join(dst_folder, name))
+
+    def cleanup(self):
+        if os.path.isdir(self.folder_path):
+            logger.info("Removing scratch folder: " + self.folder_path)
+            shutil.rmtree(self.folder_path)
+
+    def sufi2_pre(self, wrapper):
+        return_code = wrapper.sufi2_pre(self.folder_path)
+        self.sync_back(("SUFI2.IN", "SUFI2.OUT"))
+        return return_code
+
+    def sufi2_run(self, wrapper):
+        if self.sync_every is None:
+            return_code = wrapper.sufi2_run(self.folder_path)
+            self.sync_back()
+            return return_code
+        start, end = sufi2files.read_swedit_def(self.folder_path)
+        return_code = None
+        try:
+            for first in range(start, end + 1, self.sync_every):
+                last = min(first + self.sync_every - 1, end)
+                logger.debug("Running scratch simulations " + str(first) + "-" + str(last))
+                sufi2files.write_swedit_def(self.folder_path, first, last)
+                return_code = wrapper.sufi2_run(self.folder_path)
+                self.sync_back()
+                if return_code is not None and return_code != 0:
+                    logger.error("Scratch simulations " + str(first) + "-" + str(last) + " failed with return code " +
+                                 str(return_code))
+                    break
+        finally:
+            sufi2files.write_swedit_def(self.folder_path, start, end)
+        return return_code
+
+    def sufi2_post(self, wrapper):
+        return_code = wrapper.sufi2_post(self.folder_path)
+        self.sync_back()
+        return return_code
@@ -0,0 +1,251 @@
+import math
+import logging
+
+import numpy
+import pandas as pd
+from swatcuppython.objectives import SIMULATION_COLUMN, get_goal_layout
+
+logger = logging.getLogger(__name__)
+
+# Degrees of freedom above which the Student t p-values use the normal approximation
+T_NORMAL_DOF = 200
+
+_erfc = numpy.vectorize(math.erfc, otypes=[numpy.float64])
+
+
+def _betacf(a, b, x, iterations: int = 300, epsilon: float = 1e-14):
+    """ Continued fraction of the regularized incomplete beta function (modified Lentz), vectorized """
+    tiny = 1e-300
+    qab, qap, qam = a + b, a + 1.0, a - 1.0
+    c = numpy.ones_like(x)
+    d = 1.0 - qab * x / qap
+    d = 1.0 / numpy.where(numpy.abs(d) < tiny, tiny, d)
+    h = d.copy()
+    for m in range(1, iterations + 1):
+        m2 = 2 * m
+        for aa in (m * (b - m) * x / ((qam + m2) * (a + m2)), -(a + m) * (qab + m) * x / ((a + m2) * (qap + m2))):
+            d = 1.0 + aa * d
+            d = 1.0 / numpy.where(numpy.abs(d) < tiny, tiny, d)
+            c = 1.0 + aa / c
+            c = numpy.where(numpy.abs(c) < tiny, tiny, c)
+            delta = d * c
+            h = h * delta
+        if numpy.all(numpy.abs(delta - 1.0) < epsilon):
+            break
+    return h
+
+
+def betainc(a: float, b: float, x):
+    """ Regularized incomplete beta function I_x(a, b) of an array x """
+    x = numpy.clip(numpy.asarray(x, dtype=numpy.float64), 0.0, 1.0)
+    log_front = math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+    with numpy.errstate(divide="ignore"):
+        front = numpy.exp(log_front + a * numpy.log(x) + b * numpy.log1p(-x))
+    direct = x < (a + 1.0) / (a + b + 2.0)
+    result = numpy.empty_like(x)
+    result[direct] = front[direct] * _betacf(a, b, x[direct]) / a
+    result[~direct] = 1.0 - front[~direct] * _betacf(b, a, 1.0 - x[~direct]) / b
+    return result
+
+
+def t_p_value(t, dof: int):
+    """ Two-sided p-value of Student t statistics """
+    t = numpy.abs(numpy.asarray(t, dtype=numpy.float64))
+    if dof < 1:
+        return numpy.full(t.shape, numpy.nan)
+    if dof > T_NORMAL_DOF:
+        # Normal approximation of the t distribution
+        z = t * (1 - 1 / (4.0 * dof)) / numpy.sqrt(1 + t ** 2 / (2.0 * dof))
+        return _erfc(z / math.sqrt(2))
+    p_value = numpy.full(t.shape, numpy.nan)
+    finite = numpy.isfinite(t)
+    p_value[finite] = betainc(dof / 2.0, 0.5, dof / (dof + t[finite] ** 2))
+    p_value[numpy.isinf(t)] = 0.0
+    return p_value
+
+
+def rank(values, dtype=numpy.float64):
+    """ Ranks (0 to n - 1) of each column of a (n, k) array. Ties get the average of their ranks """
+    n = len(values)
+    order = numpy.argsort(values, axis=0, kind="stable")
+    sorted_values = numpy.take_along_axis(values, order, axis=0)
+    positions = numpy.broadcast_to(numpy.arange(n)[:, None], values.shape)
+    # Runs of equal values in the sorted columns: first and last position of the run of every position
+    starts = numpy.ones(values.shape, dtype=bool)
+    starts[1:] = sorted_values[1:] != sorted_values[:-1]
+    ends = numpy.ones(values.shape, dtype=bool)
+    ends[:-1] = starts[1:]
+    first = numpy.maximum.accumulate(numpy.where(starts, positions, 0), axis=0)
+    last = numpy.minimum.accumulate(numpy.where(ends, positions, n - 1)[::-1], axis=0)[::-1]
+    ranks = numpy.empty(values.shape, dtype=dtype)
+    numpy.put_along_axis(ranks, order, ((first + last) / 2.0).astype(dtype), axis=0)
+    return ranks
+
+
+class RegressionSensitivity(object):
+    """
+    SUFI2 global sensitivity: multiple regression of every objective on all the parameters (goal = a + sum(b_i * p_i)).
+    The t-stat of a parameter is its coefficient divided by its standard error; the larger its absolute value (and the
+    smaller the p-value), the more sensitive the parameter.
+
+    The normal equations are accumulated by update, so the simulations can be added in chunks and the memory does not
+    depend on their number. The parameters are scaled by the mean and std of the first chunk to keep the normal
+    equations well conditioned.
+    """
+
+    def __init__(self, n_params: int, n_objectives: int):
+        self.n_params = n_params
+        self.n_objectives = n_objectives
+        self.n = 0
+        self.center = None
+        self.scale = None
+        self.xtx = numpy.zeros((n_params + 1, n_params + 1))
+        self.xty = numpy.zeros((n_params + 1, n_objectives))
+        self.yty = numpy.zeros(n_objectives)
+
+    def update(self, values, objectives):
+        """ Adds simulations: (n, n_params) parameter values and (n, n_objectives) objective values """
+        values = numpy.asarray(values, dtype=numpy.float64)
+        objectives = numpy.asarray(objectives, dtype=numpy.float64).reshape(len(values), -1)
+        if self.center is None:
+            self.center = values.mean(axis=0)
+            std = values.std(axis=0)
+            self.scale = numpy.where(std > 0, std, 1.0)
+        x = numpy.empty((len(values), self.n_params + 1))
+        x[:, 0] = 1.0
+        x[:, 1:] = (values - self.center) / self.scale
+        self.xtx += x.T @ x
+        self.xty += x.T @ objectives
+        self.yty += numpy.sum(objectives ** 2, axis=0)
+        self.n += len(values)
+
+    def compute(self) -> dict:
+        """ Returns dict with the 'coefficients' (in parameter units), 't_stat' and 'p_value', (n_params, n_objectives)
+        arrays, and the 'r2' of each objective
+        """
+        dof = self.n - self.n_params - 1
+        if dof < 1:
+            raise ValueError("Not enough simulations for the regression: " + str(self.n) + " for " +
+                             str(self.n_params) + " parameters")
+        inverse = numpy.linalg.pinv(self.xtx)
+        beta = inverse @ self.xty
+        rss = numpy.maximum(self.yty - numpy.sum(beta * self.xty, axis=0), 0.0)
+        mean = self.xty[0] / self.n
+        tss = self.yty - self.n * mean ** 2
+        sigma2 = rss / dof
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            se = numpy.sqrt(numpy.outer(numpy.diag(inverse)[1:], sigma2))
+            t_stat = beta[1:] / se
+            r2 = numpy.where(tss > 0, 1 - rss / tss, numpy.nan)
+        return {"coefficients": beta[1:] / self.scale[:, None], "t_stat": t_stat,
+                "p_value": t_p_value(t_stat, dof), "r2": r2}
+
+
+def rank_correlation(values, objectives, chunk_size: int = None):
+    """ Spearman rank correlation of every parameter with every objective
+
+    Parameters
+    ----------
+    values : (n, n_params) parameter values
+    objectives : (n, n_objectives) objective values
+    chunk_size : parameters ranked at a time (bounded memory). All at once if None
+
+    Returns
+    -------
+    (correlation, p_value), (n_params, n_objectives) arrays
+    """
+    values = numpy.asarray(values)
+    objectives = numpy.asarray(objectives).reshape(len(values), -1)
+    n = len(values)
+    dtype = numpy.float32 if chunk_size is not None else numpy.float64
+
+    def standardize(ranks):
+        # Average ranks have mean (n - 1) / 2. Ties lower their std below sqrt((n ** 2 - 1) / 12), a column of equal
+        # values has no correlation (nan)
+        std = ranks.std(axis=0)
+        return (ranks - (n - 1) / 2.0) / numpy.where(std > 0, std, numpy.nan).astype(ranks.dtype)
+
+    objective_ranks = standardize(rank(objectives, dtype))
+    correlation = numpy.empty((values.shape[1], objective_ranks.shape[1]))
+    step = chunk_size or values.shape[1]
+    for start in range(0, values.shape[1], step):
+        ranks = standardize(rank(values[:, start:start + step], dtype))
+        correlation[start:start + step] = ranks.T @ objective_ranks / n
+    correlation = numpy.clip(correlation, -1.0, 1.0)
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        t = correlation * numpy.sqrt((n - 2) / (1 - correlation ** 2))
+    return correlation, t_p_value(t, n - 2)
+
+
+def get_objective_columns(df, names):
+    """ Objective columns of a goal DataFrame: all but the simulation column and the parameters """
+    return [column for column in df.columns if column != SIMULATION_COLUMN and column not in names]
+
+
+def global_sensitivity(goal, par_val=None, names=None, objectives: dict = None, chunk_size: int = None):
+    """ SUFI2 global sensitivity (multiple regression t-stat and p-value) and Spearman rank correlation of every
+    parameter with every objective column, in one vectorized pass
+
+    Parameters
+    ----------
+    goal : (info, df) as read_sufi2_out_goal, compute_goal or ResultStore.read_goal
+    par_val : (simulations, values) of par_val.txt, used when df does not have the parameter columns
+    names : parameter names. The r__, v__ and a__ columns of df if None
+    objectives : extra objective columns, dict name -> value of each goal.txt simulation (ex: the objectives of
+        ObjectiveEngine.evaluate)
+    chunk_size : simulations per regression chunk and parameters ranked at a time, for large archives (bounded
+        memory). All at once if None
+
+    Returns
+    -------
+    DataFrame with a row per objective and parameter: 'objective', 'parameter', 't_stat', 'p_value', 'rank' (1 is
+    the most sensitive, by absolute t-stat as SUFI2 does), 'coefficient', 'spearman' and 'spearman_p_value'
+    """
+    info, df = goal
+    if names is None:
+        names = [column for column in df.columns if str(column)[:3].lower() in ("r__", "v__", "a__")]
+    names = list(names)
+    if all(name in df.columns for name in names) and names:
+        values = df[names].values
+    elif par_val is not None:
+        simulations, par_values = par_val
+        goal_simulations = get_goal_layout(goal)["simulations"]
+        rows = numpy.searchsorted(simulations, goal_simulations)
+        if numpy.any(rows >= len(simulations)) or numpy.any(simulations[rows] != goal_simulations):
+            raise ValueError("Simulations of goal.txt not found in par_val.txt")
+        values = par_values[rows]
+        if not names:
+            names = ["par_" + str(i + 1) for i in range(values.shape[1])]
+        values = values[:, :len(names)]
+    else:
+        raise ValueError("Parameter values not found in goal.txt")
+    objective_names = get_objective_columns(df, names)
+    columns = [df[name].values for name in objective_names]
+    for name, column in (objectives or {}).items():
+        objective_names.append(name)
+        columns.append(numpy.asarray(column).ravel())
+    objective_values = numpy.column_stack(columns).astype(numpy.float64)
+    valid = numpy.all(numpy.isfinite(objective_values), axis=1) & numpy.all(numpy.isfinite(values), axis=1)
+    if not valid.all():
+        logger.warning("Simulations without valid values left out of the sensitivity: " + str(int((~valid).sum())))
+        values, objective_values = values[valid], objective_values[valid]
+
+    regression = RegressionSensitivity(len(names), len(objective_names))
+    step = chunk_size or len(values)
+    for start in range(0, len(values), step):
+        regression.update(values[start:start + step], objective_values[start:start + step])
+    result = regression.compute()
+    correlation, correlation_p = rank_correlation(values, objective_values, chunk_size)
+
+    n_params, n_objectives = len(names), len(objective_names)
+    p_value = result["p_value"]
+    # The p-values of the sensitive parameters all round to 0: the absolute t-stat still orders them
+    t_stat = numpy.abs(result["t_stat"])
+    order = numpy.argsort(-numpy.where(numpy.isnan(t_stat), -numpy.inf, t_stat), axis=0, kind="stable")
+    ranks = numpy.empty(t_stat.shape, dtype=int)
+    numpy.put_along_axis(ranks, order, numpy.arange(1, n_params + 1)[:, None], axis=0)
+    return pd.DataFrame({"objective": numpy.tile(objective_names, n_params),
+                         "parameter": numpy.repeat(names, n_objectives),
+                         "t_stat": result["t_stat"].ravel(), "p_value": p_value.ravel(), "rank": ranks.ravel(),
+                         "coefficient": result["coefficients"].ravel(), "spearman": correlation.ravel(),
+                         "spearman_p_value": correlation_p.ravel()})
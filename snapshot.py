@@ -0,0 +1,257 @@
+import os
+import json
+import zlib
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotStore(object):
+    """
+    Deduplicated snapshots of project folders (SUFI2.OUT, and SUFI2.IN if asked) in a content addressed chunk store.
+    Every file is split in fixed size chunks; a chunk is stored once, zlib compressed, under the hash of its content
+    (objects/<hash[:2]>/<hash>). A snapshot is a manifest (snapshots/<name>.json) with the chunk list of every file.
+
+    A file identical to the previous snapshot (same size and modification time) reuses its chunk list without being
+    read. The var files of SUFI2.OUT grow by appending, so all their chunks but the last are already in the store and
+    only the new data is compressed and written: the disk usage and the archive time grow with the changed data.
+    """
+    OBJECTS_FOLDER = "objects"
+    SNAPSHOTS_FOLDER = "snapshots"
+
+    def __init__(self, store_path: str, chunk_size: int = 1024 ** 2, compress_level: int = 1, max_workers: int = None):
+        """
+        Parameters
+        ----------
+        store_path : store folder. Created if it does not exist
+        chunk_size : bytes per chunk
+        compress_level : zlib level of the chunks (0 stores them without compression)
+        max_workers : threads hashing, compressing and writing chunks. os.cpu_count() if None
+        """
+        if chunk_size < 1:
+            raise ValueError("chunk_size should be a positive Int")
+        self.store_path = store_path
+        self.chunk_size = chunk_size
+        self.compress_level = compress_level
+        self.max_workers = max_workers or os.cpu_count() or 1
+        os.makedirs(os.path.join(store_path, self.OBJECTS_FOLDER), exist_ok=True)
+        os.makedirs(os.path.join(store_path, self.SNAPSHOTS_FOLDER), exist_ok=True)
+
+    def get_object_path(self, key: str) -> str:
+        return os.path.join(self.store_path, self.OBJECTS_FOLDER, key[:2], key)
+
+    def get_manifest_path(self, name: str) -> str:
+        return os.path.join(self.store_path, self.SNAPSHOTS_FOLDER, str(name) + ".json")
+
+    def list_snapshots(self) -> list:
+        """ Snapshot names, oldest first """
+        manifests = [self.read_manifest(file[:-5]) for file in os.listdir(os.path.join(self.store_path,
+                                                                                     self.SNAPSHOTS_FOLDER))
+                     if file.endswith(".json")]
+        return [manifest["name"] for manifest in sorted(manifests, key=lambda manifest: manifest["created"])]
+
+    def read_manifest(self, name: str) -> dict:
+        file = self.get_manifest_path(name)
+        if not os.path.isfile(file):
+            raise ValueError("Snapshot not found: " + str(name))
+        with open(file, "r") as fo:
+            return json.load(fo)
+
+    def _put_chunk(self, data: bytes):
+        """ Stores a chunk if it is not in the store. Returns (key, stored bytes written) """
+        key = hashlib.blake2b(data, digest_size=20).hexdigest()
+        file = self.get_object_path(key)
+        if os.path.isfile(file):
+            return key, 0
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # Level 0 still writes a zlib stream, so any store can read the chunks
+        payload = zlib.compress(data, self.compress_level)
+        tmp_file = file + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+        with open(tmp_file, "wb") as fo:
+            fo.write(payload)
+        os.replace(tmp_file, file)
+        return key, len(payload)
+
+    def _get_chunk(self, key: str) -> bytes:
+        with open(self.get_object_path(key), "rb") as fo:
+            return zlib.decompress(fo.read())
+
+    def _store_file(self, file: str) -> dict:
+        stat = os.stat(file)
+        chunks = []
+        written = 0
+        with open(file, "rb") as fo:
+            while True:
+                data = fo.read(self.chunk_size)
+                if not data:
+                    break
+                key, size = self._put_chunk(data)
+                chunks.append(key)
+                written += size
+        return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "mode": stat.st_mode & 0o777,
+                "chunks": chunks, "written": written}
+
+    def _walk(self, project_path: str, folders):
+        for folder in folders:
+            folder_path = os.path.join(project_path, folder)
+            if not os.path.isdir(folder_path):
+                raise ValueError("Folder not found: " + folder_path)
+            for root, subfolders, files in os.walk(folder_path):
+                subfolders.sort()
+                for file in sorted(files):
+                    yield os.path.relpath(os.path.join(root, file), project_path).replace(os.sep, "/")
+
+    def snapshot(self, project_path: str, name: str, folders=("SUFI2.OUT",), parent: str = None,
+                 quick_check: bool = True) -> dict:
+        """ Stores the files of folders of a project as a snapshot. A snapshot with the same name is replaced
+
+        Parameters
+        ----------
+        project_path : project folder
+        name : snapshot name
+        folders : project folders stored (ex: ("SUFI2.OUT", "SUFI2.IN"))
+        parent : snapshot whose unchanged files (size and modification time) are not read. The last snapshot if None
+        quick_check : reuses the chunks of the unchanged files of the parent. Every file is read if False
+
+        Returns
+        -------
+        dict with the 'files', the 'size' of the files, the 'reused' files and the bytes 'written' to the store
+        """
+        started = time.time()
+        if parent is None:
+            snapshots = [snapshot for snapshot in self.list_snapshots() if snapshot != str(name)]
+            parent = snapshots[-1] if snapshots else None
+        parent_files = self.read_manifest(parent)["files"] if parent is not None and quick_check else {}
+        files = {}
+        to_store = []
+        for rel_path in self._walk(project_path, folders):
+            previous = parent_files.get(rel_path)
+            stat = os.stat(os.path.join(project_path, rel_path))
+            if previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns:
+                files[rel_path] = dict(previous)
+            else:
+                to_store.append(rel_path)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            # zlib and hashlib release the GIL on large buffers
+            results = executor.map(lambda rel_path: self._store_file(os.path.join(project_path, rel_path)), to_store)
+            written = 0
+            for rel_path, entry in zip(to_store, results):
+                written += entry.pop("written")
+                files[rel_path] = entry
+        manifest = {"name": str(name), "created": time.time(), "project_path": os.path.abspath(project_path),
+                    "folders": list(folders), "parent": parent, "chunk_size": self.chunk_size,
+                    "files": dict(sorted(files.items()))}
+        file = self.get_manifest_path(name)
+        with open(file + ".tmp", "w") as fo:
+            json.dump(manifest, fo)
+        os.replace(file + ".tmp", file)
+        result = {"files": len(files), "size": sum(entry["size"] for entry in files.values()),
+                  "reused": len(files) - len(to_store), "written": written, "seconds": time.time() - started}
+        logger.info("Snapshot " + str(name) + ": " + str(result["files"]) + " files, " + str(written) +
+                    " bytes written in " + "{:.2f}".format(result["seconds"]) + " s")
+        return result
+
+    def _restore_file(self, entry: dict, dst_file: str, verify: bool):
+        if os.path.isfile(dst_file) and not verify:
+            stat = os.stat(dst_file)
+            if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+                return False
+        os.makedirs(os.path.dirname(dst_file), exist_ok=True)
+        tmp_file = dst_file + ".tmp"
+        with open(tmp_file, "wb") as fo:
+            for key in entry["chunks"]:
+                fo.write(self._get_chunk(key))
+        os.chmod(tmp_file, entry["mode"])
+        os.replace(tmp_file, dst_file)
+        os.utime(dst_file, ns=(entry["mtime_ns"], entry["mtime_ns"]))
+        return True
+
+    def restore(self, name: str, dst_path: str, folders=None, clean: bool = True, verify: bool = False) -> dict:
+        """ Restores a snapshot into a project folder
+
+        Parameters
+        ----------
+        name : snapshot name
+        dst_path : project folder the snapshot folders are restored to
+        folders : folders restored. All the folders of the snapshot if None
+        clean : removes the files of the restored folders that are not in the snapshot
+        verify : rewrites every file. Otherwise the files with the snapshot size and modification time are kept
+
+        Returns
+        -------
+        dict with the 'restored', 'kept' and 'removed' files
+        """
+        manifest = self.read_manifest(name)
+        folders = list(folders) if folders is not None else manifest["folders"]
+        entries = {rel_path: entry for rel_path, entry in manifest["files"].items()
+                   if rel_path.split("/")[0] in folders}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            restored = list(executor.map(lambda item: self._restore_file(item[1], os.path.join(dst_path, item[0]),
+                                                                         verify), entries.items()))
+        removed = 0
+        if clean:
+            for folder in folders:
+                if not os.path.isdir(os.path.join(dst_path, folder)):
+                    os.makedirs(os.path.join(dst_path, folder))
+                    continue
+                for rel_path in list(self._walk(dst_path, [folder])):
+                    if rel_path not in entries:
+                        os.remove(os.path.join(dst_path, rel_path))
+                        removed += 1
+        return {"restored": sum(restored), "kept": len(restored) - sum(restored), "removed": removed}
+
+    def diff(self, old: str, new: str) -> dict:
+        """ Files 'added', 'removed', 'changed' and 'unchanged' from snapshot old to snapshot new, and the bytes of
+        new that are not in old ('changed_bytes')
+        """
+        old_files = self.read_manifest(old)["files"]
+        new_files = self.read_manifest(new)["files"]
+        old_chunks = {key for entry in old_files.values() for key in entry["chunks"]}
+        changed = sorted(rel_path for rel_path in set(old_files) & set(new_files)
+                         if old_files[rel_path]["chunks"] != new_files[rel_path]["chunks"])
+        chunk_size = self.read_manifest(new)["chunk_size"]
+        new_bytes = 0
+        for rel_path, entry in new_files.items():
+            for number, key in enumerate(entry["chunks"]):
+                if key not in old_chunks:
+                    new_bytes += min(chunk_size, entry["size"] - number * chunk_size)
+        return {"added": sorted(set(new_files) - set(old_files)), "removed": sorted(set(old_files) - set(new_files)),
+                "changed": changed, "unchanged": sorted(set(old_files) & set(new_files) - set(changed)),
+                "changed_bytes": new_bytes}
+
+    def remove(self, name: str, collect: bool = True) -> int:
+        """ Removes a snapshot and, with collect, the chunks no other snapshot uses. Returns the chunks removed """
+        os.remove(self.get_manifest_path(name))
+        return self.collect_garbage() if collect else 0
+
+    def collect_garbage(self) -> int:
+        """ Removes the chunks not used by any snapshot. Returns the number of chunks removed """
+        used = set()
+        for name in self.list_snapshots():
+            for entry in self.read_manifest(name)["files"].values():
+                used.update(entry["chunks"])
+        removed = 0
+        objects_path = os.path.join(self.store_path, self.OBJECTS_FOLDER)
+        for folder in os.listdir(objects_path):
+            for key in os.listdir(os.path.join(objects_path, folder)):
+                if key not in used:
+                    os.remove(os.path.join(objects_path, folder, key))
+                    removed += 1
+        return removed
+
+    def get_usage(self) -> dict:
+        """ 'chunks' and 'stored_bytes' of the store and 'logical_bytes', the size of all the snapshot files """
+        objects_path = os.path.join(self.store_path, self.OBJECTS_FOLDER)
+        chunks, stored = 0, 0
+        for folder in os.listdir(objects_path):
+            for key in os.listdir(os.path.join(objects_path, folder)):
+                chunks += 1
+                stored += os.path.getsize(os.path.join(objects_path, folder, key))
+        logical = sum(entry["size"] for name in self.list_snapshots()
+                      for entry in self.read_manifest(name)["files"].values())
+        return {"snapshots": len(self.list_snapshots()), "chunks": chunks, "stored_bytes": stored,
+                "logical_bytes": logical}
@@ -0,0 +1,416 @@
+import io
+import os
+import re
+import hashlib
+import logging
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+SWEDIT_DEF_FILE = "SUFI2_swEdit.def"
+GOAL_FILE = "goal.txt"
+# Extension of the binary sidecar of a var file (FLOW_OUT_1.txt -> FLOW_OUT_1.bin)
+SIDECAR_EXTENSION = ".bin"
+
+# A simulation header inside a SUFI2.OUT var file is a line holding only the simulation number
+SIMULATION_HEADER_PATTERN = re.compile(rb"^[ \t]*(\d+)[ \t]*\r?$", re.MULTILINE)
+# Simulation header written by the SUFI2_extract executables
+SIMULATION_HEADER_FORMAT = "{:4d} \n"
+
+
+def read_swedit_def(path: str):
+    """ Reads the simulation range from SUFI2_swEdit.def
+
+    Parameters
+    ----------
+    path : project folder
+
+    Returns
+    -------
+    (start, end) simulation numbers
+    """
+    file = os.path.join(path, SWEDIT_DEF_FILE)
+    with open(file, "r") as fo:
+        lines = fo.readlines()
+    try:
+        start = int(lines[0].split(":")[0])
+        end = int(lines[1].split(":")[0])
+    except (IndexError, ValueError):
+        raise ValueError("Invalid swEdit file:" + file)
+    return start, end
+
+
+def write_swedit_def(path: str, start: int, end: int):
+    """ Writes the simulation range in SUFI2_swEdit.def, keeping any remarks after the range lines
+
+    Parameters
+    ----------
+    path : project folder
+    start : starting simulation number
+    end : ending simulation number
+    """
+    if start > end:
+        raise ValueError("Invalid simulation range: " + str(start) + " - " + str(end))
+    file = os.path.join(path, SWEDIT_DEF_FILE)
+    remarks = []
+    if os.path.isfile(file):
+        with open(file, "r") as fo:
+            remarks = fo.readlines()[2:]
+    with open(file, "w") as fo:
+        fo.write("{:<9d}: starting simulation number\n".format(start))
+        fo.write("{:<7d}: ending simulation number\n".format(end))
+        fo.writelines(remarks)
+
+
+def read_var_file_names(path: str):
+    """ Returns the var file names of SUFI2.IN/var_file_name.txt """
+    with open(os.path.join(path, "SUFI2.IN", "var_file_name.txt"), "r") as fo:
+        return [line.strip() for line in fo if line.strip()]
+
+
+def read_sufi2_var_blocks(file_path: str):
+    """ Splits a SUFI2.OUT var file into simulation blocks
+
+    Returns
+    -------
+    list of (simulation number, block bytes). Each block starts with its header line.
+    """
+    with open(file_path, "rb") as fo:
+        content = fo.read()
+    headers = list(SIMULATION_HEADER_PATTERN.finditer(content))
+    blocks = []
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(content)
+        block = content[header.start():end]
+        if not block.endswith(b"\n"):
+            block += b"\n"
+        blocks.append((int(header.group(1)), block))
+    return blocks
+
+
+def merge_sufi2_var_files(src_files, dst_file: str):
+    """ Merges SUFI2.OUT var files into dst_file, ordering the simulation blocks by simulation number.
+    Missing source files are ignored.
+    """
+    blocks = []
+    for src_file in src_files:
+        if os.path.isfile(src_file):
+            blocks.extend(read_sufi2_var_blocks(src_file))
+        else:
+            logger.warning("Var file not found, skipping: " + src_file)
+    blocks.sort(key=lambda block: block[0])
+    with open(dst_file, "wb") as fo:
+        for simulation, block in blocks:
+            fo.write(block)
+    return len(blocks)
+
+
+def merge_goal_files(src_files, dst_file: str):
+    """ Merges goal.txt files into dst_file. The header is taken from the first file, the number of
+    simulations is updated and the rows are ordered by simulation number.
+    """
+    header = None
+    rows = []
+    for src_file in src_files:
+        with open(src_file, "r") as fo:
+            lines = fo.readlines()
+        content = [line for line in lines if line.strip()]
+        if header is None:
+            header = content[:4]
+        rows.extend(content[4:])
+    if header is None:
+        raise ValueError("No goal file to merge")
+    rows.sort(key=lambda row: int(float(row.split()[0])))
+    header[1] = re.sub(r"(no_Sims=\s*)\d+", lambda m: m.group(1) + str(len(rows)), header[1])
+    with open(dst_file, "w") as fo:
+        fo.writelines(header)
+        fo.writelines(rows)
+    return len(rows)
+
+
+def filter_goal_file(file_path: str, simulations) -> int:
+    """ Keeps only the rows of the given simulations in a goal.txt, in simulation order, and updates the number of
+    simulations. Returns the number of rows kept
+    """
+    simulations = set(int(simulation) for simulation in simulations)
+    with open(file_path, "r") as fo:
+        content = [line for line in fo.readlines() if line.strip()]
+    header = content[:4]
+    if len(header) < 4:
+        raise ValueError("Invalid goal file:" + file_path)
+    columns = len(header[3].split())
+    rows = []
+    for row in content[4:]:
+        tokens = row.split()
+        if len(tokens) != columns:
+            # Partial row of a killed run
+            continue
+        try:
+            simulation = int(float(tokens[0]))
+        except ValueError:
+            continue
+        if simulation in simulations:
+            rows.append((simulation, row if row.endswith("\n") else row + "\n"))
+    rows.sort(key=lambda row: row[0])
+    header[1] = re.sub(r"(no_Sims=\s*)\d+", lambda m: m.group(1) + str(len(rows)), header[1])
+    with open(file_path, "w") as fo:
+        fo.writelines(header)
+        fo.writelines(row for simulation, row in rows)
+    return len(rows)
+
+
+def read_par_inf(path: str):
+    """ Reads SUFI2.IN/par_inf.txt
+
+    Parameters
+    ----------
+    path : project folder
+
+    Returns
+    -------
+    (names, ranges, simulation_number). names is the list of the parameter names (ex: r__CN2.mgt) and ranges a list
+    of (min, max)
+    """
+    file = os.path.join(path, "SUFI2.IN", "par_inf.txt")
+    with open(file, "r") as fo:
+        lines = fo.readlines()
+    try:
+        param_number = int(lines[0].split(":")[0])
+        simulation_number = int(lines[1].split(":")[0])
+    except (IndexError, ValueError):
+        raise ValueError("Invalid par_inf file:" + file)
+    names = []
+    ranges = []
+    for line in lines[2:]:
+        tokens = line.split()
+        if len(tokens) < 3 or tokens[0][:3].lower() not in ("r__", "v__", "a__"):
+            continue
+        names.append(tokens[0])
+        ranges.append((float(tokens[1]), float(tokens[2])))
+        if len(names) == param_number:
+            break
+    if len(names) != param_number:
+        raise ValueError("Invalid par_inf file:" + file + ". Found " + str(len(names)) + " of " +
+                         str(param_number) + " parameters")
+    return names, ranges, simulation_number
+
+
+def write_par_inf(path: str, ranges, simulation_number: int = None):
+    """ Writes new parameter ranges (and number of simulations) in SUFI2.IN/par_inf.txt, keeping the rest of the
+    file: the remarks, the parameters after the first 'Number of Parameters' and the lines not read by SUFI2
+
+    Parameters
+    ----------
+    path : project folder
+    ranges : (min, max) of each parameter, in the order of read_par_inf
+    simulation_number : number of simulations. Not changed if None
+    """
+    file = os.path.join(path, "SUFI2.IN", "par_inf.txt")
+    with open(file, "r") as fo:
+        lines = fo.readlines()
+    param_number = int(lines[0].split(":")[0])
+    if len(ranges) != param_number:
+        raise ValueError("Expected " + str(param_number) + " parameter ranges, got " + str(len(ranges)))
+    if simulation_number is not None:
+        lines[1] = "{:<3d}: ".format(int(simulation_number)) + lines[1].split(":", 1)[1].lstrip()
+    param = 0
+    for number, line in enumerate(lines[2:], 2):
+        if param == param_number:
+            break
+        tokens = line.split()
+        if len(tokens) < 3 or tokens[0][:3].lower() not in ("r__", "v__", "a__"):
+            continue
+        low, high = ranges[param]
+        if low > high:
+            raise ValueError("Invalid range of " + tokens[0] + ": " + str(low) + " - " + str(high))
+        lines[number] = " {:<17s} {:<12.10g} {:<12.10g}".format(tokens[0], low, high).rstrip() + \
+            ("  " + " ".join(tokens[3:]) if len(tokens) > 3 else "") + "\n"
+        param += 1
+    with open(file, "w") as fo:
+        fo.writelines(lines)
+
+
+def read_par_val(path: str):
+    """ Reads SUFI2.IN/par_val.txt
+
+    Returns
+    -------
+    (simulations, values). values is a (n_sims, n_pars) NumPy array
+    """
+    file = os.path.join(path, "SUFI2.IN", "par_val.txt")
+    data = numpy.loadtxt(file, ndmin=2)
+    return data[:, 0].astype(int), data[:, 1:]
+
+
+def par_val_fingerprint(path: str) -> str:
+    """ Hash of SUFI2.IN/par_val.txt: results are only valid for the parameter sets they were run with """
+    with open(os.path.join(path, "SUFI2.IN", "par_val.txt"), "rb") as fo:
+        return hashlib.sha256(fo.read()).hexdigest()
+
+
+def write_par_val(path: str, simulations, values):
+    """ Writes SUFI2.IN/par_val.txt in the SUFI2_LH_sample.exe layout
+
+    Parameters
+    ----------
+    path : project folder
+    simulations : simulation numbers
+    values : (n_sims, n_pars) parameter values
+    """
+    file = os.path.join(path, "SUFI2.IN", "par_val.txt")
+    with open(file, "w") as fo:
+        for simulation, row in zip(simulations, values):
+            fo.write("{:d}   ".format(int(simulation)) + "".join("{:.6f}  ".format(value) for value in row) + "\n")
+
+
+def read_observed(file_path: str):
+    """ Reads a SUFI2.IN observed file. Works with observed.txt (with the objective function settings and the
+    weight of each variable) and with observed_rch.txt, observed_sub.txt and observed_hru.txt.
+
+    Returns
+    -------
+    dict with 'goal_type', 'threshold', 'mns_power' (None if not in the file) and 'variables', a list of dicts with
+    'name', 'weight', 'error', 'index' (time step numbers) and 'values' (NumPy arrays)
+    """
+    with open(file_path, "r") as fo:
+        lines = [line.rstrip("\n") for line in fo]
+
+    def value(line):
+        return line.split(":")[0].strip()
+
+    observed = {"goal_type": None, "threshold": None, "mns_power": None, "variables": []}
+    variable_number = int(float(value(lines[0])))
+    i = 1
+    # Objective function settings (observed.txt only)
+    while i < len(lines) and not lines[i].strip():
+        i += 1
+    if "objective function type" in lines[i].lower():
+        observed["goal_type"] = int(float(value(lines[i])))
+        observed["threshold"] = float(value(lines[i + 1]))
+        if "power" in lines[i + 2].lower():
+            observed["mns_power"] = float(value(lines[i + 2]))
+            i += 1
+        i += 2
+
+    for v in range(variable_number):
+        while i < len(lines) and not lines[i].strip():
+            i += 1
+        if i >= len(lines):
+            raise ValueError("Invalid observed file:" + file_path + ". Found " + str(v) + " of " +
+                             str(variable_number) + " variables")
+        variable = {"name": value(lines[i]).split()[0], "weight": 1.0, "error": None}
+        i += 1
+        while "number of data points" not in lines[i].lower():
+            comment = lines[i].lower()
+            if "weight of the variable" in comment:
+                variable["weight"] = float(value(lines[i]))
+            elif "measurement error" in comment:
+                variable["error"] = float(value(lines[i]))
+            i += 1
+        point_number = int(float(value(lines[i])))
+        i += 1
+        while i < len(lines) and lines[i].strip().startswith(":"):
+            i += 1
+        index = []
+        values = []
+        while len(index) < point_number:
+            tokens = lines[i].split()
+            i += 1
+            if len(tokens) >= 3:
+                index.append(int(tokens[0]))
+                values.append(float(tokens[2]))
+        variable["index"] = numpy.array(index, dtype=int)
+        variable["values"] = numpy.array(values, dtype=numpy.float64)
+        observed["variables"].append(variable)
+    return observed
+
+
+def write_goal(path: str, param_names, simulations, param_values, goal_values, goal_type: str):
+    """ Writes SUFI2.OUT/goal.txt in the layout of SUFI2_goal_fn.exe
+
+    Parameters
+    ----------
+    path : project folder
+    param_names : parameter names (columns)
+    simulations : simulation numbers
+    param_values : (n_sims, n_pars) parameter values
+    goal_values : goal function value of each simulation
+    goal_type : goal function name of goal.txt (ex: Nash_Sutcliff, see objectives.GOAL_FUNCTION_NAMES)
+    """
+    file = os.path.join(path, "SUFI2.OUT", GOAL_FILE)
+    with open(file, "w") as fo:
+        fo.write("no_pars=  " + str(len(param_names)) + "\n")
+        fo.write("no_Sims=  " + str(len(simulations)) + "\n")
+        fo.write("type_of_goal_fn= " + goal_type + "\n")
+        fo.write("Sim_No.     " + "   ".join(param_names) + " goal_value\n")
+        for simulation, values, goal in zip(simulations, param_values, goal_values):
+            fo.write("{:<5d}".format(int(simulation)) + "".join("{:9.4f}".format(v) for v in values) +
+                     "  {:f}\n".format(goal))
+
+
+def read_trk(path: str) -> int:
+    """ Reads the current simulation number from SUFI2.IN/trk.txt """
+    file = os.path.join(path, "SUFI2.IN", "trk.txt")
+    with open(file, "r") as fo:
+        content = fo.read().split()
+    try:
+        return int(content[0])
+    except (IndexError, ValueError):
+        raise ValueError("Invalid trk file:" + file)
+
+
+def write_trk(path: str, simulation: int):
+    """ Writes the current simulation number to SUFI2.IN/trk.txt """
+    with open(os.path.join(path, "SUFI2.IN", "trk.txt"), "w") as fo:
+        fo.write(str(int(simulation)) + "\n")
+
+
+def append_sufi2_var(file_path: str, simulation: int, time_steps, values):
+    """ Appends a simulation block to a SUFI2.OUT var file in the SUFI2_extract_*.exe layout
+
+    Parameters
+    ----------
+    file_path : var file path
+    simulation : simulation number
+    time_steps : time step numbers
+    values : value of each time step
+    """
+    with open(file_path, "ab") as fo:
+        fo.write(format_sufi2_var_block(simulation, time_steps, values))
+
+
+def format_sufi2_var_block(simulation: int, time_steps, values) -> bytes:
+    """ Returns a simulation block (header line and one line per time step) in the SUFI2_extract_*.exe layout """
+    fo = io.BytesIO()
+    fo.write(SIMULATION_HEADER_FORMAT.format(int(simulation)).encode())
+    numpy.savetxt(fo, numpy.column_stack((time_steps, values)), fmt=["%d", "%.6e"], delimiter="  ")
+    return fo.getvalue()
+
+
+def truncate_sufi2_var_file(file_path: str, simulation: int):
+    """ Removes the block of a simulation, and everything after it, from the end of a var file. Used to drop the
+    partial block of a simulation that was killed. If the simulation has no block, only an incomplete last line is
+    removed.
+    """
+    with open(file_path, "rb") as fo:
+        content = fo.read()
+    size = content.rfind(b"\n") + 1
+    for header in SIMULATION_HEADER_PATTERN.finditer(content):
+        if int(header.group(1)) == simulation:
+            size = header.start()
+    if size < len(content):
+        with open(file_path, "r+b") as fo:
+            fo.truncate(size)
+
+
+def append_sufi2_var_sidecar(file_path: str, simulation: int, time_steps, values):
+    """ Appends a simulation record to the binary sidecar of a var file (see SIDECAR_EXTENSION). A record is the
+    simulation number and the number of time steps (int64), followed by the time steps (int64) and the values
+    (float64), in native byte order.
+    """
+    time_steps = numpy.asarray(time_steps, dtype=numpy.int64)
+    with open(file_path, "ab") as fo:
+        fo.write(numpy.array([simulation, len(time_steps)], dtype=numpy.int64).tobytes())
+        fo.write(time_steps.tobytes())
+        fo.write(numpy.asarray(values, dtype=numpy.float64).tobytes())
@@ -0,0 +1,398 @@
+import math
+import logging
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.objectives import MAXIMIZED_GOAL_FUNCTIONS, get_goal_function, get_goal_layout
+from swatcuppython.sampling import LatinHypercubeSampler
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("mean", "ucb", "ei", "std")
+
+_erf = numpy.vectorize(math.erf, otypes=[numpy.float64])
+
+
+def normal_pdf(x):
+    return numpy.exp(-0.5 * x ** 2) / math.sqrt(2 * math.pi)
+
+
+def normal_cdf(x):
+    return 0.5 * (1 + _erf(x / math.sqrt(2)))
+
+
+def spearman(x, y) -> float:
+    """ Rank correlation of two samples (ties get consecutive ranks) """
+    if len(x) < 2:
+        return float("nan")
+    rx = numpy.argsort(numpy.argsort(x, kind="stable"), kind="stable").astype(numpy.float64)
+    ry = numpy.argsort(numpy.argsort(y, kind="stable"), kind="stable").astype(numpy.float64)
+    return float(numpy.corrcoef(rx, ry)[0, 1])
+
+
+def accuracy(observed, predicted) -> dict:
+    """ 'r2', 'rmse' and 'spearman' rank correlation of predicted goal values """
+    observed = numpy.asarray(observed, dtype=numpy.float64)
+    predicted = numpy.asarray(predicted, dtype=numpy.float64)
+    residual = observed - predicted
+    total = numpy.sum((observed - observed.mean()) ** 2)
+    return {"r2": float(1 - numpy.sum(residual ** 2) / total) if total > 0 else float("nan"),
+            "rmse": float(numpy.sqrt(numpy.mean(residual ** 2))), "spearman": spearman(observed, predicted)}
+
+
+class GaussianProcess(object):
+    """
+    Gaussian process regression with a squared exponential kernel, in NumPy. The inputs should be scaled to [0, 1];
+    the outputs are standardized. The length scale and the noise are chosen from a grid by the log marginal likelihood
+    when they are not given.
+    """
+    LENGTH_SCALES = (0.05, 0.1, 0.2, 0.35, 0.5, 0.75, 1.0, 2.0)
+    NOISES = (1e-6, 1e-3, 1e-2, 1e-1)
+
+    def __init__(self, length_scale: float = None, noise: float = None):
+        """
+        Parameters
+        ----------
+        length_scale : kernel length scale (inputs in [0, 1]). Chosen from LENGTH_SCALES if None
+        noise : noise variance of the standardized outputs. Chosen from NOISES if None
+        """
+        self.length_scale = length_scale
+        self.noise = noise
+        self.x = None
+        self.y_mean = 0.0
+        self.y_std = 1.0
+        self._cholesky = None
+        self._alpha = None
+        self.log_likelihood = None
+        self.fitted_length_scale = None
+        self.fitted_noise = None
+
+    @staticmethod
+    def _squared_distances(a, b):
+        distances = numpy.sum(a ** 2, axis=1)[:, None] + numpy.sum(b ** 2, axis=1)[None, :] - 2 * a @ b.T
+        return numpy.maximum(distances, 0.0)
+
+    def _factor(self, distances, y, length_scale: float, noise: float):
+        """ (cholesky, alpha, log marginal likelihood), or None if the kernel matrix is not positive definite """
+        kernel = numpy.exp(-0.5 * distances / length_scale ** 2)
+        kernel[numpy.diag_indices_from(kernel)] += noise
+        try:
+            cholesky = numpy.linalg.cholesky(kernel)
+        except numpy.linalg.LinAlgError:
+            return None
+        alpha = numpy.linalg.solve(cholesky.T, numpy.linalg.solve(cholesky, y))
+        log_likelihood = -0.5 * y @ alpha - numpy.sum(numpy.log(numpy.diag(cholesky))) - \
+            0.5 * len(y) * math.log(2 * math.pi)
+        return cholesky, alpha, float(log_likelihood)
+
+    def fit(self, x, y):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        y = numpy.asarray(y, dtype=numpy.float64)
+        self.y_mean = float(y.mean())
+        self.y_std = float(y.std()) or 1.0
+        y = (y - self.y_mean) / self.y_std
+        distances = self._squared_distances(x, x)
+        length_scales = self.LENGTH_SCALES if self.length_scale is None else (self.length_scale,)
+        noises = self.NOISES if self.noise is None else (self.noise,)
+        best = None
+        for length_scale in length_scales:
+            for noise in noises:
+                result = self._factor(distances, y, length_scale, noise)
+                if result is not None and (best is None or result[2] > best[0][2]):
+                    best = (result, length_scale, noise)
+        if best is None:
+            raise ValueError("Gaussian process kernel matrix is not positive definite")
+        (self._cholesky, self._alpha, self.log_likelihood), self.fitted_length_scale, self.fitted_noise = best
+        self.x = x
+        return self
+
+    def predict(self, x, batch_size: int = 4096):
+        """ Returns (mean, std) of the predicted outputs """
+        if self.x is None:
+            raise ValueError("Gaussian process not fitted")
+        x = numpy.asarray(x, dtype=numpy.float64)
+        mean = numpy.empty(len(x))
+        std = numpy.empty(len(x))
+        for start in range(0, len(x), batch_size):
+            kernel = numpy.exp(-0.5 * self._squared_distances(x[start:start + batch_size], self.x) /
+                               self.fitted_length_scale ** 2)
+            mean[start:start + batch_size] = kernel @ self._alpha
+            v = numpy.linalg.solve(self._cholesky, kernel.T)
+            std[start:start + batch_size] = numpy.sqrt(numpy.maximum(1.0 - numpy.sum(v ** 2, axis=0), 0.0))
+        return mean * self.y_std + self.y_mean, std * self.y_std
+
+
+class SurrogateScreening(object):
+    """
+    Surrogate pre-screening of the SUFI2 samples. A GaussianProcess is trained on the parameter values and goal
+    values of the simulations run so far (goal.txt of the iterations, as read_sufi2_out_goal), scores a pool of
+    oversample times more Latin hypercube candidates than simulations from the par_inf.txt ranges and only the best
+    scored candidates are written to par_val.txt, so swat.exe runs only them.
+
+    Usage:
+        surrogate = swatcup.get_surrogate()           # trained with the goal.txt of the project
+        selection = surrogate.screen(100, oversample=20)
+        surrogate.write_par_val(selection["values"])
+        swatcup.sufi2_run(); info, df = swatcup.compute_goal()
+        surrogate.report((info, df))                  # accuracy and SWAT runs saved
+        surrogate.add_goal((info, df))                # history for the next iteration
+    """
+
+    def __init__(self, project_path: str, goal_type: str = None, threshold: float = None, max_train: int = 500,
+                 length_scale: float = None, noise: float = None, seed: int = None):
+        """
+        Parameters
+        ----------
+        project_path : project folder, with the par_inf.txt ranges of the candidates
+        goal_type : goal function (ex: 'NS', 'Nash_Sutcliff' or 5). Taken from the first goal added if None
+        threshold : behavioral threshold, used for the hit rates of the report. Not reported if None
+        max_train : simulations the surrogate is trained with: the best half and a random sample of the others
+        length_scale, noise : GaussianProcess hyperparameters. Chosen by the marginal likelihood if None
+        seed : random seed of the candidates and of the training subsample
+        """
+        self.project_path = project_path
+        self.goal_type = get_goal_function(goal_type) if goal_type is not None else None
+        self.threshold = threshold
+        self.max_train = max_train
+        self.model = GaussianProcess(length_scale, noise)
+        self.rng = numpy.random.default_rng(seed)
+        self.seed = seed
+        self.names, self.ranges, self.simulation_number = sufi2files.read_par_inf(project_path)
+        self.values = numpy.empty((0, len(self.names)))
+        self.goal = numpy.empty(0)
+        self.lower = None
+        self.upper = None
+        self.fitted = False
+        self.last_selection = None
+
+    def is_maximized(self) -> bool:
+        return self.goal_type in MAXIMIZED_GOAL_FUNCTIONS
+
+    def add(self, values, goal):
+        """ Adds simulations to the history
+
+        Parameters
+        ----------
+        values : (n_sims, n_pars) parameter values, in the order of the par_inf.txt parameters
+        goal : goal value of each simulation
+        """
+        values = numpy.asarray(values, dtype=numpy.float64).reshape(-1, len(self.names))
+        goal = numpy.asarray(goal, dtype=numpy.float64).ravel()
+        if len(values) != len(goal):
+            raise ValueError("Got " + str(len(values)) + " parameter sets and " + str(len(goal)) + " goal values")
+        valid = numpy.isfinite(goal) & numpy.all(numpy.isfinite(values), axis=1)
+        self.values = numpy.vstack((self.values, values[valid]))
+        self.goal = numpy.concatenate((self.goal, goal[valid]))
+        self.fitted = False
+
+    def add_goal(self, goal, par_val=None):
+        """ Adds the simulations of a goal.txt
+
+        Parameters
+        ----------
+        goal : (info, df) as read_sufi2_out_goal, compute_goal or ResultStore.read_goal
+        par_val : (simulations, values) as sufi2files.read_par_val, used when df does not have the parameter columns
+        """
+        info, df = goal
+        layout = get_goal_layout(goal)
+        if self.goal_type is None:
+            self.goal_type = layout["goal_function"]
+        elif layout["goal_function"] != self.goal_type:
+            raise ValueError("Goal function " + str(info["type_of_goal_fn"]) + " differs from " + self.goal_type)
+        if all(name in df.columns for name in self.names):
+            values = df[self.names].values
+        elif par_val is not None:
+            simulations, par_values = par_val
+            rows = numpy.searchsorted(simulations, layout["simulations"])
+            if numpy.any(rows >= len(simulations)) or numpy.any(simulations[rows] != layout["simulations"]):
+                raise ValueError("Simulations of goal.txt not found in par_val.txt")
+            values = par_values[rows, :len(self.names)]
+        else:
+            raise ValueError("Parameters of par_inf.txt not found in goal.txt: " + str(self.names))
+        self.add(values, layout["goal"])
+
+    def add_store(self, store, iterations=None):
+        """ Adds the goal.txt of the iterations (all if None) of a ResultStore """
+        for iteration in (iterations if iterations is not None else store.list_iterations()):
+            self.add_goal(store.read_goal(iteration), store.read_par_val(iteration))
+
+    def _scale(self, values):
+        return (values - self.lower) / (self.upper - self.lower)
+
+    def _training_rows(self):
+        n = len(self.goal)
+        if n <= self.max_train:
+            return numpy.arange(n)
+        order = numpy.argsort(-self.goal if self.is_maximized() else self.goal, kind="stable")
+        best = order[:self.max_train // 2]
+        others = self.rng.choice(order[self.max_train // 2:], self.max_train - len(best), replace=False)
+        return numpy.sort(numpy.concatenate((best, others)))
+
+    def fit(self):
+        """ Trains the surrogate with the history """
+        if len(self.goal) < 2:
+            raise ValueError("At least 2 simulations are needed to train the surrogate")
+        ranges = numpy.array(self.ranges, dtype=numpy.float64)
+        self.lower = numpy.minimum(ranges[:, 0], self.values.min(axis=0))
+        self.upper = numpy.maximum(ranges[:, 1], self.values.max(axis=0))
+        self.upper = numpy.where(self.upper > self.lower, self.upper, self.lower + 1.0)
+        rows = self._training_rows()
+        self.model.fit(self._scale(self.values[rows]), self.goal[rows])
+        self.fitted = True
+        logger.debug("Surrogate trained with " + str(len(rows)) + " simulations, length scale " +
+                     str(self.model.fitted_length_scale) + ", noise " + str(self.model.fitted_noise))
+        return self
+
+    def predict(self, values):
+        """ Returns (mean, std) of the goal values predicted for (n, n_pars) parameter values """
+        if not self.fitted:
+            self.fit()
+        return self.model.predict(self._scale(numpy.asarray(values, dtype=numpy.float64)))
+
+    def cross_validate(self, folds: int = 5) -> dict:
+        """ Accuracy ('r2', 'rmse', 'spearman') of the surrogate predicting the history simulations it was not trained
+        with (k-fold)
+        """
+        rows = self._training_rows()
+        if len(rows) < folds:
+            raise ValueError("Not enough simulations for " + str(folds) + " folds")
+        if not self.fitted:
+            self.fit()
+        shuffled = self.rng.permutation(rows)
+        predicted = numpy.empty(len(shuffled))
+        model = GaussianProcess(self.model.fitted_length_scale, self.model.fitted_noise)
+        for fold in numpy.array_split(numpy.arange(len(shuffled)), folds):
+            train = numpy.setdiff1d(numpy.arange(len(shuffled)), fold)
+            model.fit(self._scale(self.values[shuffled[train]]), self.goal[shuffled[train]])
+            predicted[fold] = model.predict(self._scale(self.values[shuffled[fold]]))[0]
+        return accuracy(self.goal[shuffled], predicted)
+
+    def score(self, mean, std, strategy: str = "ei", kappa: float = 2.0):
+        """ Score of the candidates, higher is better
+
+        Parameters
+        ----------
+        mean, std : predicted goal values
+        strategy : 'mean' (most promising), 'std' (most informative), 'ucb' (mean + kappa * std) or 'ei' (expected
+            improvement over the best simulation of the history)
+        kappa : weight of the std in 'ucb'
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError("Unknown strategy: " + str(strategy) + ". Use one of " + str(STRATEGIES))
+        sign = 1.0 if self.is_maximized() else -1.0
+        if strategy == "mean":
+            return sign * mean
+        if strategy == "std":
+            return std
+        if strategy == "ucb":
+            return sign * mean + kappa * std
+        best = self.goal.max() if self.is_maximized() else self.goal.min()
+        improvement = sign * (mean - best)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            z = numpy.where(std > 0, improvement / std, 0.0)
+        return numpy.where(std > 0, improvement * normal_cdf(z) + std * normal_pdf(z), numpy.maximum(improvement, 0))
+
+    def screen(self, n_select: int = None, oversample: int = 10, strategy: str = "ei", kappa: float = 2.0,
+               min_distance: float = 0.0) -> dict:
+        """ Scores oversample * n_select Latin hypercube candidates of the par_inf.txt ranges and selects the best
+
+        Parameters
+        ----------
+        n_select : simulations to run. The par_inf.txt number of simulations if None
+        oversample : candidates per selected simulation
+        strategy, kappa : see score
+        min_distance : minimum distance (parameters scaled to [0, 1]) between selected candidates, so the batch is
+            not a cluster around one optimum
+
+        Returns
+        -------
+        dict with the selected 'values' (n_select, n_pars), their predicted 'mean', 'std' and 'score', the number of
+        'candidates' and 'selected' and the 'runs_saved' (candidates not run)
+        """
+        if n_select is None:
+            n_select = self.simulation_number
+        if not self.fitted:
+            self.fit()
+        seed = int(self.rng.integers(2 ** 31)) if self.seed is not None else None
+        candidates = LatinHypercubeSampler(self.project_path, seed).sample(n_select * oversample)
+        mean, std = self.predict(candidates)
+        scores = self.score(mean, std, strategy, kappa)
+        order = numpy.argsort(-scores, kind="stable")
+        if min_distance > 0:
+            scaled = self._scale(candidates)
+            chosen = []
+            for row in order:
+                if all(numpy.linalg.norm(scaled[row] - scaled[other]) >= min_distance for other in chosen):
+                    chosen.append(row)
+                    if len(chosen) == n_select:
+                        break
+            selected = numpy.array(chosen, dtype=int)
+        else:
+            selected = order[:n_select]
+        selection = {"values": candidates[selected], "mean": mean[selected], "std": std[selected],
+                     "score": scores[selected], "candidates": len(candidates), "selected": len(selected),
+                     "runs_saved": len(candidates) - len(selected)}
+        if self.threshold is not None:
+            pool_hits = mean >= self.threshold if self.is_maximized() else mean <= self.threshold
+            selection["predicted_behavioral_pool"] = float(pool_hits.mean())
+            selection["predicted_behavioral_selected"] = float(pool_hits[selected].mean())
+        self.last_selection = selection
+        logger.info("Surrogate selected " + str(len(selected)) + " of " + str(len(candidates)) + " candidates (" +
+                    strategy + ")")
+        return selection
+
+    def write_par_val(self, values, path: str = None):
+        """ Writes the selected values to par_val.txt (simulations 1 to n) and sets the number of simulations of
+        par_inf.txt and the SUFI2_swEdit.def range to them
+
+        Parameters
+        ----------
+        values : (n_sims, n_pars) parameter values
+        path : project folder. The surrogate project if None
+        """
+        path = path or self.project_path
+        sufi2files.write_par_val(path, numpy.arange(1, len(values) + 1), values)
+        sufi2files.write_par_inf(path, sufi2files.read_par_inf(path)[1], len(values))
+        sufi2files.write_swedit_def(path, 1, len(values))
+
+    def report(self, goal, selection: dict = None, baseline_rate: float = None) -> dict:
+        """ Accuracy of the surrogate on the simulations it selected and SWAT runs saved, once they ran
+
+        Parameters
+        ----------
+        goal : (info, df) of the selected simulations (par_val.txt order), as read_sufi2_out_goal
+        selection : screen result. The last one if None
+        baseline_rate : behavioral fraction of a plain Latin hypercube sample. The fraction of the history if None
+
+        Returns
+        -------
+        dict with the 'r2', 'rmse' and 'spearman' accuracy and the number of 'candidates' and 'selected'. With a
+        threshold, the behavioral 'hit_rate' of the selected simulations, the 'baseline_rate', the 'equivalent_runs' a
+        plain sample needs for as many behavioral simulations and the 'runs_saved' against it. Without a threshold,
+        'runs_saved' is the number of candidates not run
+        """
+        selection = selection if selection is not None else self.last_selection
+        if selection is None:
+            raise ValueError("No surrogate selection to report")
+        layout = get_goal_layout(goal)
+        observed = layout["goal"]
+        rows = layout["simulations"] - 1
+        if numpy.any(rows < 0) or numpy.any(rows >= selection["selected"]):
+            raise ValueError("Simulations of goal.txt are not the ones of the selection")
+        predicted = selection["mean"][rows]
+        result = accuracy(observed, predicted)
+        result.update({"candidates": selection["candidates"], "selected": selection["selected"],
+                       "runs_saved": selection["runs_saved"]})
+        if self.threshold is not None:
+            hits = observed >= self.threshold if self.is_maximized() else observed <= self.threshold
+            if baseline_rate is None and len(self.goal):
+                history_hits = self.goal >= self.threshold if self.is_maximized() else self.goal <= self.threshold
+                baseline_rate = float(history_hits.mean())
+            result["hit_rate"] = float(hits.mean())
+            result["baseline_rate"] = baseline_rate
+            if baseline_rate:
+                result["equivalent_runs"] = int(math.ceil(hits.sum() / baseline_rate))
+                result["runs_saved"] = max(result["equivalent_runs"] - len(observed), 0)
+        logger.info("Surrogate accuracy: R2 " + "{:.3f}".format(result["r2"]) + ", rank correlation " +
+                    "{:.3f}".format(result["spearman"]) + ", SWAT runs saved " + str(result["runs_saved"]))
+        return result
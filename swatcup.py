@@ -4,10 +4,35 @@ import subprocess
 import shutil
 import subprocess
 import platform
+import time
+import numpy
+import pandas as pd
 from swatcuppython.swatcupversion import SWATCUPVersion
 from swatcuppython.operationalsystem import OperationalSystem
 from swatcuppython.sawtcupv5_1_6_2.swatcupv5_1_6_2 import SWATCUPv5_1_6_2
 from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+from swatcuppython.parallel import ParallelRunner
+from swatcuppython.workspace import WorkspaceProvisioner
+from swatcuppython.scratch import ScratchWorkspace
+from swatcuppython.varfile import SUFI2OutputTail
+from swatcuppython.objectives import ObjectiveEngine, GOAL_FUNCTION_NAMES, SIMULATION_COLUMN, get_goal_layout
+from swatcuppython.ppu import PPUCalculator
+from swatcuppython.sampling import LatinHypercubeSampler
+from swatcuppython.extract import SWATOutputExtractor
+from swatcuppython.resultstore import ResultStore
+from swatcuppython.cache import SimulationCache, CachedRunner
+from swatcuppython.editor import ParameterEditor, EditorRunner
+from swatcuppython.asyncrunner import AsyncSUFI2Runner
+from swatcuppython.distributed import DistributedCoordinator
+from swatcuppython.watchdog import WatchdogRunner
+from swatcuppython.earlystop import EarlyStopping
+from swatcuppython.profiling import Profiler
+from swatcuppython.driver import IterationDriver
+from swatcuppython.surrogate import SurrogateScreening
+from swatcuppython.sensitivity import global_sensitivity
+from swatcuppython.snapshot import SnapshotStore
+from swatcuppython.checkpoint import CheckpointRunner
+from swatcuppython import sufi2files
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +83,8 @@ class SWATCUP(object):
         self.swatcuppython_base_folder_path = None
         self.process_number = 1;
         self.async_process = None
+        self.workspace_provisioner = None
+        self.scratch_workspace = None
 
         logger.info("Detected OS: " + self.operational_system + " " + self.architecture)
         # Select the right class for the swat version
@@ -101,33 +128,171 @@ class SWATCUP(object):
             os.mkdir(self.swatcuppython_base_folder_path)
         else:
             logger.info("Found swatcuppython folder: " + self.swatcuppython_base_folder_path)
+        self.workspace_provisioner = WorkspaceProvisioner(self.project_folder_path,
+                                                          exclude=[self.swatcuppython_base_folder_name])
+
+    def set_scratch_mode(self, enabled: bool = True, scratch_folder_path: str = None, sync_every: int = None,
+                         memory_budget: int = None):
+        """ Runs the SUFI2 stages in a copy of the project staged in a scratch folder (tmpfs RAM disk by default).
+        Only SUFI2.OUT (and SUFI2.IN after sufi2_pre) is synced back to the project folder.
+
+        Parameters
+        ----------
+        enabled : enables or disables the scratch mode. Disabling removes the scratch copy
+        scratch_folder_path : scratch folder. /dev/shm if None
+        sync_every : syncs SUFI2.OUT every N simulations during sufi2_run. Only at the end if None
+        memory_budget : max bytes used by the staged project. Raises MemoryError if the project does not fit
+        """
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.cleanup()
+            self.scratch_workspace = None
+        if enabled:
+            if self.project_folder_path is None:
+                raise ValueError("Project folder not set")
+            scratch_workspace = ScratchWorkspace(self.project_folder_path, scratch_folder_path, sync_every,
+                                                 memory_budget, exclude=[self.swatcuppython_base_folder_name])
+            scratch_workspace.stage()
+            self.scratch_workspace = scratch_workspace
+
+    def set_profiler(self, profiler: Profiler):
+        """ Measures the SUFI2 stages and the executables they run (wall time, CPU time, peak RSS and bytes
+        read/written, per simulation) with a Profiler. Also applies to the parallel, scratch and cached runs, which
+        use the same wrapper
+
+        Parameters
+        ----------
+        profiler : profiler receiving the measures. None disables the profiling
+        """
+        self.wrapper.set_profiler(profiler)
+
+    def get_profiler(self) -> Profiler:
+        return self.wrapper.profiler
+
+    def get_execution_folder_path(self):
+        """ Folder where the SUFI2 stages run: the scratch folder in scratch mode, the project folder otherwise """
+        if self.scratch_workspace is not None:
+            return self.scratch_workspace.folder_path
+        return self.project_folder_path
 
     def sufi2_pre(self):
+        if self.scratch_workspace is not None:
+            return self.scratch_workspace.sufi2_pre(self.wrapper)
         return self.wrapper.sufi2_pre(self.project_folder_path)
 
+    def sufi2_lh_sample(self, seed: int = None, maximin_candidates: int = 1, clean_output: bool = True):
+        """ Writes SUFI2.IN/par_val.txt with a Latin hypercube sample of the par_inf.txt parameters, in place of
+        SUFI2_LH_sample.exe (sufi2_pre). The sample is reproducible across platforms for a given seed.
+
+        Parameters
+        ----------
+        seed : random seed
+        maximin_candidates : number of designs generated to choose the one with the largest minimum distance
+        clean_output : removes the files of SUFI2.OUT, as SUFI2_Pre.bat does
+
+        Returns
+        -------
+        (n_sims, n_pars) parameter values
+        """
+        path = self.get_execution_folder_path()
+        sampler = LatinHypercubeSampler(path, seed, maximin_candidates)
+        values = sampler.sample()
+        sampler.write_par_val(values)
+        if clean_output:
+            out_folder = os.path.join(path, "SUFI2.OUT")
+            for file in os.listdir(out_folder):
+                if os.path.isfile(os.path.join(out_folder, file)):
+                    os.remove(os.path.join(out_folder, file))
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back(("SUFI2.IN", "SUFI2.OUT"))
+        return values
+
     def sufi2_run(self):
+        if self.scratch_workspace is not None:
+            return self.scratch_workspace.sufi2_run(self.wrapper)
         return self.wrapper.sufi2_run(self.project_folder_path)
 
+    def get_parameter_editor(self, names=None) -> ParameterEditor:
+        """ Returns a ParameterEditor of the project, an in process replacement of SWAT_Edit.exe. The editor indexes
+        the parameter fields once, then each apply_simulation(simulation) or apply_model_in() writes only those fields.
+
+        Parameters
+        ----------
+        names : parameter names. The parameters of par_inf.txt if None
+        """
+        return ParameterEditor(self.get_execution_folder_path(), names)
+
+    def sufi2_editor_run(self, editor: ParameterEditor = None, def_files=None) -> dict:
+        """ Runs the SUFI2_swEdit.def simulation range like sufi2_run, with the ParameterEditor in place of
+        SUFI2_make_input.exe and SWAT_Edit.exe and the NumPy extraction in place of the SUFI2_extract executables.
+        Only swat.exe runs as a process. Run sufi2_pre before, as for sufi2_run
+
+        Parameters
+        ----------
+        editor : parameter editor (see get_parameter_editor). Built from par_inf.txt if None
+        def_files : extract def files. The ones of the programs in SUFI2_extract.bat if None
+
+        Returns
+        -------
+        dict with the 'simulations' run, the 'return_codes' of swat.exe and the 'missing' simulations, not run
+        """
+        result = EditorRunner(self.wrapper, self.get_execution_folder_path(), editor, def_files).run()
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back(("SUFI2.IN", "SUFI2.OUT"))
+        return result
+
+    def sufi2_cached_run(self, cache: SimulationCache) -> dict:
+        """ Runs the SUFI2_swEdit.def simulation range like sufi2_run, but runs SWAT only for the parameter sets that
+        are not in the cache. The var files are rebuilt complete, in simulation order.
+
+        Parameters
+        ----------
+        cache : simulation cache, shared between runs and iterations
+
+        Returns
+        -------
+        dict with the 'hits' and 'misses' simulation lists and the 'return_codes' of the runs
+        """
+        result = CachedRunner(self.wrapper, self.get_execution_folder_path(), cache).run()
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back()
+        return result
+
+    def sufi2_extract(self, def_file: str = "SUFI2_extract_rch.def", simulation: int = None, sidecar: bool = False):
+        """ Extracts the SWAT output of the last simulation into the SUFI2.OUT var files with NumPy, in place of the
+        SUFI2_extract_*.exe executable of def_file
+
+        Parameters
+        ----------
+        def_file : extract def file (SUFI2_extract_rch.def, SUFI2_extract_sub.def, extract_rch_No_obs.def, ...)
+        simulation : simulation number. Read from SUFI2.IN/trk.txt if None
+        sidecar : also appends the values to the binary sidecar of the var files
+
+        Returns
+        -------
+        dict var file name -> (time_steps, values)
+        """
+        return SWATOutputExtractor(self.get_execution_folder_path(), def_file).run(simulation, sidecar=sidecar)
+
     def sufi2_async_pre(self):
         logger.debug("SUFI2_async_pre started")
         if self.sufi2_async_is_running():
             raise ValueError("SUFI2 is already running")
         else:
-            self.async_process = self.wrapper.sufi2_async_pre(self.project_folder_path)
+            self.async_process = self.wrapper.sufi2_async_pre(self.get_execution_folder_path())
 
     def sufi2_async_run(self):
         logger.debug("SUFI2_async_run started")
         if self.sufi2_async_is_running():
             raise ValueError("SUFI2 is already running")
         else:
-            self.async_process = self.wrapper.sufi2_async_run(self.project_folder_path)
+            self.async_process = self.wrapper.sufi2_async_run(self.get_execution_folder_path())
 
     def sufi2_async_post(self):
         logger.debug("SUFI2_async_post started")
         if self.sufi2_async_is_running():
             raise ValueError("SUFI2 is already running")
         else:
-            self.async_process = self.wrapper.sufi2_async_post(self.project_folder_path)
+            self.async_process = self.wrapper.sufi2_async_post(self.get_execution_folder_path())
 
     def sufi2_async_kill(self):
         if self.sufi2_async_is_running():
@@ -145,96 +310,419 @@ class SWATCUP(object):
     def sufi2_async_return_code(self) -> int:
         return self.async_process.poll()
 
-    def sufi2_async_wait(self):
+    def sufi2_async_wait(self) -> int:
         logger.debug("Waiting SUFI2")
-        self.async_process.wait()
+        return_code = self.async_process.wait()
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back(("SUFI2.IN", "SUFI2.OUT"))
+        return return_code
+
+    def sufi2_async_output(self, n: int = None) -> list:
+        """ Last n output lines of the async SUFI2 stage (all the lines kept if None, see set_output_capture) """
+        if self.async_process is None or not hasattr(self.async_process, "get_lines"):
+            return []
+        return self.async_process.get_lines(n)
+
+    def sufi2_async_progress(self) -> dict:
+        """ Progress of the async SUFI2 stage parsed from its output: dict with the current 'simulation', its 'index'
+        in the SUFI2_swEdit.def range, the 'total', 'completed', the SWAT 'year', 'elapsed' and 'eta' seconds. None
+        if not available
+        """
+        if self.async_process is None or not hasattr(self.async_process, "get_status"):
+            return None
+        return self.async_process.get_status()
+
+    def set_output_capture(self, max_lines: int = 1000, log: bool = False, echo: bool = False,
+                           progress_interval: float = 10.0):
+        """ Sets how the output of the SUFI2 stages is captured. It is always drained by a background thread, so the
+        stages never block on a full pipe
+
+        Parameters
+        ----------
+        max_lines : last output lines kept in memory
+        log : writes the whole output of each stage to sufi2_<stage>.log in the execution folder
+        echo : writes the output to stdout
+        progress_interval : logs the 'simulation i of N, ETA' status at most every progress_interval seconds. Not
+            logged if None
+        """
+        self.wrapper.set_output_capture(max_lines, log, echo, progress_interval)
+
 
+    ################ asyncio ################
+    def get_async_runner(self, output_callback=None) -> AsyncSUFI2Runner:
+        """ Returns an AsyncSUFI2Runner of the execution folder. Unlike sufi2_async_*, any number of runners (of this
+        and other projects) can be awaited at the same time from one event loop.
+
+        Parameters
+        ----------
+        output_callback : function(folder_path, line) called with each output line. Logged if None
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        return AsyncSUFI2Runner(self.wrapper, self.get_execution_folder_path(), output_callback)
+
+    async def _aio_stage(self, stage: str, output_callback, sync_folders) -> int:
+        return_code = await self.get_async_runner(output_callback).run_stage(stage)
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back(sync_folders)
+        return return_code
+
+    async def sufi2_aio_pre(self, output_callback=None) -> int:
+        """ Coroutine version of sufi2_pre. Cancelling it kills the process tree of the stage """
+        return await self._aio_stage("pre", output_callback, ("SUFI2.IN", "SUFI2.OUT"))
+
+    async def sufi2_aio_run(self, output_callback=None) -> int:
+        """ Coroutine version of sufi2_run. Cancelling it kills the process tree of the stage """
+        return await self._aio_stage("run", output_callback, ("SUFI2.OUT",))
+
+    async def sufi2_aio_post(self, output_callback=None) -> int:
+        """ Coroutine version of sufi2_post. Cancelling it kills the process tree of the stage """
+        return await self._aio_stage("post", output_callback, ("SUFI2.OUT",))
+
+    async def sufi2_aio_parallel_run(self, output_callback=None) -> list:
+        """ Coroutine version of sufi2_parallel_run """
+        return await self.get_parallel_runner().run_async(output_callback)
+
+    def iter_completed_simulations(self, poll_interval: float = 1.0, dtype=numpy.float64):
+        """ Follows the SUFI2.OUT var files while sufi2_async_run is running, yielding each simulation as soon as it
+        is complete in all the var files. Only the data appended since the last poll is parsed.
+
+        Yields
+        ------
+        (simulation, {file_name: values})
+        """
+        tail = SUFI2OutputTail(os.path.join(self.get_execution_folder_path(), "SUFI2.OUT"),
+                               self.wrapper.read_sufi2_var_file_name(self.get_execution_folder_path()), dtype)
+        while True:
+            running = self.sufi2_async_is_running()
+            for simulation, series in tail.poll(final=not running):
+                yield simulation, series
+            if not running:
+                break
+            time.sleep(poll_interval)
+
+    def iter_goal_rows(self, poll_interval: float = 1.0):
+        """ Follows SUFI2.OUT/goal.txt while sufi2_async_post is running, yielding each row (dict) as it is written """
+        tail = SUFI2OutputTail(os.path.join(self.get_execution_folder_path(), "SUFI2.OUT"), [])
+        while True:
+            running = self.sufi2_async_is_running()
+            for row in tail.poll_goal():
+                yield row
+            if not running:
+                break
+            time.sleep(poll_interval)
 
     def sufi2_post(self):
+        if self.scratch_workspace is not None:
+            return self.scratch_workspace.sufi2_post(self.wrapper)
         return self.wrapper.sufi2_post(self.project_folder_path)
 
     def read_sufi2_out_goal(self):
         return self.wrapper.read_sufi2_out_goal(self.project_folder_path)
 
+    def compute_95ppu(self, behavioral: bool = False, observed_file: str = "observed.txt", out_of_core: bool = False,
+                      write: bool = True):
+        """ Computes the 95PPU, P-factor and R-factor of the observed variables with NumPy, in place of
+        SUFI2_95ppu.exe (behavioral=False) and SUFI2_95ppu_beh.exe (behavioral=True). Needs SUFI2.OUT/goal.txt to
+        find the best (and the behavioral) simulations.
+
+        Parameters
+        ----------
+        behavioral : uses only the simulations that reach the behavioral threshold of the observed file
+        observed_file : observed file in SUFI2.IN
+        out_of_core : reads the var files in chunks (bounded memory)
+        write : writes SUFI2.OUT/95ppu.txt and 95ppu_g.txt (or 95ppu_beh.txt and 95ppu_g_beh.txt)
+
+        Returns
+        -------
+        dict variable name -> 95PPU results (see PPUCalculator.compute)
+        """
+        calculator = PPUCalculator(self.project_folder_path, observed_file, out_of_core)
+        goal = self.read_sufi2_out_goal()
+        layout = get_goal_layout(goal)
+        best = layout["goal"].argmax() if layout["maximize"] else layout["goal"].argmin()
+        best_simulation = int(layout["simulations"][best])
+        simulations = None
+        if behavioral:
+            simulations = calculator.get_behavioral_simulations(goal)
+            logger.info("Behavioral simulations: " + str(len(simulations)))
+        results = calculator.compute(simulations, best_simulation)
+        if write:
+            if behavioral:
+                calculator.write(results, "95ppu_beh.txt", "95ppu_g_beh.txt")
+            else:
+                calculator.write(results)
+        return results
+
+    def get_objective_engine(self, observed_file: str = "observed.txt", goal_type: int = None) -> ObjectiveEngine:
+        return ObjectiveEngine(self.project_folder_path, observed_file, goal_type)
+
+    def compute_goal(self, observed_file: str = "observed.txt", goal_type: int = None, write: bool = True):
+        """ Computes the goal function of all the simulations with NumPy, in place of SUFI2_goal_fn.exe
+
+        Parameters
+        ----------
+        observed_file : observed file in SUFI2.IN
+        goal_type : objective function type (see objectives.GOAL_FUNCTIONS). Taken from the observed file if None
+        write : writes SUFI2.OUT/goal.txt
+
+        Returns
+        -------
+        (info, df) as read_sufi2_out_goal
+        """
+        engine = self.get_objective_engine(observed_file, goal_type)
+        simulations, objectives, goal = engine.evaluate()
+        if write:
+            return engine.write_goal(simulations, goal)
+        names, ranges, simulation_number = sufi2files.read_par_inf(self.project_folder_path)
+        df = pd.DataFrame({SIMULATION_COLUMN: simulations, "goal_value": goal})
+        return {"no_pars": len(names), "no_sims": len(simulations),
+                "type_of_goal_fn": GOAL_FUNCTION_NAMES[engine.goal_type]}, df
+
+    def get_iteration_driver(self, iterations: int = 5, **kwargs) -> IterationDriver:
+        """ Returns an IterationDriver running up to iterations SUFI2 iterations of the project (sampling, run, goal,
+        new parameter ranges and archiving), with the post-processing of an iteration overlapped with the next one.
+        The kwargs are the IterationDriver options (stopping rules, store_path, run_function, ...)
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        return IterationDriver(self, iterations, **kwargs)
+
+    def get_surrogate(self, observed_file: str = "observed.txt", max_train: int = 500,
+                      seed: int = None) -> SurrogateScreening:
+        """ Returns a SurrogateScreening of the project trained with its SUFI2.OUT/goal.txt, if there is one. Add the
+        goal.txt of other iterations with add_goal or add_store
+
+        Parameters
+        ----------
+        observed_file : observed file in SUFI2.IN with the behavioral threshold
+        max_train : simulations the surrogate is trained with
+        seed : random seed of the candidates
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        path = self.get_execution_folder_path()
+        observed = sufi2files.read_observed(os.path.join(path, "SUFI2.IN", observed_file))
+        surrogate = SurrogateScreening(path, threshold=observed["threshold"], max_train=max_train, seed=seed)
+        if os.path.isfile(os.path.join(self.project_folder_path, "SUFI2.OUT", sufi2files.GOAL_FILE)):
+            surrogate.add_goal(self.read_sufi2_out_goal(), sufi2files.read_par_val(path))
+        return surrogate
+
+    def compute_sensitivity(self, goal=None, variable_objectives: bool = False, observed_file: str = "observed.txt",
+                            chunk_size: int = None) -> pd.DataFrame:
+        """ Computes the SUFI2 global sensitivity (multiple regression t-stat and p-value) and the rank correlation
+        of every parameter with every objective, in place of the SUFI2 sensitivity of SUFI2_Post (see
+        sensitivity.global_sensitivity)
+
+        Parameters
+        ----------
+        goal : (info, df) of goal.txt. Read from SUFI2.OUT if None
+        variable_objectives : adds the objectives of every observed variable (ObjectiveEngine.evaluate) as objectives,
+            named '<variable>_<objective>'
+        observed_file : observed file in SUFI2.IN, with variable_objectives
+        chunk_size : simulations per chunk, for large archives
+
+        Returns
+        -------
+        DataFrame with a row per objective and parameter
+        """
+        if goal is None:
+            goal = self.read_sufi2_out_goal()
+        names = sufi2files.read_par_inf(self.project_folder_path)[0]
+        objectives = {}
+        if variable_objectives:
+            simulations, variables, _ = self.get_objective_engine(observed_file).evaluate()
+            goal_simulations = get_goal_layout(goal)["simulations"]
+            rows = numpy.searchsorted(simulations, goal_simulations)
+            if numpy.any(rows >= len(simulations)) or numpy.any(simulations[rows] != goal_simulations):
+                raise ValueError("Simulations of goal.txt not found in the var files")
+            for variable, values in variables.items():
+                for objective, column in values.items():
+                    objectives[variable + "_" + objective] = numpy.asarray(column)[rows]
+        return global_sensitivity(goal, sufi2files.read_par_val(self.project_folder_path), names, objectives,
+                                  chunk_size)
+
     def copy_output(self, dst_path):
         self.wrapper.copy_output(self.project_folder_path, dst_path)
 
+    def archive_output(self, store_path: str, iteration: str, compress: bool = True) -> ResultStore:
+        """ Archives SUFI2.OUT (goal.txt and the var files of var_file_name.txt) and par_val.txt as an iteration of
+        a ResultStore, in place of copy_output. The iteration is read back with the ResultStore methods.
+
+        Parameters
+        ----------
+        store_path : result store folder
+        iteration : iteration name
+        compress : writes compressed chunks
+
+        Returns
+        -------
+        ResultStore
+        """
+        store = ResultStore(store_path, compress=compress)
+        goal = None
+        if os.path.isfile(os.path.join(self.project_folder_path, "SUFI2.OUT", sufi2files.GOAL_FILE)):
+            goal = self.read_sufi2_out_goal()
+        store.archive(self.project_folder_path, iteration, goal=goal)
+        return store
+
+    def snapshot_output(self, store_path: str, name: str, include_input: bool = False) -> dict:
+        """ Stores SUFI2.OUT (and SUFI2.IN with include_input) as a snapshot of a deduplicated SnapshotStore, in place
+        of copy_output. Only the data not stored by earlier snapshots is written
+
+        Parameters
+        ----------
+        store_path : snapshot store folder
+        name : snapshot name (ex: 'iteration_3'). A snapshot with the same name is replaced
+        include_input : also stores SUFI2.IN
+
+        Returns
+        -------
+        dict with the 'files', 'size', 'reused' files and bytes 'written' (see SnapshotStore.snapshot)
+        """
+        folders = ("SUFI2.OUT", "SUFI2.IN") if include_input else ("SUFI2.OUT",)
+        return SnapshotStore(store_path).snapshot(self.project_folder_path, name, folders)
+
+    def restore_output(self, store_path: str, name: str, folders=None) -> dict:
+        """ Restores the SUFI2.OUT (and SUFI2.IN if stored) of a snapshot into the project folder """
+        return SnapshotStore(store_path).restore(name, self.project_folder_path, folders)
+
     def read_sufi2_var_file_name(self):
         return self.wrapper.read_sufi2_var_file_name(self.project_folder_path)
 
     def read_sufi2_var(self, file_name):
         return self.wrapper.read_sufi2_var(self.project_folder_path, file_name)
 
-        #shutil.copytree(os.path.join(MODEL_FOLDER, 'SUFI2.OUT'), os.path.join(OUTPUT_SCENARIOS_FOLDER, input_path))
-
-    ################ Rotinas utilizadas no processamento paralelo - ainda não funciona #################
-    # def sufi2_pre(self, process: int):
-    #   self.wrapper.sufi2_pre(self.get_process_folder_path(process))
-
-    # def sufi2_run(self, process: int):
-    #   self.wrapper.sufi2_run(self.get_process_folder_path(process))
-
-    # def sufi2_pos(self, process: int):
-    #   self.wrapper.sufi2_post(self.get_process_folder_path(process))
-
-    # def load_backup(self):
-    #   self.load_backup()
-
-    # def sync_files(self, source_path, dest_path):
-    #    if self.operational_system == OperationalSystem.LINUX.value:
-    #        logger.debug("Syncing files: '" + source_path + "' -> '" + dest_path + "'")
-    #        cmd = "rsync " + source_path + "/* " + dest_path
-    #        subprocess.call(cmd, shell=True)
-    #        #TODO Criar diretorios antes do sync em caso de vazio
-#
-#        elif self.operational_system == OperationalSystem.WINDOWS.value:
-#            logger.error("Windows sync file not implemented")
-#        else:
-#            logger.error("Unknown operational system:" + self.operational_system)
-
-#    def set_process_number(self, number):
-#        self.process_number = number
-
-#    def sync_processes(self):
-#        for i in range(self.process_number):
-#            self.sync_process(i)
-
-#    def get_process_folder_path(self, process: int):
-#        if isinstance(process, int):
-#            if 0 <= process < self.process_number:
-#                return os.path.join(self.swatcuppython_base_folder_path, "process" + str(process))
-#            else:
-#                raise ValueError("Process out of range: (0: " + str(self.process_number-1) + ")")
-#        else:
-#            raise ValueError("Process should be an Int type")
-
-
-#    def sync_process(self, process: int):
-#        if isinstance(process, int):
-#            if 0 <= process < self.process_number:
-#                logger.debug("Sync process :" + str(process))
-#                process_folder = os.path.join(self.swatcuppython_base_folder_path, "process" + str(process))
-#                self.sync_files(self.project_folder_path, process_folder)
-#                self.sync_files(os.path.join(self.project_folder_path, "SUFI2.IN"),
-#                                os.path.join(process_folder, "SUFI2.IN"))
-#                self.sync_files(os.path.join(self.project_folder_path, "SUFI2.OUT"),
-#                                os.path.join(process_folder, "SUFI2.OUT"))
-#                self.sync_files(os.path.join(self.project_folder_path, "Echo"),
-#                                os.path.join(process_folder, "Echo"))
-#                self.sync_files(os.path.join(self.project_folder_path, "Backup"),
-#                                os.path.join(process_folder, "Backup"))
-
-
-#            else:
-##                raise ValueError("Process out of range: (0: " + str(self.process_number-1) + ")")
-#        else:
-#            raise ValueError("Process should be an Int type")
-
-
-#    @staticmethod
-#    def run_os_filename(folder_path, command):
-#        logger.debug("Running file: " + command)
-#        process = subprocess.Popen(["rsync", "-vt", "/media/jairo/Dados/Jairo/Projetos/SWAT/git/SWATPython/my_swatcup_project/Backup", "/media/jairo/Dados/Jairo/Projetos/SWAT/git/SWATPython/my_swatcup_project/swatcuppython/process3"])
-#        # show output
-#        process.communicate()[0]
-#        return process.returncode
+    def read_sufi2_var_array(self, file_name, dtype=numpy.float64):
+        """ Returns (simulations, time_steps, values) with values as a (n_sims, n_steps) NumPy array """
+        return self.wrapper.read_sufi2_var_array(self.project_folder_path, file_name, dtype)
+
+    def read_sufi2_var_cube(self, file_names=None, dtype=numpy.float64, max_workers=None):
+        """ Reads the var files (all the files in var_file_name.txt if None) concurrently.
+        Returns (simulations, time_steps, cube) with cube as a (n_files, n_sims, n_steps) NumPy array
+        """
+        return self.wrapper.read_sufi2_var_cube(self.project_folder_path, file_names, dtype, max_workers)
+
+    ################ Rotinas utilizadas no processamento paralelo #################
+    def set_process_number(self, number: int):
+        """ Sets the number of parallel processes used by sufi2_parallel_run """
+        if not isinstance(number, int) or number < 1:
+            raise ValueError("Process number should be a positive Int")
+        self.process_number = number
+
+    def get_parallel_runner(self) -> ParallelRunner:
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        return ParallelRunner(self.wrapper, self.project_folder_path, self.swatcuppython_base_folder_path,
+                              self.process_number, self.workspace_provisioner)
+
+    def get_process_folder_path(self, process: int):
+        return self.get_parallel_runner().get_process_folder_path(process)
+
+    def sync_process(self, process: int):
+        return self.get_parallel_runner().sync_process(process)
+
+    def sync_processes(self):
+        self.get_parallel_runner().sync_processes()
+
+    def sufi2_parallel_run(self):
+        """ Runs the SUFI2_swEdit.def simulation range split across process_number process folders and merges
+        the var files back into the project SUFI2.OUT. Use it in place of sufi2_run.
+        """
+        return self.get_parallel_runner().run()
+
+    def sufi2_watchdog_run(self, timeout_factor: float = 5.0, min_timeout: float = 60.0, initial_timeout: float = None,
+                           steal: bool = True, early_stopping: EarlyStopping = None) -> dict:
+        """ Runs the SUFI2_swEdit.def simulation range timing every simulation and killing the ones that run longer
+        than timeout_factor times the median (see watchdog.WatchdogRunner). With process_number > 1 the range runs in
+        the process folders, idle processes steal simulations from the slow ones and the var files are merged into
+        the project SUFI2.OUT. Use it in place of sufi2_run or sufi2_parallel_run.
+
+        Parameters
+        ----------
+        timeout_factor : a simulation is killed after timeout_factor times the median simulation duration
+        min_timeout : minimum timeout in seconds
+        initial_timeout : timeout in seconds until the median is known. No timeout if None
+        steal : idle processes steal simulations from the others
+        early_stopping : aborts hopeless simulations and stops the iteration once converged (see get_early_stopping)
+
+        Returns
+        -------
+        dict with the simulation 'timings' and the 'failed' and 'stragglers' simulations (see WatchdogRunner.run)
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        if self.process_number == 1:
+            worker_folder_paths = [self.get_execution_folder_path()]
+            project_folder_path = self.get_execution_folder_path()
+        else:
+            runner = self.get_parallel_runner()
+            runner.sync_processes()
+            worker_folder_paths = [runner.get_process_folder_path(process) for process in range(self.process_number)]
+            project_folder_path = self.project_folder_path
+        result = WatchdogRunner(self.wrapper, project_folder_path, worker_folder_paths, timeout_factor, min_timeout,
+                                initial_timeout, steal=steal, early_stopping=early_stopping).run()
+        if self.scratch_workspace is not None and self.process_number == 1:
+            self.scratch_workspace.sync_back()
+        return result
+
+    def sufi2_checkpoint_run(self, interval: float = 5.0):
+        """ Runs the SUFI2_swEdit.def simulation range recording the completed simulations in a checkpoint. Called
+        again after an interruption (node failure, sufi2_async_kill, ...), it validates the partial var files and
+        goal.txt and runs only the missing simulations. With process_number > 1 every process folder has its own
+        checkpoint and the results are merged into the project SUFI2.OUT. Use it in place of sufi2_run or
+        sufi2_parallel_run.
+
+        Parameters
+        ----------
+        interval : seconds between checkpoint updates
+
+        Returns
+        -------
+        dict (list of dicts with process_number > 1) with the 'resumed' simulations, the 'ran' ranges, the
+        'return_codes' and the 'missing' simulations (see checkpoint.CheckpointRunner.run)
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        if self.process_number > 1:
+            return self.get_parallel_runner().run_checkpointed(interval)
+        result = CheckpointRunner(self.wrapper, self.get_execution_folder_path(), interval).run()
+        if self.scratch_workspace is not None:
+            self.scratch_workspace.sync_back()
+        return result
+
+    def get_early_stopping(self, observed_file: str = "observed.txt", threshold: float = None,
+                           abort_simulations: bool = True, patience: int = None,
+                           tolerance: float = 0.0) -> EarlyStopping:
+        """ Returns an early stopping policy for sufi2_watchdog_run
+
+        Parameters
+        ----------
+        observed_file : observed file in SUFI2.IN with the goal function and the behavioral threshold
+        threshold : behavioral threshold. Taken from the observed file if None
+        abort_simulations : aborts the simulations that cannot reach the threshold anymore
+        patience : stops the iteration after patience simulations without improvement of the best goal
+        tolerance : improvements of the best goal up to tolerance do not count
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        return EarlyStopping(self.get_execution_folder_path(), observed_file, threshold, abort_simulations,
+                             patience=patience, tolerance=tolerance)
+
+    def sufi2_distributed_run(self, transport, batch_size: int = 10, compute_goal: bool = False,
+                              timeout: float = None) -> dict:
+        """ Runs the SUFI2_swEdit.def simulation range in worker agents (see distributed.WorkerAgent) and merges their
+        var files (and goal values with compute_goal) into the project SUFI2.OUT. Use it in place of sufi2_run.
+
+        Parameters
+        ----------
+        transport : QueueTransport of a LocalCluster or TCPTransport the agents connect to
+        batch_size : simulations per task
+        compute_goal : the agents compute the goal values and goal.txt is written
+        timeout : seconds without any result before raising TimeoutError
+        """
+        if self.project_folder_path is None:
+            raise ValueError("Project folder not set")
+        coordinator = DistributedCoordinator(self.project_folder_path, transport, batch_size, compute_goal,
+                                             timeout=timeout)
+        return coordinator.run()
@@ -33,6 +33,8 @@ class SWATCUP2019(ModuleInterface):
 
     def run_os_filename(self, folder_path, filename):
         logger.debug("Running file: " + os.path.join(folder_path, filename))
+        if self.profiler is not None:
+            return self.profiler.run_executable(folder_path, filename)
         process = subprocess.Popen(os.path.join(folder_path, filename), cwd=folder_path)
         # show output
         process.communicate()[0]
@@ -49,14 +51,13 @@ class SWATCUP2019(ModuleInterface):
 
     def sufi2_pre(self, path):
         logger.debug("Running sufi2_pre")
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "pre")
         if self.linux():
             cmd = os.path.join(path, self.get_os_filename("SUFI2_Pre.bat", "SUFI2_Pre.bat"))
             #return subprocess.call(cmd, cwd=path, shell=True)
-            process = subprocess.Popen(cmd, shell=True, cwd=path, stderr=subprocess.STDOUT,
-                                       stdout=subprocess.PIPE, universal_newlines=True)
-            for line in process.stdout:
-                sys.stdout.write(line)
-            return process.returncode
+            # The output is drained by a background thread (see set_output_capture)
+            return self.start_captured(cmd, path, "pre", shell=True).wait()
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Pre.bat")
             #return subprocess.call([cmd], cwd=path, creationflags=subprocess.CREATE_NEW_CONSOLE)
@@ -64,20 +65,15 @@ class SWATCUP2019(ModuleInterface):
 
     def sufi2_run(self, path):
         logger.debug("Running sufi2_run")
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "run")
         if self.linux():
             cmd = os.path.join(path, "SUFI2_execute.exe")
             #return subprocess.call(cmd, cwd=path, shell=True)
             # Se utiliza o stdout a formatacao se perde do texto. Precisa usar sem nada,
             # e tirar o shel para funcionar, mas ai o bat para de funcioar pois ele usa o shell
             # somente chamando as funções individualmente consegue fazer isso funcionar
-            process = subprocess.Popen(cmd, shell=True, cwd=path, stderr=subprocess.STDOUT,
-                                       stdout=subprocess.PIPE, universal_newlines=True)
-            for line in process.stdout:
-                sys.stdout.write(line)
-            return process.returncode
-            #process = subprocess.run([cmd], capture_output=True)
-            #process.wait()
-            #return process.returncode
+            return self.start_captured(cmd, path, "run", shell=True).wait()
 
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Run.bat")
@@ -86,14 +82,13 @@ class SWATCUP2019(ModuleInterface):
 
     def sufi2_post(self, path):
         logger.debug("Running sufi2_post")
+        if self.profiler is not None:
+            return self.profiler.run_stage(self, path, "post")
         if self.linux():
             cmd = os.path.join(path, self.get_os_filename("SUFI2_Post.bat", "SUFI2_Post.bat"))
             #return subprocess.call(cmd, cwd=path, shell=True)
-            process = subprocess.Popen(cmd, shell=True, cwd=path, stderr=subprocess.STDOUT,
-                                       stdout=subprocess.PIPE, universal_newlines=True)
-            for line in process.stdout:
-                sys.stdout.write(line)
-            return process.returncode
+            # The output is drained by a background thread (see set_output_capture)
+            return self.start_captured(cmd, path, "post", shell=True).wait()
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Post.bat")
             #return subprocess.call([cmd], cwd=path, creationflags=subprocess.CREATE_NEW_CONSOLE)
@@ -102,7 +97,7 @@ class SWATCUP2019(ModuleInterface):
     def sufi2_async_pre(self, path):
         if self.linux():
             cmd = os.path.join(path, self.get_os_filename("SUFI2_Pre.bat", "SUFI2_Pre.bat"))
-            return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+            return self.start_captured(cmd, path, "pre", shell=True)
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Pre.bat")
             # se nao criar um NEW CONSOLE o swat_edit da pau em windows. Parece que isso acontece
@@ -128,7 +123,7 @@ class SWATCUP2019(ModuleInterface):
         logger.debug("Runnnig sufi2_async_run")
         if self.linux():
             cmd = os.path.join(path, self.get_os_filename("SUFI2_Run.bat", "SUFI2_Run.bat"))
-            return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+            return self.start_captured(cmd, path, "run", shell=True)
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Run.bat")
             return subprocess.Popen([cmd], cwd=path, creationflags=subprocess.CREATE_NEW_CONSOLE)
@@ -137,11 +132,27 @@ class SWATCUP2019(ModuleInterface):
         logger.debug("Running sufi2_async_post")
         if self.linux():
             cmd = os.path.join(path, self.get_os_filename("SUFI2_Post.bat", "SUFI2_Post.bat"))
-            return subprocess.Popen(cmd, cwd=path, shell=True, stdout=subprocess.DEVNULL)
+            return self.start_captured(cmd, path, "post", shell=True)
         if self.windows():
             cmd = os.path.join(path, "SUFI2_Post.bat")
             return subprocess.Popen([cmd], cwd=path, creationflags=subprocess.CREATE_NEW_CONSOLE)
 
+    def get_sufi2_command(self, path, stage):
+        if stage not in ("pre", "run", "post"):
+            raise ValueError("Invalid SUFI2 stage: " + str(stage))
+        if self.linux():
+            if stage == "run":
+                return {"args": [os.path.join(path, "SUFI2_execute.exe")], "input": None, "new_console": False}
+            # The .bat files are shell scripts in the linux projects
+            cmd = os.path.join(path, {"pre": "SUFI2_Pre.bat", "post": "SUFI2_Post.bat"}[stage])
+            return {"args": ["/bin/sh", cmd], "input": None, "new_console": False}
+        if self.windows():
+            cmd = os.path.join(path, {"pre": "SUFI2_Pre.bat", "run": "SUFI2_Run.bat", "post": "SUFI2_Post.bat"}[stage])
+            # Answers the question about continuing in SUFI2_Pre.bat, as sufi2_async_pre
+            text = os.linesep.join(["y", "s", "n"]) if stage == "pre" else None
+            return {"args": [cmd], "input": text, "new_console": stage == "run"}
+        raise ValueError("Operational system not implemented: " + str(self.operational_system))
+
 
     ######## Util methods ##################
     def copy_output(self, project_folder, dst):
@@ -232,44 +243,5 @@ class SWATCUP2019(ModuleInterface):
                 "no_sims": simulation_number,
                 "type_of_goal_fn": goal_type}
 
-        df = pd.read_csv(fo, header=0, delim_whitespace=True)
+        df = pd.read_csv(fo, header=0, sep=r"\s+")
         return info, df
-
-    def read_sufi2_var_file_name(self, path):
-        file = os.path.join(path, 'SUFI2.IN/var_file_name.txt')
-        fo = open(file, "r")
-        file_names = [line.rstrip() for line in fo.readlines()]
-        fo.close()
-        folder = os.path.join(path, 'SUFI2.OUT')
-        var_file_names_path = [os.path.join(folder, file) for file in file_names]
-        return file_names
-
-    def read_sufi2_var(self, path, file_name):
-        file_path = os.path.join('SUFI2.OUT', file_name)
-        fo = open(os.path.join(path,file_path),"r")
-        iterations = []
-        data = []
-        index = []
-        data_index = -1
-        new_col = True
-        for line in fo:
-            list = line.split()
-            if len(list) == 1:
-                # numero da iteracao
-                iterations.append(int(list[0]))
-                new_col = True
-                data.append([])
-                index.append([])
-                data_index += 1
-            if len(list) == 2:
-                # dados
-                time_step = int(list[0])
-                value = float(list[1])
-                data[data_index].append(value)
-                index[data_index].append(time_step)
-
-        fo.close()
-        # TODO: this assume the file is correct and with all values. Make it more robust in the future
-        df = pd.DataFrame(columns=iterations, index=index[0], data=numpy.transpose(data))
-        return df
-
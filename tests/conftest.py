@@ -0,0 +1,54 @@
+import os
+import sys
+import stat
+import subprocess
+import importlib.util
+
+import pytest
+
+PACKAGE_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import swatcuppython
+except ImportError:
+    # Checkout not named swatcuppython: import the package from its folder
+    spec = importlib.util.spec_from_file_location("swatcuppython", os.path.join(PACKAGE_PATH, "__init__.py"),
+                                                  submodule_search_locations=[PACKAGE_PATH])
+    swatcuppython = importlib.util.module_from_spec(spec)
+    sys.modules["swatcuppython"] = swatcuppython
+    spec.loader.exec_module(swatcuppython)
+
+from swatcuppython.benchmark import build_synthetic_project, has_linux_executables, STUB_FOLDER
+
+
+def make_project(folder_path: str, **kwargs) -> str:
+    """ Small synthetic project (see build_synthetic_project) with executable SUFI2 programs """
+    options = {"n_reaches": 10, "n_hrus": 20, "begin_year": 2001, "end_year": 2001, "n_sims": 40, "n_observed": 2}
+    options.update(kwargs)
+    build_synthetic_project(folder_path, **options)
+    for name in os.listdir(folder_path):
+        if name.endswith((".exe", ".bat")):
+            file = os.path.join(folder_path, name)
+            os.chmod(file, os.stat(file).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return folder_path
+
+
+def run_executable(project_path: str, name: str):
+    """ Runs a SUFI2 program of a synthetic project with its stub swat.exe on the PATH """
+    env = dict(os.environ, PATH=os.path.join(project_path, STUB_FOLDER) + os.pathsep + os.environ.get("PATH", ""))
+    return subprocess.run([os.path.join(".", name)], cwd=project_path, env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL, timeout=300).returncode
+
+
+def use_stub_swat(project_path: str, monkeypatch):
+    """ Puts the stub folder of a synthetic project on the PATH for the SUFI2 programs run by the wrappers """
+    monkeypatch.setenv("PATH", os.path.join(project_path, STUB_FOLDER) + os.pathsep + os.environ.get("PATH", ""))
+
+
+def can_run_executables(project_path: str) -> bool:
+    return sys.platform.startswith("linux") and has_linux_executables(project_path)
+
+
+@pytest.fixture
+def project(tmp_path):
+    return make_project(str(tmp_path / "project"))
@@ -0,0 +1,129 @@
+import os
+import time
+import asyncio
+
+import pytest
+from conftest import make_project, can_run_executables, use_stub_swat
+from swatcuppython import sufi2files
+from swatcuppython.parallel import ParallelRunner
+from swatcuppython.asyncrunner import AsyncSUFI2Runner, run_concurrently
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+class ShellWrapper(object):
+    """ Runs a shell script in place of each SUFI2 stage """
+
+    def __init__(self, scripts: dict):
+        self.scripts = scripts
+
+    def get_sufi2_command(self, path, stage):
+        return {"args": ["/bin/sh", "-c", self.scripts[stage]], "input": None, "new_console": False}
+
+
+def _is_running(pid: int) -> bool:
+    """ True if the process exists and is not a zombie """
+    try:
+        with open("/proc/" + str(pid) + "/stat") as fo:
+            return fo.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except OSError:
+        return False
+
+
+@pytest.fixture
+def linux(tmp_path):
+    if not os.path.isdir("/proc"):
+        pytest.skip("Needs /proc")
+    return str(tmp_path)
+
+
+def test_run_stages_output_and_return_codes(linux):
+    lines = []
+    wrapper = ShellWrapper({"pre": "echo pre; echo second", "run": "printf 'no newline'; exit 3", "post": "true"})
+    runner = AsyncSUFI2Runner(wrapper, linux, lambda folder, line: lines.append((folder, line)))
+    # Stops at the first stage that fails
+    assert asyncio.run(runner.run_stages()) == [0, 3]
+    assert lines == [(linux, "pre"), (linux, "second"), (linux, "no newline")]
+
+
+def test_cancel_kills_process_tree(linux):
+    pid_file = os.path.join(linux, "child.pid")
+    wrapper = ShellWrapper({"run": "sleep 60 & echo $! > child.pid; wait"})
+
+    async def cancel():
+        task = asyncio.ensure_future(AsyncSUFI2Runner(wrapper, linux).run())
+        while not os.path.isfile(pid_file) or not open(pid_file).read().strip():
+            await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(cancel(), 30))
+    with open(pid_file) as fo:
+        pid = int(fo.read())
+    for i in range(50):
+        if not _is_running(pid):
+            break
+        time.sleep(0.1)
+    assert not _is_running(pid)
+
+
+def test_run_concurrently(linux):
+    folders = []
+    for i in range(3):
+        folders.append(os.path.join(linux, str(i)))
+        os.makedirs(folders[-1])
+    wrapper = ShellWrapper({"run": "sleep 0.3; exit $(basename $PWD)"})
+    started = time.time()
+    assert asyncio.run(run_concurrently([AsyncSUFI2Runner(wrapper, folder) for folder in folders],
+                                        ("run",))) == [[0], [1], [2]]
+    assert time.time() - started < 0.85
+    started = time.time()
+    asyncio.run(run_concurrently([AsyncSUFI2Runner(wrapper, folder) for folder in folders], ("run",),
+                                 max_concurrency=1))
+    assert time.time() - started >= 0.9
+
+
+def test_run_concurrently_failure_kills_the_others(linux):
+    pid_file = os.path.join(linux, "child.pid")
+
+    class FailingWrapper(ShellWrapper):
+        def get_sufi2_command(self, path, stage):
+            if stage == "post":
+                raise ValueError("Invalid SUFI2 stage: " + stage)
+            return super().get_sufi2_command(path, stage)
+
+    runners = [AsyncSUFI2Runner(ShellWrapper({"run": "sleep 60 & echo $! > child.pid; wait"}), linux),
+               AsyncSUFI2Runner(FailingWrapper({"run": "while [ ! -s child.pid ]; do sleep 0.05; done"}), linux)]
+    with pytest.raises(ValueError):
+        asyncio.run(asyncio.wait_for(run_concurrently(runners, ("run", "post")), 30))
+    with open(pid_file) as fo:
+        pid = int(fo.read())
+    for i in range(50):
+        if not _is_running(pid):
+            break
+        time.sleep(0.1)
+    assert not _is_running(pid)
+
+
+def test_parallel_run_async(tmp_path, monkeypatch):
+    project = make_project(str(tmp_path / "project"), n_sims=7)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    use_stub_swat(project, monkeypatch)
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    assert wrapper.sufi2_pre(project) == 0
+    assert wrapper.sufi2_run(project) == 0
+    expected = {}
+    for name in sufi2files.read_var_file_names(project):
+        with open(os.path.join(project, "SUFI2.OUT", name), "rb") as fo:
+            expected[name] = fo.read()
+        os.remove(os.path.join(project, "SUFI2.OUT", name))
+    runner = ParallelRunner(wrapper, project, os.path.join(project, "swatcuppython"), 3)
+    os.makedirs(runner.base_folder_path)
+    lines = []
+    assert asyncio.run(runner.run_async(lambda folder, line: lines.append(folder))) == [0, 0, 0]
+    assert set(lines) == set(runner.get_process_folder_path(process) for process in range(3))
+    for name, data in expected.items():
+        with open(os.path.join(project, "SUFI2.OUT", name), "rb") as fo:
+            assert fo.read() == data
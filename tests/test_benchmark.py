@@ -0,0 +1,15 @@
+import os
+
+import pytest
+from conftest import can_run_executables
+from swatcuppython.benchmark import benchmark_end_to_end
+
+
+def test_end_to_end_runs_the_stages(project):
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 linux executables not found")
+    path = os.environ.get("PATH")
+    result = benchmark_end_to_end(project, n_sims=3)
+    assert [result[stage + "_return_code"] for stage in ("pre", "run", "post")] == [0, 0, 0]
+    assert result["simulation_seconds"] == result["run_seconds"] / 3
+    assert os.environ.get("PATH") == path
@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import pytest
+from conftest import make_project, can_run_executables, use_stub_swat
+from swatcuppython import sufi2files
+from swatcuppython.cache import input_fingerprint, SimulationCache, CachedRunner
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+def _touch(file_path: str, text: str = "x"):
+    with open(file_path, "a") as fo:
+        fo.write(text)
+
+
+def test_input_fingerprint_without_backup(project):
+    fingerprint = input_fingerprint(project)
+    assert input_fingerprint(project) == fingerprint
+    # Outputs of the runs are not inputs
+    _touch(os.path.join(project, "output.rch"))
+    _touch(os.path.join(project, "SUFI2_swEdit.def"), "\n")
+    assert input_fingerprint(project) == fingerprint
+    _touch(os.path.join(project, "file.cio"))
+    assert input_fingerprint(project) != fingerprint
+
+
+def test_input_fingerprint_with_backup(project):
+    backup_path = os.path.join(project, "Backup")
+    os.makedirs(backup_path)
+    shutil.copy2(os.path.join(project, "000010001.hru"), backup_path)
+    fingerprint = input_fingerprint(project)
+    # The project copy of a Backup file is edited by SWAT_Edit.exe in every simulation
+    _touch(os.path.join(project, "000010001.hru"))
+    assert input_fingerprint(project) == fingerprint
+    _touch(os.path.join(backup_path, "000010001.hru"))
+    changed = input_fingerprint(project)
+    assert changed != fingerprint
+    # Model files out of Backup (climate, file.cio, ...) still count
+    _touch(os.path.join(project, "pcp1.pcp"))
+    assert input_fingerprint(project) != changed
+
+
+def _read_var_files(project: str) -> dict:
+    var_files = {}
+    for name in sufi2files.read_var_file_names(project):
+        with open(os.path.join(project, "SUFI2.OUT", name), "rb") as fo:
+            var_files[name] = fo.read()
+    return var_files
+
+
+def test_keys_and_lru(tmp_path):
+    cache = SimulationCache(str(tmp_path / "cache"), max_size=10 ** 6, decimals=3)
+    keys = cache.make_keys("fingerprint", [[0.1, -0.0], [0.1004, 0.0], [0.2, 0.0]])
+    assert keys[0] == keys[1] != keys[2]
+    assert cache.make_keys("other", [[0.1, 0.0]]) != keys[:1]
+    assert cache.get(keys[0]) is None
+    cache.put(keys[0], {"FLOW_OUT_1.txt": b"    1   1.0\n"})
+    assert cache.get(keys[0]) == {"FLOW_OUT_1.txt": b"    1   1.0\n"}
+    # Entries are reloaded from the cache folder
+    assert SimulationCache(cache.cache_path).get(keys[0]) == {"FLOW_OUT_1.txt": b"    1   1.0\n"}
+    cache.max_size = 1
+    cache.put(keys[2], {"FLOW_OUT_1.txt": b"    1   2.0\n"})
+    assert cache.get(keys[0]) is None
+    stats = cache.get_stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["entries"]) == (1, 2, 1, 1)
+
+
+def test_cached_runner_hits_and_misses(tmp_path, monkeypatch):
+    project = make_project(str(tmp_path / "project"), n_sims=6)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    # Blank lines of var_file_name.txt are not var files
+    with open(os.path.join(project, "SUFI2.IN", "var_file_name.txt"), "a") as fo:
+        fo.write("\n\n")
+    use_stub_swat(project, monkeypatch)
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    assert wrapper.sufi2_pre(project) == 0
+    assert wrapper.sufi2_run(project) == 0
+    expected = _read_var_files(project)
+
+    cache = SimulationCache(str(tmp_path / "cache"))
+    sufi2files.write_swedit_def(project, 1, 4)
+    assert CachedRunner(wrapper, project, cache).run() == {"hits": [], "misses": [1, 2, 3, 4], "return_codes": [0]}
+    sufi2files.write_swedit_def(project, 1, 6)
+    result = CachedRunner(wrapper, project, cache).run()
+    assert result == {"hits": [1, 2, 3, 4], "misses": [5, 6], "return_codes": [0]}
+    # The var files rebuilt with the cached blocks are the ones of the full run
+    assert _read_var_files(project) == expected
+    assert sufi2files.read_swedit_def(project) == (1, 6)
+
+    # New parameter values of simulation 2 miss the cache
+    simulations, values = sufi2files.read_par_val(project)
+    values[1] += 0.01
+    sufi2files.write_par_val(project, simulations, values)
+    result = CachedRunner(wrapper, project, cache).run()
+    assert (result["hits"], result["misses"]) == ([1, 3, 4, 5, 6], [2])
+    assert _read_var_files(project) == expected
+    assert cache.get_stats()["entries"] == 7
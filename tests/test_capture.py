@@ -0,0 +1,107 @@
+import io
+import os
+import sys
+
+import pytest
+from swatcuppython import capture, sufi2files
+from swatcuppython.capture import SUFI2Progress, OutputCapture, CapturedProcess
+
+
+class Clock(object):
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(capture.time, "time", clock.time)
+    return clock
+
+
+def test_progress_parse():
+    progress = SUFI2Progress()
+    assert not progress.parse("reading par_val.txt")
+    assert progress.format_status() == "starting"
+    assert progress.parse(" simulation no=   3")
+    assert (progress.first, progress.simulation, progress.year) == (3, 3, None)
+    assert progress.parse("  Executing year 1995")
+    assert progress.year == 1995
+    # A new simulation resets the year
+    assert progress.parse("Simulation No: 4")
+    assert (progress.simulation, progress.year, progress.get_completed()) == (4, None, 1)
+    assert progress.get_total() is None
+
+
+def test_progress_eta_and_status(clock):
+    progress = SUFI2Progress(5, 14)
+    progress.parse("simulation no= 5")
+    assert progress.get_eta() is None
+    assert progress.format_status() == "simulation 1 of 10"
+    clock.now += 20
+    progress.parse("simulation no= 7")
+    progress.parse("Executing year 2001")
+    # 2 simulations in 20 s, 8 to go
+    assert progress.get_eta() == pytest.approx(80.0)
+    assert progress.format_status() == "simulation 3 of 10, year 2001, ETA 80 s"
+    status = progress.get_status()
+    assert (status["simulation"], status["index"], status["total"], status["completed"], status["year"]) == \
+        (7, 3, 10, 2, 2001)
+    assert status["elapsed"] == pytest.approx(20.0)
+
+
+def test_progress_from_project(tmp_path):
+    assert SUFI2Progress.from_project(str(tmp_path)).get_total() is None
+    sufi2files.write_swedit_def(str(tmp_path), 11, 20)
+    assert SUFI2Progress.from_project(str(tmp_path)).get_total() == 10
+
+
+def test_ring_buffer_and_log(tmp_path):
+    data = b"".join(b"line " + str(i).encode() + b"\n" for i in range(100)) + b"\n\nprogress 1\rprogress 2\r\nlast"
+    lines = []
+    log_path = str(tmp_path / "output.log")
+    output = OutputCapture(io.BufferedReader(io.BytesIO(data)), max_lines=5, log_path=log_path,
+                           line_callback=lines.append)
+    output.join(10)
+    assert output.is_finished()
+    # Blank lines are dropped and \r splits the lines of the progress bars
+    assert output.get_lines() == ["line 98", "line 99", "progress 1", "progress 2", "last"]
+    assert output.get_lines(2) == ["progress 2", "last"]
+    assert output.line_count == 103
+    assert len(lines) == 103
+    with open(log_path, "rb") as fo:
+        assert fo.read() == data
+
+
+def test_long_line_without_end():
+    data = b"x" * (3 * OutputCapture.READ_SIZE)
+    output = OutputCapture(io.BufferedReader(io.BytesIO(data)), max_lines=10)
+    output.join(10)
+    assert "".join(output.get_lines()) == data.decode()
+    assert all(len(line) <= 2 * OutputCapture.READ_SIZE for line in output.get_lines())
+
+
+def test_captured_process_exit_code(tmp_path):
+    script = "import sys\nfor i in range(3):\n    print('simulation no= ' + str(i + 1))\nsys.exit(3)\n"
+    process = CapturedProcess([sys.executable, "-c", script], cwd=str(tmp_path), progress=SUFI2Progress(1, 3))
+    assert process.wait(30) == 3
+    assert process.returncode == 3
+    assert process.poll() == 3
+    assert process.get_lines() == ["simulation no= 1", "simulation no= 2", "simulation no= 3"]
+    assert process.get_status()["completed"] == 2
+
+
+def test_captured_process_stdin(tmp_path):
+    script = "import sys\nprint(sys.stdin.read().upper())"
+    log_path = str(tmp_path / "output.log")
+    process = CapturedProcess([sys.executable, "-c", script], cwd=str(tmp_path), stdin_text="y" + os.linesep + "n",
+                              log_path=log_path)
+    assert process.wait(30) == 0
+    assert process.get_lines() == ["Y", "N"]
+    assert process.get_status() is None
+    with open(log_path, "r") as fo:
+        assert fo.read().split() == ["Y", "N"]
@@ -0,0 +1,60 @@
+import os
+
+import pytest
+from conftest import make_project, can_run_executables, use_stub_swat
+from swatcuppython import sufi2files
+from swatcuppython.checkpoint import CheckpointRunner, RunCheckpoint, CHECKPOINT_FILE, get_missing_ranges
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+def _read_var_files(project: str) -> dict:
+    var_files = {}
+    for name in sufi2files.read_var_file_names(project):
+        with open(os.path.join(project, "SUFI2.OUT", name), "rb") as fo:
+            var_files[name] = fo.read()
+    return var_files
+
+
+def test_get_missing_ranges():
+    assert get_missing_ranges(1, 10, [1, 2, 5, 6, 10]) == [(3, 4), (7, 9)]
+    assert get_missing_ranges(1, 3, [1, 2, 3]) == []
+    assert get_missing_ranges(4, 6, []) == [(4, 6)]
+
+
+def test_resume_splices_the_missing_simulations(tmp_path, monkeypatch):
+    project = make_project(str(tmp_path / "project"), n_sims=6)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    use_stub_swat(project, monkeypatch)
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    assert wrapper.sufi2_pre(project) == 0
+    assert wrapper.sufi2_run(project) == 0
+    expected = _read_var_files(project)
+
+    # Killed while running simulation 4: blocks 1 to 3 and part of block 4
+    for name, content in expected.items():
+        blocks = sufi2files.read_sufi2_var_blocks(os.path.join(project, "SUFI2.OUT", name))
+        with open(os.path.join(project, "SUFI2.OUT", name), "wb") as fo:
+            for simulation, block in blocks[:3]:
+                fo.write(block)
+            fo.write(blocks[3][1][:len(blocks[3][1]) // 2])
+    result = CheckpointRunner(wrapper, project, interval=0.1).run()
+    assert result["resumed"] == [1, 2, 3]
+    assert result["ran"] == [(4, 6)]
+    assert result["return_codes"] == [0]
+    assert result["missing"] == []
+    assert _read_var_files(project) == expected
+    assert sufi2files.read_swedit_def(project) == (1, 6)
+    assert not os.path.isfile(os.path.join(project, CHECKPOINT_FILE))
+
+
+def test_checkpoint_of_other_parameter_sets(project):
+    checkpoint = RunCheckpoint(project)
+    state = checkpoint.begin()
+    assert (state["start"], state["end"]) == sufi2files.read_swedit_def(project)
+    checkpoint.mark_completed([1, 2])
+    assert RunCheckpoint(project).read()["completed"] == [1, 2]
+    with open(os.path.join(project, "SUFI2.IN", "par_val.txt"), "a") as fo:
+        fo.write("\n")
+    assert RunCheckpoint(project).read() is None
@@ -0,0 +1,96 @@
+import os
+import shutil
+import threading
+
+import pytest
+from conftest import make_project
+from swatcuppython import sufi2files
+from swatcuppython.distributed import QueueTransport, TCPTransport, WorkerAgent, DistributedCoordinator
+
+
+class FakeWrapper(object):
+    """ Writes a block per simulation of the SUFI2_swEdit.def range in every var file. Simulations in skip are left out
+    and the runs return return_code
+    """
+
+    def __init__(self, return_code: int = 0, skip=()):
+        self.return_code = return_code
+        self.skip = set(skip)
+        self.runs = 0
+
+    def sufi2_run(self, project_path):
+        self.runs += 1
+        first, last = sufi2files.read_swedit_def(project_path)
+        for name in sufi2files.read_var_file_names(project_path):
+            with open(os.path.join(project_path, "SUFI2.OUT", name), "ab") as fo:
+                for simulation in range(first, last + 1):
+                    if simulation not in self.skip:
+                        fo.write(sufi2files.SIMULATION_HEADER_FORMAT.format(simulation).encode() +
+                                 (name + " " + str(simulation) + "\n").encode())
+        return self.return_code
+
+
+def _run(tmp_path, wrapper, batch_size=4, agent_project=None):
+    project = make_project(str(tmp_path / "project"), n_sims=10)
+    transport = QueueTransport()
+    coordinator = DistributedCoordinator(project, transport, batch_size=batch_size, max_retries=1, timeout=60)
+    transport.serve()
+    agent = WorkerAgent(agent_project(project) if agent_project else project, wrapper, transport.connect(),
+                        name="agent")
+    thread = threading.Thread(target=agent.serve)
+    thread.start()
+    try:
+        summary = coordinator.run(coordinator.make_range_tasks(1, 10))
+    finally:
+        coordinator.stop_agents(1)
+        thread.join()
+    return project, summary
+
+
+def test_merge_in_simulation_order(tmp_path):
+    project, summary = _run(tmp_path, FakeWrapper())
+    assert summary["simulations"] == 10
+    assert summary["failed"] == []
+    for name in sufi2files.read_var_file_names(project):
+        blocks = sufi2files.read_sufi2_var_blocks(os.path.join(project, "SUFI2.OUT", name))
+        assert [simulation for simulation, block in blocks] == list(range(1, 11))
+
+
+def test_failed_run_is_retried(tmp_path):
+    wrapper = FakeWrapper(return_code=1)
+    project, summary = _run(tmp_path, wrapper)
+    assert summary["failed"] == [0, 1, 2]
+    assert summary["simulations"] == 0
+    # Every task is run once and retried once
+    assert wrapper.runs == 6
+
+
+def test_missing_blocks_are_errors(tmp_path):
+    project, summary = _run(tmp_path, FakeWrapper(skip=[6]))
+    assert summary["failed"] == [1]
+    assert summary["simulations"] == 6
+
+
+def test_stale_agent_copy_fails_the_tasks(tmp_path):
+    def agent_project(project):
+        # Copy provisioned before a new sufi2_pre of the project
+        path = str(tmp_path / "node")
+        shutil.copytree(project, path)
+        with open(os.path.join(project, "SUFI2.IN", "par_val.txt"), "a") as fo:
+            fo.write("\n")
+        return path
+
+    wrapper = FakeWrapper()
+    project, summary = _run(tmp_path, wrapper, agent_project=agent_project)
+    assert summary["failed"] == [0, 1, 2]
+    assert wrapper.runs == 0
+
+
+def test_tcp_transport_key():
+    assert len(TCPTransport().authkey) == 32
+    assert TCPTransport().authkey != TCPTransport().authkey
+    assert TCPTransport(("localhost", 50000)).address == ("localhost", 50000)
+    for host in ("", "0.0.0.0", "192.168.0.10", "node1"):
+        with pytest.raises(ValueError, match="authkey"):
+            TCPTransport((host, 50000))
+    assert TCPTransport(("", 50000), authkey=b"secret").authkey == b"secret"
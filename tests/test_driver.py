@@ -0,0 +1,49 @@
+import os
+
+import pytest
+from conftest import make_project, can_run_executables
+from swatcuppython.benchmark import STUB_FOLDER
+from swatcuppython.swatcup import SWATCUP
+from swatcuppython.swatcupversion import SWATCUPVersion
+from swatcuppython.driver import IterationDriver, get_run_error
+
+
+def _swatcup(project, monkeypatch):
+    monkeypatch.setenv("PATH", os.path.join(project, STUB_FOLDER) + os.pathsep + os.environ.get("PATH", ""))
+    swatcup = SWATCUP(SWATCUPVersion.SWATCUP2019)
+    swatcup.set_project_folder(project)
+    return swatcup
+
+
+def test_get_run_error():
+    assert get_run_error(0) is None
+    assert get_run_error([0, 0]) is None
+    assert get_run_error({"timings": {}, "failed": [3]}) is None
+    assert get_run_error(1) == "return code 1"
+    assert get_run_error([0, -9]) == "return code -9"
+    assert get_run_error({"return_codes": [0], "missing": [4, 5]}) == "2 simulations missing"
+    assert get_run_error([{"return_codes": [0], "missing": []}, {"return_codes": [2], "missing": []}]) == \
+        "return code 2"
+
+
+def test_failed_run_stops(project, monkeypatch):
+    swatcup = _swatcup(project, monkeypatch)
+    driver = IterationDriver(swatcup, iterations=2, simulations=10, run_function=lambda swatcup: 1, seed=1)
+    with pytest.raises(ValueError, match="return code 1"):
+        driver.run()
+    assert driver.get_history() == []
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_iterations(tmp_path, monkeypatch, native):
+    project = make_project(str(tmp_path / "project"), n_sims=10)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    swatcup = _swatcup(project, monkeypatch)
+    history = IterationDriver(swatcup, iterations=2, simulations=10, native=native, seed=1).run()
+    assert [record["iteration"] for record in history] == [1, 2]
+    for record in history:
+        assert record["simulations"] == 10
+        assert record["goal_function"] == "Nash_Sutcliff"
+        assert 1 <= record["best_simulation"] <= 10
+        assert set(record["p_factor"]) == {"FLOW_OUT_1", "FLOW_OUT_10"}
@@ -0,0 +1,116 @@
+import os
+import time
+
+import numpy
+import pytest
+from swatcuppython import sufi2files
+from swatcuppython.earlystop import EarlyStopping
+from swatcuppython.extract import SWATOutputExtractor
+from swatcuppython.varfile import SUFI2VarTail, parse_sufi2_var_bytes
+
+
+def _take_blocks(project: str) -> dict:
+    """ Empties the var files of the project and returns their blocks, dict name -> {simulation: block} """
+    blocks = {}
+    for name in sufi2files.read_var_file_names(project):
+        file = os.path.join(project, "SUFI2.OUT", name)
+        blocks[name] = dict(sufi2files.read_sufi2_var_blocks(file))
+        open(file, "wb").close()
+    return blocks
+
+
+def _append(project: str, blocks: dict, simulation: int, size: int = None):
+    for name, name_blocks in blocks.items():
+        with open(os.path.join(project, "SUFI2.OUT", name), "ab") as fo:
+            fo.write(name_blocks[simulation][:size])
+
+
+def _goals(project: str) -> dict:
+    simulations, objectives, goal = EarlyStopping(project, abort_simulations=False).engine.evaluate()
+    return dict(zip(simulations.tolist(), goal.tolist()))
+
+
+def test_tail_after_truncation(project):
+    file = os.path.join(project, "SUFI2.OUT", "FLOW_OUT_1.txt")
+    blocks = dict(sufi2files.read_sufi2_var_blocks(file))
+    with open(file, "wb") as fo:
+        fo.write(blocks[1] + blocks[2] + blocks[3][:200])
+    tail = SUFI2VarTail(file)
+    assert [simulation for simulation, time_steps, values in tail.read()] == [1, 2]
+    # The block of the killed simulation 3 is removed: the file shrinks below the offset
+    sufi2files.truncate_sufi2_var_file(file, 3)
+    assert tail.read() == []
+    with open(file, "ab") as fo:
+        fo.write(blocks[4])
+    [(simulation, time_steps, values)] = tail.read()
+    simulations, expected_time_steps, expected_values = parse_sufi2_var_bytes(blocks[4])
+    assert simulation == 4
+    assert numpy.array_equal(time_steps, expected_time_steps)
+    assert numpy.array_equal(values, expected_values[0])
+
+
+def test_reset_after_a_watchdog_kill(project):
+    goals = _goals(project)
+    blocks = _take_blocks(project)
+    stopping = EarlyStopping(project, abort_simulations=False, patience=10)
+    _append(project, blocks, 1)
+    _append(project, blocks, 2)
+    _append(project, blocks, 3, 300)
+    stopping.track(project)
+    # Killed in simulation 3 (see WatchdogRunner._kill), and the next run writes simulations 4 and 5 before the
+    # next check: the files grow past the old offset again
+    for name in blocks:
+        sufi2files.truncate_sufi2_var_file(os.path.join(project, "SUFI2.OUT", name), 3)
+    stopping.reset(project, 3)
+    _append(project, blocks, 4)
+    _append(project, blocks, 5)
+    stopping.track(project)
+    assert [simulation for simulation, goal in stopping.goals] == [1, 2, 4, 5]
+    assert [goal for simulation, goal in stopping.goals] == pytest.approx([goals[s] for s in (1, 2, 4, 5)])
+
+
+def test_patience(project):
+    goals = _goals(project)
+    blocks = _take_blocks(project)
+    order = sorted(goals, key=goals.get)
+    # NS is maximized: three improvements and then three worse simulations
+    sequence = [order[0], order[5], order[10], order[1], order[2], order[3]]
+    for tolerance, converged_at in ((0.0, 6), (1e9, 4)):
+        _take_blocks(project)
+        stopping = EarlyStopping(project, abort_simulations=False, patience=3, tolerance=tolerance)
+        for count, simulation in enumerate(sequence, 1):
+            _append(project, blocks, simulation)
+            stopping.track(project)
+            # The first simulation is complete once the second one starts
+            assert len(stopping.goals) == (count if count > 1 else 0)
+            assert stopping.is_converged() == (count >= converged_at)
+        # Improvements up to the tolerance do not count
+        assert stopping.best_goal == pytest.approx(goals[order[10] if tolerance == 0.0 else order[0]])
+    stopping = EarlyStopping(project, abort_simulations=False)
+    stopping.track(project)
+    assert stopping.goals == [] and not stopping.is_converged()
+
+
+def test_simulation_bound(project):
+    stopping = EarlyStopping(project, check_interval=0.0)
+    assert stopping.goal_name == "NS" and stopping.threshold == 0.5
+    results = SWATOutputExtractor(project, "SUFI2_extract_rch.def").extract()
+    series = {os.path.splitext(name)[0]: (numpy.array([1]), time_steps, values[None, :])
+              for name, (time_steps, values) in results.items()}
+    goal = float(stopping.engine.evaluate(series)[2][0])
+    # The whole simulated period: the bound is the goal
+    assert stopping.get_bound(project) == pytest.approx(goal)
+    # Output files older than the simulation are from the previous one
+    assert stopping.get_bound(project, started=time.time() + 60) is None
+
+    output_path = os.path.join(project, "output.rch")
+    with open(output_path, "rb") as fo:
+        lines = fo.readlines()
+    with open(output_path, "wb") as fo:
+        fo.writelines(lines[:len(lines) // 2])
+    bound = stopping.get_bound(project)
+    assert bound > goal
+    stopping.threshold = bound + 0.01
+    assert stopping.should_abort(project, time.time() - 60)
+    stopping.threshold = bound - 0.01
+    assert not stopping.should_abort(project, time.time() - 60)
@@ -0,0 +1,122 @@
+import os
+import shutil
+import subprocess
+
+import numpy
+import pytest
+from conftest import make_project, run_executable, can_run_executables
+from swatcuppython import sufi2files
+from swatcuppython.editor import ParameterEditor, EditorRunner, format_field, parse_parameter
+from swatcuppython.varfile import read_sufi2_var_array
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+NAMES = ["r__PARAM1.mgt", "v__PARAM2.gw", "a__PARAM3.sub", "r__PARAM4.hru"]
+
+
+def _read(file_path: str) -> bytes:
+    with open(file_path, "rb") as fo:
+        return fo.read()
+
+
+def _make_backup(project: str):
+    """ Backup folder with the model files of the project, with distinct values and an exponent field """
+    backup_path = os.path.join(project, "Backup")
+    os.makedirs(backup_path)
+    for name in os.listdir(project):
+        if name.split(".")[-1] in ("mgt", "gw", "sub", "hru"):
+            content = _read(os.path.join(project, name))
+            content = content.replace(b"          0.0000    | PARAM1 :", b"         75.2500    | PARAM1 :")
+            content = content.replace(b"          0.0000    | PARAM3 :", b"          1.5000    | PARAM3 :")
+            content = content.replace(b"          0.0000    | PARAM4 :", b"      1.2500E-03    | PARAM4 :")
+            with open(os.path.join(backup_path, name), "wb") as fo:
+                fo.write(content)
+            shutil.copy2(os.path.join(backup_path, name), os.path.join(project, name))
+    return backup_path
+
+
+def test_exponent_fields_keep_their_format():
+    content = b" Header\n      1.2500E-03    | ESCO : Soil evaporation\n"
+    fields = ParameterEditor.locate(content, parse_parameter("r__ESCO.hru"))
+    assert fields == [(8, 16, 4, "E", 1.25e-3)]
+    assert format_field(2.5e-3, 16, 4, "E") == b"      2.5000E-03"
+    assert format_field(75.25 * 1.1, 16, 4) == b"         82.7750"
+
+
+def test_round_trip(project):
+    backup_path = _make_backup(project)
+    editor = ParameterEditor(project, NAMES)
+    assert all(editor.index)
+    # No change gives the original files back, byte by byte
+    editor.apply([0.0, 0.0, 0.0, 0.0])
+    for name in editor.get_touched_files():
+        assert _read(os.path.join(project, name)) == _read(os.path.join(backup_path, name))
+
+    editor.apply([0.1, 2.5, -0.5, 1.0])
+    expected = {"PARAM1": 75.25 * 1.1, "PARAM2": 2.5, "PARAM3": 1.0, "PARAM4": 2.5e-3}
+    for name in editor.get_touched_files():
+        original, patched = _read(os.path.join(backup_path, name)), _read(os.path.join(project, name))
+        assert len(patched) == len(original)
+        for parameter in NAMES:
+            parameter = parse_parameter(parameter)
+            if name.endswith("." + parameter["extension"]):
+                [(offset, width, decimals, exponent, value)] = ParameterEditor.locate(patched, parameter)
+                assert value == pytest.approx(expected[parameter["name"]], rel=1e-4)
+                assert (exponent == "E") == (parameter["name"] == "PARAM4")
+                # Only the field changed
+                assert patched[:offset] + patched[offset + width:] == original[:offset] + original[offset + width:]
+
+
+def test_editor_run_matches_sufi2_execute(tmp_path, monkeypatch):
+    runs = {}
+    for mode in ("editor", "execute"):
+        project = make_project(str(tmp_path / mode), n_sims=3)
+        if not can_run_executables(project):
+            pytest.skip("SUFI2 executables cannot run here")
+        _make_backup(project)
+        for name in sufi2files.read_var_file_names(project):
+            os.remove(os.path.join(project, "SUFI2.OUT", name))
+        if mode == "editor":
+            editor = ParameterEditor(project, NAMES)
+            reads = []
+            read_par_val = sufi2files.read_par_val
+            monkeypatch.setattr(sufi2files, "read_par_val", lambda path: reads.append(path) or read_par_val(path))
+            result = EditorRunner(SWATCUP2019(OperationalSystem.LINUX), project, editor).run()
+            monkeypatch.undo()
+            assert result == {"simulations": [1, 2, 3], "return_codes": [0, 0, 0], "missing": []}
+            # par_val.txt is read once, not once per simulation
+            assert len(reads) == 1
+            assert sufi2files.read_trk(project) == 3
+            simulations, values = sufi2files.read_par_val(project)
+            [(offset, width, decimals, exponent, value)] = editor.locate(
+                _read(os.path.join(project, "000010001.gw")), parse_parameter(NAMES[1]))
+            assert value == pytest.approx(values[2, 1], abs=1e-4)
+        else:
+            assert run_executable(project, "SUFI2_execute.exe") == 0
+        runs[mode] = [read_sufi2_var_array(os.path.join(project, "SUFI2.OUT", name))
+                      for name in sufi2files.read_var_file_names(project)]
+    for editor_arrays, execute_arrays in zip(runs["editor"], runs["execute"]):
+        assert numpy.array_equal(editor_arrays[0], execute_arrays[0])
+        assert numpy.array_equal(editor_arrays[1], execute_arrays[1])
+        assert numpy.allclose(editor_arrays[2], execute_arrays[2], rtol=1e-5)
+
+
+def test_apply_matches_swat_edit(project):
+    # The synthetic projects put a stub mono on the PATH of SUFI2_execute.exe only, this is the real one
+    mono = shutil.which("mono")
+    if mono is None or not can_run_executables(project):
+        pytest.skip("SWAT_Edit.exe needs mono")
+    backup_path = _make_backup(project)
+    values = [0.1, 2.5, -0.5, 1.0]
+    with open(os.path.join(project, "model.in"), "w") as fo:
+        for name, value in zip(NAMES, values):
+            fo.write(name + "  " + str(value) + "\n")
+    subprocess.run([mono, "SWAT_Edit.exe"], cwd=project, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   timeout=300, check=True)
+    editor = ParameterEditor(project, NAMES)
+    expected = {name: _read(os.path.join(project, name)) for name in editor.get_touched_files()}
+    for name in expected:
+        shutil.copy2(os.path.join(backup_path, name), os.path.join(project, name))
+    editor.apply_model_in()
+    for name, content in expected.items():
+        assert _read(os.path.join(project, name)) == content, name
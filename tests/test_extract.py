@@ -0,0 +1,121 @@
+import os
+import shutil
+
+import numpy
+import pytest
+from conftest import run_executable, can_run_executables
+from swatcuppython import sufi2files
+from swatcuppython.extract import read_extract_def, count_time_steps, find_var_time_steps, SWATOutputExtractor
+
+NO_OBS_DEF = """SUFI2          : SWAT-CUP program: SUFI2, GLUE, ParaSol, PSO, MCMC
+output.rch     : swat output file name
+2              : number of variables to get
+7 8            : variable column number(s) in the swat output file
+
+10             : total number of subbasins in the project
+
+1              : number of subbasins to get for the first variable
+3              : subbasin numbers for the first variable
+
+2              : number of subbasins to get for the second variable
+4 10           : subbasin numbers for the second variable
+
+2001           : beginning year of simulation not including warm up period
+2001           : end year of simulation
+
+1              : time step (1=daily,2=monthly, 3=yearly)
+
+/**** Remark
+7              : not a value
+"""
+
+
+def _write(file_path: str, text: str):
+    with open(file_path, "w") as fo:
+        fo.write(text)
+
+
+def _read_out_folder(project: str) -> dict:
+    out_folder = os.path.join(project, "SUFI2.OUT")
+    files = {}
+    for name in os.listdir(out_folder):
+        with open(os.path.join(out_folder, name), "rb") as fo:
+            files[name] = fo.read()
+    return files
+
+
+def _clear_out_folder(project: str):
+    shutil.rmtree(os.path.join(project, "SUFI2.OUT"))
+    os.makedirs(os.path.join(project, "SUFI2.OUT"))
+
+
+def _add_no_obs_def(project: str):
+    _write(os.path.join(project, "extract_rch_No_obs.def"), NO_OBS_DEF)
+    _write(os.path.join(project, "SUFI2.IN", "var_file_rch_No_obs.txt"),
+           "FLOW_OUT_3.txt\nFLOW_IN_4.txt\nFLOW_IN_10.txt\n")
+
+
+def test_read_extract_def(project, tmp_path):
+    definition = read_extract_def(os.path.join(project, "SUFI2_extract_rch.def"))
+    assert definition == {"output_file": "output.rch", "columns": [7], "entity_number": 10, "entities": [[1, 10]],
+                          "begin_year": 2001, "end_year": 2001, "time_step": 1}
+    # The No_obs def files start with the program name and the remarks are not read
+    file_path = str(tmp_path / "extract_rch_No_obs.def")
+    _write(file_path, NO_OBS_DEF.replace("4 10           ", "All            ")
+           .replace("2              : number of subbasins to get for the second",
+                    "10             : number of subbasins to get for the second"))
+    definition = read_extract_def(file_path)
+    assert definition["columns"] == [7, 8]
+    assert definition["entities"] == [[3], list(range(1, 11))]
+    assert definition["time_step"] == 1
+    _write(file_path, NO_OBS_DEF.replace("4 10", "4"))
+    with pytest.raises(ValueError, match="Expected 2 entities for variable 2"):
+        read_extract_def(file_path)
+    _write(file_path, NO_OBS_DEF.replace("1              : time step", "4              : time step"))
+    with pytest.raises(ValueError, match="Invalid time step"):
+        read_extract_def(file_path)
+
+
+def test_count_time_steps():
+    assert count_time_steps(2001, 2001, 1) == 365
+    assert count_time_steps(2000, 2001, 1) == 366 + 365
+    assert count_time_steps(2000, 2002, 2) == 36
+    assert count_time_steps(2000, 2002, 3) == 3
+
+
+@pytest.mark.parametrize("def_file, program", [("SUFI2_extract_rch.def", "SUFI2_extract_rch.exe"),
+                                               ("extract_rch_No_obs.def", "extract_rch_No_Obs.exe")])
+def test_extract_matches_executable(project, def_file, program):
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    _add_no_obs_def(project)
+    _clear_out_folder(project)
+    assert run_executable(project, program) == 0
+    expected = _read_out_folder(project)
+    assert expected
+    _clear_out_folder(project)
+    SWATOutputExtractor(project, def_file).run()
+    assert _read_out_folder(project) == expected
+
+
+def test_extract_observed_time_steps(project):
+    observed = sufi2files.read_observed(os.path.join(project, "SUFI2.IN", "observed_rch.txt"))
+    steps = {variable["name"] + ".txt": variable["index"] for variable in observed["variables"]}
+    results = SWATOutputExtractor(project, "SUFI2_extract_rch.def").extract()
+    assert sorted(results) == sorted(steps)
+    for name, (time_steps, values) in results.items():
+        assert numpy.array_equal(time_steps, steps[name])
+        assert values.shape == time_steps.shape
+    _add_no_obs_def(project)
+    results = SWATOutputExtractor(project, "extract_rch_No_obs.def").extract()
+    assert sorted(results) == ["FLOW_IN_10.txt", "FLOW_IN_4.txt", "FLOW_OUT_3.txt"]
+    assert numpy.array_equal(results["FLOW_IN_4.txt"][0], numpy.arange(1, 366))
+
+
+def test_find_var_time_steps(project):
+    observed = sufi2files.read_observed(os.path.join(project, "SUFI2.IN", "observed_rch.txt"))
+    for variable in observed["variables"]:
+        assert numpy.array_equal(find_var_time_steps(project, variable["name"] + ".txt"), variable["index"])
+    # Without observed_hru.txt every time step of the hru def file is written
+    assert numpy.array_equal(find_var_time_steps(project, "PET_1.txt"), numpy.arange(1, 366))
+    assert find_var_time_steps(project, "UNKNOWN_1.txt") is None
@@ -0,0 +1,53 @@
+import os
+import re
+
+import numpy
+import pytest
+from conftest import make_project, run_executable, can_run_executables
+from swatcuppython.objectives import (ObjectiveEngine, GOAL_FUNCTIONS, compute_objectives, combine_goal,
+                                      get_goal_function, get_goal_layout)
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+def test_objective_values():
+    observed = [1.0, 2.0, 3.0, 4.0]
+    objectives = compute_objectives(observed, [[1.0, 2.0, 3.0, 4.0], [2.0, 3.0, 4.0, 5.0], [4.0, 3.0, 2.0, 1.0]])
+    expected = {"MSE": [0.0, 1.0, 5.0], "SSQ": [0.0, 4.0, 20.0], "SSQR": [0.0, 1.0, 0.0], "Chi2": [0.0, 2.4, 12.0],
+                "R": [1.0, 1.0, -1.0], "R2": [1.0, 1.0, 1.0], "bR2": [1.0, 1.0, 1.0], "NS": [1.0, 0.2, -3.0],
+                "MNS": [1.0, 0.0, -1.0], "PBIAS": [0.0, -40.0, 0.0], "KGE": [1.0, 0.6, -1.0],
+                "RSR": [0.0, 2 / numpy.sqrt(5), 2.0]}
+    for name, values in expected.items():
+        assert objectives[name] == pytest.approx(values), name
+    weights = [1.0, 3.0]
+    both = [objectives, compute_objectives(observed, [[1.0, 2.0, 3.0, 5.0]] * 3)]
+    assert combine_goal(both, weights, 1) == pytest.approx(numpy.array([0.0, 1.0, 5.0]) * 0.25 / 1e6)
+    assert combine_goal(both, weights, 2) == pytest.approx((numpy.array([0.0, 1.0, 5.0]) + 0.75) / 4)
+    # A negative correlation counts as 0 in r2, br2 and KGE
+    assert combine_goal(both, weights, 3)[2] == pytest.approx(3 * both[1]["R2"][2] / 4)
+    assert get_goal_function("Nash_Sutcliff") == get_goal_function(5) == "NS"
+
+
+@pytest.mark.parametrize("goal_type", sorted(GOAL_FUNCTIONS))
+def test_same_as_sufi2_goal_fn(tmp_path, goal_type):
+    project = make_project(str(tmp_path / "project"), n_sims=20)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    observed_file = os.path.join(project, "SUFI2.IN", "observed.txt")
+    with open(observed_file, "r") as fo:
+        text = fo.read()
+    with open(observed_file, "w") as fo:
+        fo.write(re.sub(r"(?m)^\d+(\s+: Objective function type)", str(goal_type) + r"\1", text))
+    assert run_executable(project, "SUFI2_goal_fn.exe") == 0
+    layout = get_goal_layout(SWATCUP2019(OperationalSystem.LINUX).read_sufi2_out_goal(project))
+
+    engine = ObjectiveEngine(project)
+    simulations, objectives, goal = engine.evaluate()
+    assert layout["goal_function"] == engine.get_goal_name()
+    assert numpy.array_equal(simulations, layout["simulations"])
+    # SUFI2_goal_fn.exe gives 0 to the NS and MNS of a variable without residuals (simulation 1 of the synthetic
+    # project is the observed series of the first variable)
+    fitted = numpy.any([objective["MSE"] == 0 for objective in objectives.values()], axis=0)
+    assert fitted.sum() <= 1
+    # goal.txt has 6 decimals
+    assert numpy.allclose(goal[~fitted], layout["goal"][~fitted], rtol=1e-5, atol=1e-6)
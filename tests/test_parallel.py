@@ -0,0 +1,80 @@
+import os
+
+import pytest
+from conftest import make_project, can_run_executables, use_stub_swat
+from swatcuppython import sufi2files
+from swatcuppython.parallel import ParallelRunner
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+class FailingWrapper(SWATCUP2019):
+    """ Runs SUFI2_execute, then fails process folder 1 with return_code or removes its last block """
+
+    def __init__(self, return_code: int = 0, drop_last: bool = False):
+        super().__init__(OperationalSystem.LINUX)
+        self.return_code = return_code
+        self.drop_last = drop_last
+
+    def sufi2_run(self, path):
+        return_code = super().sufi2_run(path)
+        if os.path.basename(path) != "process1":
+            return return_code
+        if self.drop_last:
+            for name in sufi2files.read_var_file_names(path):
+                file = os.path.join(path, "SUFI2.OUT", name)
+                sufi2files.truncate_sufi2_var_file(file, sufi2files.read_sufi2_var_blocks(file)[-1][0])
+        return self.return_code or return_code
+
+
+def _read_var_files(project: str) -> dict:
+    var_files = {}
+    for name in sufi2files.read_var_file_names(project):
+        with open(os.path.join(project, "SUFI2.OUT", name), "rb") as fo:
+            var_files[name] = fo.read()
+    return var_files
+
+
+def _runner(project: str, wrapper, process_number: int = 3) -> ParallelRunner:
+    return ParallelRunner(wrapper, project, os.path.join(project, "swatcuppython"), process_number)
+
+
+def test_split_range():
+    assert ParallelRunner.split_range(1, 10, 3) == [(1, 4), (5, 7), (8, 10)]
+    assert ParallelRunner.split_range(5, 6, 4) == [(5, 5), (6, 6)]
+    assert ParallelRunner.split_range(1, 1, 1) == [(1, 1)]
+
+
+@pytest.fixture
+def run_project(tmp_path, monkeypatch):
+    """ Project with the var files of a SUFI2_execute run of the whole range """
+    project = make_project(str(tmp_path / "project"), n_sims=7)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    use_stub_swat(project, monkeypatch)
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    assert wrapper.sufi2_pre(project) == 0
+    assert wrapper.sufi2_run(project) == 0
+    os.makedirs(os.path.join(project, "swatcuppython"))
+    return project
+
+
+def test_run_and_merge(run_project):
+    expected = _read_var_files(run_project)
+    for name in expected:
+        os.remove(os.path.join(run_project, "SUFI2.OUT", name))
+    assert _runner(run_project, SWATCUP2019(OperationalSystem.LINUX)).run() == [0, 0, 0]
+    for process, (first, last) in enumerate(ParallelRunner.split_range(1, 7, 3)):
+        process_folder = os.path.join(run_project, "swatcuppython", "process" + str(process))
+        assert sufi2files.read_swedit_def(process_folder) == (first, last)
+    # Same var files as one run of the whole range, in simulation order
+    assert _read_var_files(run_project) == expected
+
+
+@pytest.mark.parametrize("wrapper, error", [(FailingWrapper(return_code=1), "process 1: return code 1"),
+                                            (FailingWrapper(drop_last=True), "process 1: 1 simulations missing")])
+def test_failed_process_is_not_merged(run_project, wrapper, error):
+    before = _read_var_files(run_project)
+    with pytest.raises(ValueError, match=error):
+        _runner(run_project, wrapper).run()
+    assert _read_var_files(run_project) == before
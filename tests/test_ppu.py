@@ -0,0 +1,111 @@
+import os
+import re
+
+import numpy
+import pytest
+from conftest import make_project, run_executable, can_run_executables
+from swatcuppython.ppu import PPUCalculator, PPUHistogram, p_factor, r_factor
+
+
+def _read_rows(file_path: str):
+    """ Numeric rows of a 95ppu.txt or 95ppu_g.txt """
+    with open(file_path, "r") as fo:
+        return numpy.array([[float(value) for value in re.split(r"\s+", line.strip())[-4:]] for line in fo
+                            if re.match(r"^\S*\s*-?\d", line) and "factor" not in line and "=" not in line])
+
+
+def test_histogram_band_of_uniform_values():
+    values = numpy.arange(1.0, 101.0)[:, None]
+    histogram = PPUHistogram(1)
+    histogram.update_range(values)
+    histogram.update_histogram(values)
+    lower, mean, upper = histogram.band()[:, 0]
+    # SUFI2_95ppu.exe: L95PPU at 1.25% and U95PPU at 92.5% of the range of 1..100
+    assert lower == pytest.approx(1 + 0.0125 * 99)
+    assert mean == pytest.approx(50.5)
+    assert upper == pytest.approx(1 + 0.925 * 99)
+
+
+def test_histogram_band_of_constant_values():
+    values = numpy.full((20, 3), 4.0)
+    histogram = PPUHistogram(3)
+    histogram.update_range(values)
+    histogram.update_histogram(values)
+    assert numpy.array_equal(histogram.band(), numpy.full((3, 3), 4.0))
+
+
+def test_histogram_band_in_chunks():
+    values = numpy.random.RandomState(0).gamma(2.0, 10.0, (500, 30))
+    whole = PPUHistogram(30)
+    whole.update_range(values)
+    whole.update_histogram(values)
+    chunked = PPUHistogram(30)
+    for update in ("update_range", "update_histogram"):
+        for chunk in numpy.array_split(values, 7):
+            getattr(chunked, update)(chunk)
+    assert numpy.allclose(whole.band(), chunked.band(), rtol=1e-12)
+
+
+def test_p_factor_measurement_error():
+    observed = numpy.array([10.0, 20.0, 30.0, numpy.nan])
+    lower = numpy.array([11.0, 15.0, 25.0, 0.0])
+    upper = numpy.array([12.0, 25.0, 29.0, 1.0])
+    assert p_factor(observed, lower, upper) == pytest.approx(1 / 3)
+    # 10% of 10 reaches 11, 10% of 30 reaches 29
+    assert p_factor(observed, lower, upper, 10.0) == pytest.approx(1.0)
+
+
+def test_r_factor():
+    observed = numpy.array([1.0, 3.0, 5.0, 7.0])
+    lower = observed - 1
+    upper = observed + 1
+    assert r_factor(observed, lower, upper) == pytest.approx(2 / numpy.std(observed))
+
+
+def test_in_memory_and_out_of_core(project):
+    results = PPUCalculator(project).compute(best_simulation=3)
+    streamed = PPUCalculator(project, out_of_core=True, chunk_size=4096).compute(best_simulation=3)
+    assert list(results) == list(streamed)
+    for name, result in results.items():
+        for key in ("L95PPU", "M95PPU", "U95PPU", "best_sim"):
+            assert numpy.allclose(result[key], streamed[name][key], rtol=1e-12)
+        assert result["p_factor"] == streamed[name]["p_factor"]
+
+
+def test_behavioral_simulations(project):
+    from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+    from swatcuppython.operationalsystem import OperationalSystem
+    goal = SWATCUP2019(OperationalSystem.LINUX).read_sufi2_out_goal(project)
+    calculator = PPUCalculator(project)
+    simulations = calculator.get_behavioral_simulations(goal, threshold=0.0)
+    info, df = goal
+    assert numpy.array_equal(simulations, df["Sim_No."].values[df["goal_value"].values >= 0.0])
+
+
+def test_same_as_sufi2_95ppu(tmp_path):
+    project = make_project(str(tmp_path / "project"), n_sims=60)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    # SUFI2_95ppu.exe opens SUFI2.out/summary_stat.txt
+    os.symlink("SUFI2.OUT", os.path.join(project, "SUFI2.out"))
+    assert run_executable(project, "SUFI2_goal_fn.exe") == 0
+    assert run_executable(project, "SUFI2_95ppu.exe") == 0
+    with open(os.path.join(project, "SUFI2.OUT", "best_sim_nr.txt"), "r") as fo:
+        best_simulation = int(fo.read().split()[0])
+    calculator = PPUCalculator(project)
+    results = calculator.compute(best_simulation=best_simulation)
+    calculator.write(results, "95ppu_py.txt", "95ppu_g_py.txt")
+    for exe_file, py_file in (("95ppu.txt", "95ppu_py.txt"), ("95ppu_g.txt", "95ppu_g_py.txt")):
+        exe_path = os.path.join(project, "SUFI2.OUT", exe_file)
+        py_path = os.path.join(project, "SUFI2.OUT", py_file)
+        with open(exe_path, "r") as fo, open(py_path, "r") as fp:
+            exe_lines, py_lines = fo.read().splitlines(), fp.read().splitlines()
+        assert len(exe_lines) == len(py_lines)
+        # Same layout, values up to the float precision of the executable
+        assert [re.sub(r"-?\d+\.\d+", "#", line) for line in exe_lines] == \
+               [re.sub(r"-?\d+\.\d+", "#", line) for line in py_lines]
+        assert numpy.allclose(_read_rows(exe_path), _read_rows(py_path), rtol=1e-5, atol=1e-4)
+    with open(os.path.join(project, "SUFI2.OUT", "95ppu.txt"), "r") as fo:
+        factors = re.findall(r"p-factor= (\S+)\nr-factor= (\S+)", fo.read())
+    assert factors == [("{:.2f}".format(result["p_factor"]), "{:.2f}".format(result["r_factor"]))
+                       for result in results.values()]
@@ -0,0 +1,17 @@
+import resource
+
+import pytest
+from swatcuppython.profiling import Profiler, ProcessGroupMonitor, STAGE
+
+
+@pytest.mark.skipif(not ProcessGroupMonitor.is_supported(), reason="needs /proc")
+def test_stage_peak_rss_leaves_out_the_parent(tmp_path):
+    # This process is much larger than the stage, which only runs sh and sleep
+    ballast = bytearray(300 * 1024 * 1024)
+    ballast[::4096] = b"x" * len(ballast[::4096])
+    assert resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 > 300 * 1024 * 1024
+    profiler = Profiler(interval=0.02)
+    assert profiler.run_command(["sh", "-c", "sleep 0.3"], str(tmp_path), STAGE, "run", "run") == 0
+    record = profiler.records[-1]
+    assert record["kind"] == STAGE and record["cpu_time"] is not None
+    assert 0 < record["peak_rss"] < 100 * 1024 * 1024
@@ -0,0 +1,52 @@
+import os
+
+import numpy
+import pytest
+from swatcuppython.swatcup import SWATCUP
+from swatcuppython.resultstore import ResultStore
+from swatcuppython.swatcupversion import SWATCUPVersion
+from swatcuppython.varfile import read_sufi2_var_array
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_archive_round_trip(project, tmp_path, compress):
+    goal = SWATCUP2019(OperationalSystem.LINUX).read_sufi2_out_goal(project)
+    store = ResultStore(str(tmp_path / "store"), chunk_size=16, compress=compress)
+    store.archive(project, "iteration_1", goal=goal)
+    info, df = store.read_goal("iteration_1")
+    assert info["type_of_goal_fn"] == "Nash_Sutcliff"
+    assert numpy.array_equal(df["Sim_No."].values, goal[1]["Sim_No."].values)
+    assert numpy.allclose(df["goal_value"].values, goal[1]["goal_value"].values)
+
+    file_path = os.path.join(project, "SUFI2.OUT", "FLOW_OUT_1.txt")
+    simulations, time_steps, values = read_sufi2_var_array(file_path)
+    stored = store.read_variable("iteration_1", "FLOW_OUT_1.txt", [20, 3, 17], time_steps[5:9])
+    assert numpy.array_equal(stored[0], [20, 3, 17])
+    assert numpy.array_equal(stored[2], values[[19, 2, 16]][:, 5:9])
+    assert numpy.array_equal(store.read_par_val("iteration_1")[0], numpy.arange(1, 41))
+
+
+def test_top_simulations(project, tmp_path):
+    goal = SWATCUP2019(OperationalSystem.LINUX).read_sufi2_out_goal(project)
+    store = ResultStore(str(tmp_path / "store"))
+    store.archive(project, "iteration_1", goal=goal)
+    values = goal[1]["goal_value"].values
+    # Nash_Sutcliff is maximized
+    expected = goal[1]["Sim_No."].values[numpy.argsort(-values, kind="stable")[:5]]
+    assert numpy.array_equal(store.top_simulations("iteration_1", 5), expected)
+    simulations, time_steps, top = store.read_top("iteration_1", "FLOW_OUT_1", 5)
+    assert numpy.array_equal(simulations, expected)
+    assert top.shape[0] == 5
+    minimized = store.top_simulations("iteration_1", 5, maximize=False)
+    assert numpy.array_equal(minimized, goal[1]["Sim_No."].values[numpy.argsort(values, kind="stable")[:5]])
+
+
+def test_archive_output_with_blank_var_file_names(project, tmp_path):
+    with open(os.path.join(project, "SUFI2.IN", "var_file_name.txt"), "a") as fo:
+        fo.write("\n\n")
+    swatcup = SWATCUP(SWATCUPVersion.SWATCUP2019)
+    swatcup.project_folder_path = project
+    store = swatcup.archive_output(str(tmp_path / "store"), "iteration_1")
+    assert sorted(store.read_index("iteration_1")["variables"]) == ["FLOW_OUT_1", "FLOW_OUT_10"]
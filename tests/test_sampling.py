@@ -0,0 +1,87 @@
+import os
+import re
+
+import numpy
+import pytest
+from conftest import run_executable, can_run_executables
+from swatcuppython import sufi2files
+from swatcuppython.swatcup import SWATCUP
+from swatcuppython.swatcupversion import SWATCUPVersion
+from swatcuppython.sampling import latin_hypercube, min_distance, LatinHypercubeSampler
+
+
+def _assert_latin_hypercube(design: numpy.ndarray):
+    n_samples = len(design)
+    assert numpy.all((design >= 0) & (design < 1))
+    for column in design.T:
+        # One sample in each of the n_samples strata of every dimension
+        assert numpy.array_equal(numpy.sort(numpy.floor(column * n_samples)), numpy.arange(n_samples))
+
+
+def _layout(file_path: str) -> list:
+    """ Lines of a par_val.txt with the numbers replaced, to compare the separators """
+    with open(file_path, "r") as fo:
+        return [re.sub(r"-?\d+\.\d{6}", "V", line) for line in fo]
+
+
+def test_one_sample_per_stratum():
+    rng = numpy.random.default_rng(1)
+    for n_samples, n_params in [(1, 3), (7, 2), (100, 10)]:
+        design = latin_hypercube(n_samples, n_params, rng)
+        assert design.shape == (n_samples, n_params)
+        _assert_latin_hypercube(design)
+
+
+def test_min_distance():
+    design = numpy.array([[0.0, 0.0], [3.0, 4.0], [0.5, 0.0], [10.0, 10.0]])
+    assert min_distance(design) == pytest.approx(0.5)
+    # Same distance computed in blocks of rows
+    assert min_distance(design, block_size=1) == pytest.approx(0.5)
+    design = numpy.random.default_rng(2).random((50, 4))
+    distances = numpy.linalg.norm(design[:, None] - design[None, :], axis=2)
+    assert min_distance(design, block_size=7) == pytest.approx(distances[numpy.triu_indices(50, 1)].min())
+
+
+def test_seed_reproducibility(project):
+    values = LatinHypercubeSampler(project, seed=42).sample(30)
+    assert numpy.array_equal(LatinHypercubeSampler(project, seed=42).sample(30), values)
+    assert not numpy.array_equal(LatinHypercubeSampler(project, seed=43).sample(30), values)
+    batches = LatinHypercubeSampler(project, seed=42).sample_batches([10, 5])
+    for (simulations, batch), (other_simulations, other) in \
+            zip(batches, LatinHypercubeSampler(project, seed=42).sample_batches([10, 5])):
+        assert numpy.array_equal(simulations, other_simulations)
+        assert numpy.array_equal(batch, other)
+    assert numpy.array_equal(batches[1][0], numpy.arange(11, 16))
+
+
+def test_maximin_improves_min_distance(project):
+    sampler = LatinHypercubeSampler(project, seed=7)
+    ranges = numpy.array(sampler.ranges, dtype=numpy.float64)
+    single = min_distance((sampler.sample(20) - ranges[:, 0]) / (ranges[:, 1] - ranges[:, 0]))
+    sampler = LatinHypercubeSampler(project, seed=7, maximin_candidates=20)
+    design = (sampler.sample(20) - ranges[:, 0]) / (ranges[:, 1] - ranges[:, 0])
+    _assert_latin_hypercube(design)
+    # The first candidate is the single design, so the best one is at least as far apart
+    assert min_distance(design) > single
+
+
+def test_sufi2_lh_sample_layout(project):
+    names, ranges, simulation_number = sufi2files.read_par_inf(project)
+    with open(os.path.join(project, "SUFI2.OUT", "goal.txt"), "a"):
+        pass
+    swatcup = SWATCUP(SWATCUPVersion.SWATCUP2019)
+    swatcup.project_folder_path = project
+    values = swatcup.sufi2_lh_sample(seed=3)
+    assert os.listdir(os.path.join(project, "SUFI2.OUT")) == []
+    simulations, written = sufi2files.read_par_val(project)
+    assert numpy.array_equal(simulations, numpy.arange(1, simulation_number + 1))
+    assert numpy.allclose(written, values, atol=5e-7)
+    ranges = numpy.array(ranges, dtype=numpy.float64)
+    _assert_latin_hypercube((values - ranges[:, 0]) / (ranges[:, 1] - ranges[:, 0]))
+    layout = _layout(os.path.join(project, "SUFI2.IN", "par_val.txt"))
+    assert layout[0] == "1   " + "V  " * len(names) + "\n"
+    if not can_run_executables(project):
+        return
+    # Same layout as the par_val.txt of SUFI2_LH_sample.exe
+    assert run_executable(project, "SUFI2_LH_sample.exe") == 0
+    assert _layout(os.path.join(project, "SUFI2.IN", "par_val.txt")) == layout
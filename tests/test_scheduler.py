@@ -0,0 +1,170 @@
+import os
+import time
+import threading
+
+import numpy
+import pytest
+from conftest import make_project
+from swatcuppython import sufi2files, scheduler
+from swatcuppython.swatcup import SWATCUP
+from swatcuppython.scheduler import CalibrationScheduler, CalibrationJob
+from swatcuppython.swatcupversion import SWATCUPVersion
+from swatcuppython.varfile import read_sufi2_var_array
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+class StubWrapper(SWATCUP2019):
+    """ Records the SUFI2 stages in place of running them. The run stage appends a block with the simulation number
+    as values to every var file of the folder
+    """
+    lock = threading.Lock()
+    units = []
+    running = 0
+    max_running = 0
+    failing_ranges = set()
+
+    def __init__(self):
+        super().__init__(OperationalSystem.LINUX)
+
+    def set_permissions(self, path):
+        pass
+
+    def _record(self, stage: str, path: str, simulation_range=None):
+        with self.lock:
+            StubWrapper.units.append((stage, path, simulation_range))
+            StubWrapper.running += 1
+            StubWrapper.max_running = max(StubWrapper.max_running, StubWrapper.running)
+        time.sleep(0.05)
+        with self.lock:
+            StubWrapper.running -= 1
+
+    def sufi2_pre(self, path):
+        self._record("pre", path)
+        return 0
+
+    def sufi2_run(self, path):
+        simulation_range = sufi2files.read_swedit_def(path)
+        self._record("run", path, simulation_range)
+        if simulation_range in self.failing_ranges:
+            return 1
+        for simulation in range(simulation_range[0], simulation_range[1] + 1):
+            for name in sufi2files.read_var_file_names(path):
+                sufi2files.append_sufi2_var(os.path.join(path, "SUFI2.OUT", name), simulation, numpy.arange(1, 4),
+                                            numpy.full(3, float(simulation)))
+        return 0
+
+    def sufi2_post(self, path):
+        self._record("post", path)
+        return 0
+
+
+class StubSWATCUP(SWATCUP):
+
+    def __init__(self, version):
+        super().__init__(version)
+        self.wrapper = StubWrapper()
+
+
+@pytest.fixture(autouse=True)
+def stub_wrapper(monkeypatch):
+    monkeypatch.setattr(scheduler, "SWATCUP", StubSWATCUP)
+    StubWrapper.units = []
+    StubWrapper.running = 0
+    StubWrapper.max_running = 0
+    StubWrapper.failing_ranges = set()
+
+
+def _project(tmp_path, name: str, simulations: int = 7) -> str:
+    project = make_project(str(tmp_path / name), n_sims=simulations)
+    sufi2files.write_swedit_def(project, 1, simulations)
+    return project
+
+
+def _job_units(project: str) -> list:
+    return [(stage, simulation_range) for stage, path, simulation_range in StubWrapper.units
+            if path.startswith(project)]
+
+
+def test_job_units_and_merge(tmp_path):
+    project = _project(tmp_path, "project")
+    calibration = CalibrationScheduler(cores=2, pin_workers=False, poll_interval=0.05)
+    job = calibration.submit(CalibrationJob("job", project, SWATCUPVersion.SWATCUP2019, chunk_size=3))
+    assert calibration.get_queue_state()["jobs"][0]["state"] == CalibrationJob.QUEUED
+    calibration.run()
+
+    units = _job_units(project)
+    assert units[0] == ("pre", None) and units[-1] == ("post", None)
+    assert sorted(simulation_range for stage, simulation_range in units[1:-1]) == [(1, 3), (4, 6), (7, 7)]
+    # The chunks run in the process folders, pre and post in the project
+    assert all(path.startswith(os.path.join(project, "swatcuppython", "process")) for stage, path, simulation_range
+               in StubWrapper.units if stage == "run")
+    for name in sufi2files.read_var_file_names(project):
+        simulations, time_steps, values = read_sufi2_var_array(os.path.join(project, "SUFI2.OUT", name))
+        assert numpy.array_equal(simulations, numpy.arange(1, 8))
+        assert numpy.array_equal(values[:, 0], numpy.arange(1, 8))
+
+    assert job.state == CalibrationJob.DONE
+    state = calibration.get_queue_state()
+    assert (state["free_slots"], state["used_memory"]) == (2, 0)
+    job_state = state["jobs"][0]
+    assert (job_state["state"], job_state["phase"], job_state["workers"]) == (CalibrationJob.DONE, None, 0)
+    assert (job_state["total_simulations"], job_state["completed_simulations"], job_state["pending_simulations"]) == \
+        (7, 7, 0)
+    assert job_state["throughput"] > 0
+
+
+def test_priority(tmp_path):
+    low = _project(tmp_path, "low")
+    high = _project(tmp_path, "high")
+    calibration = CalibrationScheduler(cores=1, pin_workers=False, poll_interval=0.05)
+    calibration.submit(CalibrationJob("low", low, SWATCUPVersion.SWATCUP2019, chunk_size=4))
+    calibration.submit(CalibrationJob("high", high, SWATCUPVersion.SWATCUP2019, chunk_size=4, priority=1))
+    calibration.run()
+    # The single slot goes to the job with the highest priority while it has work
+    paths = [path for stage, path, simulation_range in StubWrapper.units]
+    assert [path.startswith(high) for path in paths] == [True] * 4 + [False] * 4
+    assert [job["state"] for job in calibration.get_queue_state()["jobs"]] == [CalibrationJob.DONE] * 2
+
+
+def test_memory_budget_admission(tmp_path):
+    projects = [_project(tmp_path, "project" + str(i)) for i in range(2)]
+    calibration = CalibrationScheduler(cores=4, memory_budget=100, pin_workers=False, poll_interval=0.05)
+    with pytest.raises(ValueError, match="does not fit in the memory budget"):
+        calibration.submit(CalibrationJob("big", projects[0], SWATCUPVersion.SWATCUP2019, memory_per_worker=101))
+    for i, project in enumerate(projects):
+        calibration.submit(CalibrationJob("job" + str(i), project, SWATCUPVersion.SWATCUP2019, chunk_size=2,
+                                          memory_per_worker=60))
+    calibration.run()
+    # Only one worker of 60 bytes fits in the budget at a time
+    assert StubWrapper.max_running == 1
+    assert [job["state"] for job in calibration.get_queue_state()["jobs"]] == [CalibrationJob.DONE] * 2
+    assert calibration.get_queue_state()["used_memory"] == 0
+
+
+def test_failed_chunk_fails_the_job(tmp_path):
+    project = _project(tmp_path, "project")
+    StubWrapper.failing_ranges = {(4, 6)}
+    calibration = CalibrationScheduler(cores=1, pin_workers=False, poll_interval=0.05)
+    job = calibration.submit(CalibrationJob("job", project, SWATCUPVersion.SWATCUP2019, chunk_size=3))
+    calibration.run()
+    assert job.state == CalibrationJob.FAILED
+    assert job.error == "SUFI2 run failed with return code 1"
+    assert _job_units(project) == [("pre", None), ("run", (1, 3)), ("run", (4, 6))]
+    assert job.finished_time is not None
+
+
+def test_cancel_and_invalid_jobs(tmp_path):
+    project = _project(tmp_path, "project")
+    calibration = CalibrationScheduler(cores=2, pin_workers=False, poll_interval=0.05)
+    cancelled = calibration.submit(CalibrationJob("cancelled", project, SWATCUPVersion.SWATCUP2019))
+    with pytest.raises(ValueError, match="Job already submitted"):
+        calibration.submit(CalibrationJob("cancelled", project, SWATCUPVersion.SWATCUP2019))
+    calibration.cancel("cancelled")
+    too_many = calibration.submit(CalibrationJob("too_many", project, SWATCUPVersion.SWATCUP2019, simulations=8,
+                                                 run_pre=False))
+    calibration.run()
+    assert cancelled.state == CalibrationJob.CANCELLED
+    assert too_many.state == CalibrationJob.FAILED
+    assert too_many.error == "Job too_many: par_val.txt has only 7 simulations"
+    assert StubWrapper.units == []
@@ -0,0 +1,83 @@
+import os
+
+import pytest
+from swatcuppython import sufi2files
+from swatcuppython.scratch import ScratchWorkspace
+
+
+class StubWrapper(object):
+    """ Writes the SUFI2_swEdit.def range it runs to SUFI2.OUT and returns the return code of each range """
+
+    def __init__(self, return_codes: dict = None):
+        self.return_codes = return_codes or {}
+        self.ranges = []
+
+    def sufi2_run(self, path):
+        first, last = sufi2files.read_swedit_def(path)
+        self.ranges.append((first, last))
+        with open(os.path.join(path, "SUFI2.OUT", "ranges.txt"), "a") as fo:
+            fo.write(str(first) + " " + str(last) + "\n")
+        return self.return_codes.get((first, last), 0)
+
+
+@pytest.fixture
+def workspace(project, tmp_path):
+    workspace = ScratchWorkspace(project, str(tmp_path / "scratch"), sync_every=2)
+    os.makedirs(os.path.dirname(workspace.folder_path))
+    sufi2files.write_swedit_def(project, 1, 6)
+    yield workspace
+    workspace.cleanup()
+
+
+def test_stage(workspace, project):
+    with open(os.path.join(project, "SUFI2.OUT", "old.txt"), "w") as fo:
+        fo.write("previous run")
+    workspace.stage()
+    for rel_path in ["SUFI2_swEdit.def", "SUFI2.IN/par_val.txt", "SUFI2.IN/observed.txt", "SUFI2.OUT/old.txt"]:
+        assert os.path.isfile(os.path.join(workspace.folder_path, rel_path)), rel_path
+    # swat.exe creates its output files
+    assert not os.path.isfile(os.path.join(workspace.folder_path, "output.rch"))
+
+
+def test_memory_check(workspace):
+    workspace.memory_budget = workspace.get_required_size() - 1
+    with pytest.raises(MemoryError):
+        workspace.stage()
+    assert not os.path.isdir(workspace.folder_path)
+    workspace.memory_budget = workspace.get_required_size()
+    workspace.stage()
+
+
+def test_chunked_run_syncs_back(workspace, project):
+    workspace.stage()
+    wrapper = StubWrapper()
+    assert workspace.sufi2_run(wrapper) == 0
+    assert wrapper.ranges == [(1, 2), (3, 4), (5, 6)]
+    with open(os.path.join(project, "SUFI2.OUT", "ranges.txt")) as fo:
+        assert fo.read() == "1 2\n3 4\n5 6\n"
+    # The range is restored after the chunks
+    assert sufi2files.read_swedit_def(workspace.folder_path) == (1, 6)
+
+
+def test_chunked_run_stops_at_failed_chunk(workspace, project):
+    workspace.stage()
+    wrapper = StubWrapper({(1, 2): 1})
+    assert workspace.sufi2_run(wrapper) == 1
+    assert wrapper.ranges == [(1, 2)]
+    # The output of the failed chunk is synced back
+    with open(os.path.join(project, "SUFI2.OUT", "ranges.txt")) as fo:
+        assert fo.read() == "1 2\n"
+    assert sufi2files.read_swedit_def(workspace.folder_path) == (1, 6)
+
+
+def test_sync_back_removes_deleted_files(workspace, project):
+    with open(os.path.join(project, "SUFI2.OUT", "old.txt"), "w") as fo:
+        fo.write("previous run")
+    workspace.stage()
+    os.remove(os.path.join(workspace.folder_path, "SUFI2.OUT", "old.txt"))
+    with open(os.path.join(workspace.folder_path, "SUFI2.OUT", "new.txt"), "w") as fo:
+        fo.write("new run")
+    workspace.sync_back()
+    assert not os.path.isfile(os.path.join(project, "SUFI2.OUT", "old.txt"))
+    with open(os.path.join(project, "SUFI2.OUT", "new.txt")) as fo:
+        assert fo.read() == "new run"
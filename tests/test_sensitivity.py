@@ -0,0 +1,69 @@
+import numpy
+import pandas as pd
+from swatcuppython.sensitivity import global_sensitivity, get_objective_columns, rank, rank_correlation
+from swatcuppython.swatcup import SWATCUP
+from swatcuppython.swatcupversion import SWATCUPVersion
+
+NAMES = ["r__CN2.mgt", "v__ALPHA_BF.gw", "v__ESCO.hru", "v__GW_DELAY.gw"]
+
+
+def _goal(n: int = 2000, seed: int = 0):
+    rng = numpy.random.default_rng(seed)
+    values = rng.uniform(0.0, 1.0, (n, len(NAMES)))
+    # Both first parameters have p-values of 0: only the t-stat tells them apart
+    goal = 10 * values[:, 1] + 5 * values[:, 0] + 0.1 * values[:, 2] + rng.normal(0.0, 0.1, n)
+    df = pd.DataFrame(values, columns=NAMES)
+    df.insert(0, "Sim_No.", numpy.arange(1, n + 1))
+    df["goal_value"] = goal
+    return {"no_pars": len(NAMES), "no_Sims": n, "type_of_goal_fn": "Nash_Sutcliff"}, df
+
+
+def test_objective_columns():
+    info, df = _goal(10)
+    assert get_objective_columns(df, NAMES) == ["goal_value"]
+
+
+def test_rank_by_t_stat():
+    result = global_sensitivity(_goal())
+    assert list(result["objective"].unique()) == ["goal_value"]
+    ranks = dict(zip(result["parameter"], result["rank"]))
+    assert ranks == {"v__ALPHA_BF.gw": 1, "r__CN2.mgt": 2, "v__ESCO.hru": 3, "v__GW_DELAY.gw": 4}
+    first, second = result.set_index("parameter").loc[["v__ALPHA_BF.gw", "r__CN2.mgt"], "p_value"]
+    assert first == second == 0.0
+
+
+def test_par_val_lookup():
+    info, df = _goal(200)
+    values = df[NAMES].values
+    shuffled = df.sample(frac=1.0, random_state=0)
+    result = global_sensitivity((info, shuffled[["Sim_No.", "goal_value"]]), (numpy.arange(1, 201), values), NAMES)
+    expected = global_sensitivity((info, df), names=NAMES)
+    assert numpy.allclose(result["t_stat"].values, expected["t_stat"].values)
+
+
+def test_variable_objectives(project):
+    swatcup = SWATCUP(SWATCUPVersion.SWATCUP2019)
+    swatcup.set_project_folder(project)
+    result = swatcup.compute_sensitivity(variable_objectives=True)
+    objectives = set(result["objective"])
+    assert "goal_value" in objectives and "FLOW_OUT_1_NS" in objectives
+    assert "Sim_No." not in objectives
+
+
+def test_average_ranks_of_ties():
+    values = numpy.array([[3.0, 1.0], [1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [5.0, 1.0]])
+    assert numpy.array_equal(rank(values), [[3.0, 2.0], [0.5, 2.0], [2.0, 2.0], [0.5, 2.0], [4.0, 2.0]])
+    assert numpy.array_equal(rank(values, numpy.float32), rank(values))
+
+
+def test_rank_correlation_with_ties():
+    rng = numpy.random.default_rng(3)
+    values = numpy.round(rng.uniform(0.0, 1.0, (300, 3)), 1)
+    objectives = numpy.round(values[:, :1] + rng.normal(0.0, 0.2, (300, 1)), 1)
+    expected = pd.DataFrame(numpy.column_stack((values, objectives))).corr(method="spearman").values[:3, 3]
+    for chunk_size in (None, 1):
+        correlation, p_value = rank_correlation(values, objectives, chunk_size)
+        assert numpy.allclose(correlation[:, 0], expected, atol=1e-5)
+    # A constant column has no rank correlation
+    correlation, p_value = rank_correlation(numpy.column_stack((values, numpy.ones(300))), objectives)
+    assert numpy.isnan(correlation[3, 0]) and numpy.isnan(p_value[3, 0])
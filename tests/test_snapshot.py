@@ -0,0 +1,53 @@
+import os
+
+import numpy
+import pytest
+from swatcuppython import sufi2files
+from swatcuppython.snapshot import SnapshotStore
+
+
+def _read_folder(project: str, folder: str) -> dict:
+    files = {}
+    for name in sorted(os.listdir(os.path.join(project, folder))):
+        file = os.path.join(project, folder, name)
+        with open(file, "rb") as fo:
+            files[name] = (fo.read(), os.stat(file).st_mtime_ns, os.stat(file).st_mode & 0o777)
+    return files
+
+
+def test_round_trip(project, tmp_path):
+    store = SnapshotStore(str(tmp_path / "store"), chunk_size=4096, max_workers=2)
+    first = store.snapshot(project, "iteration_1", folders=("SUFI2.OUT", "SUFI2.IN"))
+    assert first["reused"] == 0
+    original = {folder: _read_folder(project, folder) for folder in ("SUFI2.OUT", "SUFI2.IN")}
+
+    # The next iteration appends a simulation to a var file and writes a new file
+    name = sufi2files.read_var_file_names(project)[0]
+    var_file = os.path.join(project, "SUFI2.OUT", name)
+    simulation = sufi2files.read_sufi2_var_blocks(var_file)[-1][0] + 1
+    sufi2files.append_sufi2_var(var_file, simulation, numpy.arange(1, 366), numpy.ones(365))
+    with open(os.path.join(project, "SUFI2.OUT", "new.txt"), "w") as fo:
+        fo.write("new\n")
+    second = store.snapshot(project, "iteration_2", folders=("SUFI2.OUT", "SUFI2.IN"))
+    assert second["reused"] == second["files"] - 2
+    # Only the chunks after the old end of the var file are new
+    assert second["written"] < first["written"]
+    diff = store.diff("iteration_1", "iteration_2")
+    assert diff["added"] == ["SUFI2.OUT/new.txt"]
+    assert diff["changed"] == ["SUFI2.OUT/" + name]
+    assert diff["changed_bytes"] <= os.path.getsize(var_file) - len(original["SUFI2.OUT"][name][0]) + 4096
+    assert store.list_snapshots() == ["iteration_1", "iteration_2"]
+
+    # Restored into a new folder and over the project: same bytes, modification times and modes
+    for dst_path in (str(tmp_path / "restored"), project):
+        result = store.restore("iteration_1", dst_path)
+        assert {folder: _read_folder(dst_path, folder) for folder in ("SUFI2.OUT", "SUFI2.IN")} == original
+    assert result["restored"] == 1
+    assert result["removed"] == 1
+    assert store.restore("iteration_1", project) == {"restored": 0, "kept": first["files"], "removed": 0}
+
+    assert store.remove("iteration_2") > 0
+    with pytest.raises(ValueError):
+        store.read_manifest("iteration_2")
+    store.restore("iteration_1", str(tmp_path / "restored"), verify=True)
+    assert _read_folder(str(tmp_path / "restored"), "SUFI2.OUT") == original["SUFI2.OUT"]
@@ -0,0 +1,38 @@
+import numpy
+import pandas as pd
+import pytest
+from swatcuppython.surrogate import SurrogateScreening
+
+
+def _goal(values, goal, goal_function: str = "Nash_Sutcliff"):
+    df = pd.DataFrame(values, columns=["r__CN2.mgt", "v__ALPHA_BF.gw", "v__ESCO.hru", "v__GW_DELAY.gw"])
+    df.insert(0, "Sim_No.", numpy.arange(1, len(goal) + 1))
+    df["goal_value"] = goal
+    return {"no_pars": 4, "no_Sims": len(goal), "type_of_goal_fn": goal_function}, df
+
+
+def test_goal_of_sufi2_goal_fn(project):
+    rng = numpy.random.default_rng(0)
+    values = rng.uniform([-0.2, 0.0, 0.8, 0.0], [0.2, 1.0, 1.0, 500.0], (60, 4))
+    # Best close to CN2 = 0.1
+    goal = 1 - (values[:, 0] - 0.1) ** 2 * 50
+    surrogate = SurrogateScreening(project, threshold=0.5, seed=0)
+    surrogate.add_goal(_goal(values, goal))
+    assert surrogate.goal_type == "NS"
+    assert surrogate.is_maximized()
+    selection = surrogate.screen(10, oversample=20)
+    # Maximized: the selected candidates are predicted better than the pool
+    assert selection["mean"].mean() > goal.mean()
+    report = surrogate.report(_goal(selection["values"], 1 - (selection["values"][:, 0] - 0.1) ** 2 * 50))
+    assert report["selected"] == 10
+    assert report["hit_rate"] >= report["baseline_rate"]
+
+
+def test_par_val_lookup_and_goal_check(project):
+    values = numpy.random.default_rng(1).uniform(0.0, 1.0, (20, 4))
+    info, df = _goal(values, values[:, 1])
+    surrogate = SurrogateScreening(project, goal_type=5)
+    surrogate.add_goal((info, df[["Sim_No.", "goal_value"]]), (numpy.arange(1, 21), values))
+    assert numpy.array_equal(surrogate.values, values)
+    with pytest.raises(ValueError):
+        surrogate.add_goal(_goal(values, values[:, 1], "Summation_MSE"))
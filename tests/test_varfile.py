@@ -0,0 +1,75 @@
+import numpy
+import pytest
+from swatcuppython import varfile
+from swatcuppython.benchmark import write_synthetic_var_file, _read_sufi2_var_lines
+from swatcuppython.sufi2files import format_sufi2_var_block
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.sawtcupv5_1_6_2.swatcupv5_1_6_2 import SWATCUPv5_1_6_2
+
+
+def _assert_same(result, expected):
+    for array, expected_array in zip(result, expected):
+        assert numpy.array_equal(array, expected_array)
+
+
+def test_fixed_width_matches_line_parser(tmp_path):
+    file_path = str(tmp_path / "FLOW_OUT_1.txt")
+    write_synthetic_var_file(file_path, 7, 30)
+    with open(file_path, "rb") as fo:
+        content = fo.read()
+    assert varfile._parse_uniform_blocks(numpy.frombuffer(content, dtype=numpy.uint8), numpy.float64) is not None
+    simulations, time_steps, values = varfile.read_sufi2_var_array(file_path)
+    reference = _read_sufi2_var_lines(file_path)
+    assert numpy.array_equal(simulations, reference.columns)
+    assert numpy.array_equal(time_steps, reference.index)
+    # Same rounding as float()
+    assert numpy.array_equal(values, reference.values.T)
+    # A blank line leaves the fixed width layout: the general parser gives the same arrays
+    _assert_same(varfile.parse_sufi2_var_bytes(content.replace(b"\n", b"\n\n", 1)), (simulations, time_steps, values))
+    _assert_same(varfile.parse_sufi2_var_bytes(content.replace(b"\n", b"\r\n")), (simulations, time_steps, values))
+
+
+def test_general_layout():
+    time_steps = numpy.arange(1, 5)
+    blocks = {1: [-1e-3, 12.5, 0.0, 3.25e7], 12: [1.5, -2.0, 1e-12, 7.0]}
+    content = b"".join(format_sufi2_var_block(simulation, time_steps, values) for simulation, values in blocks.items())
+    simulations, steps, values = varfile.parse_sufi2_var_bytes(content)
+    assert numpy.array_equal(simulations, [1, 12])
+    assert numpy.array_equal(steps, time_steps)
+    assert numpy.array_equal(values, [[float("{:.6e}".format(value)) for value in row] for row in blocks.values()])
+
+
+def test_negative_and_tokens_out_of_the_fast_path():
+    content = b"   1 \n    1   -0.0010\n    2   12.5000\n   2 \n    1    3.0000\n    2   -4.2500\n"
+    _assert_same(varfile.parse_sufi2_var_bytes(content), ([1, 2], [1, 2], [[-0.001, 12.5], [3.0, -4.25]]))
+    content = b"1\n1 1234567890123456789\n2 nan\n"
+    simulations, time_steps, values = varfile.parse_sufi2_var_bytes(content)
+    assert values[0, 0] == 1234567890123456789.0 and numpy.isnan(values[0, 1])
+    with pytest.raises(ValueError, match="abc"):
+        varfile.parse_sufi2_var_bytes(b"1\n1 abc\n")
+
+
+def test_v5_module_reads_var_files(project):
+    wrapper = SWATCUPv5_1_6_2(OperationalSystem.LINUX)
+    names = wrapper.read_sufi2_var_file_name(project)
+    assert names == ["FLOW_OUT_1.txt", "FLOW_OUT_10.txt"]
+    simulations, time_steps, values = wrapper.read_sufi2_var_array(project, names[0])
+    assert values.shape == (40, len(time_steps))
+    simulations, time_steps, cube = wrapper.read_sufi2_var_cube(project)
+    assert cube.shape == (2, 40, len(time_steps))
+    assert numpy.array_equal(cube[0], values)
+    assert wrapper.read_sufi2_var(project, names[1]).shape == (len(time_steps), 40)
+
+
+def test_goal_tail_with_crlf(tmp_path):
+    file_path = str(tmp_path / "goal.txt")
+    tail = varfile.SUFI2OutputTail(str(tmp_path), [])
+    with open(file_path, "wb") as fo:
+        fo.write(b"no_pars= 2\r\nno_sims= 3\r\ntype_of_goal_fn= Nash_Sutcliff\r\nSim_No. r__A v__B goal_value\r\n"
+                 b"1 0.5 1.25 0.75\r\n2 0.25")
+    assert tail.poll_goal() == [{"Sim_No.": 1, "r__A": 0.5, "v__B": 1.25, "goal_value": 0.75}]
+    with open(file_path, "ab") as fo:
+        fo.write(b" 2.5 0.5\r\n3 0.125 3.5 -0.25\r\n")
+    assert tail.poll_goal() == [{"Sim_No.": 2, "r__A": 0.25, "v__B": 2.5, "goal_value": 0.5},
+                                {"Sim_No.": 3, "r__A": 0.125, "v__B": 3.5, "goal_value": -0.25}]
+    assert tail.poll_goal() == []
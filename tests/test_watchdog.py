@@ -0,0 +1,42 @@
+import os
+
+import numpy
+import pytest
+from conftest import make_project, can_run_executables, use_stub_swat
+from swatcuppython import sufi2files
+from swatcuppython.watchdog import WatchdogRunner, FAILED_VALUE
+from swatcuppython.varfile import read_sufi2_var_array
+from swatcuppython.operationalsystem import OperationalSystem
+from swatcuppython.swatcup2019.swatcup2019 import SWATCUP2019
+
+
+def _hang_on(project: str, simulation: int):
+    """ The stub swat.exe hangs in the given simulation (SUFI2.IN/trk.txt) """
+    with open(os.path.join(project, "swat.exe"), "r") as fo:
+        lines = fo.readlines()
+    lines.insert(2, "read current < SUFI2.IN/trk.txt\n"
+                    "if [ \"$current\" -eq " + str(simulation) + " ]; then sleep 120; fi\n")
+    with open(os.path.join(project, "swat.exe"), "w") as fo:
+        fo.writelines(lines)
+
+
+def test_hung_simulation_gets_the_failed_value(tmp_path, monkeypatch):
+    project = make_project(str(tmp_path / "project"), n_sims=5)
+    if not can_run_executables(project):
+        pytest.skip("SUFI2 executables cannot run here")
+    use_stub_swat(project, monkeypatch)
+    wrapper = SWATCUP2019(OperationalSystem.LINUX)
+    assert wrapper.sufi2_pre(project) == 0
+    _hang_on(project, 3)
+    runner = WatchdogRunner(wrapper, project, initial_timeout=3.0, min_samples=10, poll_interval=0.1)
+    result = runner.run()
+    assert result["failed"] == [3]
+    assert result["aborted"] == []
+    assert sufi2files.read_swedit_def(project) == (1, 5)
+    for name in sufi2files.read_var_file_names(project):
+        simulations, time_steps, values = read_sufi2_var_array(os.path.join(project, "SUFI2.OUT", name))
+        assert numpy.array_equal(simulations, [1, 2, 3, 4, 5])
+        # The sentinel in every time step of the killed simulation, the SWAT outputs in the others
+        assert numpy.all(values[2] == FAILED_VALUE)
+        assert not numpy.any(values[[0, 1, 3, 4]] == FAILED_VALUE)
+        assert numpy.array_equal(values[0], values[4])
@@ -0,0 +1,46 @@
+import os
+
+from swatcuppython.workspace import WorkspaceProvisioner
+
+
+def _read(file_path: str) -> bytes:
+    with open(file_path, "rb") as fo:
+        return fo.read()
+
+
+def test_refresh_copies_rewritten_files(project, tmp_path):
+    provisioner = WorkspaceProvisioner(project)
+    workspace = str(tmp_path / "workspace")
+    stats = provisioner.provision(workspace)
+    assert stats["copied"] > 0 and stats["linked"] > 0
+    assert provisioner.provision(workspace)["unchanged"] == stats["copied"] + stats["linked"]
+
+    # A run rewrites the workspace copy of par_val.txt, the project keeps the original
+    edited = os.path.join(workspace, "SUFI2.IN", "par_val.txt")
+    with open(edited, "ab") as fo:
+        fo.write(b"edited\n")
+    stats = provisioner.provision(workspace)
+    assert stats["copied"] == 1
+    assert _read(edited) == _read(os.path.join(project, "SUFI2.IN", "par_val.txt"))
+
+
+def test_rules_apply_in_subfolders(project, tmp_path):
+    for folder in ("TxtInOut", "Backup"):
+        os.makedirs(os.path.join(project, folder))
+        for name in ("output.rch", "000010001.mgt", "pcp1.pcp"):
+            with open(os.path.join(project, folder, name), "w") as fo:
+                fo.write(name)
+    workspace = str(tmp_path / "workspace")
+    WorkspaceProvisioner(project).provision(workspace)
+
+    def is_linked(rel_path):
+        return os.path.samefile(os.path.join(project, rel_path), os.path.join(workspace, rel_path))
+
+    assert not os.path.exists(os.path.join(workspace, "TxtInOut", "output.rch"))
+    assert not os.path.exists(os.path.join(workspace, "Backup", "output.rch"))
+    # mgt files are edited by SWAT_Edit.exe (r__CN2.mgt in par_inf.txt), except the originals of Backup
+    assert not is_linked("TxtInOut/000010001.mgt")
+    assert _read(os.path.join(workspace, "TxtInOut", "000010001.mgt")) == b"000010001.mgt"
+    assert is_linked("TxtInOut/pcp1.pcp")
+    assert is_linked("Backup/000010001.mgt")
+    assert not is_linked("000010001.mgt")
@@ -0,0 +1,499 @@
+import os
+import mmap
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Bytes parsed at a time by parse_sufi2_var_bytes. Bounds the temporary arrays of the parser
+PARSE_CHUNK_SIZE = 4 * 1024 * 1024
+# Powers of ten exactly representable as float64
+_FLOAT_POWERS = numpy.array([float(10 ** k) for k in range(23)])
+
+
+def read_sufi2_var_array(file_path: str, dtype=numpy.float64):
+    """ Reads a SUFI2.OUT var file into a NumPy array.
+
+    The file is memory mapped and parsed in place from the mapped bytes, without a copy of the file. In the fixed
+    width layout of the SUFI2_extract programs the header offsets follow from the first block and the value columns
+    are decoded from a (n_sims, n_steps, line length) view of the bytes. Other files are split into tokens with
+    vectorized byte operations, the simulation header lines (lines with a single token) give the offsets of the
+    blocks and the values are gathered into a preallocated (n_sims, n_steps) array.
+
+    Parameters
+    ----------
+    file_path : var file path
+    dtype : dtype of the values (numpy.float32 halves the memory)
+
+    Returns
+    -------
+    (simulations, time_steps, values). simulations has n_sims simulation numbers, time_steps has n_steps time
+    step numbers and values is a (n_sims, n_steps) array
+    """
+    with open(file_path, "rb") as fo:
+        if os.fstat(fo.fileno()).st_size == 0:
+            return numpy.empty(0, dtype=int), numpy.empty(0, dtype=int), numpy.empty((0, 0), dtype=dtype)
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return parse_sufi2_var_bytes(mm, dtype, file_path)
+
+
+def parse_sufi2_var_bytes(content, dtype=numpy.float64, name: str = ""):
+    """ Parses the content of a var file (complete simulation blocks), bytes or a mmap. See read_sufi2_var_array """
+    data = numpy.frombuffer(content, dtype=numpy.uint8)
+    result = _parse_uniform_blocks(data, dtype)
+    if result is not None:
+        del data
+        return result
+    size = data.size
+    tokens = []
+    tokens_per_line = []
+    rejected = []
+    n_tokens = 0
+    start = 0
+    while start < size:
+        # Chunks end at a line end, so the temporary arrays stay bounded
+        end = size if start + PARSE_CHUNK_SIZE >= size else content.rfind(b"\n", start, start + PARSE_CHUNK_SIZE) + 1
+        if end <= start:
+            end = content.find(b"\n", start + PARSE_CHUNK_SIZE) + 1 or size
+        chunk_tokens, chunk_tokens_per_line, chunk_rejected = _parse_tokens(data[start:end])
+        rejected.extend((n_tokens + index, text) for index, text in chunk_rejected)
+        n_tokens += chunk_tokens.size
+        tokens.append(chunk_tokens)
+        tokens_per_line.append(chunk_tokens_per_line)
+        start = end
+    # No view of content is left once the tokens are parsed (a mapped file can be closed even if this raises)
+    del data
+    tokens = numpy.concatenate(tokens) if tokens else numpy.empty(0)
+    for index, text in rejected:
+        try:
+            tokens[index] = float(text)
+        except ValueError:
+            raise ValueError("Invalid var file " + name + ": " + text.decode("ascii", "replace"))
+    tokens_per_line = numpy.concatenate(tokens_per_line) if tokens_per_line else numpy.empty(0, dtype=numpy.int64)
+    return _reshape_blocks(tokens_per_line, tokens, dtype, name)
+
+
+def iter_sufi2_var_chunks(file_path: str, chunk_size: int = 64 * 1024 * 1024, dtype=numpy.float64):
+    """ Reads a var file in chunks of whole simulations, so large files can be processed in bounded memory
+
+    Parameters
+    ----------
+    file_path : var file path
+    chunk_size : approximate number of bytes read per chunk
+    dtype : dtype of the values
+
+    Yields
+    ------
+    (simulations, time_steps, values) of each chunk
+    """
+    remainder = b""
+    with open(file_path, "rb") as fo:
+        while True:
+            data = fo.read(chunk_size)
+            content = remainder + data
+            if not data:
+                if content.strip():
+                    yield parse_sufi2_var_bytes(content, dtype, file_path)
+                return
+            # Cuts the chunk before the last simulation header, which may be incomplete
+            cut = _find_last_header(content)
+            if cut <= 0:
+                remainder = content
+                continue
+            remainder = content[cut:]
+            yield parse_sufi2_var_bytes(content[:cut], dtype, file_path)
+
+
+def _find_last_header(content: bytes) -> int:
+    """ Returns the position of the last simulation header line of content, or -1 """
+    end = content.rfind(b"\n")
+    while end > 0:
+        start = content.rfind(b"\n", 0, end) + 1
+        if len(content[start:end].split()) == 1:
+            return start
+        end = start - 1
+    return -1
+
+
+def _parse_uniform_blocks(data, dtype):
+    """ Fast path for the layout of the SUFI2_extract programs: every block has a header line of the same length and
+    the same number of fixed width lines (right aligned time step and value). The file is then a (n_sims, n_steps,
+    line length) array of bytes, viewed without copy, and the numbers are decoded from its columns.
+    Returns None if the file does not have this layout.
+    """
+    window = 1 << 16
+    while True:
+        line_ends = numpy.flatnonzero(data[:window] == ord("\n"))
+        lengths = numpy.diff(line_ends)
+        next_headers = numpy.flatnonzero(lengths[1:] != lengths[0]) if lengths.size else lengths
+        if next_headers.size or window >= data.size:
+            break
+        window *= 4
+    if line_ends.size < 2 or data[-1] != ord("\n"):
+        return None
+    header_size = int(line_ends[0]) + 1
+    line_size = int(lengths[0])
+    block_size = int(line_ends[next_headers[0] + 1]) + 1 if next_headers.size else data.size
+    n_steps = (block_size - header_size) // line_size
+    if n_steps * line_size != block_size - header_size or data.size % block_size != 0:
+        return None
+    blocks = data.reshape(-1, block_size)
+    headers = blocks[:, :header_size]
+    lines = blocks[:, header_size:].reshape(len(blocks), n_steps, line_size)
+    header_ends = _get_token_bounds(headers[0])[1]
+    line_ends = _get_token_bounds(lines[0, 0])[1]
+    if header_ends.size != 1 or line_ends.size != 2:
+        return None
+    time_step_end, value_end = int(line_ends[0]), int(line_ends[1])
+
+    simulations = _decode_fixed_field(headers, 0, int(header_ends[0]), header_size - 1)
+    time_steps = _decode_fixed_field(lines[0], 0, time_step_end, time_step_end)
+    if simulations is None or time_steps is None:
+        return None
+    values = numpy.empty((len(blocks), n_steps), dtype=dtype)
+    # Simulations decoded at a time, so the temporary arrays fit in the cache
+    step = max(1, PARSE_CHUNK_SIZE // 64 // block_size)
+    for start in range(0, len(blocks), step):
+        chunk = lines[start:start + step]
+        chunk_values = _decode_fixed_field(chunk.reshape(-1, line_size), time_step_end, value_end, line_size - 1)
+        if chunk_values is None:
+            return None
+        values[start:start + step] = chunk_values.reshape(len(chunk), n_steps)
+    return simulations.astype(int), time_steps.astype(int), values
+
+
+def _get_token_bounds(line):
+    """ Start and end columns of the whitespace separated tokens of a line (uint8 array) """
+    is_space = (line == ord(" ")) | (line == ord("\t")) | (line == ord("\n")) | (line == ord("\r"))
+    edges = numpy.diff(numpy.concatenate(([True], is_space, [True])).view(numpy.int8))
+    return numpy.flatnonzero(edges == -1), numpy.flatnonzero(edges == 1)
+
+
+def _decode_fixed_field(lines, start: int, end: int, line_end: int):
+    """ Decodes the right aligned numbers ([-]digits[.digits]) in the columns start to end of lines, a (n, line
+    length) uint8 array. The columns end to line_end must be blank. The decimal point is where the first line has it.
+    Returns None if a line does not fit.
+    """
+    field = numpy.ascontiguousarray(lines[:, start:end])
+    dots = numpy.flatnonzero(field[0] == ord("."))
+    if field.shape[1] - dots.size > 15:
+        # More digits than a float64 integer holds exactly
+        return None
+    trailing = lines[:, end:line_end]
+    if not ((trailing == ord(" ")) | (trailing == ord("\r"))).all():
+        return None
+    digits = field - numpy.uint8(ord("0"))
+    is_digit = digits <= 9
+    is_blank = field == ord(" ")
+    is_minus = field == ord("-")
+    is_dot = field == ord(".")
+    if not ((is_digit | is_blank | is_minus | is_dot).all() and is_digit[:, -1].all() and
+            is_dot.sum() == dots.size * len(field) and is_dot[:, dots].all() and
+            # Blanks only before the number and the sign only first
+            not (is_blank[:, 1:] & ~is_blank[:, :-1]).any() and not (is_minus[:, 1:] & ~is_blank[:, :-1]).any()):
+        return None
+    # Power of ten of each column: the digit columns to its right
+    powers = numpy.cumsum(~is_dot[0, ::-1])[::-1] - 1
+    weights = numpy.where(is_dot[0], 0.0, _FLOAT_POWERS[powers])
+    digits[~is_digit] = 0
+    # Exact: the sum of the digits times their power of ten is an integer below 2 ** 53
+    number = digits @ weights
+    if dots.size:
+        number /= _FLOAT_POWERS[field.shape[1] - 1 - dots[0]]
+    negative = is_minus.any(axis=1)
+    number[negative] *= -1
+    return number
+
+
+def _reshape_blocks(tokens_per_line, tokens, dtype, file_path: str):
+    if tokens.size == 0 or tokens.size != tokens_per_line.sum() or tokens_per_line.max() > 2:
+        raise ValueError("Invalid var file: " + file_path)
+    # Token index of each simulation header line
+    line_offsets = numpy.cumsum(tokens_per_line) - tokens_per_line
+    header_tokens = line_offsets[tokens_per_line == 1]
+    if header_tokens.size == 0:
+        raise ValueError("Invalid var file: " + file_path)
+    simulations = tokens[header_tokens].astype(int)
+    block_sizes = numpy.diff(numpy.append(header_tokens, tokens.size)) - 1
+    n_steps = block_sizes[0] // 2
+    invalid = numpy.flatnonzero(block_sizes != 2 * n_steps)
+    if invalid.size > 0:
+        raise ValueError("Invalid var file " + file_path + ": simulation " + str(simulations[invalid[0]]) +
+                         " has " + str(block_sizes[invalid[0]] // 2) + " time steps, expected " + str(n_steps))
+    time_steps = tokens[header_tokens[0] + 1:header_tokens[0] + 1 + 2 * n_steps:2].astype(int)
+    values = numpy.empty((len(simulations), n_steps), dtype=dtype)
+    values[:] = tokens[header_tokens[:, None] + 2 + 2 * numpy.arange(n_steps)]
+    return simulations, time_steps, values
+
+
+def _parse_tokens(data):
+    """ Parses the whitespace separated numbers of a uint8 array of whole lines
+
+    The tokens are gathered into a (width, n_tokens) byte matrix and converted a character column at a time: the
+    mantissa digits are accumulated as an exact integer and scaled once by the power of ten of the decimal point and
+    the exponent, which rounds like strtod. Tokens out of this fast path (more than 15 digits, large exponents, nan,
+    ...) are returned as (index, bytes) to be converted with float.
+
+    Returns
+    -------
+    (tokens, tokens_per_line, rejected)
+    """
+    is_space = (data == ord(" ")) | (data == ord("\t")) | (data == ord("\n")) | (data == ord("\r"))
+    edges = numpy.diff(numpy.concatenate(([True], is_space, [True])).view(numpy.int8))
+    del is_space
+    starts = numpy.flatnonzero(edges == -1)
+    lengths = numpy.flatnonzero(edges == 1) - starts
+    del edges
+    line_ends = numpy.flatnonzero(data == ord("\n"))
+    n_lines = line_ends.size + (1 if data.size and data[-1] != ord("\n") else 0)
+    tokens_per_line = numpy.bincount(numpy.searchsorted(line_ends, starts), minlength=n_lines).astype(numpy.int64)
+    if starts.size == 0:
+        return numpy.empty(0), tokens_per_line, []
+
+    columns = numpy.arange(int(lengths.max()))
+    chars = data[numpy.minimum(starts + columns[:, None], data.size - 1)]
+    chars[columns[:, None] >= lengths] = ord(" ")
+    n = starts.size
+    mantissa = numpy.zeros(n, dtype=numpy.int64)
+    exponent = numpy.zeros(n, dtype=numpy.int64)
+    n_digits = numpy.zeros(n, dtype=numpy.int64)
+    n_exponent_digits = numpy.zeros(n, dtype=numpy.int64)
+    decimals = numpy.zeros(n, dtype=numpy.int64)
+    exponent_at = numpy.full(n, -2)
+    has_dot = numpy.zeros(n, dtype=bool)
+    has_exponent = numpy.zeros(n, dtype=bool)
+    negative = numpy.zeros(n, dtype=bool)
+    negative_exponent = numpy.zeros(n, dtype=bool)
+    valid = numpy.ones(n, dtype=bool)
+    for column, c in enumerate(chars):
+        inside = column < lengths
+        digit = c.astype(numpy.int64) - ord("0")
+        is_digit = (c >= ord("0")) & (c <= ord("9"))
+        mantissa_digit = is_digit & ~has_exponent
+        exponent_digit = is_digit & has_exponent
+        mantissa = numpy.where(mantissa_digit, mantissa * 10 + digit, mantissa)
+        n_digits += mantissa_digit
+        decimals += mantissa_digit & has_dot
+        exponent = numpy.where(exponent_digit, exponent * 10 + digit, exponent)
+        n_exponent_digits += exponent_digit
+        is_dot = c == ord(".")
+        valid &= ~(is_dot & (has_dot | has_exponent))
+        has_dot |= is_dot
+        lower = c | 0x20
+        is_exponent = (lower == ord("e")) | (lower == ord("d"))
+        valid &= ~(is_exponent & has_exponent)
+        exponent_at[is_exponent] = column
+        has_exponent |= is_exponent
+        is_minus = c == ord("-")
+        is_sign = is_minus | (c == ord("+"))
+        after_exponent = exponent_at == column - 1
+        valid &= ~is_sign | after_exponent | (column == 0)
+        if column == 0:
+            negative = is_minus
+        negative_exponent |= is_minus & after_exponent
+        valid &= ~inside | is_digit | is_dot | is_exponent | is_sign
+    valid &= (n_digits > 0) & (n_digits <= 15) & (n_exponent_digits <= 3) & ((n_exponent_digits > 0) | ~has_exponent)
+    scale = numpy.where(negative_exponent, -exponent, exponent) - decimals
+    valid &= numpy.abs(scale) < len(_FLOAT_POWERS)
+    factors = _FLOAT_POWERS[numpy.where(valid, numpy.abs(scale), 0)]
+    tokens = numpy.where(scale < 0, mantissa / factors, mantissa * factors)
+    tokens[negative] *= -1
+    rejected = [(index, data[starts[index]:starts[index] + lengths[index]].tobytes())
+                for index in numpy.flatnonzero(~valid)]
+    return tokens, tokens_per_line, rejected
+
+
+def read_sufi2_var_sidecar(file_path: str, dtype=numpy.float64):
+    """ Reads the binary sidecar of a var file (see sufi2files.append_sufi2_var_sidecar). Same result as
+    read_sufi2_var_array. Every simulation must have the same time steps.
+    """
+    raw = numpy.fromfile(file_path, dtype=numpy.uint8)
+    simulations = []
+    rows = []
+    time_steps = None
+    offset = 0
+    while offset + 16 <= len(raw):
+        simulation, n = raw[offset:offset + 16].view(numpy.int64)
+        if offset + 16 + 16 * n > len(raw):
+            # Record being written
+            break
+        offset += 16
+        record_steps = raw[offset:offset + 8 * n].view(numpy.int64)
+        offset += 8 * n
+        if time_steps is None:
+            time_steps = record_steps
+        elif not numpy.array_equal(time_steps, record_steps):
+            raise ValueError("Simulations with different time steps in sidecar: " + file_path)
+        rows.append(raw[offset:offset + 8 * n].view(numpy.float64))
+        offset += 8 * n
+        simulations.append(simulation)
+    if not rows:
+        return numpy.empty(0, dtype=int), numpy.empty(0, dtype=int), numpy.empty((0, 0), dtype=dtype)
+    return (numpy.array(simulations, dtype=int), time_steps.astype(int),
+            numpy.array(rows, dtype=dtype).reshape(len(rows), len(time_steps)))
+
+
+def read_sufi2_var_cube(folder_path: str, file_names, dtype=numpy.float64, max_workers: int = None):
+    """ Reads several SUFI2.OUT var files concurrently into one cube with a shared simulation index.
+
+    Parameters
+    ----------
+    folder_path : SUFI2.OUT folder
+    file_names : var file names (see read_sufi2_var_file_name)
+    dtype : dtype of the values
+    max_workers : number of reader threads
+
+    Returns
+    -------
+    (simulations, time_steps, cube). cube is a (n_files, n_sims, n_steps) array. Files with fewer time steps or
+    missing simulations are padded with NaN. time_steps is the time step index of the longest file.
+    """
+    file_names = list(file_names)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        arrays = list(executor.map(lambda name: read_sufi2_var_array(os.path.join(folder_path, name), dtype),
+                                   file_names))
+    if not arrays:
+        return numpy.empty(0, dtype=int), numpy.empty(0, dtype=int), numpy.empty((0, 0, 0), dtype=dtype)
+    simulations = numpy.unique(numpy.concatenate([array[0] for array in arrays]))
+    time_steps = max((array[1] for array in arrays), key=len)
+    cube = numpy.full((len(arrays), len(simulations), len(time_steps)), numpy.nan, dtype=dtype)
+    for i, (file_simulations, file_time_steps, values) in enumerate(arrays):
+        rows = numpy.searchsorted(simulations, file_simulations)
+        cube[i, rows, :values.shape[1]] = values
+    return simulations, time_steps, cube
+
+
+class SUFI2VarTail(object):
+    """
+    Follows a growing SUFI2.OUT var file. Only the bytes appended since the last read are parsed (the file offset
+    is kept between reads), and each simulation is returned once it is complete: when the next simulation header
+    is written, when it has as many time steps as the first simulation, or when the file is finished.
+
+    A file truncated below the offset (the block of a killed simulation removed, see truncate_sufi2_var_file) is
+    read again from the start; the simulations already returned are not returned again.
+    """
+
+    def __init__(self, file_path: str, dtype=numpy.float64):
+        self.file_path = file_path
+        self.dtype = dtype
+        self.offset = 0
+        self.n_steps = None
+        self.simulation = None
+        self.time_steps = []
+        self.values = []
+        self.returned = set()
+
+    def reset(self):
+        """ Reads the file again from the start, dropping the incomplete simulation. Call it when the file was
+        truncated and may have grown again since the last read
+        """
+        self.offset = 0
+        self.simulation = None
+        self.time_steps = []
+        self.values = []
+
+    def read(self, final: bool = False):
+        """ Reads the new data of the file
+
+        Parameters
+        ----------
+        final : the file is not going to grow anymore (the process finished), so the last simulation is complete
+
+        Returns
+        -------
+        list of (simulation, time_steps, values) of the simulations completed since the last read
+        """
+        completed = []
+        if os.path.isfile(self.file_path):
+            with open(self.file_path, "rb") as fo:
+                if os.fstat(fo.fileno()).st_size < self.offset:
+                    self.reset()
+                fo.seek(self.offset)
+                data = fo.read()
+            if not final:
+                # Keeps an incomplete last line for the next read
+                data = data[:data.rfind(b"\n") + 1]
+            self.offset += len(data)
+            for line in data.splitlines():
+                tokens = line.split()
+                if len(tokens) == 1:
+                    self._complete(completed)
+                    self.simulation = int(tokens[0])
+                elif len(tokens) == 2 and self.simulation is not None:
+                    self.time_steps.append(int(tokens[0]))
+                    self.values.append(float(tokens[1]))
+                    if self.n_steps is not None and len(self.values) == self.n_steps:
+                        self._complete(completed)
+        if final:
+            self._complete(completed)
+        return completed
+
+    def _complete(self, completed):
+        if self.simulation is None or not self.values:
+            return
+        if self.n_steps is None:
+            self.n_steps = len(self.values)
+        if self.simulation not in self.returned:
+            self.returned.add(self.simulation)
+            completed.append((self.simulation, numpy.array(self.time_steps, dtype=int),
+                              numpy.array(self.values, dtype=self.dtype)))
+        self.simulation = None
+        self.time_steps = []
+        self.values = []
+
+
+class SUFI2OutputTail(object):
+    """
+    Follows the var files and goal.txt of a SUFI2.OUT folder while SUFI2 is running. A simulation is returned once
+    it is complete in every var file.
+    """
+
+    def __init__(self, folder_path: str, file_names, dtype=numpy.float64):
+        """
+        Parameters
+        ----------
+        folder_path : SUFI2.OUT folder
+        file_names : var file names to follow (see read_sufi2_var_file_name)
+        dtype : dtype of the values
+        """
+        self.folder_path = folder_path
+        self.file_names = [name for name in file_names if name]
+        self.tails = {name: SUFI2VarTail(os.path.join(folder_path, name), dtype) for name in self.file_names}
+        self.pending = {}
+        self.goal_offset = 0
+        self.goal_columns = None
+
+    def poll(self, final: bool = False):
+        """ Returns a list of (simulation, {file_name: values}) of the simulations completed since the last poll,
+        in simulation order
+        """
+        for name, tail in self.tails.items():
+            for simulation, time_steps, values in tail.read(final):
+                self.pending.setdefault(simulation, {})[name] = values
+        completed = [simulation for simulation, series in self.pending.items()
+                     if len(series) == len(self.file_names)]
+        return [(simulation, self.pending.pop(simulation)) for simulation in sorted(completed)]
+
+    def poll_goal(self):
+        """ Returns the goal.txt rows (dict column -> value) written since the last poll """
+        file = os.path.join(self.folder_path, "goal.txt")
+        rows = []
+        if not os.path.isfile(file):
+            return rows
+        with open(file, "rb") as fo:
+            fo.seek(self.goal_offset)
+            data = fo.read()
+        # Keeps an incomplete last line for the next poll
+        data = data[:data.rfind(b"\n") + 1]
+        self.goal_offset += len(data)
+        for line in data.splitlines():
+            tokens = line.decode("ascii", "replace").split()
+            if not tokens or tokens[0].endswith("="):
+                continue
+            if self.goal_columns is None:
+                self.goal_columns = tokens
+                continue
+            rows.append(dict(zip(self.goal_columns, [float(token) for token in tokens])))
+        return rows
@@ -0,0 +1,272 @@
+import os
+import time
+import logging
+import subprocess
+
+import numpy
+from swatcuppython import sufi2files
+from swatcuppython.parallel import ParallelRunner
+from swatcuppython.extract import find_var_time_steps
+from swatcuppython.processutil import new_process_group_kwargs, kill_process_tree
+
+logger = logging.getLogger(__name__)
+
+# Value written in the var files for every time step of a failed simulation
+FAILED_VALUE = -99.0
+
+
+class _Worker(object):
+    """ SUFI2_execute process of a worker folder and the simulation it is running """
+
+    def __init__(self, index: int, folder_path: str):
+        self.index = index
+        self.folder_path = folder_path
+        self.process = None
+        self.first = None
+        self.end = None
+        self.process_end = None
+        self.current = None
+        self.started = None
+        self.stale_trk = None
+        self.failures = 0
+
+    def is_running(self) -> bool:
+        return self.process is not None
+
+
+class WatchdogRunner(object):
+    """
+    Runs the SUFI2_swEdit.def simulation range watching every simulation. SUFI2.IN/trk.txt of each worker folder is
+    polled to time the simulations; a simulation running longer than timeout_factor times the median duration is
+    killed (with its whole process tree), recorded as failed and SUFI2_execute is started again from the next
+    simulation. The failed simulations get FAILED_VALUE in every time step of the var files.
+
+    With several worker folders, a worker that runs out of simulations steals the second half of the simulations
+    left to the worker with most of them; the victim is stopped when it reaches the stolen part.
+    """
+
+    def __init__(self, wrapper, project_folder_path: str, worker_folder_paths=None, timeout_factor: float = 5.0,
+                 min_timeout: float = 60.0, initial_timeout: float = None, min_samples: int = 3,
+                 straggler_factor: float = 2.0, poll_interval: float = 0.5, steal: bool = True, early_stopping=None):
+        """
+        Parameters
+        ----------
+        wrapper : SWAT-CUP version module used to run the simulations
+        project_folder_path : SWAT-CUP project folder. The var files are written to its SUFI2.OUT
+        worker_folder_paths : provisioned worker folders. Only the project folder if None
+        timeout_factor : a simulation is killed after timeout_factor times the median simulation duration
+        min_timeout : minimum timeout in seconds
+        initial_timeout : timeout in seconds until min_samples simulations are timed. No timeout if None
+        min_samples : timed simulations needed to use the median
+        straggler_factor : simulations slower than straggler_factor times the median are reported as stragglers
+        poll_interval : seconds between checks of the workers
+        steal : idle workers steal simulations from the others
+        early_stopping : EarlyStopping policy. Hopeless simulations are aborted (and written as failed) and the
+            iteration stops once converged, leaving out the simulations not run. None disables it
+        """
+        self.wrapper = wrapper
+        self.project_folder_path = project_folder_path
+        self.worker_folder_paths = list(worker_folder_paths or [project_folder_path])
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+        self.initial_timeout = initial_timeout
+        self.min_samples = min_samples
+        self.straggler_factor = straggler_factor
+        self.poll_interval = poll_interval
+        self.steal = steal
+        self.early_stopping = early_stopping
+        self.timings = {}
+        self.failed = set()
+        self.aborted = set()
+        self.converged = False
+        self.owner = {}
+        self.steals = 0
+
+    def get_timeout(self):
+        """ Current timeout in seconds, or None while there are not enough timed simulations """
+        if len(self.timings) < self.min_samples:
+            return self.initial_timeout
+        return max(self.min_timeout, self.timeout_factor * float(numpy.median(list(self.timings.values()))))
+
+    def _read_trk(self, worker: _Worker):
+        try:
+            return sufi2files.read_trk(worker.folder_path)
+        except (OSError, ValueError):
+            # Missing or being written
+            return None
+
+    def _start(self, worker: _Worker, first: int, end: int):
+        sufi2files.write_swedit_def(worker.folder_path, first, end)
+        for simulation in range(first, end + 1):
+            self.owner[simulation] = worker.index
+        command = self.wrapper.get_sufi2_command(worker.folder_path, "run")
+        worker.stale_trk = self._read_trk(worker)
+        worker.process = subprocess.Popen(command["args"], cwd=worker.folder_path, stdin=subprocess.DEVNULL,
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT,
+                                          **new_process_group_kwargs(command["new_console"]))
+        worker.first, worker.end, worker.process_end = first, end, end
+        worker.current, worker.started = first, time.time()
+        logger.debug("Worker " + str(worker.index) + " running simulations " + str(first) + "-" + str(end))
+
+    def _kill(self, worker: _Worker):
+        kill_process_tree(worker.process.pid)
+        worker.process.wait()
+        worker.process = None
+        out_folder = os.path.join(worker.folder_path, "SUFI2.OUT")
+        for name in sufi2files.read_var_file_names(worker.folder_path):
+            file = os.path.join(out_folder, name)
+            if os.path.isfile(file):
+                sufi2files.truncate_sufi2_var_file(file, worker.current)
+        if self.early_stopping is not None:
+            self.early_stopping.reset(worker.folder_path, worker.current)
+
+    def _complete(self, worker: _Worker, now: float):
+        self.timings[worker.current] = now - worker.started
+        worker.failures = 0
+
+    def _fail(self, worker: _Worker, reason: str, aborted: bool = False):
+        if aborted:
+            logger.info("Simulation " + str(worker.current) + " aborted (" + reason + ") in " + worker.folder_path)
+            self.aborted.add(worker.current)
+        else:
+            logger.warning("Simulation " + str(worker.current) + " failed (" + reason + ") in " + worker.folder_path)
+        self.failed.add(worker.current)
+        if worker.current < worker.end:
+            self._start(worker, worker.current + 1, worker.end)
+
+    def _track(self, worker: _Worker, now: float):
+        simulation = self._read_trk(worker)
+        if simulation is None or simulation == worker.stale_trk:
+            return
+        worker.stale_trk = None
+        if simulation <= worker.current or simulation > worker.process_end:
+            return
+        self._complete(worker, now)
+        # Simulations finished between two polls are not timed
+        worker.current, worker.started = simulation, now
+
+    def _check(self, worker: _Worker, now: float):
+        self._track(worker, now)
+        return_code = worker.process.poll()
+        if worker.current > worker.end:
+            # Reached simulations stolen by another worker
+            self._kill(worker)
+            return
+        if return_code is not None:
+            worker.process = None
+            if return_code == 0:
+                self._complete(worker, now)
+            elif worker.failures >= 2:
+                # Fails without running any simulation, the remaining simulations are not tried
+                logger.error("SUFI2_execute keeps failing in " + worker.folder_path + " (return code " +
+                             str(return_code) + ")")
+                self.failed.update(range(worker.current, worker.end + 1))
+            else:
+                worker.failures += 1
+                self._fail(worker, "return code " + str(return_code))
+            return
+        timeout = self.get_timeout()
+        if timeout is not None and now - worker.started > timeout:
+            self._kill(worker)
+            self._fail(worker, "timeout of " + "{:.1f}".format(timeout) + " s")
+        elif self.early_stopping is not None and self.early_stopping.should_abort(worker.folder_path,
+                                                                                  worker.started):
+            self._kill(worker)
+            self._fail(worker, "cannot reach the behavioral threshold", aborted=True)
+
+    def _steal(self, thief: _Worker, workers):
+        victims = [worker for worker in workers if worker.is_running() and worker.end - worker.current >= 1]
+        if not victims:
+            return
+        victim = max(victims, key=lambda worker: worker.end - worker.current)
+        stolen = (victim.end - victim.current + 1) // 2
+        first, end = victim.end - stolen + 1, victim.end
+        victim.end = first - 1
+        self.steals += 1
+        logger.debug("Worker " + str(thief.index) + " steals simulations " + str(first) + "-" + str(end) +
+                     " from worker " + str(victim.index))
+        self._start(thief, first, end)
+
+    def run(self) -> dict:
+        """ Runs the simulation range and writes the var files of the project SUFI2.OUT
+
+        Returns
+        -------
+        dict with the 'timings' (simulation -> seconds), the 'failed' (aborted included), 'aborted' and
+        'stragglers' simulations, the 'median' duration, the number of 'steals' and whether the iteration
+        'converged' (early stopping)
+        """
+        start, end = sufi2files.read_swedit_def(self.project_folder_path)
+        workers = [_Worker(index, folder) for index, folder in enumerate(self.worker_folder_paths)]
+        self.timings, self.failed, self.aborted, self.owner, self.steals = {}, set(), set(), {}, 0
+        self.converged = False
+        try:
+            for worker, (first, last) in zip(workers, ParallelRunner.split_range(start, end, len(workers))):
+                self._start(worker, first, last)
+            while any(worker.is_running() for worker in workers):
+                time.sleep(self.poll_interval)
+                now = time.time()
+                for worker in workers:
+                    if worker.is_running():
+                        self._check(worker, now)
+                if self.early_stopping is not None:
+                    for worker in workers:
+                        self.early_stopping.track(worker.folder_path)
+                    if self.early_stopping.is_converged():
+                        logger.info("Iteration converged, stopping the simulations")
+                        self.converged = True
+                        break
+                if self.steal:
+                    for worker in workers:
+                        if not worker.is_running():
+                            self._steal(worker, workers)
+        finally:
+            for worker in workers:
+                if worker.is_running():
+                    self._kill(worker)
+            for worker in workers:
+                if worker.folder_path == self.project_folder_path:
+                    sufi2files.write_swedit_def(worker.folder_path, start, end)
+        self.write_outputs(workers)
+        if self.early_stopping is not None:
+            # goal.txt of the simulations in the var files, readable by read_sufi2_out_goal
+            self.early_stopping.write_goal(self.project_folder_path)
+
+        median = float(numpy.median(list(self.timings.values()))) if self.timings else None
+        stragglers = sorted(simulation for simulation, seconds in self.timings.items()
+                            if median and seconds > self.straggler_factor * median)
+        if self.failed:
+            logger.warning("Failed simulations: " + str(sorted(self.failed)))
+        return {"timings": self.timings, "failed": sorted(self.failed), "aborted": sorted(self.aborted),
+                "stragglers": stragglers, "median": median, "steals": self.steals, "converged": self.converged}
+
+    def write_outputs(self, workers):
+        """ Writes the var files of the project from the blocks of the simulations owned by each worker, with the
+        FAILED_VALUE block of the failed simulations
+        """
+        out_folder = os.path.join(self.project_folder_path, "SUFI2.OUT")
+        for name in sufi2files.read_var_file_names(self.project_folder_path):
+            blocks = {}
+            for worker in workers:
+                file = os.path.join(worker.folder_path, "SUFI2.OUT", name)
+                if not os.path.isfile(file):
+                    continue
+                for simulation, block in sufi2files.read_sufi2_var_blocks(file):
+                    if self.owner.get(simulation) == worker.index and simulation not in self.failed:
+                        blocks[simulation] = block
+            if self.failed:
+                if blocks:
+                    lines = next(iter(blocks.values())).split(b"\n")[1:]
+                    time_steps = [int(line.split()[0]) for line in lines if line.strip()]
+                else:
+                    # Every simulation failed: the time steps the extract def files would write
+                    time_steps = find_var_time_steps(self.project_folder_path, name)
+                if time_steps is None:
+                    logger.warning("Time steps of " + name + " not found, failed simulations not written")
+                else:
+                    failed_values = numpy.full(len(time_steps), FAILED_VALUE)
+                    for simulation in self.failed:
+                        blocks[simulation] = sufi2files.format_sufi2_var_block(simulation, time_steps, failed_values)
+            with open(os.path.join(out_folder, name), "wb") as fo:
+                for simulation in sorted(blocks):
+                    fo.write(blocks[simulation])
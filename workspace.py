@@ -0,0 +1,197 @@
+import os
+import re
+import json
+import errno
+import shutil
+import fnmatch
+import logging
+from swatcuppython import sufi2files
+
+logger = logging.getLogger(__name__)
+
+# Linux ioctl used to clone a file (reflink) in copy on write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+class WorkspaceProvisioner(object):
+    """
+    Provisions worker workspaces from a SWAT-CUP project without copying the whole tree.
+
+    Files that SWAT_Edit.exe and swat.exe write are copied (using reflink when the file system supports it), all the
+    other files are read only inputs and are hardlinked to the project. The files written by SWAT_Edit.exe are the
+    ones with the extensions of the parameters in SUFI2.IN/par_inf.txt, plus WRITABLE_PATTERNS. The output files of
+    swat.exe are not provisioned at all, swat.exe creates them.
+
+    A manifest with the size and modification time of each provisioned file, in the project and in the workspace, is
+    kept in the workspace, so a stale workspace is refreshed by updating only the files that changed in the project
+    or were rewritten in the workspace.
+    """
+    MANIFEST_FILE = ".swatcuppython_manifest.json"
+    # Files rewritten during a simulation (relative to the project folder)
+    WRITABLE_PATTERNS = ["SUFI2_swEdit.def", "SUFI2.IN/*", "model.in", "file.cio", "*.log"]
+    # Files created by swat.exe or SUFI2 during a simulation
+    SKIPPED_PATTERNS = ["output.*", "*.out", "*.std", "fin.fin", "chan.deg", "watout.dat"]
+    # Folders created empty in the workspace
+    EMPTY_FOLDERS = ["SUFI2.OUT", "Echo"]
+    # Folders only read during a simulation: SWAT_Edit.exe reads the original model files of Backup
+    READ_ONLY_FOLDERS = ["Backup"]
+
+    def __init__(self, project_folder_path: str, exclude=None, writable_extensions=None):
+        """
+        Parameters
+        ----------
+        project_folder_path : SWAT-CUP project folder
+        exclude : top level names of the project that are not provisioned (ex: swatcuppython folder)
+        writable_extensions : extensions of files edited by SWAT_Edit.exe. Read from par_inf.txt if None
+        """
+        self.project_folder_path = project_folder_path
+        self.exclude = set(exclude or [])
+        self.writable_extensions = writable_extensions
+
+    def get_writable_extensions(self):
+        """ Extensions of the model files edited by SWAT_Edit.exe, read from the parameters in par_inf.txt """
+        if self.writable_extensions is not None:
+            return set(self.writable_extensions)
+        extensions = set()
+        if not os.path.isfile(os.path.join(self.project_folder_path, "SUFI2.IN", "par_inf.txt")):
+            return extensions
+        names, ranges, simulation_number = sufi2files.read_par_inf(self.project_folder_path)
+        for param in names:
+            # x__NAME(layer){...}.ext__hydrogrp__soltext__landuse__subbsn__slope
+            name = re.sub(r"\{.*?\}|\(.*?\)", "", param[3:]).split("__")[0]
+            if "." in name:
+                extensions.add(name.split(".", 1)[1].lower())
+        return extensions
+
+    def _classify(self, rel_path: str, writable_extensions) -> str:
+        """ Returns 'skip', 'copy' or 'link' for a file of the project. The file name rules apply at every depth
+        (projects may keep the model files in a subfolder), except in READ_ONLY_FOLDERS
+        """
+        file_name = os.path.basename(rel_path)
+        if any(fnmatch.fnmatch(file_name.lower(), pattern.lower()) for pattern in self.SKIPPED_PATTERNS):
+            return "skip"
+        if rel_path.split("/")[0] in self.READ_ONLY_FOLDERS:
+            return "link"
+        if "." in file_name and file_name.split(".", 1)[1].lower() in writable_extensions:
+            return "copy"
+        if any(fnmatch.fnmatch(rel_path.lower(), pattern.lower()) for pattern in self.WRITABLE_PATTERNS):
+            return "copy"
+        return "link"
+
+    def _walk(self):
+        """ Yields the relative path of every file of the project that is provisioned """
+        skipped_folders = self.exclude | set(self.EMPTY_FOLDERS)
+        for folder, folders, files in os.walk(self.project_folder_path):
+            rel_folder = os.path.relpath(folder, self.project_folder_path)
+            if rel_folder == ".":
+                folders[:] = [name for name in folders if name not in skipped_folders]
+                files = [name for name in files if name not in self.exclude]
+                rel_folder = ""
+            for name in files:
+                yield os.path.join(rel_folder, name).replace(os.sep, "/")
+
+    def read_manifest(self, workspace_path: str) -> dict:
+        file = os.path.join(workspace_path, self.MANIFEST_FILE)
+        if not os.path.isfile(file):
+            return {}
+        with open(file, "r") as fo:
+            return json.load(fo)
+
+    def provision(self, workspace_path: str, clean_output: bool = True) -> dict:
+        """ Creates or refreshes a workspace
+
+        Parameters
+        ----------
+        workspace_path : workspace folder. Created if it does not exist
+        clean_output : empties the workspace SUFI2.OUT folder
+
+        Returns
+        -------
+        dict with the number of files 'linked', 'copied', 'unchanged' and 'removed'
+        """
+        stats = {"linked": 0, "copied": 0, "unchanged": 0, "removed": 0}
+        os.makedirs(workspace_path, exist_ok=True)
+        old_manifest = self.read_manifest(workspace_path)
+        manifest = {}
+        writable_extensions = self.get_writable_extensions()
+        for rel_path in self._walk():
+            action = self._classify(rel_path, writable_extensions)
+            if action == "skip":
+                continue
+            src = os.path.join(self.project_folder_path, rel_path)
+            dst = os.path.join(workspace_path, rel_path)
+            src_stat = os.stat(src)
+            fingerprint = [src_stat.st_size, src_stat.st_mtime_ns, action]
+            old_fingerprint = old_manifest.get(rel_path)
+            if (old_fingerprint is not None and old_fingerprint[:3] == fingerprint and
+                    self._is_fresh(src_stat, dst, action, old_fingerprint[3:])):
+                manifest[rel_path] = old_fingerprint
+                stats["unchanged"] += 1
+                continue
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if action == "link" and self._link(src, dst):
+                stats["linked"] += 1
+            else:
+                self._copy(src, dst)
+                stats["copied"] += 1
+            dst_stat = os.stat(dst)
+            manifest[rel_path] = fingerprint + [dst_stat.st_size, dst_stat.st_mtime_ns]
+
+        for rel_path in old_manifest:
+            if rel_path not in manifest:
+                dst = os.path.join(workspace_path, rel_path)
+                if os.path.lexists(dst):
+                    os.remove(dst)
+                stats["removed"] += 1
+
+        for folder in self.EMPTY_FOLDERS:
+            folder_path = os.path.join(workspace_path, folder)
+            if clean_output and folder == "SUFI2.OUT" and os.path.isdir(folder_path):
+                shutil.rmtree(folder_path)
+            os.makedirs(folder_path, exist_ok=True)
+
+        with open(os.path.join(workspace_path, self.MANIFEST_FILE), "w") as fo:
+            json.dump(manifest, fo)
+        logger.debug("Workspace provisioned: " + workspace_path + " " + str(stats))
+        return stats
+
+    @staticmethod
+    def _is_fresh(src_stat, dst: str, action: str, dst_fingerprint) -> bool:
+        """ Whether the workspace file is still the one provisioned: same size and modification time as recorded in
+        the manifest (a copy rewritten by SWAT_Edit.exe is not) and, for links, still the project file
+        """
+        if not os.path.isfile(dst):
+            return False
+        dst_stat = os.stat(dst)
+        if [dst_stat.st_size, dst_stat.st_mtime_ns] != list(dst_fingerprint):
+            return False
+        if action == "link":
+            # The project file may have been replaced by a new one (ex: copied over), breaking the link
+            return (dst_stat.st_ino, dst_stat.st_dev) == (src_stat.st_ino, src_stat.st_dev)
+        return True
+
+    @staticmethod
+    def _link(src: str, dst: str) -> bool:
+        try:
+            os.link(src, dst)
+            return True
+        except OSError as e:
+            # Different devices or file system without hardlinks. Copy instead
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+                raise
+            return False
+
+    @staticmethod
+    def _copy(src: str, dst: str):
+        try:
+            import fcntl
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (ImportError, OSError):
+            # No reflink support (Windows or file system without copy on write)
+            pass
+        shutil.copy2(src, dst)